@@ -19,31 +19,10 @@ function getPool() {
   return pool;
 }
 
-// --- classify managers into: hedge_fund | bank | asset_manager | other
-function classifyManager(nameRaw) {
-  const name = String(nameRaw || "").toUpperCase();
-
-  const bankKW = [
-    "BANK", "BANC", "TRUST", "CREDIT UNION",
-    "JPMORGAN", "CHASE", "WELLS FARGO", "CITIGROUP",
-    "MORGAN STANLEY", "GOLDMAN SACHS", "BANK OF AMERICA",
-    "BARCLAYS", "UBS", "HSBC", "STATE STREET", "NORTHERN TRUST",
-  ];
-
-  const assetKW = [
-    "VANGUARD", "BLACKROCK", "FIDELITY", "SCHWAB", "INVESCO",
-    "T ROWE", "T. ROWE", "FRANKLIN", "DIMENSIONAL", "PIMCO",
-    "CAPITAL GROUP", "WELLINGTON", "AMUNDI",
-  ];
-
-  if (bankKW.some((k) => name.includes(k))) return "bank";
-  if (assetKW.some((k) => name.includes(k))) return "asset_manager";
-
-  const hfKW = ["CAPITAL", "MANAGEMENT", "PARTNERS", "ADVISOR", "ADVISERS", "FUND", "INVEST"];
-  if (hfKW.some((k) => name.includes(k))) return "hedge_fund";
-
-  return "other";
-}
+// Manager categories (hedge_fund | bank | asset_manager | other) are precomputed
+// into public.manager_classification by scripts/manager_classification.py.
+// Its rules differ from the keyword lists this file used to carry (e.g. "LLC" /
+// "LP" now mean hedge_fund); see that module's docstring for the full list.
 
 function pct(curr, prev) {
   if (prev == null || prev === 0) return null;
@@ -108,6 +87,7 @@ export default async function handler(req, res) {
         SELECT
           a.cik,
           c.manager_name,
+          COALESCE(c.category, 'other') AS category,
           a.period_end,
           a.total_value_usd,
           a.num_holdings
@@ -139,6 +119,7 @@ export default async function handler(req, res) {
       SELECT
         cur.cik,
         cur.manager_name,
+        cur.category,
         cur.period_end,
         cur.total_value_usd,
         cur.num_holdings,
@@ -167,7 +148,7 @@ export default async function handler(req, res) {
       return {
         cik: r.cik,
         manager: r.manager_name,
-        category: classifyManager(r.manager_name),
+        category: r.category,
         period_end: r.period_end,
 
         // ✅ canonical truth (USD)
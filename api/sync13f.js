@@ -35,26 +35,43 @@ function parseQStr(qStr) {
   return `${y}-${month}-${day}`;
 }
 
-// very lightweight classifier used by your UI filters
+// Fallback for managers scripts/manager_classification.py has not classified yet.
+// Same ordered rules as RULES there (first rule with a keyword in the upper-cased
+// name wins); keep the two in step.
+const CATEGORY_RULES = [
+  ["bank", [
+    "BANK", "BANC", "BANCORP", "TRUST", "CREDIT UNION",
+    "JPMORGAN", "CHASE", "WELLS FARGO", "CITIGROUP", "CITI ",
+    "MORGAN STANLEY", "GOLDMAN SACHS", "BANK OF AMERICA",
+    "BARCLAYS", "UBS", "HSBC", "STATE STREET", "NORTHERN TRUST",
+    "PNC ", "US BANK", "CITIZENS", "FIFTH THIRD", "TRUIST",
+  ]],
+  ["asset_manager", [
+    "VANGUARD", "BLACKROCK", "FIDELITY", "SCHWAB", "INVESCO",
+    "T ROWE", "T. ROWE", "FRANKLIN TEMPLETON", "DIMENSIONAL",
+    "PIMCO", "CAPITAL GROUP", "WELLINGTON", "AMUNDI",
+    "GEODE", "SSGA", "NORTHERN TRUST INVEST", "PRUDENTIAL",
+  ]],
+  ["hedge_fund", ["HEDGE", "MASTER FUND", "OPPORTUNITY FUND"]],
+  ["hedge_fund", [
+    "CAPITAL", "MANAGEMENT", "PARTNERS", "ADVISOR", "ADVISER", "FUND", "INVEST", "LP", "LLC",
+  ]],
+];
+
 function classifyManager(name = "") {
-  const n = name.toLowerCase();
-
-  const bankWords = ["bank", "bancorp", "trust", "credit union"];
-  const assetMgrWords = [
-    "asset management",
-    "capital management",
-    "investment management",
-    "advisors",
-    "adviser",
-    "partners",
-    "management llc",
-  ];
-  const hedgeWords = ["hedge", "master fund", "opportunity", "capital"];
-
-  if (bankWords.some((w) => n.includes(w))) return "bank";
-  if (hedgeWords.some((w) => n.includes(w))) return "hedge_fund";
-  if (assetMgrWords.some((w) => n.includes(w))) return "asset_manager";
-  return "other";
+  const n = String(name || "").toUpperCase();
+  const rule = CATEGORY_RULES.find(([, words]) => words.some((w) => n.includes(w)));
+  return rule ? rule[0] : "other";
+}
+
+// Manager category, precomputed by scripts/manager_classification.py;
+// managers it has not seen yet are classified from their name
+async function lookupCategory(pool, cik, name) {
+  const r = await pool.query(
+    `SELECT category FROM manager_classification WHERE cik=$1 LIMIT 1`,
+    [cik]
+  );
+  return r.rows?.[0]?.category || classifyManager(name);
 }
 
 // --- SEC fetch helper (SEC requires a User-Agent) ---
@@ -165,8 +182,8 @@ export default async function handler(req, res) {
     }
     if (!canonicalName) canonicalName = `CIK ${cik}`;
 
-    // 🔹 classify manager
-    const category = classifyManager(canonicalName);
+    // 🔹 manager category (materialized)
+    const category = await lookupCategory(pool, cik, canonicalName);
 
     // Step 2: Get 13F filings from SEC JSON API (use reportDate, not filingDate)
     let filings = [];
@@ -1,23 +1,28 @@
 import os
 import re
 import json
+import math
 import argparse
 from decimal import Decimal, InvalidOperation
 from urllib.parse import urlparse
 
 import psycopg2
-from psycopg2.extras import execute_values
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+from holdings_table import HOLDING_COLUMNS, ensure_holdings_key, normalize_cik, upsert_holdings_rows
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from thirteenf_json import decode_holdings_rows, find_holdings_table
+
 
 TABLE_13FINFO = "public.expected_13finfo_holdings"
 
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) stock-analyzer/1.0"
 TIMEOUT = 30
 INSERT_CHUNK = 5000
+STREAM_CHUNK = 64 * 1024
 BASE = "https://13f.info"
 
 
@@ -46,6 +51,11 @@ def clean_text(x):
 
 
 def to_decimal(x):
+    # JSON numbers skip the text cleanup (str(float) is its repr, so the value is unchanged)
+    if type(x) is int:
+        return Decimal(x)
+    if type(x) is float and math.isfinite(x):
+        return Decimal(repr(x))
     t = clean_text(x)
     if t is None:
         return None
@@ -86,106 +96,113 @@ def parse_filing_url(filing_url: str):
     return filing_id, cik, quarter
 
 
+# DB column -> JSON key names it may come under (case-insensitive, first match wins).
+# List rows (the current API format) are positional in this same order:
+# 0: sym, 1: issuer, 2: class, 3: cusip, 4: value, 5: pct, 6: shares, 7: principal, 8: option
+HOLDING_FIELDS = [
+    ("sym", ("sym", "ticker", "symbol")),
+    ("issuer_name", ("issuer_name", "issuer", "name", "issuerName")),
+    ("class", ("class", "cl", "title_of_class", "titleOfClass")),
+    ("cusip", ("cusip",)),
+    ("value_000", ("value_000", "value", "value000", "value_000s")),
+    ("pct", ("pct", "percent", "percentage")),
+    ("shares", ("shares", "share", "sshPrnamt", "sshprnamt")),
+    ("principal", ("principal", "share_type", "shareType")),
+    ("option_type", ("option_type", "put_call", "putCall", "optionType")),
+]
+NUM_FIELDS = len(HOLDING_FIELDS)
+MAX_KEY_PLANS = 256
+
+# Key order of a dict row -> the row key to read for each HOLDING_FIELDS entry (None if absent)
+_KEY_PLANS = {}
+
+
+def _key_plan(keys):
+    """Resolve HOLDING_FIELDS aliases against one dict schema; cached per key order."""
+    plan = _KEY_PLANS.get(keys)
+    if plan is None:
+        by_lower = {}
+        for k in keys:
+            by_lower.setdefault(k.lower(), k)
+        plan = tuple(
+            next((by_lower[a.lower()] for a in aliases if a.lower() in by_lower), None)
+            for _, aliases in HOLDING_FIELDS
+        )
+        if len(_KEY_PLANS) >= MAX_KEY_PLANS:
+            _KEY_PLANS.clear()
+        _KEY_PLANS[keys] = plan
+    return plan
+
+
+def _row_values(d):
+    """The nine raw field values of a list or dict row, in HOLDING_FIELDS order."""
+    if isinstance(d, list):
+        values = d[:NUM_FIELDS]
+        if len(values) < NUM_FIELDS:
+            values = values + [None] * (NUM_FIELDS - len(values))
+        return values
+    plan = _key_plan(tuple(d))
+    return [None if k is None else d[k] for k in plan]
+
+
 def normalize_holding_row(d):
     """
     Map JSON keys to DB columns.
-    JSON key names can vary; we handle common ones.
-    Also handles list input (new API format) by mapping by index.
+    JSON key names can vary; HOLDING_FIELDS lists the ones we handle.
+    List rows (new API format) are mapped by index; dict rows through a key
+    plan resolved once per schema, so each row is a handful of lookups.
     """
-    if isinstance(d, list):
-        # 0: sym, 1: issuer, 2: class, 3: cusip, 4: value, 5: pct, 6: shares, 7: principal, 8: option
-        keys = ["sym", "issuer_name", "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]
-        d_map = {}
-        for i, k in enumerate(keys):
-            if i < len(d):
-                d_map[k] = d[i]
-        d = d_map
-
-    def get_any(*names):
-        for n in names:
-            for k, v in d.items():
-                if k.lower() == n.lower():
-                    return v
+    if not isinstance(d, (list, dict)):
         return None
+    sym, issuer_name, cls, cusip, value_000, pct, shares, principal, option_type = _row_values(d)
 
-    sym = clean_text(get_any("sym", "ticker", "symbol"))
-    issuer_name = clean_text(get_any("issuer_name", "issuer", "name", "issuerName"))
-    cls = clean_text(get_any("class", "cl", "title_of_class", "titleOfClass"))
-    cusip = clean_text(get_any("cusip"))
-    value_000 = to_decimal(get_any("value_000", "value", "value000", "value_000s"))
-    pct = to_decimal(get_any("pct", "percent", "percentage"))
-    shares = to_decimal(get_any("shares", "share", "sshPrnamt", "sshprnamt"))
-    principal = clean_text(get_any("principal", "share_type", "shareType"))
-    option_type = clean_text(get_any("option_type", "put_call", "putCall", "optionType"))
-
+    cusip = clean_text(cusip)
+    issuer_name = clean_text(issuer_name)
     if cusip is None or issuer_name is None:
         return None
 
     return {
-        "sym": sym,
+        "sym": clean_text(sym),
         "issuer_name": issuer_name,
-        "class": cls,
+        "class": clean_text(cls),
         "cusip": cusip,
-        "value_000": value_000,
-        "pct": pct,
-        "shares": shares,
-        "principal": principal,
-        "option_type": option_type,
+        "value_000": to_decimal(value_000),
+        "pct": to_decimal(pct),
+        "shares": to_decimal(shares),
+        "principal": clean_text(principal),
+        "option_type": clean_text(option_type),
     }
 
 
-def extract_holdings_from_json(payload: dict):
-    """
-    13f.info endpoint returns {"data": ...}
-    Holdings are nested inside payload["data"].
-    We find the largest list[dict] that looks like holdings:
-      - dict contains 'cusip'
-    """
-    root = payload.get("data", payload)
-
-    best = []
-    stack = [root]
-
-    def is_holding_dict(d):
-        if not isinstance(d, dict):
-            return False
-        keys = {k.lower() for k in d.keys()}
-        return "cusip" in keys
-
-    while stack:
-        x = stack.pop()
-
-        if isinstance(x, dict):
-            for vv in x.values():
-                stack.append(vv)
-
-        elif isinstance(x, list):
-            if not x:
-                continue
+@stage("parse")
+def normalize_holding_rows(rows):
+    """normalize_holding_row over a payload's rows, dropping the ones without cusip/issuer."""
+    out = []
+    for d in rows:
+        row = normalize_holding_row(d)
+        if row:
+            out.append(row)
+    return out
 
-            is_list_of_dicts = all(isinstance(i, dict) for i in x)
-            is_list_of_lists = all(isinstance(i, list) for i in x)
 
-            if is_list_of_dicts:
-                # must contain cusip in most rows
-                holding_like = sum(1 for i in x if is_holding_dict(i))
-                if holding_like >= max(5, int(0.5 * len(x))):
-                    if len(x) > len(best):
-                        best = x
-            
-            elif is_list_of_lists:
-                # New format: list of lists
-                # We assume a list of lists that is substantial is our table
-                if len(x) > len(best):
-                    best = x
+@stage("parse")
+def holding_value_rows(rows):
+    """normalize_holding_rows as tuples in HOLDING_FIELDS order (the tail of HOLDING_COLUMNS)."""
+    return [tuple(h[name] for name, _ in HOLDING_FIELDS) for h in normalize_holding_rows(rows)]
 
-            for i in x:
-                # Only recurse if the item is a container (list or dict), 
-                # but valid rows (lists) might be recursed into and ignored, which is fine.
-                if isinstance(i, (dict, list)):
-                    stack.append(i)
 
-    return best
+@stage("parse")
+def extract_holdings_from_json(payload: dict):
+    """
+    13f.info endpoint returns {"data": ...}
+    The known layout is payload["data"] as a list of row lists; anything else
+    falls back to searching the tree for the largest holdings-like list
+    (thirteenf_json.find_holdings_table).
+    """
+    data = payload.get("data") if isinstance(payload, dict) else None
+    if isinstance(data, list) and data and all(isinstance(i, list) for i in data):
+        return data
+    return find_holdings_table(payload)
 
 
 def main():
@@ -201,7 +218,9 @@ def main():
     ap.add_argument("--filing-url", required=True)
     ap.add_argument("--mode", choices=["replace", "append"], default="replace")
     ap.add_argument("--dry-run", action="store_true")
+    add_profile_arguments(ap)
     args = ap.parse_args()
+    start_profiling_from_args(args)
 
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
@@ -213,18 +232,12 @@ def main():
     manager_url = f"{BASE}/manager/{filing_id[:10]}"
 
     api_url = f"{BASE}/data/13f/{filing_id}"
-    r = session.get(api_url, timeout=TIMEOUT)
-    if r.status_code != 200:
-        raise RuntimeError(f"13f.info API failed: {r.status_code} {api_url}")
-
-    payload = r.json()
-    raw_holdings = extract_holdings_from_json(payload)  # now searches inside payload["data"]
+    with session.get(api_url, timeout=TIMEOUT, stream=True) as r:
+        if r.status_code != 200:
+            raise RuntimeError(f"13f.info API failed: {r.status_code} {api_url}")
 
-    holdings = []
-    for d in raw_holdings:
-        row = normalize_holding_row(d)
-        if row:
-            holdings.append(row)
+        # Rows are decoded and normalized as the payload streams in
+        holdings = normalize_holding_rows(decode_holdings_rows(r.iter_content(STREAM_CHUNK)))
 
     print("======================================================================")
     print("Scrape holdings from 13f.info JSON endpoint -> DB")
@@ -249,12 +262,14 @@ def main():
     save_holdings_to_db(holdings, db_url, args.mode, args.filing_url, manager_url, cik, quarter)
 
 
+@stage("db")
 def save_holdings_to_db(holdings, db_url, mode, filing_url, manager_url, cik, quarter):
     conn = psycopg2.connect(db_url)
     conn.autocommit = False
 
     try:
         with conn.cursor() as cur:
+            ensure_holdings_key(cur, TABLE_13FINFO)
             if mode == "replace":
                 cur.execute(
                     f"DELETE FROM {TABLE_13FINFO} WHERE filing_url = %s",
@@ -269,30 +284,8 @@ def save_holdings_to_db(holdings, db_url, mode, filing_url, manager_url, cik, qu
             if not batch:
                 return
             with conn.cursor() as cur:
-                execute_values(
-                    cur,
-                    f"""
-                    INSERT INTO {TABLE_13FINFO}
-                    (
-                      manager_url,
-                      cik,
-                      quarter,
-                      filing_url,
-                      sym,
-                      issuer_name,
-                      class,
-                      cusip,
-                      value_000,
-                      pct,
-                      shares,
-                      principal,
-                      option_type
-                    )
-                    VALUES %s
-                    """,
-                    batch,
-                    page_size=len(batch),
-                )
+                # Upsert on (cik, quarter, cusip, class, option_type): re-adding a filing can't duplicate it
+                upsert_holdings_rows(cur, TABLE_13FINFO, HOLDING_COLUMNS, batch)
             conn.commit()
             total += len(batch)
             batch = []
@@ -301,7 +294,7 @@ def save_holdings_to_db(holdings, db_url, mode, filing_url, manager_url, cik, qu
             batch.append(
                 (
                     manager_url,     # manager_url (best-effort)
-                    cik,
+                    normalize_cik(cik),
                     quarter,
                     filing_url,
                     h["sym"],
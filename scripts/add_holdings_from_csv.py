@@ -4,12 +4,16 @@ import csv
 import os
 import sys
 
-import aiohttp
 from dotenv import load_dotenv
 
 # Add current directory to path to allow imports
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from filing_ids import FilingIdResolver, filing_url, holdings_api_url
+from holdings_table import HOLDING_COLUMNS, ensure_holdings_key, normalize_cik, upsert_holdings_rows
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from thirteenf_client import ThirteenFClient
+
 from backfill_13finfo_holdings import (
     collect_all_manager_urls,
     get_manager_filings,
@@ -20,42 +24,16 @@ from backfill_13finfo_holdings import (
     BASE
 )
 
-async def fetch_json(session, url, semaphore, retries=3):
-    async with semaphore:
-        for i in range(retries):
-            try:
-                # Add delay to avoid aggressive rate limiting
-                if i > 0:
-                    await asyncio.sleep(1 * i)
-                    
-                async with session.get(url, timeout=aiohttp.ClientTimeout(total=45)) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    elif resp.status == 429:
-                        print(f"⚠️ 429 Too Many Requests for {url}, retrying...")
-                        await asyncio.sleep(2 + i)
-                        continue
-                    else:
-                        if i == retries - 1:
-                            print(f"❌ HTTP {resp.status} for {url}")
-                        return None
-            except Exception as e:
-                if i == retries - 1:
-                    print(f"❌ Exception for {url}: {e}")
-                pass
-        return None
 from add_holdings_from_13finfo_filing import (
-    extract_holdings_from_json,
-    normalize_holding_row,
+    normalize_holding_rows,
     save_holdings_to_db
 )
 
-from psycopg2.extras import execute_values
 import psycopg2
 
 TABLE_13FINFO = "public.expected_13finfo_holdings"
 
-async def fetch_direct_task_data(session, semaphore, task):
+async def fetch_direct_task_data(client, task):
     """
     Fetches and parses data for a single task but DOES NOT save to DB.
     Returns a tuple: (success_bool, result_data_or_error_msg)
@@ -71,28 +49,24 @@ async def fetch_direct_task_data(session, semaphore, task):
     manager_url = f"{BASE}/manager/{cik.zfill(10)}"
     api_url = direct_url
 
-    payload = await fetch_json(session, api_url, semaphore)
-    if not payload:
+    raw_holdings = await client.fetch_holdings_rows(api_url)
+    if raw_holdings is None:
         return False, f"❌ CIK={cik} Q={quarter}: Failed to fetch JSON {api_url}"
-
-    raw_holdings = extract_holdings_from_json(payload)
     
-    holdings = []
-    for d in raw_holdings:
-        row = normalize_holding_row(d)
-        if row:
-            # Enriched row with metadata needed for DB
-            row['manager_url'] = manager_url
-            row['cik'] = cik
-            row['quarter'] = quarter.upper()
-            row['filing_url'] = direct_url
-            holdings.append(row)
+    holdings = normalize_holding_rows(raw_holdings)
+    for row in holdings:
+        # Enriched row with metadata needed for DB
+        row['manager_url'] = manager_url
+        row['cik'] = normalize_cik(cik)
+        row['quarter'] = quarter.upper()
+        row['filing_url'] = task.get("filing_url") or direct_url
     
     if not holdings:
         return False, f"⚠️ CIK={cik} Q={quarter}: No valid holdings found in {api_url}"
 
     return True, holdings
 
+@stage("db")
 def bulk_save_holdings_direct(all_holdings_lists, db_url, mode):
     """
     Saves a batch of holdings lists to the DB in a SINGLE connection/transaction.
@@ -118,6 +92,8 @@ def bulk_save_holdings_direct(all_holdings_lists, db_url, mode):
     try:
         with conn:
             with conn.cursor() as cur:
+                ensure_holdings_key(cur, TABLE_13FINFO)
+
                 # 1. Bulk Delete (if replace mode)
                 if mode == "replace" and filing_urls_to_clean:
                     cur.execute(
@@ -125,42 +101,9 @@ def bulk_save_holdings_direct(all_holdings_lists, db_url, mode):
                         (list(filing_urls_to_clean),)
                     )
 
-                # 2. Bulk Insert
-                # Prepare tuples
-                # Columns matching add_holdings_from_13finfo_filing.py schema
-                values = [
-                    (
-                        r["manager_url"],
-                        r["cik"],
-                        r["quarter"],
-                        r["filing_url"],
-                        r["sym"],
-                        r["issuer_name"],
-                        r["class"],
-                        r["cusip"],
-                        r["value_000"],
-                        r["pct"],
-                        r["shares"],
-                        r["principal"],
-                        r["option_type"]
-                    )
-                    for r in flat_rows
-                ]
-                
-                execute_values(
-                    cur,
-                    f"""
-                    INSERT INTO {TABLE_13FINFO}
-                    (
-                      manager_url, cik, quarter, filing_url,
-                      sym, issuer_name, class, cusip, value_000,
-                      pct, shares, principal, option_type
-                    )
-                    VALUES %s
-                    """,
-                    values,
-                    page_size=5000
-                )
+                # 2. Bulk upsert on the natural key (holdings_table)
+                values = [tuple(r[c] for c in HOLDING_COLUMNS) for r in flat_rows]
+                upsert_holdings_rows(cur, TABLE_13FINFO, HOLDING_COLUMNS, values)
         print(f"✅ DB BATCH: Saved {len(flat_rows)} rows across {len(filing_urls_to_clean) if mode=='replace' else 'multiple'} filings.")
             
     except Exception as e:
@@ -169,7 +112,65 @@ def bulk_save_holdings_direct(all_holdings_lists, db_url, mode):
         conn.close()
 
 
-async def process_manager_tasks(session, semaphore, manager_url, tasks, db_url, mode):
+async def run_direct_tasks(client, tasks, db_url, mode):
+    """Fetch tasks with a known holdings URL in concurrent batches and bulk-save them.
+
+    Returns the tasks that failed or had no holdings.
+    """
+    failed = []
+    # Batch size for Fetching AND Saving
+    chunk_size = 50
+    
+    for i in range(0, len(tasks), chunk_size):
+        chunk = tasks[i:i+chunk_size]
+        batch_num = i//chunk_size + 1
+        total_batches = (len(tasks)+chunk_size-1)//chunk_size
+        print(f"⚡ Batch {batch_num}/{total_batches}: Fetching {len(chunk)}...")
+        
+        # 1. Concurrent Fetch
+        coroutines = [
+            fetch_direct_task_data(client, t)
+            for t in chunk
+        ]
+        results = await asyncio.gather(*coroutines)
+        
+        # 2. Process Results
+        batch_holdings = []
+        for task, (success, data) in zip(chunk, results):
+            if success:
+                batch_holdings.append(data)
+            else:
+                print(data) # Print error message
+                failed.append(task)
+        
+        # 3. Bulk Save (Sync but fast due to single transaction)
+        if batch_holdings:
+            bulk_save_holdings_direct(batch_holdings, db_url, mode)
+    
+    return failed
+
+
+def bridge_tasks(tasks, db_url):
+    """Split tasks into (direct tasks with a filing ID known locally, tasks that need the manager page)."""
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            resolver = FilingIdResolver.load(cur, {t["cik"] for t in tasks})
+    finally:
+        conn.close()
+    
+    direct, unresolved = [], []
+    for t in tasks:
+        fid = resolver.resolve(t["cik"], t["quarter"])
+        if fid:
+            direct.append({**t, "filing_id": holdings_api_url(fid), "filing_url": filing_url(fid)})
+        else:
+            unresolved.append(t)
+    print(f"🔗 Filing-ID bridge: {resolver.summary()}")
+    return direct, unresolved
+
+
+async def process_manager_tasks(client, manager_url, tasks, db_url, mode):
     """
     Process all tasks (quarters) for a single manager.
     Fetch manager page ONCE, then fetch all needed quarters.
@@ -178,7 +179,7 @@ async def process_manager_tasks(session, semaphore, manager_url, tasks, db_url,
     quarters_needed = {t["quarter"].lower() for t in tasks}
     
     # Get filings for this manager (1 request)
-    filings = await get_manager_filings(session, semaphore, manager_url)
+    filings = await get_manager_filings(client, manager_url)
     
     # Map quarter -> (filing_id, filing_url)
     q_map = {}
@@ -202,19 +203,13 @@ async def process_manager_tasks(session, semaphore, manager_url, tasks, db_url,
         
         # Fetch holdings (1 request per quarter)
         api_url = f"{BASE}/data/13f/{target_filing_id}"
-        payload = await fetch_json(session, api_url, semaphore)
+        raw_holdings = await client.fetch_holdings_rows(api_url)
         
-        if not payload:
+        if raw_holdings is None:
             print(f"❌ CIK={cik} Q={quarter} Type={form_type}: Failed to fetch JSON {api_url}")
             continue
-            
-        raw_holdings = extract_holdings_from_json(payload)
         
-        holdings = []
-        for d in raw_holdings:
-            row = normalize_holding_row(d)
-            if row:
-                holdings.append(row)
+        holdings = normalize_holding_rows(raw_holdings)
         
         if not holdings:
             print(f"⚠️ CIK={cik} Q={quarter} Type={form_type}: No valid holdings found")
@@ -275,49 +270,29 @@ async def main_async(csv_file, mode):
     unique_ciks = set(t["cik"] for t in tasks)
     print(f"🔍 Found {len(unique_ciks)} unique CIKs")
 
-    # Shared connector/session
-    connector = aiohttp.TCPConnector(limit=100) # Increased limit for optimization
-    semaphore = asyncio.Semaphore(100) # Increased concurrency
-    
-    async with aiohttp.ClientSession(connector=connector, headers={"User-Agent": UA}) as session:
+    async with ThirteenFClient(user_agent=UA) as client:
         
         if has_filing_id:
             print("🚀 DIRECT MODE DETECTED: Optimized Batch Processing.")
             print(f"Processing {len(tasks)} requests...")
-            
-            # Batch size for Fetching AND Saving
-            chunk_size = 50
-            
-            for i in range(0, len(tasks), chunk_size):
-                chunk = tasks[i:i+chunk_size]
-                batch_num = i//chunk_size + 1
-                total_batches = (len(tasks)+chunk_size-1)//chunk_size
-                print(f"⚡ Batch {batch_num}/{total_batches}: Fetching {len(chunk)}...")
-                
-                # 1. Concurrent Fetch
-                coroutines = [
-                    fetch_direct_task_data(session, semaphore, t) 
-                    for t in chunk
-                ]
-                results = await asyncio.gather(*coroutines)
-                
-                # 2. Process Results
-                batch_holdings = []
-                for success, data in results:
-                    if success:
-                        batch_holdings.append(data)
-                    else:
-                        print(data) # Print error message
-                
-                # 3. Bulk Save (Sync but fast due to single transaction)
-                if batch_holdings:
-                    bulk_save_holdings_direct(batch_holdings, db_url, mode)
-                
+            await run_direct_tasks(client, tasks, db_url, mode)
             print("✅ All direct tasks completed.")
+            client.report()
+            return
+
+        # --- Filing-ID bridge: quarters whose accession we already have skip the manager page ---
+        print("ℹ️ No 'filing_id' column found. Resolving filing IDs from local accession data.")
+        direct, tasks = bridge_tasks(tasks, db_url)
+        if direct:
+            print(f"🚀 {len(direct)} tasks go straight to the holdings API...")
+            tasks += await run_direct_tasks(client, direct, db_url, mode)
+        if not tasks:
+            print("✅ All tasks completed.")
+            client.report()
             return
 
-        # --- OLD LOGIC (Fallback) ---
-        print("ℹ️ No 'filing_id' column found. Falling back to Manager Index lookup.")
+        # --- OLD LOGIC (Fallback for unresolved / failed tasks) ---
+        print(f"ℹ️ {len(tasks)} tasks left. Falling back to Manager Index lookup.")
         
         # Group tasks by CIK for the old logic
         tasks_by_cik = {}
@@ -325,7 +300,7 @@ async def main_async(csv_file, mode):
             tasks_by_cik.setdefault(t["cik"], []).append(t)
 
         print("📥 Fetching manager index to map CIKs to URLs...")
-        all_manager_urls = await collect_all_manager_urls(session, semaphore)
+        all_manager_urls = await collect_all_manager_urls(client)
         
         cik_to_url = {}
         for url in all_manager_urls:
@@ -343,7 +318,7 @@ async def main_async(csv_file, mode):
                 continue
             
             manager_coroutines.append(
-                process_manager_tasks(session, semaphore, manager_url, manager_tasks, db_url, mode)
+                process_manager_tasks(client, manager_url, manager_tasks, db_url, mode)
             )
             
         print(f"🚀 Starting parallel processing for {len(manager_coroutines)} managers...")
@@ -355,12 +330,15 @@ async def main_async(csv_file, mode):
             await asyncio.gather(*chunk)
             
         print("✅ All tasks completed.")
+        client.report()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("csv_file", help="Path to CSV file with cik, quarter columns")
     parser.add_argument("--mode", choices=["replace", "append"], default="replace")
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling_from_args(args)
     
     if not os.path.exists(args.csv_file):
         print(f"Error: File {args.csv_file} does not exist")
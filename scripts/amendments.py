@@ -0,0 +1,111 @@
+"""
+Amendment-aware application of 13F filings to manager_quarter_holding.
+
+A (cik, period_end) can have an original 13F-HR followed by any number of
+13F-HR/A amendments. The cover page's amendmentType says how each applies:
+
+  RESTATEMENT    replaces the whole period, like the original
+  NEW HOLDINGS   adds its rows to the period; earlier rows stay
+
+Holdings are keyed by (cik, period_end, accession_no, line_no), so every filing
+is applied as a delta keyed by its accession: only a base filing (original or
+restatement) rewrites the period, and a NEW HOLDINGS amendment deletes and
+inserts just its own rows. Which accessions are already applied comes from
+sec_filing_ledger, so a late amendment costs its own few hundred rows instead
+of a reload of the whole period.
+
+Every write also refreshes the period's row in holding_period_stats
+(holding_stats.py), in the same transaction.
+
+Usage:
+    plan = plan_period(filings, applied)        # [(filing, REPLACE|APPEND), ...]
+    for filing, mode in plan:
+        write_filing(cur, cik, period_end, filing["accession_no"], holdings, mode)
+
+    clear_for_base(cur, cik, period_end, accession_no)   # repair scripts re-writing one base filing
+"""
+from psycopg2.extras import execute_values
+
+from holding_stats import refresh_period_stats
+from sec_ledger import LEDGER_TABLE
+
+RESTATEMENT = "RESTATEMENT"
+NEW_HOLDINGS = "NEW HOLDINGS"
+
+REPLACE = "replace"
+APPEND = "append"
+
+
+def is_amendment(filing):
+    return filing["form_type"].endswith("/A")
+
+
+def is_base(filing):
+    """Originals and restatements rebuild the period.
+
+    Amendments whose type is unknown are treated as restatements, which can
+    never double-count rows.
+    """
+    return not is_amendment(filing) or filing.get("amendment_type") != NEW_HOLDINGS
+
+
+def effective_chain(filings):
+    """The filings that make up the period now, in filing order.
+
+    That is the latest base filing followed by the NEW HOLDINGS amendments
+    filed after it; anything before the latest base is superseded.
+    """
+    ordered = sorted(filings, key=lambda f: (f["filing_date"], f["accession_no"]))
+    base_idx = max((i for i, f in enumerate(ordered) if is_base(f)), default=None)
+    if base_idx is None:
+        return ordered
+    return ordered[base_idx:]
+
+
+def plan_period(filings, applied):
+    """Return [(filing, mode)] still to apply for one period, in order.
+
+    applied: accession numbers already loaded for this period.
+    """
+    chain = effective_chain(filings)
+    if not chain:
+        return []
+    base, additions = (chain[0], chain[1:]) if is_base(chain[0]) else (None, chain)
+    if base is not None and base["accession_no"] not in applied:
+        return [(base, REPLACE)] + [(f, APPEND) for f in additions]
+    return [(f, APPEND) for f in additions if f["accession_no"] not in applied]
+
+
+def clear_for_base(cur, cik, period_end, accession_no):
+    """Delete a period's rows before its base filing accession_no is re-inserted.
+
+    Rows of NEW HOLDINGS amendments the ledger records as appended are kept:
+    they still apply on top of the base.
+    """
+    cur.execute(f"""
+        DELETE FROM manager_quarter_holding h
+        WHERE h.cik = %s AND h.period_end = %s
+          AND NOT EXISTS (
+              SELECT 1 FROM {LEDGER_TABLE} l
+              WHERE l.accession_no = h.accession_no AND l.accession_no <> %s
+                AND l.status = 'loaded' AND l.applied_mode = %s
+          )
+    """, (cik, period_end, accession_no, APPEND))
+
+
+def write_filing(cur, cik, period_end, accession_no, holdings, mode, source="sec"):
+    """Write one filing's holdings (already in USD) as a replace or an append."""
+    if mode == REPLACE:
+        cur.execute("DELETE FROM manager_quarter_holding WHERE cik = %s AND period_end = %s",
+                    (cik, period_end))
+    else:
+        cur.execute("DELETE FROM manager_quarter_holding WHERE cik = %s AND period_end = %s AND accession_no = %s",
+                    (cik, period_end, accession_no))
+    values = [(cik, period_end, accession_no, *h) for h in holdings]
+    execute_values(cur, """
+        INSERT INTO manager_quarter_holding (cik, period_end, accession_no, line_no, issuer,
+        title_of_class, cusip, value_usd, shares, share_type, put_call, investment_discretion,
+        other_manager, voting_sole, voting_shared, voting_none) VALUES %s
+        ON CONFLICT (cik, period_end, accession_no, line_no) DO NOTHING
+    """, values, page_size=1000)
+    refresh_period_stats(cur, [(cik, period_end)], source)
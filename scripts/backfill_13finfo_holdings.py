@@ -6,8 +6,21 @@ This script:
 2. For each manager, finds ALL available quarters on 13f.info
 3. Only scrapes quarters that are missing
 
+The manager page still lists the quarters (13f.info may have filings no
+local table knows about yet), but a missing quarter whose filing is already
+known locally (13f.info summary or SEC ledger accessions; see filing_ids.py)
+is fetched straight from /data/13f/{filing_id}. The page's filing ID is used
+for unknown and ambiguous quarters and when a known ID returns nothing; if
+the page cannot be read, the locally known quarters are still tried.
+--no-bridge only uses the filing IDs on the manager pages.
+
+Rows are streamed into the table with COPY (copy_writer.CopyWriter); pass
+--archive-dir to also keep a compressed Parquet copy (holdings_archive).
+
 Usage:
   python backfill_13finfo_holdings.py --max-workers 50
+  python backfill_13finfo_holdings.py --archive-dir archive/backfill
+  python backfill_13finfo_holdings.py --no-bridge
 
 Test (limit managers):
   python backfill_13finfo_holdings.py --limit 100 --max-workers 20
@@ -17,17 +30,23 @@ import asyncio
 import os
 import re
 import time
+from collections import Counter
 from urllib.parse import urljoin
 
-import aiohttp
-import pandas as pd
-from bs4 import BeautifulSoup
-
 from dotenv import load_dotenv
+
+from add_holdings_from_13finfo_filing import holding_value_rows
+from copy_writer import CopyWriter
+from filing_ids import FilingIdResolver, filing_url as bridged_filing_url
+from holdings_archive import HoldingsArchive
+from holdings_table import HOLDING_COLUMNS, ensure_holdings_key, normalize_cik, upsert_holdings_rows
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from thirteenf_client import ThirteenFClient
+from thirteenf_html import manager_links, quarter_filings
+
 load_dotenv()
 
 import psycopg2
-from psycopg2.extras import execute_values
 
 
 BASE = "https://13f.info"
@@ -35,67 +54,53 @@ UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) 13f-backfill/1.0"
 
 TABLE = "public.expected_13finfo_holdings"
 
-DEFAULT_OUT_CSV = "13finfo_holdings_backfill.csv"
-
-SEMAPHORE_LIMIT = 50
+STATS = Counter()   # manager pages fetched, quarters fetched directly / via a page
 
 
 def parse_cik_from_manager_url(manager_url: str) -> str | None:
     m = re.search(r"/manager/(\d{10})-", manager_url)
-    return m.group(1) if m else None
+    return normalize_cik(m.group(1)) if m else None
 
 
-def get_existing_cik_quarters(db_url: str) -> set[tuple[str, str]]:
-    """Get all (cik, quarter) combinations already in database"""
+def load_filing_resolver(db_url: str) -> FilingIdResolver:
+    """Filing IDs known from local accession data (filing_ids.py)"""
     conn = psycopg2.connect(db_url)
     try:
         with conn.cursor() as cur:
-            cur.execute(f"SELECT DISTINCT cik, quarter FROM {TABLE} WHERE cik IS NOT NULL")
-            rows = cur.fetchall()
-            return set((row[0], row[1]) for row in rows)
+            return FilingIdResolver.load(cur)
     finally:
         conn.close()
 
 
-async def fetch_page(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore) -> str | None:
-    async with semaphore:
-        try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                return None
-        except Exception:
-            return None
-
-
-async def fetch_json(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore) -> dict | None:
-    async with semaphore:
-        try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                return None
-        except Exception:
-            return None
+def get_existing_cik_quarters(db_url: str) -> set[tuple[str, str]]:
+    """Get all (cik, quarter) combinations already in database"""
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                ensure_holdings_key(cur, TABLE)
+                cur.execute(f"SELECT DISTINCT cik, quarter FROM {TABLE} WHERE cik IS NOT NULL")
+                rows = cur.fetchall()
+                return set((row[0], row[1]) for row in rows)
+    finally:
+        conn.close()
 
 
-async def collect_all_manager_urls(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore) -> list[str]:
+async def collect_all_manager_urls(client: ThirteenFClient) -> list[str]:
     """Collect ALL manager URLs from A-Z index pages"""
     urls = set()
     index_pages = [f"{BASE}/managers"] + [f"{BASE}/managers/{c}" for c in "abcdefghijklmnopqrstuvwxyz0"]
     
     print(f"📥 Fetching {len(index_pages)} manager index pages...")
     
-    tasks = [fetch_page(session, url, semaphore) for url in index_pages]
+    tasks = [client.fetch_text(url, cache=True) for url in index_pages]
     results = await asyncio.gather(*tasks)
     
     for html in results:
         if not html:
             continue
-        soup = BeautifulSoup(html, "html.parser")
-        for a in soup.select('a[href^="/manager/"]'):
-            href = a.get("href", "")
-            if "/manager/" in href:
+        with stage("parse"):
+            for href, _ in manager_links(html):
                 urls.add(urljoin(BASE, href))
     
     print(f"✅ Found {len(urls)} unique managers")
@@ -103,107 +108,95 @@ async def collect_all_manager_urls(session: aiohttp.ClientSession, semaphore: as
 
 
 async def get_manager_filings(
-    session: aiohttp.ClientSession,
-    semaphore: asyncio.Semaphore,
+    client: ThirteenFClient,
     manager_url: str
 ) -> list[tuple[str, str, str]]:
     """
     Get all available filings for a manager.
     Returns list of (quarter, filing_id, filing_url)
     """
-    html = await fetch_page(session, manager_url, semaphore)
+    STATS["manager_pages"] += 1
+    html = await client.fetch_text(manager_url)
     if not html:
         return []
     
-    soup = BeautifulSoup(html, "html.parser")
-    filings = []
-    
-    # Find all /13f/ links with quarter info
-    for a in soup.select('a[href^="/13f/"]'):
-        href = a.get("href", "")
-        text = a.get_text(strip=True)
-        
-        # Extract quarter from link text (e.g., "Q3 2025")
-        quarter_match = re.match(r"^(Q[1-4]\s+\d{4})$", text)
-        if quarter_match:
-            quarter = quarter_match.group(1)
-            filing_url = urljoin(BASE, href)
-            
-            # Extract filing ID
-            id_match = re.search(r"/13f/(\d+)-", href)
-            if id_match:
-                filing_id = id_match.group(1)
-                filings.append((quarter, filing_id, filing_url))
-    
-    return filings
+    # /13f/ links whose text is a quarter (e.g., "Q3 2025")
+    with stage("parse"):
+        return [(quarter, filing_id, urljoin(BASE, href)) for quarter, filing_id, href in quarter_filings(html)]
 
 
 async def fetch_holdings(
-    session: aiohttp.ClientSession,
-    semaphore: asyncio.Semaphore,
+    client: ThirteenFClient,
     filing_id: str
 ) -> list[list] | None:
-    """Fetch holdings from JSON API"""
+    """Fetch holdings rows from JSON API (decoded as they stream in)"""
     api_url = f"{BASE}/data/13f/{filing_id}"
-    data = await fetch_json(session, api_url, semaphore)
-    
-    if data and "data" in data:
-        return data["data"]
-    return None
+    return await client.fetch_holdings_rows(api_url)
 
 
 async def process_manager(
-    session: aiohttp.ClientSession,
-    semaphore: asyncio.Semaphore,
+    client: ThirteenFClient,
     manager_url: str,
-    existing_cik_quarters: set[tuple[str, str]]
-) -> tuple[list[dict], int, int]:
+    existing_cik_quarters: set[tuple[str, str]],
+    resolver: FilingIdResolver | None = None
+) -> tuple[list[tuple], int, int]:
     """
     Process a manager - only fetch missing quarters.
-    Returns (holdings_list, num_scraped, num_skipped)
+    Returns (holdings rows in HOLDING_COLUMNS order, num_scraped, num_skipped)
     """
     cik = parse_cik_from_manager_url(manager_url)
     if not cik:
         return [], 0, 0
     
-    # Get all available filings for this manager
-    filings = await get_manager_filings(session, semaphore, manager_url)
-    if not filings:
+    page = None
+    
+    async def page_filings():
+        """{quarter: (filing_id, filing_url)} from the manager page, fetched at most once"""
+        nonlocal page
+        if page is None:
+            page = {}
+            for quarter, filing_id, filing_url in await get_manager_filings(client, manager_url):
+                page.setdefault(quarter, (filing_id, filing_url))
+        return page
+    
+    # The page lists what 13f.info has; locally known quarters cover a page that failed
+    quarters = list(await page_filings())
+    if resolver:
+        quarters += [q for q in resolver.quarters(cik) if q not in page]
+    if not quarters:
         return [], 0, 0
     
     all_holdings = []
     num_scraped = 0
     num_skipped = 0
     
-    for quarter, filing_id, filing_url in filings:
+    for quarter in quarters:
         # Check if we already have this (cik, quarter)
         if (cik, quarter) in existing_cik_quarters:
             num_skipped += 1
             continue
         
-        # Fetch holdings
-        rows = await fetch_holdings(session, semaphore, filing_id)
-        if not rows:
-            continue
+        # Known filing ID: straight to the holdings API
+        filing_id = resolver.resolve(cik, quarter) if resolver else None
+        rows = await fetch_holdings(client, filing_id) if filing_id else None
+        if rows:
+            filing_url = bridged_filing_url(filing_id)
+            STATS["direct"] += 1
+        else:
+            # Unknown/ambiguous ID, or it returned nothing: the manager page decides
+            page_filing = (await page_filings()).get(quarter)
+            if not page_filing or page_filing[0] == filing_id:
+                continue
+            filing_id, filing_url = page_filing
+            rows = await fetch_holdings(client, filing_id)
+            if not rows:
+                continue
+            STATS["via_page"] += 1
         
-        # Parse holdings
-        for row in rows:
-            if len(row) >= 9:
-                all_holdings.append({
-                    "manager_url": manager_url,
-                    "cik": cik,
-                    "quarter": quarter,
-                    "filing_url": filing_url,
-                    "sym": row[0],
-                    "issuer_name": row[1],
-                    "class": row[2],
-                    "cusip": row[3],
-                    "value_000": row[4],
-                    "pct": row[5],
-                    "shares": row[6],
-                    "principal": row[7],
-                    "option_type": row[8],
-                })
+        # Normalized API rows (list or dict) are sym, issuer_name, class, cusip,
+        # value_000, pct, shares, principal, option_type: the tail of HOLDING_COLUMNS
+        prefix = (manager_url, cik, quarter, filing_url)
+        all_holdings.extend(prefix + values for values in holding_value_rows(rows))
         
         num_scraped += 1
     
@@ -211,17 +204,17 @@ async def process_manager(
 
 
 async def process_batch(
-    session: aiohttp.ClientSession,
-    semaphore: asyncio.Semaphore,
+    client: ThirteenFClient,
     manager_urls: list[str],
     existing_cik_quarters: set[tuple[str, str]],
     batch_num: int,
-    total_batches: int
-) -> tuple[list[dict], int, int]:
+    total_batches: int,
+    resolver: FilingIdResolver | None = None
+) -> tuple[list[tuple], int, int]:
     """Process a batch of managers"""
     
     tasks = [
-        process_manager(session, semaphore, url, existing_cik_quarters)
+        process_manager(client, url, existing_cik_quarters, resolver)
         for url in manager_urls
     ]
     results = await asyncio.gather(*tasks)
@@ -240,58 +233,6 @@ async def process_batch(
     return all_holdings, total_scraped, total_skipped
 
 
-def append_to_db(db_url: str, holdings: list[dict]):
-    """Append holdings to database (no truncate)"""
-    if not holdings:
-        return 0
-    
-    conn = psycopg2.connect(db_url)
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cols = ["manager_url", "cik", "quarter", "filing_url", "sym", "issuer_name",
-                        "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]
-                
-                rows = [tuple(h.get(c) for c in cols) for h in holdings]
-                
-                execute_values(
-                    cur,
-                    f"""
-                    INSERT INTO {TABLE}
-                    (manager_url, cik, quarter, filing_url, sym, issuer_name,
-                     class, cusip, value_000, pct, shares, principal, option_type)
-                    VALUES %s
-                    """,
-                    rows,
-                    page_size=5000,
-                )
-                
-                return len(rows)
-    finally:
-        conn.close()
-
-
-def save_checkpoint(holdings: list[dict], csv_path: str, mode: str = "a"):
-    """Save/append holdings to CSV"""
-    if not holdings:
-        return
-    
-    df = pd.DataFrame(holdings)
-    
-    cols = ["manager_url", "cik", "quarter", "filing_url", "sym", "issuer_name",
-            "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]
-    for c in cols:
-        if c not in df.columns:
-            df[c] = None
-    df = df[cols]
-    
-    for c in ["value_000", "pct", "shares"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
-    
-    write_header = mode == "w" or not os.path.exists(csv_path)
-    df.to_csv(csv_path, mode=mode, header=write_header, index=False)
-
-
 async def main_async(args):
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
@@ -303,21 +244,15 @@ async def main_async(args):
     existing_cik_quarters = get_existing_cik_quarters(db_url)
     print(f"✅ Found {len(existing_cik_quarters)} existing (cik, quarter) combinations")
     
-    # Setup
-    connector = aiohttp.TCPConnector(
-        limit=SEMAPHORE_LIMIT,
-        limit_per_host=SEMAPHORE_LIMIT,
-        keepalive_timeout=30,
-    )
-    semaphore = asyncio.Semaphore(SEMAPHORE_LIMIT)
+    resolver = None
+    if not args.no_bridge:
+        resolver = load_filing_resolver(db_url)
+        print(f"🔗 Filing-ID bridge: {resolver.summary()}")
     
-    async with aiohttp.ClientSession(
-        connector=connector,
-        headers={"User-Agent": UA}
-    ) as session:
+    async with ThirteenFClient(user_agent=UA) as client:
         
         # Collect all manager URLs
-        all_manager_urls = await collect_all_manager_urls(session, semaphore)
+        all_manager_urls = await collect_all_manager_urls(client)
         
         if args.limit and args.limit > 0:
             all_manager_urls = all_manager_urls[:args.limit]
@@ -335,48 +270,58 @@ async def main_async(args):
         
         start_time = time.time()
         
-        # Clear/create CSV
-        if os.path.exists(args.out_csv):
-            os.remove(args.out_csv)
+        # Optional compressed copy of everything written (replaces the CSV backup)
+        archive = HoldingsArchive(args.archive_dir, prefix="backfill") if args.archive_dir else None
         
-        for i in range(0, len(all_manager_urls), batch_size):
-            batch = all_manager_urls[i:i + batch_size]
-            batch_num = (i // batch_size) + 1
-            
-            holdings, scraped, skipped = await process_batch(
-                session, semaphore, batch, existing_cik_quarters, batch_num, total_batches
-            )
-            
-            if holdings:
-                # Append to database immediately
-                inserted = append_to_db(db_url, holdings)
-                total_holdings += inserted
-                
-                # Update existing set to avoid re-scraping in case of resume
-                for h in holdings:
-                    existing_cik_quarters.add((h["cik"], h["quarter"]))
-                
-                # Save to CSV as backup
-                save_checkpoint(holdings, args.out_csv, mode="a")
-            
-            total_quarters_scraped += scraped
-            total_quarters_skipped += skipped
-            
-            # Progress
-            elapsed = time.time() - start_time
-            processed = i + len(batch)
-            rate = processed / elapsed if elapsed > 0 else 0
-            eta = (len(all_manager_urls) - processed) / rate if rate > 0 else 0
-            
-            print(f"📊 Progress: {processed}/{len(all_manager_urls)} ({100*processed/len(all_manager_urls):.1f}%) | "
-                  f"Rate: {rate:.1f}/s | ETA: {eta/60:.1f}min | "
-                  f"New quarters: {total_quarters_scraped} | Holdings: {total_holdings}")
+        try:
+            # Rows go straight from the API decoder to COPY; no DataFrame/CSV round trip
+            async with CopyWriter(db_url, TABLE, HOLDING_COLUMNS, copy=upsert_holdings_rows) as writer:
+                for i in range(0, len(all_manager_urls), batch_size):
+                    batch = all_manager_urls[i:i + batch_size]
+                    batch_num = (i // batch_size) + 1
+                    
+                    holdings, scraped, skipped = await process_batch(
+                        client, batch, existing_cik_quarters, batch_num, total_batches, resolver
+                    )
+                    
+                    if holdings:
+                        await writer.put_many(holdings)
+                        total_holdings += len(holdings)
+                        
+                        # Update existing set to avoid re-scraping in case of resume
+                        existing_cik_quarters.update((row[1], row[2]) for row in holdings)
+                        
+                        if archive:
+                            archive.write(holdings)
+                    
+                    total_quarters_scraped += scraped
+                    total_quarters_skipped += skipped
+                    
+                    # Progress
+                    elapsed = time.time() - start_time
+                    processed = i + len(batch)
+                    rate = processed / elapsed if elapsed > 0 else 0
+                    eta = (len(all_manager_urls) - processed) / rate if rate > 0 else 0
+                    
+                    print(f"📊 Progress: {processed}/{len(all_manager_urls)} ({100*processed/len(all_manager_urls):.1f}%) | "
+                          f"Rate: {rate:.1f}/s | ETA: {eta/60:.1f}min | "
+                          f"New quarters: {total_quarters_scraped} | Holdings: {total_holdings}")
+        finally:
+            if archive:
+                archive.close()
         
         elapsed = time.time() - start_time
         print(f"\n✅ COMPLETE in {elapsed/60:.1f} minutes")
         print(f"   New quarters scraped: {total_quarters_scraped}")
         print(f"   Quarters skipped (already had): {total_quarters_skipped}")
-        print(f"   New holdings added: {total_holdings}")
+        print(f"   Manager pages fetched: {STATS['manager_pages']} | quarters fetched directly: "
+              f"{STATS['direct']}, via manager page: {STATS['via_page']}")
+        if resolver:
+            print(f"   Filing-ID bridge: {resolver.summary()}")
+        print(f"   New holdings added: {writer.rows_written} ({writer.chunks_written} COPY chunks)")
+        if archive:
+            print(f"   Archived: {archive.rows_written} rows in {len(archive.files)} files under {args.archive_dir}")
+        client.report()
         
         # Final count
         conn = psycopg2.connect(db_url)
@@ -400,8 +345,13 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=0, help="Limit managers (0=all)")
     ap.add_argument("--batch-size", type=int, default=100, help="Managers per batch")
-    ap.add_argument("--out-csv", default=DEFAULT_OUT_CSV)
+    ap.add_argument("--archive-dir", default=None,
+                    help="Also write the scraped rows as compressed Parquet files here (needs pyarrow)")
+    ap.add_argument("--no-bridge", action="store_true",
+                    help="Use only the manager pages' filing IDs, not local accession data")
+    add_profile_arguments(ap)
     args = ap.parse_args()
+    start_profiling_from_args(args)
     
     print("=" * 70)
     print("13f.info Holdings Backfill - Missing Quarters Only")
@@ -7,8 +7,19 @@ Two-phase approach for maximum speed:
 
 This is much faster than processing managers sequentially.
 
+Manager pages are revalidated against the page cache (page_cache.py): a page
+that comes back 304 is not parsed or diffed again. A page that is downloaded
+is always diffed against the table (a set lookup), even when its filing list
+digest is unchanged, so quarters deleted from the table since are found
+again. --full ignores the cache (and rebuilds it).
+
+--archive-dir also keeps a compressed Parquet copy of the rows written
+(holdings_archive.py).
+
 Usage:
   python backfill_13finfo_holdings_fast.py
+  python backfill_13finfo_holdings_fast.py --full
+  python backfill_13finfo_holdings_fast.py --archive-dir archive/backfill
 
 Test:
   python backfill_13finfo_holdings_fast.py --limit 200
@@ -21,15 +32,22 @@ import time
 from urllib.parse import urljoin
 from dataclasses import dataclass
 
-import aiohttp
 import pandas as pd
-from bs4 import BeautifulSoup
 
 from dotenv import load_dotenv
+
+from add_holdings_from_13finfo_filing import holding_value_rows
+from copy_writer import CopyWriter
+from holdings_archive import HoldingsArchive
+from holdings_table import HOLDING_COLUMNS, ensure_holdings_key, normalize_cik, upsert_holdings_rows
+from page_cache import drop_page_cache, ensure_page_cache, filings_digest, load_page_cache, save_page_cache
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from thirteenf_client import ThirteenFClient
+from thirteenf_html import manager_links, quarter_filings
+
 load_dotenv()
 
 import psycopg2
-from psycopg2.extras import execute_values
 
 
 BASE = "https://13f.info"
@@ -37,11 +55,9 @@ UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) 13f-backfill/2.0"
 
 TABLE = "public.expected_13finfo_holdings"
 
-# Concurrency settings - tune based on server tolerance
-SEMAPHORE_LIMIT = 100       # Max concurrent requests
+# Batch sizes (request concurrency/backoff are tuned in thirteenf_client)
 BATCH_SIZE_PHASE1 = 500     # Manager pages per batch
-BATCH_SIZE_PHASE2 = 200     # Holdings API calls per batch
-DB_INSERT_BATCH = 50000     # Holdings per DB insert
+BATCH_SIZE_PHASE2 = 200     # Holdings API calls per batch (rows stream to COPY as they arrive)
 
 
 @dataclass
@@ -57,7 +73,7 @@ def parse_cik_from_manager_url(manager_url: str) -> str | None:
     m = re.search(r"/manager/(\d+)-", manager_url)
     if m:
         # Always normalize to 10-digit padded format
-        return m.group(1).lstrip('0').zfill(10)
+        return normalize_cik(m.group(1))
     return None
 
 
@@ -65,60 +81,70 @@ def get_existing_cik_quarters(db_url: str) -> set[tuple[str, str]]:
     """Get all (cik, quarter) combinations already in database"""
     conn = psycopg2.connect(db_url)
     try:
-        with conn.cursor() as cur:
-            # Normalize CIK to 10-digit padded format for consistent matching
-            cur.execute(f"""
-                SELECT DISTINCT LPAD(LTRIM(cik, '0'), 10, '0'), quarter 
-                FROM {TABLE} 
-                WHERE cik IS NOT NULL
-            """)
-            return set(cur.fetchall())
+        with conn:
+            with conn.cursor() as cur:
+                # CIKs are stored canonical (holdings_table), so this is an index scan
+                ensure_holdings_key(cur, TABLE)
+                cur.execute(f"""
+                    SELECT DISTINCT cik, quarter 
+                    FROM {TABLE} 
+                    WHERE cik IS NOT NULL
+                """)
+                return set(cur.fetchall())
     finally:
         conn.close()
 
 
-async def fetch_text(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore) -> str | None:
-    async with semaphore:
-        try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-        except:
-            pass
-        return None
+@stage("db")
+def load_manager_page_cache(db_url: str) -> dict:
+    """Validators and filing digests saved by previous runs, keyed by manager URL"""
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                ensure_page_cache(cur)
+                return load_page_cache(cur)
+    finally:
+        conn.close()
 
 
-async def fetch_json(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore) -> dict | None:
-    async with semaphore:
-        try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-        except:
-            pass
-        return None
+@stage("db")
+def save_manager_page_cache(db_url: str, entries: dict, urls, forget=()) -> int:
+    """Save the page cache entries for the given manager URLs, and drop the ones to re-check"""
+    rows = [(url, *entries[url]) for url in urls if url in entries]
+    forget = list(forget)
+    if not rows and not forget:
+        return 0
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                save_page_cache(cur, rows)
+                drop_page_cache(cur, forget)
+        return len(rows)
+    finally:
+        conn.close()
 
 
-async def collect_manager_urls(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore) -> list[str]:
+async def collect_manager_urls(client: ThirteenFClient) -> list[str]:
     """Collect ALL manager URLs from A-Z index pages"""
     urls = set()
     index_pages = [f"{BASE}/managers"] + [f"{BASE}/managers/{c}" for c in "abcdefghijklmnopqrstuvwxyz0"]
     
-    tasks = [fetch_text(session, url, semaphore) for url in index_pages]
+    tasks = [client.fetch_text(url, cache=True) for url in index_pages]
     results = await asyncio.gather(*tasks)
     
     for html in results:
         if not html:
             continue
-        soup = BeautifulSoup(html, "html.parser")
-        for a in soup.select('a[href^="/manager/"]'):
-            href = a.get("href", "")
-            if "/manager/" in href:
+        with stage("parse"):
+            for href, _ in manager_links(html):
                 urls.add(urljoin(BASE, href))
     
     return list(urls)
 
 
+@stage("parse")
 def parse_manager_page(html: str, manager_url: str) -> list[FilingInfo]:
     """Parse manager page to extract all filing info"""
     cik = parse_cik_from_manager_url(manager_url)
@@ -126,32 +152,14 @@ def parse_manager_page(html: str, manager_url: str) -> list[FilingInfo]:
         # Try extracting from URL with looser pattern and normalize
         m = re.search(r"/manager/(\d+)-", manager_url)
         if m:
-            cik = m.group(1).lstrip('0').zfill(10)
+            cik = normalize_cik(m.group(1))
         else:
             return []
     
-    soup = BeautifulSoup(html, "html.parser")
     filings = []
     seen = set()
     
-    for a in soup.select('a[href^="/13f/"]'):
-        href = a.get("href", "")
-        text = a.get_text(strip=True)
-        
-        # Extract quarter from link text
-        quarter_match = re.match(r"^(Q[1-4]\s+\d{4})$", text)
-        if not quarter_match:
-            continue
-        
-        quarter = quarter_match.group(1)
-        
-        # Extract filing ID
-        id_match = re.search(r"/13f/(\d+)-", href)
-        if not id_match:
-            continue
-        
-        filing_id = id_match.group(1)
-        
+    for quarter, filing_id, href in quarter_filings(html):
         # Dedupe
         key = (cik, quarter)
         if key in seen:
@@ -170,35 +178,55 @@ def parse_manager_page(html: str, manager_url: str) -> list[FilingInfo]:
 
 
 async def phase1_collect_filings(
-    session: aiohttp.ClientSession,
-    semaphore: asyncio.Semaphore,
+    client: ThirteenFClient,
     manager_urls: list[str],
-    existing: set[tuple[str, str]]
-) -> list[FilingInfo]:
+    existing: set[tuple[str, str]],
+    page_cache: dict
+) -> tuple[list[FilingInfo], dict]:
     """
-    Phase 1: Fetch all manager pages and collect missing filings
+    Phase 1: Revalidate all manager pages and collect missing filings from every page downloaded (not 304)
+
+    Returns (missing filings, {manager_url: (etag, last_modified, digest)} for pages to re-cache)
     """
-    print(f"\n📥 Phase 1: Fetching {len(manager_urls)} manager pages...")
+    print(f"\n📥 Phase 1: Revalidating {len(manager_urls)} manager pages "
+          f"({len(page_cache):,} cached)...")
     
     all_filings = []
     total_available = 0
+    fresh_entries = {}
+    not_modified = 0
+    same_digest = 0
     
     for i in range(0, len(manager_urls), BATCH_SIZE_PHASE1):
         batch = manager_urls[i:i + BATCH_SIZE_PHASE1]
         batch_num = (i // BATCH_SIZE_PHASE1) + 1
         total_batches = (len(manager_urls) + BATCH_SIZE_PHASE1 - 1) // BATCH_SIZE_PHASE1
         
-        # Fetch all pages in parallel
-        tasks = [fetch_text(session, url, semaphore) for url in batch]
+        # Revalidate all pages in parallel
+        tasks = []
+        for url in batch:
+            cached = page_cache.get(url)
+            tasks.append(client.revalidate(url, cached.etag, cached.last_modified) if cached
+                         else client.revalidate(url))
         results = await asyncio.gather(*tasks)
         
         # Parse results
         batch_filings = []
         batch_available = 0
-        for html, manager_url in zip(results, batch):
-            if not html:
+        for page, manager_url in zip(results, batch):
+            if not page:
+                continue
+            if page.not_modified:
+                not_modified += 1
                 continue
-            filings = parse_manager_page(html, manager_url)
+            if not page.body:
+                continue
+            filings = parse_manager_page(page.body, manager_url)
+            digest = filings_digest((f.quarter, f.filing_id) for f in filings)
+            fresh_entries[manager_url] = (page.etag, page.last_modified, digest)
+            cached = page_cache.get(manager_url)
+            if cached and cached.digest == digest:
+                same_digest += 1
             batch_available += len(filings)
             
             # Filter to only missing
@@ -213,132 +241,90 @@ async def phase1_collect_filings(
               f"found {batch_available} quarters, {len(batch_filings)} missing | "
               f"Total missing: {len(all_filings)}")
     
-    print(f"✅ Phase 1 complete: {total_available} total quarters, {len(all_filings)} missing")
-    return all_filings
+    changed = len(fresh_entries) - same_digest
+    print(f"✅ Phase 1 complete: {not_modified:,} not modified, {same_digest:,} unchanged filing lists, "
+          f"{changed:,} changed managers | {total_available} quarters checked, {len(all_filings)} missing")
+    return all_filings, fresh_entries
 
 
 async def fetch_single_holding(
-    session: aiohttp.ClientSession,
-    semaphore: asyncio.Semaphore,
-    filing: FilingInfo
-) -> list[dict]:
-    """Fetch holdings for a single filing"""
+    client: ThirteenFClient,
+    writer: CopyWriter,
+    filing: FilingInfo,
+    archive: HoldingsArchive | None = None
+) -> int:
+    """Fetch holdings for a single filing and queue them for COPY; returns the row count"""
     api_url = f"{BASE}/data/13f/{filing.filing_id}"
-    data = await fetch_json(session, api_url, semaphore)
+    api_rows = await client.fetch_holdings_rows(api_url)
     
-    if not data or "data" not in data:
-        return []
+    if not api_rows:
+        return 0
     
     # Ensure CIK is normalized (10-digit padded)
-    normalized_cik = filing.cik.lstrip('0').zfill(10)
-    
-    holdings = []
-    for row in data["data"]:
-        if len(row) >= 9:
-            holdings.append({
-                "manager_url": filing.manager_url,
-                "cik": normalized_cik,
-                "quarter": filing.quarter,
-                "filing_url": filing.filing_url,
-                "sym": row[0],
-                "issuer_name": row[1],
-                "class": row[2],
-                "cusip": row[3],
-                "value_000": row[4],
-                "pct": row[5],
-                "shares": row[6],
-                "principal": row[7],
-                "option_type": row[8],
-            })
+    normalized_cik = normalize_cik(filing.cik)
     
-    return holdings
+    # Rows in HOLDING_COLUMNS order: sym, issuer_name, class, cusip, value_000, pct,
+    # shares, principal, option_type from the normalized API row (list or dict)
+    prefix = (filing.manager_url, normalized_cik, filing.quarter, filing.filing_url)
+    rows = [prefix + values for values in holding_value_rows(api_rows)]
+    await writer.put_many(rows)
+    if archive:
+        archive.write(rows)
+    return len(rows)
 
 
 async def phase2_fetch_holdings(
-    session: aiohttp.ClientSession,
-    semaphore: asyncio.Semaphore,
+    client: ThirteenFClient,
     filings: list[FilingInfo],
-    db_url: str
-) -> int:
+    db_url: str,
+    archive: HoldingsArchive | None = None
+) -> tuple[int, set[str]]:
     """
-    Phase 2: Fetch all holdings in parallel and insert to DB
+    Phase 2: Fetch all holdings in parallel and stream them into the DB
+
+    Parsed rows go through CopyWriter's bounded queue to a background COPY, so
+    memory does not grow with quarter size and DB writes overlap the fetches.
+    Each chunk is upserted on the natural key, so a re-fetched filing replaces
+    its rows instead of duplicating them.
+
+    Returns (holdings written, manager URLs with a filing that returned no holdings)
     """
     print(f"\n📥 Phase 2: Fetching holdings for {len(filings)} quarters...")
     
     total_holdings = 0
     total_batches = (len(filings) + BATCH_SIZE_PHASE2 - 1) // BATCH_SIZE_PHASE2
     
-    holdings_buffer = []
+    incomplete = set()
     start_time = time.time()
     
-    for i in range(0, len(filings), BATCH_SIZE_PHASE2):
-        batch = filings[i:i + BATCH_SIZE_PHASE2]
-        batch_num = (i // BATCH_SIZE_PHASE2) + 1
-        
-        # Fetch all holdings in parallel
-        tasks = [fetch_single_holding(session, semaphore, f) for f in batch]
-        results = await asyncio.gather(*tasks)
-        
-        # Collect holdings
-        batch_holdings = []
-        for holdings in results:
-            batch_holdings.extend(holdings)
-        
-        holdings_buffer.extend(batch_holdings)
-        
-        # Insert to DB periodically
-        if len(holdings_buffer) >= DB_INSERT_BATCH or batch_num == total_batches:
-            if holdings_buffer:
-                inserted = insert_holdings(db_url, holdings_buffer)
-                total_holdings += inserted
-                holdings_buffer = []
-        
-        # Progress
-        elapsed = time.time() - start_time
-        processed = i + len(batch)
-        rate = processed / elapsed if elapsed > 0 else 0
-        eta = (len(filings) - processed) / rate if rate > 0 else 0
-        
-        print(f"  Batch {batch_num}/{total_batches}: +{len(batch_holdings)} holdings | "
-              f"Total: {total_holdings:,} | Rate: {rate:.0f} quarters/s | ETA: {eta/60:.1f}min")
-    
-    # Insert remaining
-    if holdings_buffer:
-        inserted = insert_holdings(db_url, holdings_buffer)
-        total_holdings += inserted
-    
-    print(f"✅ Phase 2 complete: {total_holdings:,} holdings inserted")
-    return total_holdings
-
-
-def insert_holdings(db_url: str, holdings: list[dict]) -> int:
-    """Insert holdings to database"""
-    if not holdings:
-        return 0
+    async with CopyWriter(db_url, TABLE, HOLDING_COLUMNS, copy=upsert_holdings_rows) as writer:
+        for i in range(0, len(filings), BATCH_SIZE_PHASE2):
+            batch = filings[i:i + BATCH_SIZE_PHASE2]
+            batch_num = (i // BATCH_SIZE_PHASE2) + 1
+            
+            # Fetch all holdings in parallel; each filing's rows are queued as soon as it arrives
+            tasks = [fetch_single_holding(client, writer, f, archive) for f in batch]
+            counts = await asyncio.gather(*tasks)
+            
+            for f, count in zip(batch, counts):
+                if not count:
+                    incomplete.add(f.manager_url)
+            batch_holdings = sum(counts)
+            total_holdings += batch_holdings
+            
+            # Progress
+            elapsed = time.time() - start_time
+            processed = i + len(batch)
+            rate = processed / elapsed if elapsed > 0 else 0
+            eta = (len(filings) - processed) / rate if rate > 0 else 0
+            
+            print(f"  Batch {batch_num}/{total_batches}: +{batch_holdings} holdings | "
+                  f"Queued: {total_holdings:,} | Written: {writer.rows_written:,} | "
+                  f"Rate: {rate:.0f} quarters/s | ETA: {eta/60:.1f}min")
     
-    conn = psycopg2.connect(db_url)
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cols = ["manager_url", "cik", "quarter", "filing_url", "sym", "issuer_name",
-                        "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]
-                
-                rows = [tuple(h.get(c) for c in cols) for h in holdings]
-                
-                execute_values(
-                    cur,
-                    f"""
-                    INSERT INTO {TABLE}
-                    (manager_url, cik, quarter, filing_url, sym, issuer_name,
-                     class, cusip, value_000, pct, shares, principal, option_type)
-                    VALUES %s
-                    """,
-                    rows,
-                    page_size=10000,
-                )
-                return len(rows)
-    finally:
-        conn.close()
+    print(f"✅ Phase 2 complete: {writer.rows_written:,} holdings written "
+          f"in {writer.chunks_written:,} COPY chunks")
+    return writer.rows_written, incomplete
 
 
 async def main_async(args):
@@ -352,23 +338,15 @@ async def main_async(args):
     existing = get_existing_cik_quarters(db_url)
     print(f"✅ Found {len(existing):,} existing (cik, quarter) combinations")
     
-    # Setup connection pool
-    connector = aiohttp.TCPConnector(
-        limit=SEMAPHORE_LIMIT,
-        limit_per_host=SEMAPHORE_LIMIT,
-        keepalive_timeout=60,
-        enable_cleanup_closed=True,
-    )
-    semaphore = asyncio.Semaphore(SEMAPHORE_LIMIT)
+    page_cache = {} if args.full else load_manager_page_cache(db_url)
+    if args.full:
+        print("⚠️ FULL MODE: ignoring the manager page cache")
     
-    async with aiohttp.ClientSession(
-        connector=connector,
-        headers={"User-Agent": UA}
-    ) as session:
+    async with ThirteenFClient(user_agent=UA) as client:
         
         # Collect manager URLs
         print("\n📥 Collecting manager URLs...")
-        manager_urls = await collect_manager_urls(session, semaphore)
+        manager_urls = await collect_manager_urls(client)
         print(f"✅ Found {len(manager_urls):,} managers")
         
         if args.limit and args.limit > 0:
@@ -378,18 +356,28 @@ async def main_async(args):
         start_time = time.time()
         
         # Phase 1: Collect all missing filings
-        missing_filings = await phase1_collect_filings(
-            session, semaphore, manager_urls, existing
+        missing_filings, fresh_entries = await phase1_collect_filings(
+            client, manager_urls, existing, page_cache
         )
         
+        # Managers with nothing missing are complete now; the rest only once phase 2 loads them
+        pending = {f.manager_url for f in missing_filings}
+        save_manager_page_cache(db_url, fresh_entries, fresh_entries.keys() - pending)
+        
         if not missing_filings:
             print("\n✅ No missing quarters to backfill!")
             return
         
         # Phase 2: Fetch all holdings
-        total_holdings = await phase2_fetch_holdings(
-            session, semaphore, missing_filings, db_url
-        )
+        archive = HoldingsArchive(args.archive_dir, prefix="backfill") if args.archive_dir else None
+        try:
+            total_holdings, incomplete = await phase2_fetch_holdings(
+                client, missing_filings, db_url, archive
+            )
+        finally:
+            if archive:
+                archive.close()
+        cached = save_manager_page_cache(db_url, fresh_entries, pending - incomplete, forget=incomplete)
         
         # Summary
         elapsed = time.time() - start_time
@@ -397,6 +385,10 @@ async def main_async(args):
         print(f"✅ BACKFILL COMPLETE in {elapsed/60:.1f} minutes")
         print(f"   Quarters backfilled: {len(missing_filings):,}")
         print(f"   Holdings added: {total_holdings:,}")
+        print(f"   Managers cached: {cached:,} ({len(incomplete):,} left to re-check)")
+        if archive:
+            print(f"   Archived: {archive.rows_written:,} rows in {len(archive.files)} files under {args.archive_dir}")
+        client.report()
         
         # Final DB stats
         conn = psycopg2.connect(db_url)
@@ -419,7 +411,13 @@ async def main_async(args):
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=0, help="Limit managers (0=all)")
+    ap.add_argument("--full", action="store_true",
+                    help="Fetch and diff every manager page, ignoring the page cache")
+    ap.add_argument("--archive-dir", default=None,
+                    help="Also write the scraped rows as compressed Parquet files here (needs pyarrow)")
+    add_profile_arguments(ap)
     args = ap.parse_args()
+    start_profiling_from_args(args)
     
     print("=" * 70)
     print("13f.info Holdings Backfill - FULLY OPTIMIZED")
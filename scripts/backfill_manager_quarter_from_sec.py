@@ -9,6 +9,7 @@ Features:
 - Bulk inserts with execute_values
 - Ruby-style HTML directory parsing for XML URLs
 """
+import argparse
 import requests
 import psycopg2
 from psycopg2.extras import execute_values
@@ -20,6 +21,10 @@ from dotenv import load_dotenv
 from lxml import etree
 import time
 
+from cover_page import parse_cover_page
+from holding_stats import ensure_period_stats, refresh_period_stats
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+
 SEC_HEADERS = {
     "User-Agent": "Naveen Mokkapati navmok@gmail.com",
     "Accept": "*/*",
@@ -49,6 +54,7 @@ SESSION.headers.update(SEC_HEADERS)
 QUARTERLY_INDEXES = {}  # {(year, quarter): {cik: [filings]}}
 
 
+@stage("index")
 def download_quarterly_index(year, quarter):
     """Download and parse master.idx for a quarter - with retry logic"""
     key = (year, quarter)
@@ -139,6 +145,7 @@ def period_to_quarter(period_end):
     return dt.year, quarter, dt
 
 
+@stage("index")
 def find_13f_filing(cik, period_end, debug=False):
     """Find 13F filing for a CIK and period - fast local lookup"""
     cik_padded = str(cik).zfill(10)
@@ -245,38 +252,29 @@ def find_info_table_url(xml_urls):
     return None
 
 
+@stage("parse")
 def fetch_value_total(xml_url):
-    """Fetch total value from primary_doc.xml"""
+    """Fetch total value from primary_doc.xml (one-pass cover-page extraction)"""
     try:
-        r = SESSION.get(xml_url, timeout=30)
+        with stage("fetch"):
+            r = SESSION.get(xml_url, timeout=30)
         if r.status_code == 404:
             return None
         r.raise_for_status()
         
-        root = etree.fromstring(r.content)
-        
-        for elem in root.iter():
-            if '}' in elem.tag:
-                elem.tag = elem.tag.split('}', 1)[1]
-        
-        for elem in root.iter():
-            if elem.tag in ['tableValueTotal', 'valueTotal', 'securitiesOwnedAggregateValue']:
-                if elem.text and elem.text.strip():
-                    try:
-                        return int(elem.text.strip())
-                    except ValueError:
-                        pass
-        
-        return None
+        cover = parse_cover_page(r.content)
+        return cover["table_value_total"] if cover else None
         
     except:
         return None
 
 
+@stage("parse")
 def fetch_holdings(xml_url, max_size_mb=25):
     """Fetch holdings from info_table.xml"""
     try:
-        r = SESSION.get(xml_url, timeout=45, stream=True)
+        with stage("fetch"):
+            r = SESSION.get(xml_url, timeout=45, stream=True)
         if r.status_code == 404:
             return []
         r.raise_for_status()
@@ -286,7 +284,8 @@ def fetch_holdings(xml_url, max_size_mb=25):
             print(f"  ⚠️  Skipping large file: {int(content_length) / 1_000_000:.1f}MB", flush=True)
             return []
         
-        xml_content = r.content
+        with stage("fetch"):
+            xml_content = r.content     # streamed: the body downloads here
         holdings = []
         idx = 0
         
@@ -370,6 +369,7 @@ def fetch_holdings(xml_url, max_size_mb=25):
         return []
 
 
+@stage("db")
 def get_processed_periods(cur, ciks=None):
     """Get set of (cik, period_end) that already have COMPLETE holdings in DB.
     
@@ -378,18 +378,19 @@ def get_processed_periods(cur, ciks=None):
     """
     print("📊 Checking for already-processed periods...", flush=True)
     
+    # Periods with at least one holding that has shares
     if ciks:
         cur.execute("""
-            SELECT DISTINCT cik, period_end 
-            FROM manager_quarter_holding 
+            SELECT cik, period_end
+            FROM holding_period_stats
             WHERE cik = ANY(%s)
-              AND shares IS NOT NULL
+              AND null_shares < num_holdings
         """, (list(ciks),))
     else:
         cur.execute("""
-            SELECT DISTINCT cik, period_end 
-            FROM manager_quarter_holding
-            WHERE shares IS NOT NULL
+            SELECT cik, period_end
+            FROM holding_period_stats
+            WHERE null_shares < num_holdings
         """)
     
     processed = set()
@@ -456,6 +457,7 @@ def process_manager_period(cik, period_end, cur, conn, debug_first=False):
                 ) VALUES %s
                 ON CONFLICT (cik, period_end, accession_no, line_no) DO NOTHING
             """, values, page_size=1000)
+            refresh_period_stats(cur, [(cik, period_end)], "backfill_manager_quarter_from_sec")
             
             cur.execute("""
                 UPDATE manager_quarter
@@ -478,6 +480,10 @@ def process_manager_period(cik, period_end, cur, conn, debug_first=False):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Backfill manager_quarter from SEC 13F filings")
+    add_profile_arguments(parser)
+    start_profiling_from_args(parser.parse_args())
+
     print("=" * 70)
     print("Fast SEC 13F Downloader (Ruby Strategy)")
     print("=" * 70)
@@ -518,6 +524,7 @@ def main():
             PRIMARY KEY (cik, period_end, accession_no, line_no)
         )
     """)
+    ensure_period_stats(cur)
     conn.commit()
     
     # Get all tasks (manager-period combinations)
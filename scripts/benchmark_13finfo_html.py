@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Benchmark 13f.info HTML parsing: BeautifulSoup (previous implementation) vs
+thirteenf_html (lxml).
+
+Both implementations run over the same recorded pages; their outputs are
+compared so a speedup never hides a behaviour change, and per-page parse
+times are printed for each extractor.
+
+Usage:
+    # Record the 27 index pages plus the first 300 manager pages
+    python benchmark_13finfo_html.py --pages recorded_13finfo --record --managers 300
+
+    # Benchmark what is recorded
+    python benchmark_13finfo_html.py --pages recorded_13finfo --repeat 3
+"""
+import argparse
+import asyncio
+import os
+import re
+import time
+
+from bs4 import BeautifulSoup
+
+import thirteenf_html
+from thirteenf_client import BASE, ThirteenFClient
+
+INDEX_LETTERS = "abcdefghijklmnopqrstuvwxyz0"
+
+
+# --- previous BeautifulSoup implementations (reference) ----------------------
+
+def bs_manager_links(html):
+    soup = BeautifulSoup(html, "html.parser")
+    return [(a.get("href", ""), a.get_text(strip=True)) for a in soup.select('a[href^="/manager/"]')]
+
+
+def bs_quarter_filings(html):
+    soup = BeautifulSoup(html, "html.parser")
+    filings = []
+    for a in soup.select('a[href^="/13f/"]'):
+        href = a.get("href", "")
+        quarter_match = re.match(r"^(Q[1-4]\s+\d{4})$", a.get_text(strip=True))
+        if not quarter_match:
+            continue
+        id_match = re.search(r"/13f/(\d+)-", href)
+        if id_match:
+            filings.append((quarter_match.group(1), id_match.group(1), href))
+    return filings
+
+
+def bs_filing_for_quarter(html, quarter):
+    soup = BeautifulSoup(html, "html.parser")
+    quarter_pat = re.compile(rf"\b{re.escape(quarter)}\b", re.I)
+    for row in soup.find_all(["tr", "div", "li"]):
+        txt = row.get_text(" ", strip=True)
+        if txt and quarter_pat.search(txt):
+            a = row.find("a", href=re.compile(r"^/13f/"))
+            if a and a.get("href"):
+                m = re.search(r"/13f/(\d+)-", a["href"])
+                if m:
+                    return m.group(1), a["href"]
+    return None, None
+
+
+def bs_first_table_rows(html):
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table")
+    if not table:
+        return []
+    return [[td.get_text(strip=True) for td in tr.find_all(["td", "th"])] for tr in table.select("tr")]
+
+
+# --- recording ---------------------------------------------------------------
+
+async def record_pages(pages_dir, max_managers):
+    os.makedirs(pages_dir, exist_ok=True)
+    async with ThirteenFClient() as client:
+        index_urls = [f"{BASE}/managers/{c}" for c in INDEX_LETTERS]
+        index_html = await asyncio.gather(*[client.fetch_text(u) for u in index_urls])
+        manager_urls = []
+        for c, html in zip(INDEX_LETTERS, index_html):
+            if not html:
+                continue
+            with open(os.path.join(pages_dir, f"managers_{c}.html"), "w", encoding="utf-8") as f:
+                f.write(html)
+            manager_urls.extend(BASE + href for href, _ in thirteenf_html.manager_links(html))
+
+        manager_urls = sorted(set(manager_urls))[:max_managers]
+        manager_html = await asyncio.gather(*[client.fetch_text(u) for u in manager_urls])
+        for url, html in zip(manager_urls, manager_html):
+            if html:
+                slug = url.rsplit("/", 1)[-1][:60]
+                with open(os.path.join(pages_dir, f"manager_{slug}.html"), "w", encoding="utf-8") as f:
+                    f.write(html)
+        client.report()
+    print(f"💾 Recorded {sum(1 for h in index_html if h)} index pages and "
+          f"{sum(1 for h in manager_html if h)} manager pages in {pages_dir}")
+
+
+# --- benchmark ---------------------------------------------------------------
+
+def load_pages(pages_dir):
+    index_pages, manager_pages = [], []
+    for name in sorted(os.listdir(pages_dir)):
+        if not name.endswith(".html"):
+            continue
+        with open(os.path.join(pages_dir, name), encoding="utf-8") as f:
+            html = f.read()
+        (index_pages if name.startswith("managers_") else manager_pages).append((name, html))
+    return index_pages, manager_pages
+
+
+def time_calls(fn, pages, repeat):
+    """Best-of-`repeat` total seconds for fn over all pages, plus the outputs of the last run."""
+    best = float("inf")
+    outputs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [fn(page) for _, page in pages]
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+def compare(label, pages, slow_fn, fast_fn, repeat):
+    if not pages:
+        return
+    slow_s, slow_out = time_calls(slow_fn, pages, repeat)
+    fast_s, fast_out = time_calls(fast_fn, pages, repeat)
+    mismatches = [name for (name, _), a, b in zip(pages, slow_out, fast_out) if a != b]
+    n = len(pages)
+    print(f"{label:<22} {n:>6} {1000 * slow_s / n:>12.2f} {1000 * fast_s / n:>12.2f} "
+          f"{slow_s / fast_s if fast_s else 0:>8.1f}x {len(mismatches):>10}")
+    for name in mismatches[:5]:
+        print(f"   ≠ {name}")
+
+
+def latest_quarter(html):
+    filings = thirteenf_html.quarter_filings(html)
+    return filings[0][0] if filings else "Q1 1900"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark 13f.info HTML parsing (BeautifulSoup vs lxml)")
+    ap.add_argument("--pages", required=True, help="Directory of recorded pages")
+    ap.add_argument("--record", action="store_true", help="Download pages into --pages first")
+    ap.add_argument("--managers", type=int, default=300, help="Manager pages to record (default: 300)")
+    ap.add_argument("--repeat", type=int, default=3, help="Runs per implementation; best is reported")
+    args = ap.parse_args()
+
+    if args.record:
+        asyncio.run(record_pages(args.pages, args.managers))
+
+    index_pages, manager_pages = load_pages(args.pages)
+    print(f"📄 {len(index_pages)} index pages, {len(manager_pages)} manager pages\n")
+    print(f"{'Extractor':<22} {'Pages':>6} {'BS ms/page':>12} {'lxml ms/page':>12} {'Speedup':>9} {'Mismatches':>10}")
+
+    compare("manager_links", index_pages, bs_manager_links, thirteenf_html.manager_links, args.repeat)
+    compare("quarter_filings", manager_pages, bs_quarter_filings, thirteenf_html.quarter_filings, args.repeat)
+    with_quarter = [(name, (html, latest_quarter(html))) for name, html in manager_pages]
+    compare("filing_for_quarter", with_quarter,
+            lambda page: bs_filing_for_quarter(*page),
+            lambda page: thirteenf_html.filing_for_quarter(*page),
+            args.repeat)
+    compare("first_table_rows", manager_pages, bs_first_table_rows, thirteenf_html.first_table_rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Background COPY writer for asyncio scrapers.
+
+Producers hand parsed rows to the writer as they arrive; rows are grouped
+into chunks and a background task streams each chunk into Postgres with
+COPY ... FROM STDIN on a worker thread. The chunk queue is bounded, so
+memory stays at a few chunks however large a quarter is, and a producer
+that outruns the database waits on the queue instead of buffering. DB
+writes overlap with network fetches instead of alternating with them.
+
+Each chunk is committed on its own, like the batch INSERTs it replaces.
+`copy` swaps the per-chunk load step, e.g. holdings_table.upsert_holdings_rows
+to stage and upsert instead of appending.
+
+Usage:
+    async with CopyWriter(db_url, TABLE, COLUMNS) as writer:
+        await writer.put_many(rows)          # tuples in COLUMNS order
+    print(writer.rows_written)
+
+A failed COPY is raised from the next put/put_many/close; remaining rows
+are discarded rather than blocking producers.
+"""
+import asyncio
+import io
+from decimal import Decimal
+
+import psycopg2
+
+from profiling import stage
+
+CHUNK_ROWS = 20000      # rows per COPY
+QUEUE_CHUNKS = 4        # chunks waiting for the writer before producers block
+
+
+def copy_sql(table, columns):
+    return f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+
+
+def _csv_field(v):
+    # Only an unquoted empty field is NULL in COPY csv; strings are always quoted so ''
+    # stays an empty string. (csv.QUOTE_NONNUMERIC quotes None too, so it can't be used.)
+    if v is None:
+        return ""
+    if isinstance(v, (int, float, Decimal)):
+        return str(v)
+    return '"' + str(v).replace('"', '""') + '"'
+
+
+def copy_rows(cur, table, columns, rows):
+    """COPY rows (tuples in column order) into table. None is written as NULL."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write(",".join(map(_csv_field, row)))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(copy_sql(table, columns), buf)
+
+
+class CopyWriter:
+    """Streams rows into a table through a bounded queue and a background COPY task."""
+
+    def __init__(self, db_url, table, columns, chunk_rows=CHUNK_ROWS, queue_chunks=QUEUE_CHUNKS, copy=copy_rows):
+        self.db_url = db_url
+        self.table = table
+        self.columns = list(columns)
+        self.copy = copy
+        self.chunk_rows = chunk_rows
+        self.rows_written = 0
+        self.chunks_written = 0
+        self._queue = asyncio.Queue(maxsize=queue_chunks)
+        self._chunk = []
+        self._conn = None
+        self._task = None
+        self._error = None
+
+    async def __aenter__(self):
+        self._conn = await asyncio.to_thread(psycopg2.connect, self.db_url)
+        self._task = asyncio.create_task(self._drain())
+        return self
+
+    async def __aexit__(self, exc_type, *exc):
+        await self.close(flush=exc_type is None)
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    async def put(self, row):
+        self._chunk.append(row)
+        if len(self._chunk) >= self.chunk_rows:
+            await self._submit()
+
+    async def put_many(self, rows):
+        """Queue rows as a unit: they are never split across two chunks (one filing stays in one COPY)."""
+        self._chunk.extend(rows)
+        if len(self._chunk) >= self.chunk_rows:
+            await self._submit()
+
+    async def flush(self):
+        """Queue the partial chunk and wait until everything queued so far is committed."""
+        if self._chunk:
+            await self._submit()
+        await self._queue.join()
+        self._check()
+
+    async def _submit(self):
+        self._check()
+        chunk, self._chunk = self._chunk, []
+        await self._queue.put(chunk)
+
+    @stage("db")
+    def _copy(self, chunk):
+        with self._conn.cursor() as cur:
+            self.copy(cur, self.table, self.columns, chunk)
+        self._conn.commit()
+
+    async def _drain(self):
+        while True:
+            chunk = await self._queue.get()
+            try:
+                if chunk is None:
+                    return
+                if self._error is None:
+                    await asyncio.to_thread(self._copy, chunk)
+                    self.rows_written += len(chunk)
+                    self.chunks_written += 1
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    async def close(self, flush=True):
+        if self._task is None:
+            return
+        try:
+            if flush and self._chunk and self._error is None:
+                await self._submit()
+            self._chunk = []
+            await self._queue.put(None)
+            await self._task
+        finally:
+            self._task = None
+            await asyncio.to_thread(self._conn.close)
+        if flush:
+            self._check()
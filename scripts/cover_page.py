@@ -0,0 +1,107 @@
+"""
+One-pass cover-page extraction for SEC 13F primary_doc.xml.
+
+primary_doc.xml carries everything we need to know about a filing before the
+information table is downloaded:
+
+  headerData   submissionType (13F-HR, 13F-HR/A, 13F-NT, ...), periodOfReport
+  coverPage    isAmendment, amendmentType (RESTATEMENT / NEW HOLDINGS), reportType
+  summaryPage  otherIncludedManagersCount, tableEntryTotal, tableValueTotal
+
+parse_cover_page walks the document once with iterparse, matches local tag
+names (no namespace stripping, no tree kept around) and stops at the end of
+summaryPage, so the signature block and document list are never parsed.
+
+Usage:
+    from cover_page import parse_cover_page, is_notice
+
+    cover = parse_cover_page(r.content)
+    if is_notice(cover):
+        ...  # 13F-NT: no information table to fetch
+    cover["table_entry_total"], cover["table_value_total"]
+"""
+import io
+from datetime import datetime
+
+from lxml import etree
+
+# lowercased local tag name -> field name (first occurrence wins)
+COVER_TAGS = {
+    "submissiontype": "submission_type",
+    "periodofreport": "period_of_report",
+    "isamendment": "is_amendment",
+    "amendmenttype": "amendment_type",
+    "reporttype": "report_type",
+    "otherincludedmanagerscount": "other_managers_count",
+    "tableentrytotal": "table_entry_total",
+    "tablevaluetotal": "table_value_total",
+    # Pre-2013 / malformed filings
+    "valuetotal": "table_value_total",
+    "securitiesownedaggregatevalue": "table_value_total",
+}
+COVER_FIELDS = tuple(dict.fromkeys(COVER_TAGS.values()))
+INT_FIELDS = ("other_managers_count", "table_entry_total", "table_value_total")
+STOP_TAG = "summarypage"
+
+
+def _to_int(text):
+    try:
+        return int(text.replace(",", "").replace(" ", "").split(".")[0])
+    except ValueError:
+        return None
+
+
+def _to_date(text):
+    for fmt in ("%m-%d-%Y", "%Y-%m-%d", "%m/%d/%Y"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_cover_page(content):
+    """Extract cover/summary page fields from primary_doc.xml bytes.
+
+    Returns a dict with every key in COVER_FIELDS (None when absent), or None
+    when the document has none of them.
+    """
+    raw = {}
+    try:
+        for _, elem in etree.iterparse(io.BytesIO(content), events=("end",), recover=True):
+            tag = elem.tag
+            if not isinstance(tag, str):
+                continue
+            local = tag.rsplit('}', 1)[-1].lower()
+            field = COVER_TAGS.get(local)
+            if field and field not in raw and elem.text and elem.text.strip():
+                raw[field] = elem.text.strip()
+            if local == STOP_TAG:
+                break
+    except etree.XMLSyntaxError:
+        pass
+
+    if not raw:
+        return None
+
+    cover = dict.fromkeys(COVER_FIELDS)
+    cover.update(raw)
+    for field in INT_FIELDS:
+        if cover[field] is not None:
+            cover[field] = _to_int(cover[field])
+    if cover["period_of_report"] is not None:
+        cover["period_of_report"] = _to_date(cover["period_of_report"])
+    if cover["is_amendment"] is not None:
+        cover["is_amendment"] = cover["is_amendment"].upper() in ("Y", "YES", "TRUE", "1")
+    for field in ("submission_type", "amendment_type", "report_type"):
+        if cover[field] is not None:
+            cover[field] = cover[field].upper()
+    return cover
+
+
+def is_notice(cover):
+    """True for 13F-NT notices, which have no information table."""
+    if not cover:
+        return False
+    return ((cover["submission_type"] or "").startswith("13F-NT")
+            or "NOTICE" in (cover["report_type"] or ""))
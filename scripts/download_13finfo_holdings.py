@@ -3,9 +3,8 @@
 # Full optimized 13f.info holdings scraper:
 # - Fast HTML parsing (BeautifulSoup, NO pd.read_html)
 # - Retry + connection pooling
-# - Append-only checkpoint CSV (no full rewrites)
-# - Separate done-managers file for fast resume
-# - DB load from CSV in CHUNKS (no full CSV in memory)
+# - SQLite resume store (resume_store.py): rows + per-(manager, quarter) status in one transaction
+# - DB load from the store with COPY, in CHUNKS
 #
 # Usage:
 #   cd C:\Users\mokkapatin\Downloads\stock-analyzer-frontend\scripts
@@ -38,10 +37,15 @@ from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 from dotenv import load_dotenv
+
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from fingerprint_tree import INFO, clear_fingerprints
+from holdings_table import ensure_holdings_key
+from resume_store import DEFAULT_STORE, HOLDING_COLUMNS, ResumeStore
+
 load_dotenv()
 
 import psycopg2
-from psycopg2.extras import execute_values
 
 
 BASE = "https://13f.info"
@@ -49,9 +53,6 @@ UA = os.getenv("SCRAPER_UA", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) 13f-hold
 
 TABLE = "public.expected_13finfo_holdings"
 
-DEFAULT_OUT_CSV = "13finfo_holdings_checkpoint.csv"
-DEFAULT_DONE_TXT = "13finfo_holdings_done_managers.txt"
-DEFAULT_FAIL_TXT = "13finfo_holdings_failed_managers.txt"
 
 # Polite jitter (per request)
 MIN_JITTER = 0.03
@@ -106,7 +107,8 @@ def get_text(el) -> str:
 def get_soup(url: str, timeout=30) -> BeautifulSoup:
     r = SESSION.get(url, timeout=timeout)
     r.raise_for_status()
-    return BeautifulSoup(r.text, "html.parser")
+    with stage("parse"):
+        return BeautifulSoup(r.text, "html.parser")
 
 
 def parse_cik_from_manager_url(manager_url: str) -> str | None:
@@ -114,33 +116,6 @@ def parse_cik_from_manager_url(manager_url: str) -> str | None:
     return m.group(1) if m else None
 
 
-def append_lines(path: str, lines: list[str]):
-    if not lines:
-        return
-    with open(path, "a", encoding="utf-8") as f:
-        for line in lines:
-            f.write(line.rstrip("\n") + "\n")
-
-
-def load_done_set(done_path: str) -> set[str]:
-    if not os.path.exists(done_path):
-        return set()
-    done = set()
-    with open(done_path, "r", encoding="utf-8") as f:
-        for line in f:
-            u = line.strip()
-            if u:
-                done.add(u)
-    return done
-
-
-def append_checkpoint_csv(path: str, df: pd.DataFrame):
-    if df is None or df.empty:
-        return
-    write_header = not os.path.exists(path)
-    df.to_csv(path, mode="a", header=write_header, index=False)
-
-
 # -----------------------------
 # Collect manager URLs (paged)
 # -----------------------------
@@ -221,6 +196,7 @@ def _largest_table(soup: BeautifulSoup):
     return max(tables, key=lambda t: len(t.find_all("tr")))
 
 
+@stage("parse")
 def _table_to_df(table) -> pd.DataFrame:
     rows = table.find_all("tr")
     if not rows:
@@ -247,7 +223,8 @@ def _table_to_df(table) -> pd.DataFrame:
 def scrape_holdings_from_filing(filing_url: str) -> pd.DataFrame:
     r = SESSION.get(filing_url, timeout=60)
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    with stage("parse"):
+        soup = BeautifulSoup(r.text, "html.parser")
     tables = soup.find_all("table")
     if not tables:
         raise RuntimeError("No tables found on filing page")
@@ -285,6 +262,7 @@ def _pick_col(df: pd.DataFrame, patterns: list[str]) -> str | None:
     return None
 
 
+@stage("parse")
 def normalize_holdings_table(raw: pd.DataFrame, manager_url: str, cik: str | None, quarter: str, filing_url: str) -> pd.DataFrame:
     df = raw.copy()
     df.columns = [str(c).strip() for c in df.columns]
@@ -332,45 +310,16 @@ def normalize_holdings_table(raw: pd.DataFrame, manager_url: str, cik: str | Non
 
 
 # -----------------------------
-# DB load from CSV in chunks (no full file in memory)
+# DB load from the resume store (COPY, chunked)
 # -----------------------------
-def insert_chunk(cur, df: pd.DataFrame):
-    cols = [
-        "manager_url", "cik", "quarter", "filing_url",
-        "sym", "issuer_name", "class", "cusip",
-        "value_000", "pct", "shares", "principal", "option_type"
-    ]
-
-    for c in cols:
-        if c not in df.columns:
-            df[c] = None
-
-    df2 = df[cols].copy()
-
-    # Ensure numeric types
-    for c in ["value_000", "pct", "shares"]:
-        df2[c] = pd.to_numeric(df2[c], errors="coerce")
-
-    rows = list(df2.itertuples(index=False, name=None))
-    if not rows:
-        return 0
-
-    execute_values(
-        cur,
-        f"""
-        INSERT INTO {TABLE}
-        (manager_url, cik, quarter, filing_url,
-         sym, issuer_name, class, cusip,
-         value_000, pct, shares, principal, option_type)
-        VALUES %s
-        """,
-        rows,
-        page_size=5000,
-    )
-    return len(rows)
+def frame_to_rows(normdf: pd.DataFrame) -> list[tuple]:
+    """normalize_holdings_table output as row tuples in HOLDING_COLUMNS order (NaN -> None)"""
+    df = normdf[HOLDING_COLUMNS].astype(object)
+    return list(df.where(df.notna(), None).itertuples(index=False, name=None))
 
 
-def load_db_from_checkpoint_csv(csv_path: str, chunksize: int = 200_000):
+@stage("db")
+def load_db_from_store(store: ResumeStore):
     db_url = os.environ["DATABASE_URL"]
 
     conn = psycopg2.connect(db_url)
@@ -378,12 +327,11 @@ def load_db_from_checkpoint_csv(csv_path: str, chunksize: int = 200_000):
         with conn:
             with conn.cursor() as cur:
                 cur.execute(f"TRUNCATE TABLE {TABLE};")
+                ensure_holdings_key(cur, TABLE)
+                # Every 13f.info period is reloaded; the upserts refresh their fingerprints
+                clear_fingerprints(cur, INFO)
 
-                total_inserted = 0
-                for chunk in pd.read_csv(csv_path, chunksize=chunksize):
-                    n = insert_chunk(cur, chunk)
-                    total_inserted += n
-                    print(f"✅ Inserted chunk: {n} rows (total={total_inserted})")
+                store.copy_to_postgres(cur, TABLE)
 
                 cur.execute(f"SELECT COUNT(*) FROM {TABLE};")
                 count = cur.fetchone()[0]
@@ -400,23 +348,27 @@ def main():
     ap.add_argument("--quarter", required=True, help='e.g. "Q3 2025"')
     ap.add_argument("--max-workers", type=int, default=8)
     ap.add_argument("--limit", type=int, default=0, help="test: only first N managers (0=all)")
-    ap.add_argument("--out-csv", default=DEFAULT_OUT_CSV)
-    ap.add_argument("--done-file", default=DEFAULT_DONE_TXT)
-    ap.add_argument("--fail-file", default=DEFAULT_FAIL_TXT)
+    ap.add_argument("--store", default=DEFAULT_STORE, help="SQLite resume store")
     ap.add_argument("--checkpoint-every", type=int, default=200)
-    ap.add_argument("--db-chunksize", type=int, default=200_000)
+    add_profile_arguments(ap)
     args = ap.parse_args()
+    start_profiling_from_args(args)
 
     quarter = norm_quarter(args.quarter)
 
-    out_csv = args.out_csv
-    done_file = args.done_file
-    fail_file = args.fail_file
     max_workers = max(1, args.max_workers)
 
-    # Resume: done managers are tracked in done_file
-    done_set = load_done_set(done_file)
-    print(f"🔁 Resume mode: {len(done_set)} managers already done (from {done_file})")
+    store = ResumeStore(args.store)
+    try:
+        scrape_quarter(args, quarter, store, max_workers)
+    finally:
+        store.close()
+
+
+def scrape_quarter(args, quarter: str, store: ResumeStore, max_workers: int):
+    # Resume: per-(manager, quarter) state lives in the resume store
+    print(f"🔁 Resume mode: {len(store.done_managers(quarter))} managers already done for {quarter} "
+          f"(from {args.store})")
 
     print("Collecting manager URLs...")
     manager_urls = collect_manager_urls()
@@ -424,24 +376,17 @@ def main():
         manager_urls = manager_urls[: args.limit]
         print(f"⚠️ TEST MODE: limiting to first {args.limit} managers")
 
-    remaining = [u for u in manager_urls if u not in done_set]
+    remaining = store.remaining(quarter, manager_urls)
     print(f"▶️ Remaining managers: {len(remaining)} (of {len(manager_urls)} total)")
 
-    # If nothing to scrape, just load DB from CSV (if CSV exists)
+    # If nothing to scrape, just load DB from the store
     if not remaining:
-        if os.path.exists(out_csv):
-            if os.path.exists(out_csv):
-                print(f"📥 Loading DB from checkpoint CSV in chunks: {out_csv}")
-                load_db_from_checkpoint_csv(out_csv, chunksize=args.db_chunksize)
-            else:
-                print(f"⚠️ No checkpoint CSV created (0 holdings). Skipping DB load.")
-        else:
-            print(f"✅ No remaining managers and no checkpoint CSV found: {out_csv}")
+        print(f"📥 Loading DB from resume store: {args.store}")
+        load_db_from_store(store)
         return
 
-    scraped_rows_buffer = []
-    done_to_append = []
-    fail_to_append = []
+    # (manager_url, quarter, status, filing_url, rows, error), committed every --checkpoint-every
+    pending = []
 
     def worker(manager_url: str):
         jitter()
@@ -449,7 +394,7 @@ def main():
 
         filing_url = find_filing_link_for_quarter(manager_url, quarter)
         if not filing_url:
-            return manager_url, "no_filing", None
+            return manager_url, "no_filing", None, None
 
         raw = scrape_holdings_from_filing(filing_url)
         normdf = normalize_holdings_table(raw, manager_url, cik, quarter, filing_url)
@@ -462,7 +407,7 @@ def main():
     fail_count = 0
 
     with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futs = [ex.submit(worker, u) for u in remaining]
+        futs = {ex.submit(worker, u): u for u in remaining}
 
         for fut in as_completed(futs):
             done += 1
@@ -470,55 +415,38 @@ def main():
                 manager_url, status, filing_url, normdf = fut.result()
             except Exception as e:
                 fail_count += 1
-                msg = f"{remaining[done-1]}\t{repr(e)}"
                 print(f"[{done}/{total}] FAIL -> {e}")
-                fail_to_append.append(msg)
+                pending.append((futs[fut], quarter, "failed", None, None, repr(e)))
                 continue
 
             if status == "no_filing":
                 skip_count += 1
                 print(f"[{done}/{total}] SKIP {manager_url} -> no_filing")
-                done_to_append.append(manager_url)  # ok to mark done
+                pending.append((manager_url, quarter, "no_filing", None, None, None))  # ok to mark done
             else:
                 if normdf is None or len(normdf) == 0:
                     print(f"[{done}/{total}] WARN {manager_url} -> holdings 0 rows (will retry later) | filing_url={filing_url}")
                     # DO NOT mark done
-                    fail_to_append.append(f"{manager_url}\tzero_rows")
+                    pending.append((manager_url, quarter, "no_data", filing_url, None, "zero_rows"))
                 else:
                     ok_count += 1
                     print(f"[{done}/{total}] OK {manager_url} -> holdings {len(normdf)} rows")
-                    scraped_rows_buffer.append(normdf)
-                    done_to_append.append(manager_url)  # mark done only if real rows
+                    pending.append((manager_url, quarter, "ok", filing_url, frame_to_rows(normdf), None))
 
-            # checkpoint every N managers
+            # checkpoint every N managers: rows and status in one transaction
             if done % args.checkpoint_every == 0 or done == total:
-                if scraped_rows_buffer:
-                    batch_df = pd.concat(scraped_rows_buffer, ignore_index=True)
-                    append_checkpoint_csv(out_csv, batch_df)
-                    print(f"💾 Appended checkpoint: {out_csv} (+{len(batch_df)} rows)")
-                    scraped_rows_buffer = []
-
-                if done_to_append:
-                    append_lines(done_file, done_to_append)
-                    done_set.update(done_to_append)
-                    done_to_append = []
-
-                if fail_to_append:
-                    append_lines(fail_file, fail_to_append)
-                    fail_to_append = []
+                with stage("io"):
+                    store.record(pending)
+                print(f"💾 Checkpoint: {len(pending)} managers -> {args.store}")
+                pending = []
 
     print(f"✅ Scrape complete. ok={ok_count} skip={skip_count} fail={fail_count}")
-    if os.path.exists(out_csv) and os.path.getsize(out_csv) > 0:
-        # also ensure it has at least 2 lines (header + 1 row)
-        with open(out_csv, "r", encoding="utf-8") as f:
-            line_count = sum(1 for _ in f)
-        if line_count >= 2:
-            print(f"📥 Loading DB from checkpoint CSV in chunks: {out_csv}")
-            load_db_from_checkpoint_csv(out_csv, chunksize=args.db_chunksize)
-        else:
-            print("⚠️ Checkpoint CSV has header only (0 rows). Skipping DB load.")
+    counts = store.status_counts()
+    if counts.get("ok", (0, 0))[1]:
+        print(f"📥 Loading DB from resume store: {args.store}")
+        load_db_from_store(store)
     else:
-        print("⚠️ No checkpoint CSV created (0 holdings). Skipping DB load.")
+        print("⚠️ Resume store has no holdings (0 rows). Skipping DB load.")
 
 
 if __name__ == "__main__":
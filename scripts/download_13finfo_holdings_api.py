@@ -16,20 +16,22 @@ import time
 import random
 from urllib.parse import urljoin
 
-import pandas as pd
-import requests
 from bs4 import BeautifulSoup
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
 from dotenv import load_dotenv
+
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from add_holdings_from_13finfo_filing import normalize_holding_rows
+from fingerprint_tree import INFO, clear_fingerprints
+from holdings_table import ensure_holdings_key
+from resume_store import DEFAULT_STORE, HOLDING_COLUMNS, ResumeStore
+from thirteenf_client import SyncThirteenFClient
+
 load_dotenv()
 
 import psycopg2
-from psycopg2.extras import execute_values
 
 
 BASE = "https://13f.info"
@@ -37,37 +39,13 @@ UA = os.getenv("SCRAPER_UA", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) 13f-hold
 
 TABLE = "public.expected_13finfo_holdings"
 
-DEFAULT_OUT_CSV = "13finfo_holdings_checkpoint.csv"
-DEFAULT_DONE_TXT = "13finfo_holdings_done_managers.txt"
-DEFAULT_FAIL_TXT = "13finfo_holdings_failed_managers.txt"
-
 # Polite jitter
 MIN_JITTER = 0.05
 MAX_JITTER = 0.2
 
 
-def build_session() -> requests.Session:
-    s = requests.Session()
-    s.headers.update({"User-Agent": UA})
-
-    retry = Retry(
-        total=5,
-        backoff_factor=0.6,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET"],
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(
-        max_retries=retry,
-        pool_connections=50,
-        pool_maxsize=50,
-    )
-    s.mount("https://", adapter)
-    s.mount("http://", adapter)
-    return s
-
-
-SESSION = build_session()
+# Shared 13f.info client (pooling, retries, 429 backoff); worker threads block on it
+CLIENT = SyncThirteenFClient(user_agent=UA)
 
 
 def jitter():
@@ -81,10 +59,12 @@ def norm_quarter(q: str) -> str:
     return q
 
 
-def get_soup(url: str, timeout=30) -> BeautifulSoup:
-    r = SESSION.get(url, timeout=timeout)
-    r.raise_for_status()
-    return BeautifulSoup(r.text, "html.parser")
+def get_soup(url: str) -> BeautifulSoup:
+    html = CLIENT.fetch_text(url)
+    if html is None:
+        raise RuntimeError(f"fetch failed: {url}")
+    with stage("parse"):
+        return BeautifulSoup(html, "html.parser")
 
 
 def parse_cik_from_manager_url(manager_url: str) -> str | None:
@@ -92,33 +72,6 @@ def parse_cik_from_manager_url(manager_url: str) -> str | None:
     return m.group(1) if m else None
 
 
-def append_lines(path: str, lines: list[str]):
-    if not lines:
-        return
-    with open(path, "a", encoding="utf-8") as f:
-        for line in lines:
-            f.write(line.rstrip("\n") + "\n")
-
-
-def load_done_set(done_path: str) -> set[str]:
-    if not os.path.exists(done_path):
-        return set()
-    done = set()
-    with open(done_path, "r", encoding="utf-8") as f:
-        for line in f:
-            u = line.strip()
-            if u:
-                done.add(u)
-    return done
-
-
-def append_checkpoint_csv(path: str, df: pd.DataFrame):
-    if df is None or df.empty:
-        return
-    write_header = not os.path.exists(path)
-    df.to_csv(path, mode="a", header=write_header, index=False)
-
-
 def collect_manager_urls() -> list[str]:
     """Collect all manager URLs from 13f.info"""
     urls = []
@@ -195,110 +148,29 @@ def fetch_holdings_from_api(filing_id: str) -> list[dict] | None:
     api_url = f"{BASE}/data/13f/{filing_id}"
     
     try:
-        r = SESSION.get(api_url, timeout=30)
-        if r.status_code != 200:
-            return None
-        
-        data = r.json()
-        
         # Data format: {"data": [[sym, issuer, class, cusip, value, pct, shares, principal, option], ...]}
-        rows = data.get("data", [])
+        rows = CLIENT.fetch_holdings_rows(api_url)
         
         if not rows:
             return None
         
-        # Column order from the API
-        columns = ["sym", "issuer_name", "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]
-        
-        holdings = []
-        for row in rows:
-            if len(row) >= 9:
-                holding = {
-                    "sym": row[0],
-                    "issuer_name": row[1],
-                    "class": row[2],
-                    "cusip": row[3],
-                    "value_000": row[4],
-                    "pct": row[5],
-                    "shares": row[6],
-                    "principal": row[7],
-                    "option_type": row[8],
-                }
-                holdings.append(holding)
-        
-        return holdings
+        # List rows map by API column order, dict rows (generic fallback) by key
+        return normalize_holding_rows(rows)
         
     except Exception as e:
         return None
 
 
-def holdings_to_dataframe(holdings: list[dict], manager_url: str, cik: str, quarter: str, filing_url: str) -> pd.DataFrame:
-    """Convert holdings list to normalized DataFrame"""
-    if not holdings:
-        return pd.DataFrame()
-    
-    df = pd.DataFrame(holdings)
-    
-    # Add metadata columns
-    df["manager_url"] = manager_url
-    df["cik"] = cik
-    df["quarter"] = quarter
-    df["filing_url"] = filing_url
-    
-    # Ensure all expected columns exist
-    for col in ["sym", "issuer_name", "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]:
-        if col not in df.columns:
-            df[col] = None
-    
-    # Clean numeric fields
-    for c in ["value_000", "pct", "shares"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
-    
-    # Reorder columns
-    col_order = ["manager_url", "cik", "quarter", "filing_url", "sym", "issuer_name", "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]
-    df = df[col_order]
-    
-    return df
-
-
-def insert_chunk(cur, df: pd.DataFrame):
-    """Insert DataFrame chunk into database"""
-    cols = [
-        "manager_url", "cik", "quarter", "filing_url",
-        "sym", "issuer_name", "class", "cusip",
-        "value_000", "pct", "shares", "principal", "option_type"
-    ]
-
-    for c in cols:
-        if c not in df.columns:
-            df[c] = None
-
-    df2 = df[cols].copy()
-
-    for c in ["value_000", "pct", "shares"]:
-        df2[c] = pd.to_numeric(df2[c], errors="coerce")
-
-    rows = list(df2.itertuples(index=False, name=None))
-    if not rows:
-        return 0
-
-    execute_values(
-        cur,
-        f"""
-        INSERT INTO {TABLE}
-        (manager_url, cik, quarter, filing_url,
-         sym, issuer_name, class, cusip,
-         value_000, pct, shares, principal, option_type)
-        VALUES %s
-        """,
-        rows,
-        page_size=5000,
-    )
-    return len(rows)
-
-
-def load_db_from_checkpoint_csv(csv_path: str, chunksize: int = 200_000):
-    """Load CSV into database in chunks"""
+@stage("parse")
+def holdings_to_rows(holdings: list[dict], manager_url: str, cik: str, quarter: str, filing_url: str) -> list[tuple]:
+    """Holdings as row tuples in resume store (HOLDING_COLUMNS) order"""
+    meta = {"manager_url": manager_url, "cik": cik, "quarter": quarter, "filing_url": filing_url}
+    return [tuple(meta[c] if c in meta else h.get(c) for c in HOLDING_COLUMNS) for h in holdings]
+
+
+@stage("db")
+def load_db_from_store(store: ResumeStore):
+    """Replace the table's contents with every 'ok' row in the resume store"""
     db_url = os.environ["DATABASE_URL"]
 
     conn = psycopg2.connect(db_url)
@@ -306,12 +178,11 @@ def load_db_from_checkpoint_csv(csv_path: str, chunksize: int = 200_000):
         with conn:
             with conn.cursor() as cur:
                 cur.execute(f"TRUNCATE TABLE {TABLE};")
+                ensure_holdings_key(cur, TABLE)
+                # Every 13f.info period is reloaded; the upserts refresh their fingerprints
+                clear_fingerprints(cur, INFO)
 
-                total_inserted = 0
-                for chunk in pd.read_csv(csv_path, chunksize=chunksize):
-                    n = insert_chunk(cur, chunk)
-                    total_inserted += n
-                    print(f"✅ Inserted chunk: {n} rows (total={total_inserted})")
+                store.copy_to_postgres(cur, TABLE)
 
                 cur.execute(f"SELECT COUNT(*) FROM {TABLE};")
                 count = cur.fetchone()[0]
@@ -325,23 +196,27 @@ def main():
     ap.add_argument("--quarter", required=True, help='e.g. "Q3 2025"')
     ap.add_argument("--max-workers", type=int, default=8)
     ap.add_argument("--limit", type=int, default=0, help="test: only first N managers (0=all)")
-    ap.add_argument("--out-csv", default=DEFAULT_OUT_CSV)
-    ap.add_argument("--done-file", default=DEFAULT_DONE_TXT)
-    ap.add_argument("--fail-file", default=DEFAULT_FAIL_TXT)
+    ap.add_argument("--store", default=DEFAULT_STORE, help="SQLite resume store")
     ap.add_argument("--checkpoint-every", type=int, default=200)
-    ap.add_argument("--db-chunksize", type=int, default=200_000)
+    add_profile_arguments(ap)
     args = ap.parse_args()
+    start_profiling_from_args(args)
 
     quarter = norm_quarter(args.quarter)
 
-    out_csv = args.out_csv
-    done_file = args.done_file
-    fail_file = args.fail_file
     max_workers = max(1, args.max_workers)
 
-    # Resume: done managers are tracked in done_file
-    done_set = load_done_set(done_file)
-    print(f"🔁 Resume mode: {len(done_set)} managers already done (from {done_file})")
+    store = ResumeStore(args.store)
+    try:
+        scrape_quarter(args, quarter, store, max_workers)
+    finally:
+        store.close()
+
+
+def scrape_quarter(args, quarter: str, store: ResumeStore, max_workers: int):
+    # Resume: per-(manager, quarter) state lives in the resume store
+    print(f"🔁 Resume mode: {len(store.done_managers(quarter))} managers already done for {quarter} "
+          f"(from {args.store})")
 
     print("Collecting manager URLs...")
     manager_urls = collect_manager_urls()
@@ -351,20 +226,16 @@ def main():
         manager_urls = manager_urls[: args.limit]
         print(f"⚠️ TEST MODE: limiting to first {args.limit} managers")
 
-    remaining = [u for u in manager_urls if u not in done_set]
+    remaining = store.remaining(quarter, manager_urls)
     print(f"▶️ Remaining managers: {len(remaining)} (of {len(manager_urls)} total)")
 
     if not remaining:
-        if os.path.exists(out_csv) and os.path.getsize(out_csv) > 0:
-            print(f"📥 Loading DB from checkpoint CSV: {out_csv}")
-            load_db_from_checkpoint_csv(out_csv, chunksize=args.db_chunksize)
-        else:
-            print(f"✅ No remaining managers and no checkpoint CSV found")
+        print(f"📥 Loading DB from resume store: {args.store}")
+        load_db_from_store(store)
         return
 
-    scraped_rows_buffer = []
-    done_to_append = []
-    fail_to_append = []
+    # (manager_url, quarter, status, filing_url, rows, error), committed every --checkpoint-every
+    pending = []
 
     def worker(manager_url: str):
         jitter()
@@ -380,9 +251,8 @@ def main():
         if not holdings:
             return manager_url, "no_data", filing_url, None, None
 
-        # Convert to DataFrame
-        df = holdings_to_dataframe(holdings, manager_url, cik, quarter, filing_url)
-        return manager_url, "ok", filing_url, df, len(holdings)
+        rows = holdings_to_rows(holdings, manager_url, cik, quarter, filing_url)
+        return manager_url, "ok", filing_url, rows, len(holdings)
 
     total = len(remaining)
     done = 0
@@ -391,61 +261,47 @@ def main():
     fail_count = 0
 
     with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futs = [ex.submit(worker, u) for u in remaining]
+        futs = {ex.submit(worker, u): u for u in remaining}
 
         for fut in as_completed(futs):
             done += 1
             try:
-                manager_url, status, filing_url, df, num_holdings = fut.result()
+                manager_url, status, filing_url, rows, num_holdings = fut.result()
             except Exception as e:
                 fail_count += 1
                 print(f"[{done}/{total}] FAIL -> {e}")
-                fail_to_append.append(f"{remaining[done-1]}\t{repr(e)}")
+                pending.append((futs[fut], quarter, "failed", None, None, repr(e)))
                 continue
 
             if status == "no_filing":
                 skip_count += 1
                 print(f"[{done}/{total}] SKIP {manager_url} -> no filing for {quarter}")
-                done_to_append.append(manager_url)
+                pending.append((manager_url, quarter, "no_filing", None, None, None))
             elif status == "no_data":
                 fail_count += 1
                 print(f"[{done}/{total}] WARN {manager_url} -> API returned no data | filing_url={filing_url}")
-                fail_to_append.append(f"{manager_url}\tno_data")
+                pending.append((manager_url, quarter, "no_data", filing_url, None, "no_data"))
             else:
                 ok_count += 1
                 print(f"[{done}/{total}] OK {manager_url} -> {num_holdings} holdings")
-                scraped_rows_buffer.append(df)
-                done_to_append.append(manager_url)
+                pending.append((manager_url, quarter, "ok", filing_url, rows, None))
 
-            # Checkpoint every N managers
+            # Checkpoint every N managers: rows and status in one transaction
             if done % args.checkpoint_every == 0 or done == total:
-                if scraped_rows_buffer:
-                    batch_df = pd.concat(scraped_rows_buffer, ignore_index=True)
-                    append_checkpoint_csv(out_csv, batch_df)
-                    print(f"💾 Checkpoint: {out_csv} (+{len(batch_df)} rows)")
-                    scraped_rows_buffer = []
-
-                if done_to_append:
-                    append_lines(done_file, done_to_append)
-                    done_set.update(done_to_append)
-                    done_to_append = []
-
-                if fail_to_append:
-                    append_lines(fail_file, fail_to_append)
-                    fail_to_append = []
+                with stage("io"):
+                    store.record(pending)
+                print(f"💾 Checkpoint: {len(pending)} managers -> {args.store}")
+                pending = []
 
     print(f"\n✅ Scrape complete. ok={ok_count} skip={skip_count} fail={fail_count}")
+    CLIENT.report()
     
-    if os.path.exists(out_csv) and os.path.getsize(out_csv) > 0:
-        with open(out_csv, "r", encoding="utf-8") as f:
-            line_count = sum(1 for _ in f)
-        if line_count >= 2:
-            print(f"📥 Loading DB from checkpoint CSV: {out_csv}")
-            load_db_from_checkpoint_csv(out_csv, chunksize=args.db_chunksize)
-        else:
-            print("⚠️ Checkpoint CSV has header only (0 rows). Skipping DB load.")
+    counts = store.status_counts()
+    if counts.get("ok", (0, 0))[1]:
+        print(f"📥 Loading DB from resume store: {args.store}")
+        load_db_from_store(store)
     else:
-        print("⚠️ No checkpoint CSV created. Skipping DB load.")
+        print("⚠️ Resume store has no holdings. Skipping DB load.")
 
 
 if __name__ == "__main__":
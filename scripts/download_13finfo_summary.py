@@ -1,50 +1,69 @@
-import time
-import re
-import random
+"""
+Download 13f.info manager summaries (one row per manager filing) into
+public.expected_13finfo_summary.
+
+The crawl is one asyncio pipeline on the shared client (thirteenf_client):
+letter pages are fetched concurrently and every manager link is queued as
+soon as its letter page is parsed; MANAGER_WORKERS workers fetch and parse
+manager pages off that queue and hand each manager's rows to a CopyWriter,
+which COPYs them into an unlogged staging table in the background. Nothing
+waits for a whole phase to finish, and no more than a few COPY chunks of
+rows are ever in memory.
+
+The staging table doubles as the resume checkpoint: managers with rows in
+it are skipped by the next run (--restart empties it). Once the crawl is
+done the live table is synced from it in SQL (table_sync.sync_from_stage:
+only new, changed and vanished rows are written), or with --full-refresh
+rebuilt in a shadow table and swapped in with an atomic rename. The staging
+table is emptied after a successful sync.
+
+If any letter or manager page failed, rows missing from the crawl are kept
+(no tombstones, no full refresh): they were not seen, not removed.
+
+Usage:
+    python download_13finfo_summary.py
+    python download_13finfo_summary.py --full-refresh
+    python download_13finfo_summary.py --restart          # ignore a previous partial crawl
+"""
+import argparse
+import asyncio
 import os
-import requests
-import pandas as pd
-import psycopg2
-from psycopg2.extras import execute_values
-from bs4 import BeautifulSoup
+import re
+import time
+from collections import Counter
+from datetime import datetime
 from urllib.parse import urljoin
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
 from dotenv import load_dotenv
+
+from copy_writer import CopyWriter
+from holdings_table import normalize_cik
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from table_sync import latest_rows_sql, replace_table, sync_from_stage
+from thirteenf_client import ThirteenFClient
+from thirteenf_html import first_table_rows, manager_links
+
 load_dotenv()
 
 BASE = "https://13f.info"
 LETTERS = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ") + ["0"]
 
-# Be polite to the site (avoid hammering)
-MIN_SLEEP = 0.0
-MAX_SLEEP = 0.1
-MAX_WORKERS = 8   # start with 8; if stable, try 12
-
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) 13f-scraper/1.0",
-    "Accept-Language": "en-US,en;q=0.9",
-}
-
-session = requests.Session()
-session.headers.update(HEADERS)
+# Request concurrency/backoff are tuned in thirteenf_client
+MANAGER_WORKERS = 64        # manager pages being fetched/parsed at once
+QUEUE_MANAGERS = 1000       # manager URLs waiting for a worker before letter parsing blocks
+PROGRESS_EVERY = 500        # managers between progress lines
 
-DB = {
-    "host": os.getenv("PGHOST", "localhost"),
-    "port": int(os.getenv("PGPORT", "5432")),
-    "dbname": os.getenv("PGDATABASE", "stock_analyzer"),
-    "user": os.getenv("PGUSER", "postgres"),
-    "password": os.getenv("PGPASSWORD", ""),
-}
+UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) 13f-scraper/1.0"
 
-OUT_CSV = "13finfo_summary_checkpoint.csv"
+SUMMARY_TABLE = "public.expected_13finfo_summary"
+STAGE_TABLE = "public.expected_13finfo_summary_stage"
+SUMMARY_COLUMNS = ["cik", "quarter", "holdings", "value_usd", "top_holdings", "form_type", "date_filed", "filing_id"]
+SUMMARY_KEY = ["cik", "quarter", "filing_id"]
+STAGE_COLUMNS = ["manager_url"] + SUMMARY_COLUMNS
 
-def sleep_a_bit():
-    time.sleep(random.uniform(MIN_SLEEP, MAX_SLEEP))
+RE_MANAGER_CIK = re.compile(r"/manager/(\d{10})-")
 
-def get_soup(url: str) -> BeautifulSoup:
-    r = session.get(url, timeout=30)
-    r.raise_for_status()
-    return BeautifulSoup(r.text, "lxml")
 
 def parse_int(s: str):
     if s is None:
@@ -55,56 +74,38 @@ def parse_int(s: str):
     s = s.replace(",", "")
     try:
         return int(s)
-    except:
+    except ValueError:
         return None
 
-def collect_manager_urls():
-    manager_urls = set()
-    for ch in LETTERS:
-        url = f"{BASE}/managers/{ch}"
-        print(f"Listing: {url}")
-        soup = get_soup(url)
 
-        # Manager links look like: /manager/0001540358-a16z-capital-management-l-l-c
-        for a in soup.select('a[href^="/manager/"]'):
-            href = a.get("href")
-            if not href:
-                continue
-            full = urljoin(BASE, href)
-            manager_urls.add(full)
-
-        sleep_a_bit()
-
-    return sorted(manager_urls)
+def parse_date(s: str):
+    s = (s or "").strip()
+    for fmt in ("%m/%d/%Y", "%Y-%m-%d", "%m-%d-%Y"):
+        try:
+            return datetime.strptime(s, fmt).date()
+        except ValueError:
+            continue
+    return None
 
-def scrape_manager_page(url: str):
-    soup = get_soup(url)
 
+@stage("parse")
+def parse_summary_rows(html: str, url: str):
+    """Summary rows of one manager page, as tuples in STAGE_COLUMNS order."""
     # CIK is printed on the page, but easiest is from the URL:
     # https://13f.info/manager/0001540358-a16z-capital...
-    m = re.search(r"/manager/(\d{10})-", url)
-    cik = m.group(1) if m else None
+    m = RE_MANAGER_CIK.search(url)
+    cik = normalize_cik(m.group(1)) if m else None
 
     rows = []
-    table = soup.find("table")
-    if not table:
-        return rows
-
     # The first table rows are the summary rows we need:
-    # Quarter | Holdings | Value ($000) | ...
-    for tr in table.select("tr"):
-        tds = tr.find_all(["td", "th"])
-        if len(tds) < 3:
+    # Quarter | Holdings | Value ($000) | Top Holdings | Form Type | Date Filed | Filing ID
+    for tds in first_table_rows(html):
+        if len(tds) < 7:
             continue
 
-        quarter = tds[0].get_text(strip=True)
-        holdings = parse_int(tds[1].get_text(strip=True))
-        value_thousands = parse_int(tds[2].get_text(strip=True))
-
-        top_holdings = tds[3].get_text(strip=True)
-        form_type = tds[4].get_text(strip=True)
-        date_filed = tds[5].get_text(strip=True)
-        filing_id = tds[6].get_text(strip=True)
+        quarter = tds[0].strip()
+        holdings = parse_int(tds[1])
+        value_thousands = parse_int(tds[2])
 
         # Skip header row and junk
         if quarter.lower() == "quarter":
@@ -112,164 +113,155 @@ def scrape_manager_page(url: str):
         if not quarter or holdings is None or value_thousands is None:
             continue
 
-        value_usd = value_thousands * 1000  # 13f.info shows Value ($000)
+        rows.append((
+            url,
+            cik,
+            quarter,
+            holdings,
+            value_thousands * 1000,  # 13f.info shows Value ($000)
+            tds[3] or None,
+            tds[4] or None,
+            parse_date(tds[5]),
+            tds[6].strip() or None,
+        ))
+    return rows
 
-        rows.append({
-            "manager_url": url,   # ← REQUIRED for resume
-            "cik": cik,
-            "quarter": quarter,
-            "holdings": holdings,
-            "value_usd": value_usd,
-            "top_holdings": top_holdings,
-            "form_type": form_type,
-            "date_filed": date_filed,
-            "filing_id": filing_id,
-        })
 
-    return rows
+def ensure_stage_table(cur, restart=False):
+    """Create (or with restart, empty) the staging table; returns manager URLs already staged."""
+    cur.execute(f"CREATE UNLOGGED TABLE IF NOT EXISTS {STAGE_TABLE} (LIKE {SUMMARY_TABLE})")
+    cur.execute(f"ALTER TABLE {STAGE_TABLE} ADD COLUMN IF NOT EXISTS manager_url TEXT")
+    if restart:
+        cur.execute(f"TRUNCATE {STAGE_TABLE}")
+        return set()
+    cur.execute(f"SELECT DISTINCT manager_url FROM {STAGE_TABLE}")
+    return {url for (url,) in cur.fetchall()}
+
+
+async def crawl(client: ThirteenFClient, writer: CopyWriter, staged: set[str]) -> Counter:
+    """Letter pages -> manager queue -> manager workers -> COPY writer, all concurrently."""
+    queue = asyncio.Queue(maxsize=QUEUE_MANAGERS)
+    seen = set(staged)
+    counts = Counter()
+    start_time = time.time()
+
+    async def letters():
+        async def letter(ch):
+            url = f"{BASE}/managers/{ch}"
+            html = await client.fetch_text(url)
+            if html is None:
+                counts["letters_failed"] += 1
+                print(f"  ❌ {url}")
+                return
+            with stage("parse"):
+                links = manager_links(html)
+            new = 0
+            for href, _ in links:
+                # Manager links look like: /manager/0001540358-a16z-capital-management-l-l-c
+                if not href:
+                    continue
+                manager_url = urljoin(BASE, href)
+                if manager_url in seen:
+                    continue
+                seen.add(manager_url)
+                new += 1
+                counts["managers_queued"] += 1
+                await queue.put(manager_url)
+            print(f"  ✓ {url}: {len(links)} managers ({new} to fetch)")
+
+        await asyncio.gather(*(letter(ch) for ch in LETTERS))
+        for _ in range(MANAGER_WORKERS):
+            await queue.put(None)
+
+    async def worker():
+        while (url := await queue.get()) is not None:
+            html = await client.fetch_text(url)
+            if html is None:
+                counts["managers_failed"] += 1
+            else:
+                rows = parse_summary_rows(html, url)
+                # One manager's rows stay in one COPY chunk, so resume never sees half a manager
+                await writer.put_many(rows)
+                counts["managers_ok"] += 1
+                counts["rows"] += len(rows)
+
+            done = counts["managers_ok"] + counts["managers_failed"]
+            if done % PROGRESS_EVERY == 0:
+                elapsed = time.time() - start_time
+                print(f"  [{done:,}/{counts['managers_queued']:,}] rows: {counts['rows']:,} | "
+                      f"written: {writer.rows_written:,} | failed: {counts['managers_failed']:,} | "
+                      f"{done / elapsed if elapsed > 0 else 0:.0f} managers/s")
+
+    await asyncio.gather(letters(), *(worker() for _ in range(MANAGER_WORKERS)))
+    return counts
+
+
+def sync_expected_table(db_url, full_refresh=False, delete_missing=True):
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                if full_refresh:
+                    loaded = replace_table(cur, SUMMARY_TABLE, SUMMARY_COLUMNS,
+                                           source=latest_rows_sql(STAGE_TABLE, SUMMARY_KEY, SUMMARY_COLUMNS))
+                    result = f"full refresh, {loaded} rows"
+                else:
+                    # Only inserts, changed rows and tombstones are written
+                    result = sync_from_stage(cur, SUMMARY_TABLE, STAGE_TABLE, SUMMARY_KEY, SUMMARY_COLUMNS,
+                                             delete_missing=delete_missing)
+                cur.execute(f"TRUNCATE {STAGE_TABLE}")
+        print(f"DB updated: {SUMMARY_TABLE} ({result})")
+    finally:
+        conn.close()
 
-def overwrite_expected_table(df: pd.DataFrame):
-    # Ensure correct dtypes for DB
-    df = df.copy()
-    df["cik"] = df["cik"].astype(str).str.strip()
-    df["quarter"] = df["quarter"].astype(str).str.strip()
-    df["holdings"] = pd.to_numeric(df["holdings"], errors="coerce").astype("Int64")
-    df["value_usd"] = pd.to_numeric(df["value_usd"], errors="coerce")
-    df["top_holdings"] = df["top_holdings"].astype(str).fillna("")
-    df["form_type"] = df["form_type"].astype(str).fillna("")
-    df["filing_id"] = df["filing_id"].astype(str).fillna("")
-
-    # date_filed -> python date (not timestamp)
-    df["date_filed"] = pd.to_datetime(df["date_filed"], errors="coerce").dt.date
-
-    rows = [
-        (
-            r.cik,
-            r.quarter,
-            None if pd.isna(r.holdings) else int(r.holdings),
-            None if pd.isna(r.value_usd) else float(r.value_usd),
-            None if r.top_holdings == "nan" else r.top_holdings,
-            None if r.form_type == "nan" else r.form_type,
-            r.date_filed,  # already date or None
-            None if r.filing_id == "nan" else r.filing_id,
-        )
-        for r in df.itertuples(index=False)
-    ]
-
-    conn = psycopg2.connect(os.environ["DATABASE_URL"])
-    conn.autocommit = False
+
+async def main_async(args, db_url):
+    conn = psycopg2.connect(db_url)
     try:
-        with conn.cursor() as cur:
-            # Overwrite (fast + simple)
-            cur.execute("TRUNCATE TABLE public.expected_13finfo_summary;")
-
-            insert_sql = """
-                INSERT INTO public.expected_13finfo_summary
-                (cik, quarter, holdings, value_usd, top_holdings, form_type, date_filed, filing_id)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-            """
-            # Insert in chunks to avoid huge single execute
-            chunk_size = 5000
-            for i in range(0, len(rows), chunk_size):
-                cur.executemany(insert_sql, rows[i:i+chunk_size])
-
-        conn.commit()
-        print(f"DB updated: public.expected_13finfo_summary ({len(rows)} rows)")
-    except Exception:
-        conn.rollback()
-        raise
+        with conn:
+            with conn.cursor() as cur:
+                staged = ensure_stage_table(cur, restart=args.restart)
     finally:
         conn.close()
+    if staged:
+        print(f"🔁 Resume mode: {len(staged)} managers already staged")
+
+    print(f"\n📥 Crawling {len(LETTERS)} letter pages and their managers...")
+    start_time = time.time()
+    async with ThirteenFClient(user_agent=UA, headers={"Accept-Language": "en-US,en;q=0.9"}) as client:
+        async with CopyWriter(db_url, STAGE_TABLE, STAGE_COLUMNS) as writer:
+            counts = await crawl(client, writer, staged)
+        client.report()
+
+    print(f"\n✅ Crawl done in {(time.time() - start_time)/60:.1f} min: {counts['managers_ok']:,} managers, "
+          f"{counts['rows']:,} rows staged in {writer.chunks_written:,} COPY chunks")
+    return counts
+
 
 def main():
-    # If checkpoint exists, load it and skip scraping
-    existing_df = None
-    completed_urls = set()
-
-    manager_urls = collect_manager_urls()
-
-    existing_df = None
-    completed_urls = set()
-
-    if os.path.exists(OUT_CSV):
-        existing_df = pd.read_csv(OUT_CSV)
-        if "manager_url" in existing_df.columns:
-            completed_urls = set(existing_df["manager_url"].dropna().unique())
-        print(f"🔁 Resume mode: {len(completed_urls)} managers already scraped")
-
-    # Always filter remaining managers (whether CSV exists or not)
-    if completed_urls:
-        manager_urls = [u for u in manager_urls if u not in completed_urls]
-
-    print(f"▶️ Remaining managers to scrape: {len(manager_urls)}")
-
-    out = []
-    total = len(manager_urls)
-
-    def worker(url):
-        time.sleep(random.uniform(MIN_SLEEP, MAX_SLEEP))
-        return url, scrape_manager_page(url)
-
-    done = 0
-    if total > 0:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-            futures = [ex.submit(worker, url) for url in manager_urls]
-
-            for fut in as_completed(futures):
-                done += 1
-                try:
-                    url, rows = fut.result()
-                    out.extend(rows)
-                    print(f"[{done}/{total}] OK {url} -> {len(rows)} rows")
-                except Exception as e:
-                    print(f"[{done}/{total}] FAIL -> {e}")
-
-                # checkpoint every 500 managers
-                if done % 500 == 0 or done == total:
-                    new_df = pd.DataFrame(out)
-                    if existing_df is not None and not existing_df.empty:
-                        combined = pd.concat([existing_df, new_df], ignore_index=True)
-                    else:
-                        combined = new_df
-
-                    combined.to_csv(OUT_CSV, index=False)
-                    print(f"💾 Checkpoint saved: {OUT_CSV} ({len(combined)} rows)")
-    else:
-        print("✅ No remaining managers to scrape.")
-
-    # Set df for the rest of the pipeline
-    if os.path.exists(OUT_CSV):
-        df = pd.read_csv(OUT_CSV)
-    else:
-        df = pd.DataFrame(out)
-    
-    df["date_filed"] = pd.to_datetime(df["date_filed"], errors="coerce")
-
-    # Optional: sort for convenience
-    # cik small->large, quarter newer->older (approx sort by year then quarter number)
-    def quarter_sort_key(q):
-        # q like "Q3 2025"
-        m = re.match(r"Q([1-4])\s+(\d{4})", str(q))
-        if not m:
-            return (0, 0)
-        qn = int(m.group(1))
-        yr = int(m.group(2))
-        return (yr, qn)
-
-    if not df.empty:
-        df["_qkey"] = df["quarter"].apply(quarter_sort_key)
-        df = df.sort_values(["cik", "_qkey"], ascending=[True, False]).drop(columns=["_qkey"])
-
-    # Write directly to Postgres (overwrite table)
+    parser = argparse.ArgumentParser(description="Download 13f.info manager summaries")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="Rebuild the table in a shadow copy and swap it in, instead of a diff sync")
+    parser.add_argument("--restart", action="store_true", help="Discard a previous partial crawl")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiling_from_args(args)
+
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
         raise RuntimeError("DATABASE_URL environment variable is not set")
 
-    # FINAL STEP: always load full checkpoint CSV into DB
-    df = pd.read_csv(OUT_CSV)
-    print(f"📥 Loading {len(df)} rows from checkpoint into DB")
+    counts = asyncio.run(main_async(args, db_url))
+
+    failed = counts["letters_failed"] + counts["managers_failed"]
+    if failed:
+        # Rows of pages that failed this run are missing from the stage, not gone
+        print(f"⚠️ {counts['letters_failed']} letter pages and {counts['managers_failed']} managers failed: "
+              f"keeping rows missing from the crawl")
+        if args.full_refresh:
+            print("⚠️ Full refresh skipped because of the failures; running a diff sync instead")
+    sync_expected_table(db_url, full_refresh=args.full_refresh and not failed, delete_missing=not failed)
 
-    overwrite_expected_table(df)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,130 @@
+"""
+13f.info filing IDs from local accession data.
+
+A 13f.info filing ID is the SEC accession number without dashes
+(/13f/000091957414001804-kingdon-... is 0000919574-14-001804), so for a
+filing we already know locally there is no need to fetch the manager page
+just to find it: FilingIdResolver maps (cik, quarter) straight to the ID
+and the holdings come from /data/13f/{filing_id} in one request.
+
+Sources, all keyed by normalized CIK and "Q3 2025"-style quarter:
+
+  expected_13finfo_summary  13f.info's own filing list (download_13finfo_summary.py)
+  sec_filing_ledger         every accession an SEC ingest has seen (13F-NT notices skipped)
+
+Both have one row per filing, so loading everything stays cheap; the
+holdings tables are never scanned.
+
+A (cik, quarter) resolves only when the sources agree on one filing. With
+an original and an amendment for the quarter we cannot tell which one the
+manager page lists, so that is a miss, like a quarter no source knows:
+callers fall back to the manager page, as they also do when a resolved ID
+returns no holdings.
+
+Usage:
+    resolver = FilingIdResolver.load(cur, ciks)        # ciks=None loads everything
+    filing_id = resolver.resolve(cik, "Q3 2025")       # None -> fetch the manager page
+    resolver.quarters(cik)                             # quarters known locally
+    print(resolver.summary())
+"""
+import re
+from collections import Counter, defaultdict
+from datetime import date
+
+from holdings_table import normalize_cik
+
+BASE = "https://13f.info"
+
+RE_QUARTER = re.compile(r"^Q([1-4])\s+(\d{4})$", re.I)
+QUARTER_END = {1: (3, 31), 2: (6, 30), 3: (9, 30), 4: (12, 31)}
+
+
+def accession_to_filing_id(accession_no):
+    """'0000919574-14-001804' (or without dashes) -> '000091957414001804'; None if malformed."""
+    digits = re.sub(r"\D", "", str(accession_no or ""))
+    return digits if len(digits) == 18 else None
+
+
+def quarter_period_end(quarter):
+    """'Q3 2025' -> date(2025, 9, 30); None if malformed."""
+    m = RE_QUARTER.match(str(quarter or "").strip())
+    if not m:
+        return None
+    month, day = QUARTER_END[int(m.group(1))]
+    return date(int(m.group(2)), month, day)
+
+
+def period_end_quarter(period_end):
+    """date(2025, 9, 30) -> 'Q3 2025'."""
+    return f"Q{(period_end.month - 1) // 3 + 1} {period_end.year}"
+
+
+def filing_url(filing_id):
+    return f"{BASE}/13f/{filing_id}"
+
+
+def holdings_api_url(filing_id):
+    return f"{BASE}/data/13f/{filing_id}"
+
+
+class FilingIdResolver:
+    """(cik, quarter) -> 13f.info filing ID, from accession data already in the database."""
+
+    def __init__(self):
+        self._filings = defaultdict(set)     # (cik, quarter) -> {filing_id}
+        self._quarters = defaultdict(set)    # cik -> {quarter}
+        self.stats = Counter()
+
+    def add(self, cik, quarter, accession_no):
+        cik = normalize_cik(cik)
+        filing_id = accession_to_filing_id(accession_no)
+        quarter = str(quarter or "").strip().upper()
+        if not cik or not filing_id or quarter_period_end(quarter) is None:
+            return
+        self._filings[(cik, quarter)].add(filing_id)
+        self._quarters[cik].add(quarter)
+
+    @classmethod
+    def load(cls, cur, ciks=None):
+        """Resolver over every local source, optionally only for some CIKs."""
+        resolver = cls()
+        where, params = "WHERE TRUE", {}
+        if ciks is not None:
+            # Older rows may hold unpadded CIKs; both forms stay index-friendly
+            padded = sorted({c for c in map(normalize_cik, ciks) if c})
+            where = "WHERE (cik = ANY(%(padded)s) OR cik = ANY(%(stripped)s))"
+            params = {"padded": padded, "stripped": [c.lstrip("0") for c in padded]}
+
+        for table, quarter_col, id_col, extra in (
+            ("expected_13finfo_summary", "quarter", "filing_id", ""),
+            ("sec_filing_ledger", "period_end", "accession_no", "AND status IS DISTINCT FROM 'notice'"),
+        ):
+            cur.execute("SELECT to_regclass(%s)", (table,))
+            if cur.fetchone()[0] is None:
+                continue
+            cur.execute(f"SELECT DISTINCT cik, {quarter_col}, {id_col} FROM {table} {where} {extra}", params)
+            for cik, quarter, accession_no in cur.fetchall():
+                if isinstance(quarter, date):
+                    quarter = period_end_quarter(quarter)
+                resolver.add(cik, quarter, accession_no)
+        return resolver
+
+    def quarters(self, cik):
+        """Quarters some local source has a filing for."""
+        return sorted(self._quarters.get(normalize_cik(cik), ()), key=quarter_period_end, reverse=True)
+
+    def resolve(self, cik, quarter):
+        """The filing ID for (cik, quarter), or None when unknown or ambiguous."""
+        ids = self._filings.get((normalize_cik(cik), str(quarter).strip().upper()))
+        if not ids:
+            self.stats["unknown"] += 1
+            return None
+        if len(ids) > 1:
+            self.stats["ambiguous"] += 1
+            return None
+        self.stats["resolved"] += 1
+        return next(iter(ids))
+
+    def summary(self):
+        return (f"{len(self._filings):,} manager quarters known | resolved: {self.stats['resolved']:,} | "
+                f"unknown: {self.stats['unknown']:,} | ambiguous: {self.stats['ambiguous']:,}")
@@ -3,21 +3,46 @@ Compare 13f.info holdings vs SEC holdings to find value discrepancies
 
 This identifies managers where 13f.info values are ~1000x different from SEC data.
 SEC data is the source of truth.
+
+Rows are streamed from a server-side cursor into the report file
+(report_export.py); only the status counts and the first 1000x examples are
+kept in memory.
+
+Usage:
+    python find_value_discrepancies.py
+    python find_value_discrepancies.py --format csv.gz
 """
+import argparse
 import os
+from collections import Counter
+
 import psycopg2
-import pandas as pd
 from dotenv import load_dotenv
 
+from holding_stats import ensure_period_stats
+from profiling import add_profile_arguments, start_profiling_from_args
+from report_export import FORMATS, open_report, stream_query
+
 load_dotenv()
 
+EXAMPLES_1000X = 30     # 1000x_HIGH rows printed
+
 def main():
+    parser = argparse.ArgumentParser(description="Find value discrepancies between SEC and 13f.info")
+    parser.add_argument("--format", choices=FORMATS, default="csv", help="Report file format (default: csv)")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiling_from_args(args)
+
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
         print("❌ DATABASE_URL not set")
         return
     
     conn = psycopg2.connect(db_url)
+    with conn.cursor() as cur:
+        ensure_period_stats(cur)
+    conn.commit()
     
     print("=" * 70)
     print("Comparing 13f.info vs SEC holdings data")
@@ -31,22 +56,21 @@ def main():
         SELECT 
             cik,
             'Q' || EXTRACT(QUARTER FROM period_end)::text || ' ' || EXTRACT(YEAR FROM period_end)::text as quarter,
-            SUM(value_usd) / 1000 as sec_value_000,  -- Convert to thousands for comparison
-            COUNT(*) as sec_holdings
-        FROM manager_quarter_holding
-        WHERE value_usd IS NOT NULL
-        GROUP BY cik, period_end
+            value_usd_sum / 1000 as sec_value_000,  -- Convert to thousands for comparison
+            num_holdings as sec_holdings
+        FROM holding_period_stats  -- per-period totals kept by the SEC writers (holding_stats.py)
+        WHERE value_usd_sum IS NOT NULL
     ),
     info_totals AS (
         -- 13f.info data: value_000 is already in thousands
         SELECT 
-            LPAD(LTRIM(cik, '0'), 10, '0') as cik,
+            cik,
             quarter,
             SUM(value_000) as info_value_000,
             COUNT(*) as info_holdings
         FROM public.expected_13finfo_holdings
         WHERE value_000 IS NOT NULL
-        GROUP BY LPAD(LTRIM(cik, '0'), 10, '0'), quarter
+        GROUP BY cik, quarter
     ),
     manager_names AS (
         -- Get manager names from manager_quarter
@@ -95,14 +119,26 @@ def main():
     """
     
     print("\n📊 Finding value discrepancies...")
-    df = pd.read_sql(query, conn)
+    columns, rows = stream_query(conn, query)
+    status_idx = columns.index('status')
+    
+    # Rows arrive worst ratio first: the first 1000x_HIGH rows are the worst offenders
+    status_counts = Counter()
+    high_1000x = []
+    csv_file = f"value_discrepancy_report.{args.format}"
+    with open_report(csv_file, columns) as out:
+        for row in rows:
+            out.write(row)
+            status_counts[row[status_idx]] += 1
+            if row[status_idx] == '1000x_HIGH' and len(high_1000x) < EXAMPLES_1000X:
+                high_1000x.append(dict(zip(columns, row)))
+    conn.commit()
     
-    print(f"\n✅ Found {len(df)} quarters with significant value differences")
+    print(f"\n✅ Found {out.rows_written} quarters with significant value differences")
     
     # Summary by status
     print("\n📈 Summary by status:")
-    status_counts = df['status'].value_counts()
-    for status, count in status_counts.items():
+    for status, count in status_counts.most_common():
         print(f"   {status}: {count}")
     
     # Show worst offenders (1000x issues)
@@ -110,29 +146,25 @@ def main():
     print("🚨 1000x VALUE ISSUES (13f.info is ~1000x too high)")
     print("=" * 70)
     
-    high_1000x = df[df['status'] == '1000x_HIGH'].head(30)
-    if len(high_1000x) > 0:
-        for _, row in high_1000x.iterrows():
+    if high_1000x:
+        for row in high_1000x:
             sec_val = row['sec_value_000'] / 1000  # Convert to millions
             info_val = row['info_value_000'] / 1000
-            print(f"\n  {row['manager_name'][:50]}")
+            print(f"\n  {(row['manager_name'] or 'Unknown')[:50]}")
             print(f"    CIK: {row['cik']} | Quarter: {row['quarter']}")
             print(f"    SEC: ${sec_val:,.1f}M | 13f.info: ${info_val:,.1f}M | Ratio: {row['value_ratio']:.1f}x")
     else:
         print("   None found")
     
-    # Save full report to CSV
-    csv_file = "value_discrepancy_report.csv"
-    df.to_csv(csv_file, index=False)
     print(f"\n💾 Full report saved to: {csv_file}")
     
     # Count affected quarters
-    issues_1000x = df[df['status'].isin(['1000x_HIGH', '1000x_LOW'])]
-    print(f"\n📊 Total quarters with 1000x issue: {len(issues_1000x)}")
+    issues_1000x = status_counts['1000x_HIGH'] + status_counts['1000x_LOW']
+    print(f"\n📊 Total quarters with 1000x issue: {issues_1000x}")
     
     conn.close()
     
-    return df
+    return status_counts
 
 
 if __name__ == "__main__":
@@ -0,0 +1,486 @@
+"""
+Period fingerprints rolled up into a hash tree, to find drifted data
+without comparing every holding.
+
+Finding which periods differ between manager_quarter_holding (SEC) and
+expected_13finfo_holdings (13f.info) used to mean re-aggregating both tables.
+Here every (cik, quarter) of each source has a fingerprint: a multiset hash
+of its normalized positions (as in fingerprints.holdings_hash, each position
+is hashed on its own and the digests are summed mod 2**64, so row order
+does not matter). Positions are normalized the same way for both sources:
+
+  (cusip, put_call, shares, value_000)   one per (cusip, put_call); class
+                                         variants and multi-line positions
+                                         summed, values rounded to $000 per
+                                         line as 13f.info shows them
+
+Period fingerprints roll up per source into a tree, stored in
+period_fingerprint_node; each node is again a multiset hash:
+
+  quarter   sum of the digests of (cik, fingerprint) over a quarter's periods
+  manager   sum of the digests of (quarter, fingerprint) over a CIK's periods
+  root      sum of the digests of (quarter, cik, fingerprint) over all periods
+
+diff_periods compares the roots, then the quarter nodes (or, for one CIK,
+the manager node), and only reads the periods of quarters whose hashes
+differ, so a drifted quarter costs one quarter's periods.
+
+Period fingerprints are maintained at write time, in the writer's
+transaction: holding_stats.refresh_period_stats refreshes the SEC periods
+it is given and holdings_table.upsert_holdings_rows the 13f.info periods it
+staged; scripts that DELETE / INSERT 13f.info rows directly call
+refresh_fingerprints themselves. A writer locks the period rows it
+refreshes, in key order, and adds what changed to the nodes as delta rows,
+digest(new) - digest(old), which it only ever inserts: writers share no row,
+so writers on different periods never wait on (or deadlock with) each
+other. diff_periods folds each node's delta rows into one first
+(compact_nodes). A fresh EDGAR parse can be checked against the stored SEC
+fingerprint with period_fingerprint(rows). After a manual fix in psql,
+rebuild: --rebuild below.
+
+Usage:
+    refresh_fingerprints(cur, SEC, [(cik, "Q3 2025")])
+    drifted, compared = diff_periods(cur, SEC, INFO, quarter="Q3 2025")
+    if period_fingerprint(parsed_rows) != stored_fingerprint(cur, SEC, cik, "Q3 2025"): ...
+
+From the shell:
+    python fingerprint_tree.py                          # periods where SEC and 13f.info differ
+    python fingerprint_tree.py --quarter "Q3 2025"
+    python fingerprint_tree.py --cik 0001067983
+    python fingerprint_tree.py --rebuild
+"""
+import argparse
+import hashlib
+import os
+from collections import Counter
+from decimal import ROUND_HALF_UP, Decimal
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from fingerprints import SEP
+from profiling import stage
+
+TABLE = "period_fingerprint"
+NODE_TABLE = "period_fingerprint_node"
+
+SEC = "sec"
+INFO = "13finfo"
+
+ROOT, QUARTER, MANAGER = "root", "quarter", "manager"     # node levels
+
+MODULUS = 1 << 64
+HALF = 1 << 63
+
+_READY = set()      # DSNs whose fingerprint tables are known to exist
+
+# Normalized positions of each source in a scope of periods s (cik, quarter, period_end),
+# one row per (cik, quarter, cusip, put_call)
+POSITIONS_SQL = {
+    SEC: """
+        SELECT h.cik, s.quarter, COALESCE(h.cusip, '') AS cusip, COALESCE(UPPER(h.put_call), '') AS put_call,
+               ROUND(SUM(h.shares))::bigint AS shares, SUM(ROUND(h.value_usd / 1000.0))::bigint AS value_000
+        FROM public.manager_quarter_holding h
+        JOIN {scope} s ON h.cik = s.cik AND h.period_end = s.period_end
+        GROUP BY 1, 2, 3, 4
+    """,
+    INFO: """
+        SELECT h.cik, h.quarter, COALESCE(h.cusip, '') AS cusip, COALESCE(UPPER(h.option_type), '') AS put_call,
+               ROUND(SUM(h.shares))::bigint AS shares, ROUND(SUM(h.value_000))::bigint AS value_000
+        FROM public.expected_13finfo_holdings h
+        JOIN {scope} s ON h.cik = s.cik AND h.quarter = s.quarter
+        GROUP BY 1, 2, 3, 4
+    """,
+}
+
+# Every period a source has, in the scope's shape
+PERIODS_SQL = {
+    SEC: """
+        SELECT DISTINCT cik, 'Q' || EXTRACT(QUARTER FROM period_end)::int || ' ' || EXTRACT(YEAR FROM period_end)::int
+               AS quarter, period_end
+        FROM public.manager_quarter_holding
+    """,
+    INFO: """
+        SELECT DISTINCT cik, quarter, NULL::date AS period_end FROM public.expected_13finfo_holdings
+    """,
+}
+
+# 'Q3 2025' -> 2025-09-30, NULL if malformed
+QUARTER_END_SQL = """
+    CASE WHEN {q} ~ '^Q[1-4] [0-9]{{4}}$'
+         THEN (make_date(split_part({q}, ' ', 2)::int, substr({q}, 2, 1)::int * 3, 1)
+               + INTERVAL '1 month - 1 day')::date
+    END
+"""
+
+
+def _digest_sql(*parts):
+    """SQL for the signed 64-bit digest of the parts (the first 8 bytes of their md5)."""
+    text = ", ".join(f"COALESCE(({p})::text, '')" for p in parts)
+    return f"('x' || left(md5(concat_ws(chr(31), {text})), 16))::bit(64)::bigint::numeric"
+
+
+def _fold_sql(total):
+    """SQL folding a numeric sum of digests into a signed 64-bit fingerprint."""
+    return f"(mod(mod({total}, {MODULUS}) + {MODULUS} + {HALF}, {MODULUS}) - {HALF})::bigint"
+
+
+def _digest(*parts):
+    text = SEP.join("" if p is None else str(p) for p in parts)
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "big", signed=True)
+
+
+def _fold(total):
+    return (total + HALF) % MODULUS - HALF
+
+
+def _round(value):
+    return int(Decimal(str(value)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def period_fingerprint(rows):
+    """Fingerprint of one period from SEC-style rows (cusip, put_call, shares, value_usd).
+
+    The same value as refresh_fingerprints stores for the period, so a fresh
+    parse can be compared without reading the stored holdings.
+    """
+    positions = {}
+    for cusip, put_call, shares, value_usd in rows:
+        key = (cusip or "", (put_call or "").upper())
+        total_shares, total_value = positions.get(key, (None, None))
+        if shares is not None:
+            total_shares = (total_shares or 0) + Decimal(str(shares))
+        if value_usd is not None:
+            total_value = (total_value or 0) + _round(Decimal(str(value_usd)) / 1000)
+        positions[key] = (total_shares, total_value)
+    total = 0
+    for (cusip, put_call), (shares, value_000) in positions.items():
+        total += _digest(cusip, put_call, None if shares is None else _round(shares), value_000)
+    return _fold(total)
+
+
+def _node_rows_sql(rows, sign=""):
+    """SELECT of node delta rows (source, level, key, fingerprint) for the periods in `rows`.
+
+    rows: name of a relation of (cik, quarter, fingerprint); sign "-" removes them.
+    """
+    return f"""
+        SELECT %(source)s, level, key, {_fold_sql(f"{sign}SUM(d)")}
+        FROM (
+            SELECT '{ROOT}' AS level, '' AS key, {_digest_sql('quarter', 'cik', 'fingerprint')} AS d FROM {rows}
+            UNION ALL
+            SELECT '{QUARTER}', quarter, {_digest_sql('cik', 'fingerprint')} FROM {rows}
+            UNION ALL
+            SELECT '{MANAGER}', cik, {_digest_sql('quarter', 'fingerprint')} FROM {rows}
+        ) d
+        GROUP BY level, key
+    """
+
+
+def _node_deltas(source, changes):
+    """Node delta rows for (cik, quarter, old, new) period changes (None: no period), in key order."""
+    totals = Counter()
+    for cik, quarter, old, new in changes:
+        for level, key, parts in ((ROOT, "", (quarter, cik)), (QUARTER, quarter, (cik,)), (MANAGER, cik, (quarter,))):
+            if old is not None:
+                totals[(level, key)] -= _digest(*parts, old)
+            if new is not None:
+                totals[(level, key)] += _digest(*parts, new)
+    return [(source, level, key, _fold(total)) for (level, key), total in sorted(totals.items()) if _fold(total)]
+
+
+def ensure_fingerprint_tables(cur):
+    """Create the fingerprint tables; returns True when the period table was just created and filled.
+
+    Checked once per process and database, so write-time refreshes skip it.
+    """
+    dsn = cur.connection.dsn
+    if dsn in _READY:
+        return False
+    cur.execute("SELECT to_regclass(%s), to_regclass(%s)", (TABLE, NODE_TABLE))
+    has_periods, has_nodes = (name is not None for name in cur.fetchone())
+    if has_periods and has_nodes:
+        _READY.add(dsn)
+        return False
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            source TEXT NOT NULL,
+            cik TEXT NOT NULL,
+            quarter TEXT NOT NULL,
+            fingerprint BIGINT NOT NULL,
+            positions INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (source, cik, quarter)
+        )
+    """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE}_quarter ON {TABLE} (source, quarter)")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {NODE_TABLE} (
+            source TEXT NOT NULL,
+            level TEXT NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint BIGINT NOT NULL
+        )
+    """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{NODE_TABLE}_key ON {NODE_TABLE} (source, level, key)")
+    for source, table in ((SEC, "manager_quarter_holding"), (INFO, "expected_13finfo_holdings")):
+        if has_periods:
+            print(f"🔧 {NODE_TABLE}: building {source} nodes from {TABLE} (one-time)...")
+            cur.execute(f"LOCK TABLE {TABLE} IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute(f"DELETE FROM {NODE_TABLE} WHERE source = %s", (source,))
+            _build_nodes(cur, source)
+            continue
+        cur.execute("SELECT to_regclass(%s)", (table,))
+        if cur.fetchone()[0] is not None:
+            print(f"🔧 {TABLE}: building {source} fingerprints from {table} (one-time)...")
+            rebuild_fingerprints(cur, source)
+    _READY.add(dsn)
+    return not has_periods
+
+
+def _build_nodes(cur, source):
+    """Add the nodes of every stored period of a source (to an empty tree)."""
+    cur.execute(f"""
+        WITH r AS (SELECT cik, quarter, fingerprint FROM {TABLE} WHERE source = %(source)s)
+        INSERT INTO {NODE_TABLE} (source, level, key, fingerprint)
+        {_node_rows_sql("r")}
+    """, {"source": source})
+
+
+def _refresh_scope(cur, source, scope_sql, params=None, track=True):
+    """Recompute the periods of a scope (SQL of (cik, quarter, period_end) rows). Returns periods changed.
+
+    With track, the scope's period rows are locked (and absent ones reserved)
+    first, in key order, so their old fingerprints are read before the write
+    and the changes are added to the nodes as deltas.
+    """
+    params = {**(params or {}), "source": source}
+    old = {}
+    if track:
+        # DO UPDATE ... WHERE FALSE locks an existing row without writing it
+        cur.execute(f"""
+            INSERT INTO {TABLE} (source, cik, quarter, fingerprint, positions)
+            SELECT %(source)s, cik, quarter, 0, -1 FROM ({scope_sql}) s
+            ORDER BY cik, quarter
+            ON CONFLICT (source, cik, quarter) DO UPDATE SET positions = EXCLUDED.positions WHERE FALSE
+        """, params)
+        cur.execute(f"""
+            SELECT f.cik, f.quarter, f.fingerprint
+            FROM {TABLE} f
+            JOIN ({scope_sql}) s ON f.cik = s.cik AND f.quarter = s.quarter
+            WHERE f.source = %(source)s AND f.positions >= 0
+        """, params)
+        old = {(cik, quarter): fp for cik, quarter, fp in cur.fetchall()}
+
+    positions = POSITIONS_SQL[source].format(scope=f"({scope_sql})")
+    cur.execute(f"""
+        WITH fresh AS (
+            SELECT cik, quarter, {_fold_sql(f"SUM({_digest_sql('cusip', 'put_call', 'shares', 'value_000')})")}
+                   AS fingerprint, COUNT(*) AS positions
+            FROM ({positions}) p
+            GROUP BY cik, quarter
+        ),
+        gone AS (
+            DELETE FROM {TABLE} f
+            USING ({scope_sql}) s
+            WHERE f.source = %(source)s AND f.cik = s.cik AND f.quarter = s.quarter
+              AND NOT EXISTS (SELECT 1 FROM fresh n WHERE n.cik = s.cik AND n.quarter = s.quarter)
+            RETURNING f.cik, f.quarter
+        ),
+        written AS (
+            INSERT INTO {TABLE} (source, cik, quarter, fingerprint, positions)
+            SELECT %(source)s, cik, quarter, fingerprint, positions FROM fresh
+            ORDER BY cik, quarter
+            ON CONFLICT (source, cik, quarter) DO UPDATE SET
+                fingerprint = EXCLUDED.fingerprint, positions = EXCLUDED.positions, updated_at = NOW()
+            WHERE {TABLE}.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint
+               OR {TABLE}.positions IS DISTINCT FROM EXCLUDED.positions
+            RETURNING cik, quarter, fingerprint
+        )
+        SELECT cik, quarter, fingerprint FROM written
+        UNION ALL
+        SELECT cik, quarter, NULL FROM gone
+    """, params)
+    changes = [(cik, quarter, old.get((cik, quarter)), new) for cik, quarter, new in cur.fetchall()]
+    changes = [c for c in changes if c[2] != c[3]]
+    if track and changes:
+        execute_values(cur, f"INSERT INTO {NODE_TABLE} (source, level, key, fingerprint) VALUES %s",
+                       _node_deltas(source, changes), page_size=1000)
+    return len(changes)
+
+
+@stage("db")
+def refresh_fingerprints(cur, source, periods):
+    """Recompute the fingerprints of the given (cik, quarter) periods of a source and their nodes.
+
+    Call in the writer's transaction, after its writes. Returns periods changed.
+    """
+    periods = sorted(set(periods))
+    if not periods:
+        return 0
+    ensure_fingerprint_tables(cur)
+    scope = f"""
+        SELECT cik, quarter, {QUARTER_END_SQL.format(q="quarter")} AS period_end
+        FROM unnest(%(ciks)s::text[], %(quarters)s::text[]) AS t (cik, quarter)
+    """
+    return _refresh_scope(cur, source, scope, {"ciks": [p[0] for p in periods], "quarters": [p[1] for p in periods]})
+
+
+def clear_fingerprints(cur, source):
+    """Drop every fingerprint of a source (before a full reload that refreshes them as it writes).
+
+    A plain DELETE: it row-locks only this source's periods, and takes their
+    contributions out of the nodes as deltas, so other writers go on.
+    """
+    ensure_fingerprint_tables(cur)
+    cur.execute(f"""
+        WITH r AS (DELETE FROM {TABLE} WHERE source = %(source)s RETURNING cik, quarter, fingerprint)
+        INSERT INTO {NODE_TABLE} (source, level, key, fingerprint)
+        {_node_rows_sql("r", "-")}
+    """, {"source": source})
+
+
+@stage("db")
+def rebuild_fingerprints(cur, source):
+    """Recompute every fingerprint and node of a source from its holdings. Returns periods written.
+
+    Locks out fingerprint writers while it runs (a manual or one-time step).
+    """
+    cur.execute(f"LOCK TABLE {TABLE} IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(f"DELETE FROM {TABLE} WHERE source = %s", (source,))
+    cur.execute(f"DELETE FROM {NODE_TABLE} WHERE source = %s", (source,))
+    written = _refresh_scope(cur, source, PERIODS_SQL[source], track=False)
+    _build_nodes(cur, source)
+    cur.execute(f"ANALYZE {TABLE}")
+    cur.execute(f"ANALYZE {NODE_TABLE}")
+    return written
+
+
+def stored_fingerprint(cur, source, cik, quarter):
+    """The stored fingerprint of one period, or None when the source has no holdings for it."""
+    cur.execute(f"SELECT fingerprint FROM {TABLE} WHERE source = %s AND cik = %s AND quarter = %s",
+                (source, cik, quarter))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def compact_nodes(cur, source):
+    """Fold each node's delta rows into one row (nodes that sum to nothing are dropped).
+
+    Rows added by concurrent writers after this statement's snapshot are left for next time.
+    """
+    cur.execute(f"""
+        WITH gone AS (DELETE FROM {NODE_TABLE} WHERE source = %(source)s RETURNING level, key, fingerprint)
+        INSERT INTO {NODE_TABLE} (source, level, key, fingerprint)
+        SELECT %(source)s, level, key, {_fold_sql("SUM(fingerprint)")}
+        FROM gone
+        GROUP BY level, key
+        HAVING {_fold_sql("SUM(fingerprint)")} <> 0
+    """, {"source": source})
+
+
+def _nodes(cur, source, level, where="TRUE", params=None):
+    """{key: fingerprint} of one level of a source's tree (empty nodes left out)."""
+    cur.execute(f"""
+        SELECT key, {_fold_sql("SUM(fingerprint)")}
+        FROM {NODE_TABLE}
+        WHERE source = %(source)s AND level = %(level)s AND {where}
+        GROUP BY key
+    """, {**(params or {}), "source": source, "level": level})
+    return {key: fp for key, fp in cur.fetchall() if fp}
+
+
+def _differing_periods(cur, a, b, where, params):
+    """(cik, quarter) periods matching `where` whose fingerprint differs between sources a and b."""
+    cur.execute(f"""
+        SELECT cik, quarter
+        FROM (SELECT cik, quarter, fingerprint FROM {TABLE} WHERE source = %(a)s AND {where}) x
+        FULL JOIN (SELECT cik, quarter, fingerprint FROM {TABLE} WHERE source = %(b)s AND {where}) y
+             USING (cik, quarter)
+        WHERE x.fingerprint IS DISTINCT FROM y.fingerprint
+        ORDER BY cik, quarter
+    """, {**params, "a": a, "b": b})
+    return cur.fetchall()
+
+
+@stage("db")
+def diff_periods(cur, a, b, quarter=None, cik=None):
+    """(cik, quarter) periods whose fingerprints differ between sources a and b.
+
+    Walks the stored trees top-down: root, then quarters (or the manager node
+    when cik is given), then only the periods under differing nodes.
+    Returns (periods, Counter of nodes compared per level).
+    """
+    ensure_fingerprint_tables(cur)
+    for source in (a, b):
+        compact_nodes(cur, source)
+    compared = Counter()
+    if cik is not None:
+        compared[MANAGER] += 1
+        managers = [_nodes(cur, s, MANAGER, "key = %(cik)s", {"cik": cik}) for s in (a, b)]
+        if managers[0] == managers[1]:
+            return [], compared
+        periods = _differing_periods(cur, a, b,
+                                     "cik = %(cik)s AND (%(quarter)s::text IS NULL OR quarter = %(quarter)s)",
+                                     {"cik": cik, "quarter": quarter})
+        compared["period"] += len(periods)
+        return periods, compared
+
+    if quarter is None:
+        compared[ROOT] += 1
+        if _nodes(cur, a, ROOT) == _nodes(cur, b, ROOT):
+            return [], compared
+    where, params = ("key = %(quarter)s", {"quarter": quarter}) if quarter is not None else ("TRUE", {})
+    nodes_a, nodes_b = (_nodes(cur, s, QUARTER, where, params) for s in (a, b))
+    compared[QUARTER] += len(nodes_a.keys() | nodes_b.keys())
+    drifted = sorted(q for q in nodes_a.keys() | nodes_b.keys() if nodes_a.get(q) != nodes_b.get(q))
+    if not drifted:
+        return [], compared
+    periods = _differing_periods(cur, a, b, "quarter = ANY(%(quarters)s)", {"quarters": drifted})
+    cur.execute(f"SELECT COUNT(*) FROM {TABLE} WHERE source = %s AND quarter = ANY(%s)", (a, drifted))
+    compared["period"] += cur.fetchone()[0]
+    return periods, compared
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Find periods where SEC and 13f.info holdings differ, by fingerprint")
+    ap.add_argument("--quarter", help='Only this quarter, e.g. "Q3 2025"')
+    ap.add_argument("--cik", help="Only this manager")
+    ap.add_argument("--rebuild", action="store_true", help="Recompute every fingerprint from the holdings first")
+    args = ap.parse_args()
+
+    load_dotenv()
+    if "DATABASE_URL" not in os.environ:
+        print("❌ DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                created = ensure_fingerprint_tables(cur)
+                if args.rebuild and not created:
+                    for source in (SEC, INFO):
+                        written = rebuild_fingerprints(cur, source)
+                        print(f"✅ {source} fingerprints rebuilt: {written:,} periods")
+                cik = args.cik.strip().zfill(10) if args.cik else None
+                periods, compared = diff_periods(cur, SEC, INFO, args.quarter, cik)
+    finally:
+        conn.close()
+
+    print("🔍 Nodes compared: " + ", ".join(f"{level} {n:,}" for level, n in compared.items()))
+    if not periods:
+        print("✅ SEC and 13f.info fingerprints agree")
+        return 0
+    print(f"⚠️ {len(periods):,} periods differ:")
+    for cik, quarter in periods[:50]:
+        print(f"   CIK {cik} {quarter}")
+    if len(periods) > 50:
+        print(f"   ... and {len(periods) - 50:,} more")
+    print("   python reconcile_holdings.py --drifted compares them position by position")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
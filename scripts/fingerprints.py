@@ -0,0 +1,81 @@
+"""
+Content fingerprints for 13F filings, used to skip re-ingests that would not
+change anything.
+
+Two hashes are stored per accession in sec_filing_ledger:
+
+  raw_hash       sha256 of the information table XML as downloaded
+  holdings_hash  order-independent hash of the holdings rows as written to
+                 manager_quarter_holding (after the value-unit multiplier)
+
+holdings_hash is a multiset hash: every row is hashed on its own and the
+digests are summed mod 2**128, so the same rows give the same hash whatever
+order they were parsed or SELECTed in, and numbers hash the same whether
+they come back from Postgres as int, float or Decimal.
+
+A repair pass compares the new filing against what is stored and only
+DELETEs/INSERTs when they differ:
+
+    stored = stored_holdings_hash(cur, cik, period_end)
+    if prior_raw_hash == content_hash(xml) and stored == prior_holdings_hash:
+        ...  # unchanged: skip parsing and writing
+    if holdings_hash(rows) == stored:
+        ...  # parsed to the same rows: skip writing
+"""
+import hashlib
+from decimal import Decimal
+
+# Holding columns covered by holdings_hash, in manager_quarter_holding order
+HOLDING_COLUMNS = (
+    "line_no", "issuer", "title_of_class", "cusip", "value_usd", "shares", "share_type",
+    "put_call", "investment_discretion", "other_manager", "voting_sole", "voting_shared", "voting_none",
+)
+MODULUS = 1 << 128
+SEP = "\x1f"
+
+
+def content_hash(content):
+    """sha256 hex digest of raw document bytes (None for no content)."""
+    if not content:
+        return None
+    return hashlib.sha256(content).hexdigest()
+
+
+def _canon(value):
+    if value is None:
+        return "\x00"
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        f = float(value)
+        return str(int(f)) if f.is_integer() else repr(f)
+    return str(value)
+
+
+def row_digest(row):
+    """Integer digest of one holding row (a tuple in HOLDING_COLUMNS order)."""
+    text = SEP.join(_canon(v) for v in row)
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest(), "big")
+
+
+def holdings_hash(rows):
+    """Order-independent hash of holding rows (tuples in HOLDING_COLUMNS order).
+
+    Returns a 32-character hex string; an empty filing hashes to all zeros.
+    """
+    total = 0
+    for row in rows:
+        total = (total + row_digest(row)) % MODULUS
+    return f"{total:032x}"
+
+
+def stored_holdings_hash(cur, cik, period_end, accession_no=None):
+    """holdings_hash of the rows currently stored for (cik, period_end), or only for one accession.
+
+    The ledger's holdings_hash is per accession, so compare it with the
+    accession's rows: a period with NEW HOLDINGS amendments has more.
+    """
+    cur.execute(f"""
+        SELECT {", ".join(HOLDING_COLUMNS)}
+        FROM manager_quarter_holding
+        WHERE cik = %s AND period_end = %s AND (%s::text IS NULL OR accession_no = %s)
+    """, (cik, period_end, accession_no, accession_no))
+    return holdings_hash(cur.fetchall())
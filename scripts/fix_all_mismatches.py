@@ -1,9 +1,10 @@
 """
 Fix ALL mismatched holdings from CSV file
 
-This script reads the mismatch CSV and re-downloads all periods
-with correct value parsing.
+This script reads the mismatch CSV (or the low-confidence filings in
+sec_filing_ledger) and re-downloads all periods with correct value parsing.
 """
+import argparse
 import requests
 import psycopg2
 from psycopg2.extras import execute_values
@@ -16,6 +17,13 @@ from dotenv import load_dotenv
 from lxml import etree
 import time
 
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from amendments import REPLACE, clear_for_base
+from fingerprints import content_hash, holdings_hash, stored_holdings_hash
+from holding_stats import ensure_period_stats, refresh_period_stats
+from sec_ledger import ensure_ledger, loaded_fingerprint, low_confidence_periods, record_loaded
+from value_units import LOW_CONFIDENCE, detect_value_units
+
 SEC_HEADERS = {
     "User-Agent": "Naveen Mokkapati navmok@gmail.com",
     "Accept": "*/*",
@@ -24,6 +32,12 @@ SEC_HEADERS = {
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
+# Where to take the periods to fix from:
+# - "csv": the mismatch CSV below
+# - "low_confidence": filings whose value units were decided with confidence
+#   below value_units.LOW_CONFIDENCE (sec_filing_ledger)
+FIX_SOURCE = "csv"
+
 # Path to the CSV file with mismatched holdings
 CSV_FILE = "value_holdings_chk_mismatch_filtered.csv"
 
@@ -43,6 +57,7 @@ SESSION.headers.update(SEC_HEADERS)
 QUARTERLY_INDEXES = {}
 
 
+@stage("fetch")
 def request_with_retry(url, timeout=None, stream=False):
     """Make HTTP request with retry logic"""
     if timeout is None:
@@ -80,6 +95,7 @@ def request_with_retry(url, timeout=None, stream=False):
     return FailedResponse()
 
 
+@stage("index")
 def download_quarterly_index(year, quarter):
     """Download and parse master.idx for a quarter"""
     key = (year, quarter)
@@ -156,6 +172,7 @@ def period_to_quarter(period_end):
     return dt.year, quarter, dt
 
 
+@stage("index")
 def find_13f_filing(cik, period_end):
     """Find 13F filing for a CIK and period"""
     cik_padded = str(cik).zfill(10)
@@ -239,17 +256,26 @@ def find_info_table_url(xml_urls):
     return None
 
 
-def fetch_holdings_fixed(xml_url):
-    """
-    Fetch holdings with CORRECT value parsing.
-    SEC 13F values are in THOUSANDS of dollars.
-    """
+@stage("fetch")
+def fetch_info_table(xml_url):
+    """Download info_table.xml; returns the raw bytes, or None."""
     try:
         r = request_with_retry(xml_url, timeout=REQUEST_TIMEOUT * 2)
         if r.status_code != 200:
-            return []
-        
-        xml_content = r.content
+            return None
+        return r.content
+    except Exception:
+        return None
+
+
+@stage("parse")
+def parse_holdings_fixed(xml_content):
+    """
+    Parse holdings with CORRECT value parsing.
+    Values are returned RAW ("value_raw"); fix_manager_period decides
+    thousands vs dollars with value_units.detect_value_units.
+    """
+    try:
         holdings = []
         idx = 0
         
@@ -306,16 +332,15 @@ def fetch_holdings_fixed(xml_url):
                 voting_shared = get_int(voting_elem, 'shared')
                 voting_none = get_int(voting_elem, 'none')
             
-            # Get value in THOUSANDS and convert to actual USD
-            value_thousands = get_int(elem, "value")
-            value_usd = value_thousands * 1000 if value_thousands else None
+            # Raw value as reported (thousands or dollars, decided later)
+            value_raw = get_int(elem, "value")
             
             holding = {
                 "line_no": idx,
                 "issuer": get_text(elem, "nameOfIssuer"),
                 "title_of_class": get_text(elem, "titleOfClass"),
                 "cusip": get_text(elem, "cusip"),
-                "value_usd": value_usd,
+                "value_raw": value_raw,
                 "shares": get_float(elem, "sshPrnamt"),
                 "share_type": get_text(elem, "sshPrnamtType"),
                 "put_call": get_text(elem, "putCall"),
@@ -360,19 +385,28 @@ def fix_manager_period(cik, period_end, cur, conn):
     if not info_table_url:
         return {"status": "no_infotable"}
     
-    # Fetch holdings
-    holdings = fetch_holdings_fixed(info_table_url)
+    xml_content = fetch_info_table(info_table_url)
+    raw_hash = content_hash(xml_content)
+    
+    # Same document as the loaded one and the stored rows untouched: nothing to rewrite
+    prior = loaded_fingerprint(cur, acc_no)
+    stored_hash = stored_holdings_hash(cur, cik_padded, period_date, acc_no) if prior else None
+    if prior and raw_hash and prior[0] == raw_hash and prior[1] == stored_hash:
+        time.sleep(REQUEST_DELAY)
+        return {"status": "unchanged"}
+    
+    # Parse holdings
+    holdings = parse_holdings_fixed(xml_content) if xml_content else []
     
     if not holdings:
         return {"status": "no_holdings"}
     
-    # Delete old holdings
-    cur.execute("""
-        DELETE FROM manager_quarter_holding
-        WHERE cik = %s AND period_end = %s
-    """, (cik_padded, period_date))
+    units = detect_value_units([
+        ([(h["value_raw"], h["shares"], h["share_type"]) for h in holdings], None, period_date)
+    ])[0]
+    for h in holdings:
+        h["value_usd"] = h["value_raw"] * units.multiplier if h["value_raw"] is not None else None
     
-    # Insert new holdings
     values = []
     for h in holdings:
         values.append((
@@ -382,7 +416,21 @@ def fix_manager_period(cik, period_end, cur, conn):
             h["put_call"], h["investment_discretion"], h["other_manager"],
             h["voting_sole"], h["voting_shared"], h["voting_none"]
         ))
+    new_hash = holdings_hash(v[3:] for v in values)
+    total_value_m = sum(h["value_usd"] or 0 for h in holdings) / 1_000_000.0
+    
+    # Parses to exactly the stored rows: only refresh the ledger
+    if stored_hash is None:
+        stored_hash = stored_holdings_hash(cur, cik_padded, period_date, acc_no)
+    if new_hash == stored_hash:
+        record_loaded(cur, [(acc_no, cik_padded, period_date, len(holdings), units, REPLACE, raw_hash, new_hash)])
+        time.sleep(REQUEST_DELAY)
+        return {"status": "unchanged", "holdings": len(holdings), "value_m": total_value_m, "units": units}
     
+    # Delete old holdings (appended NEW HOLDINGS amendments stay)
+    clear_for_base(cur, cik_padded, period_date, acc_no)
+    
+    # Insert new holdings
     execute_values(cur, """
         INSERT INTO manager_quarter_holding (
             cik, period_end, accession_no, line_no, issuer, title_of_class,
@@ -393,17 +441,21 @@ def fix_manager_period(cik, period_end, cur, conn):
             value_usd = EXCLUDED.value_usd,
             shares = EXCLUDED.shares
     """, values, page_size=500)
+    refresh_period_stats(cur, [(cik_padded, period_date)], "fix_all_mismatches")
     
-    # Update manager_quarter
-    total_value_m = sum(h["value_usd"] or 0 for h in holdings) / 1_000_000.0
+    # Update manager_quarter from the whole period, amendments included
     cur.execute("""
-        UPDATE manager_quarter
-        SET total_value_m = %s, num_holdings = %s
-        WHERE cik = %s AND period_end = %s
-    """, (total_value_m, len(holdings), cik_padded, period_date))
+        UPDATE manager_quarter q
+        SET total_value_m = COALESCE(s.value_usd_sum, 0) / 1000000.0, num_holdings = COALESCE(s.num_holdings, 0)
+        FROM (SELECT %s::text AS cik, %s::date AS period_end) p
+        LEFT JOIN holding_period_stats s ON s.cik = p.cik AND s.period_end = p.period_end
+        WHERE q.cik = p.cik AND q.period_end = p.period_end
+    """, (cik_padded, period_date))
+    
+    record_loaded(cur, [(acc_no, cik_padded, period_date, len(holdings), units, REPLACE, raw_hash, new_hash)])
     
     time.sleep(REQUEST_DELAY)
-    return {"status": "success", "holdings": len(holdings), "value_m": total_value_m}
+    return {"status": "success", "holdings": len(holdings), "value_m": total_value_m, "units": units}
 
 
 def load_fixes_from_csv(csv_file):
@@ -429,20 +481,43 @@ def load_fixes_from_csv(csv_file):
     return fixes
 
 
+def load_fixes_from_ledger(threshold):
+    """Load (cik, period_end) pairs whose value units were decided with low confidence"""
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], connect_timeout=30)
+    try:
+        with conn.cursor() as cur:
+            ensure_ledger(cur)
+            conn.commit()
+            return [
+                {'cik': cik, 'period_end': period_end.isoformat(), 'manager_name': 'Unknown'}
+                for cik, period_end in low_confidence_periods(cur, threshold)
+            ]
+    finally:
+        conn.close()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Re-fetch holdings for mismatched manager periods")
+    add_profile_arguments(parser)
+    start_profiling_from_args(parser.parse_args())
+
     print("=" * 70)
     print("SEC 13F Holdings Mismatch Fixer")
     print("=" * 70)
     
     load_dotenv()
     
-    # Load fixes from CSV
-    if not os.path.exists(CSV_FILE):
-        print(f"❌ CSV file not found: {CSV_FILE}")
-        return
-    
-    fixes = load_fixes_from_csv(CSV_FILE)
-    print(f"\n📋 Loaded {len(fixes)} unique (cik, period_end) pairs to fix")
+    if FIX_SOURCE == "low_confidence":
+        fixes = load_fixes_from_ledger(LOW_CONFIDENCE)
+        print(f"\n📋 Loaded {len(fixes)} low-confidence (cik, period_end) pairs from the ledger")
+    else:
+        # Load fixes from CSV
+        if not os.path.exists(CSV_FILE):
+            print(f"❌ CSV file not found: {CSV_FILE}")
+            return
+        
+        fixes = load_fixes_from_csv(CSV_FILE)
+        print(f"\n📋 Loaded {len(fixes)} unique (cik, period_end) pairs to fix")
     
     # Time estimate
     est_seconds = len(fixes) * 2.5
@@ -464,6 +539,9 @@ def main():
     )
     conn.autocommit = False
     cur = conn.cursor()
+    ensure_ledger(cur)
+    ensure_period_stats(cur)
+    conn.commit()
     
     # Pre-download quarterly indexes
     print("\n📥 Pre-downloading quarterly indexes...")
@@ -484,6 +562,7 @@ def main():
     # Process fixes
     start_time = datetime.now()
     success = 0
+    unchanged = 0
     failed = 0
     no_filing = 0
     
@@ -503,7 +582,14 @@ def main():
                 
                 if result["status"] == "success":
                     success += 1
-                    print(f"✓ {result['holdings']} holdings, ${result['value_m']:.1f}M", flush=True)
+                    units = result["units"]
+                    unit_info = " [x1 dollars]" if units.multiplier == 1 else ""
+                    if units.confidence < LOW_CONFIDENCE:
+                        unit_info += f" [low unit confidence {units.confidence:.2f}]"
+                    print(f"✓ {result['holdings']} holdings, ${result['value_m']:.1f}M{unit_info}", flush=True)
+                elif result["status"] == "unchanged":
+                    unchanged += 1
+                    print("= unchanged", flush=True)
                 elif result["status"] == "no_filing":
                     no_filing += 1
                     print(f"⚠️ No filing", flush=True)
@@ -535,14 +621,14 @@ def main():
         
         print(f"\n📊 Progress: {done}/{len(fixes)} ({100*done/len(fixes):.1f}%)")
         print(f"⏱️  Elapsed: {str(elapsed).split('.')[0]} | ETA: {eta}")
-        print(f"✓ {success} success | ⚠️ {no_filing} no filing | ❌ {failed} failed")
+        print(f"✓ {success} success | = {unchanged} unchanged | ⚠️ {no_filing} no filing | ❌ {failed} failed")
     
     # Final summary
     total_time = datetime.now() - start_time
     print("\n" + "=" * 70)
     print("✅ COMPLETED")
     print(f"   Total time: {str(total_time).split('.')[0]}")
-    print(f"   Success: {success} | No filing: {no_filing} | Failed: {failed}")
+    print(f"   Success: {success} | Unchanged: {unchanged} | No filing: {no_filing} | Failed: {failed}")
     print("=" * 70)
     
     cur.close()
@@ -7,6 +7,7 @@ known issues (value mismatch, missing holdings).
 The root cause: SEC 13F values are in THOUSANDS, but some XML files
 may have different formatting or our parser had issues.
 """
+import argparse
 import requests
 import psycopg2
 from psycopg2.extras import execute_values
@@ -18,6 +19,9 @@ from dotenv import load_dotenv
 from lxml import etree
 import time
 
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from holding_stats import ensure_period_stats, refresh_period_stats
+
 SEC_HEADERS = {
     "User-Agent": "Naveen Mokkapati navmok@gmail.com",
     "Accept": "*/*",
@@ -44,6 +48,7 @@ SESSION.headers.update(SEC_HEADERS)
 QUARTERLY_INDEXES = {}
 
 
+@stage("index")
 def download_quarterly_index(year, quarter):
     """Download and parse master.idx for a quarter"""
     key = (year, quarter)
@@ -113,6 +118,7 @@ def period_to_quarter(period_end):
     return dt.year, quarter, dt
 
 
+@stage("index")
 def find_13f_filing(cik, period_end):
     """Find 13F filing for a CIK and period"""
     cik_padded = str(cik).zfill(10)
@@ -196,6 +202,7 @@ def find_info_table_url(xml_urls):
     return None
 
 
+@stage("parse")
 def fetch_holdings_fixed(xml_url):
     """
     Fetch holdings with CORRECT value parsing.
@@ -206,7 +213,8 @@ def fetch_holdings_fixed(xml_url):
     print(f"    Fetching: {xml_url}", flush=True)
     
     try:
-        r = SESSION.get(xml_url, timeout=REQUEST_TIMEOUT)
+        with stage("fetch"):
+            r = SESSION.get(xml_url, timeout=REQUEST_TIMEOUT)
         if r.status_code != 200:
             print(f"    ❌ HTTP {r.status_code}", flush=True)
             return []
@@ -398,6 +406,7 @@ def fix_manager_period(cik, period_end, info_table_url, cur, conn):
             value_usd = EXCLUDED.value_usd,
             shares = EXCLUDED.shares
     """, values, page_size=500)
+    refresh_period_stats(cur, [(cik_padded, period_end)], "fix_specific_manager")
     
     # Update manager_quarter
     total_value_m = sum(h["value_usd"] or 0 for h in holdings) / 1_000_000.0
@@ -417,6 +426,10 @@ def fix_manager_period(cik, period_end, info_table_url, cur, conn):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Re-fetch holdings for specific manager periods")
+    add_profile_arguments(parser)
+    start_profiling_from_args(parser.parse_args())
+
     print("=" * 70)
     print("SEC 13F Data Fixer - Specific Manager Periods")
     print("=" * 70)
@@ -429,6 +442,8 @@ def main():
     )
     conn.autocommit = False
     cur = conn.cursor()
+    ensure_period_stats(cur)
+    conn.commit()
     
     success = 0
     failed = 0
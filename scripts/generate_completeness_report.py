@@ -3,39 +3,153 @@ SEC 13F Data Completeness Report Generator
 
 Generates CSV reports comparing expected vs downloaded holdings/values
 for each manager and period.
+
+The full comparison is streamed from a server-side cursor (report_export.py)
+straight into the full report; its non-OK rows go from the same pass into
+an ExternalSort (report_export.py, sorted runs spilled to temporary files)
+and are written to the problems-only report ordered by status,
+manager_name, period_end, as that report always was. The status breakdown is counted on
+the way. The manager summary is the only other query, and the top problem
+managers are picked from its rows.
+
+Every query runs partitioned by CIK range (report_export.cik_ranges) on
+--workers connections at once; the partial results are merged here. Ranges
+are disjoint and ordered, so counts add up and the full report stays in
+cik / period order. --format csv.gz / parquet writes compressed files.
+
+Periods found MISSING, PARTIAL or VALUE_1000X_HIGH are enqueued in
+repair_queue (unless --no-enqueue), for scrape_single_13f_optimized.py
+--queue to re-ingest.
+
+Usage:
+    python generate_completeness_report.py
+    python generate_completeness_report.py --format parquet --workers 8
 """
+import argparse
 import psycopg2
-import csv
 import os
+from collections import Counter, defaultdict
 from datetime import datetime
 from dotenv import load_dotenv
 
+from holding_stats import PERIOD_TOTALS, ensure_period_stats
+from profiling import add_profile_arguments, start_profiling_from_args
+from repair_queue import REASONS as REPAIR_REASONS, enqueue_repairs, ensure_repair_queue
+from report_export import (FORMATS, ExternalSort, cik_range_sql, cik_ranges, map_partitions, open_report,
+                           stream_partitions)
+
+WORKERS = 4                 # connections running partitions at once
+PARTITIONS_PER_WORKER = 2   # more ranges than connections, so one slow range doesn't hold up the rest
+
+STATUS_ORDER = ['OK', 'PARTIAL', 'VALUE_MISMATCH', 'VALUE_1000X_HIGH', 'MISSING']
+
+# Problems-only report: the full report's columns without holdings_pct_complete
+PROBLEM_COLUMNS = [
+    'cik', 'period_end', 'manager_name',
+    'expected_holdings', 'downloaded_holdings',
+    'expected_value_millions', 'downloaded_value_millions',
+    'value_pct_complete', 'status'
+]
+
+SUMMARY_SQL = f"""
+    SELECT
+        (SELECT COUNT(*) FROM manager_quarter mq WHERE {cik_range_sql("mq.cik")}),
+        (SELECT COUNT(*) FROM holding_period_stats s WHERE {cik_range_sql("s.cik")}),
+        (SELECT COUNT(DISTINCT mq.cik) FROM manager_quarter mq WHERE {cik_range_sql("mq.cik")})
+"""
+
+FULL_SQL = f"""
+    SELECT 
+        mq.cik,
+        mq.period_end,
+        mq.manager_name,
+        mq.num_holdings as expected_holdings,
+        COALESCE(h.actual_holdings, 0) as downloaded_holdings,
+        mq.total_value_m as expected_value_millions,
+        ROUND(COALESCE(h.sum_value_m, 0)::numeric, 2) as downloaded_value_millions,
+        CASE 
+            WHEN mq.num_holdings > 0 THEN 
+                ROUND(100.0 * COALESCE(h.actual_holdings, 0) / mq.num_holdings, 1)
+            ELSE NULL 
+        END as holdings_pct_complete,
+        CASE 
+            WHEN mq.total_value_m > 0 THEN 
+                ROUND(100.0 * COALESCE(h.sum_value_m, 0) / mq.total_value_m, 1)
+            ELSE NULL 
+        END as value_pct_complete,
+        CASE
+            WHEN h.actual_holdings IS NULL THEN 'MISSING'
+            WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 'VALUE_1000X_HIGH'
+            WHEN mq.total_value_m > 0 AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 THEN 'VALUE_MISMATCH'
+            WHEN mq.num_holdings > 0 AND COALESCE(h.actual_holdings, 0) < mq.num_holdings * 0.95 THEN 'PARTIAL'
+            ELSE 'OK'
+        END as status
+    FROM manager_quarter mq
+    LEFT JOIN {PERIOD_TOTALS} h ON mq.cik = h.cik AND mq.period_end = h.period_end
+    WHERE {cik_range_sql("mq.cik")}
+    ORDER BY mq.cik, mq.period_end
+"""
+
+MANAGER_SQL = f"""
+    SELECT 
+        mq.cik,
+        mq.manager_name,
+        COUNT(*) as total_periods,
+        SUM(CASE WHEN h.actual_holdings IS NOT NULL 
+                 AND (mq.total_value_m IS NULL OR mq.total_value_m = 0 OR ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) <= mq.total_value_m * 0.2)
+                 AND (mq.num_holdings IS NULL OR mq.num_holdings = 0 OR COALESCE(h.actual_holdings, 0) >= mq.num_holdings * 0.95)
+                 THEN 1 ELSE 0 END) as ok_periods,
+        SUM(CASE WHEN h.actual_holdings IS NULL THEN 1 ELSE 0 END) as missing_periods,
+        SUM(CASE WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 1 ELSE 0 END) as value_1000x_periods,
+        SUM(CASE WHEN h.actual_holdings IS NOT NULL 
+                 AND mq.total_value_m > 0 
+                 AND COALESCE(h.sum_value_m, 0) <= mq.total_value_m * 1000
+                 AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 
+                 THEN 1 ELSE 0 END) as value_mismatch_periods,
+        SUM(CASE WHEN h.actual_holdings IS NOT NULL 
+                 AND mq.num_holdings > 0 
+                 AND COALESCE(h.actual_holdings, 0) < mq.num_holdings * 0.95 
+                 THEN 1 ELSE 0 END) as partial_periods
+    FROM manager_quarter mq
+    LEFT JOIN {PERIOD_TOTALS} h ON mq.cik = h.cik AND mq.period_end = h.period_end
+    WHERE {cik_range_sql("mq.cik")}
+    GROUP BY mq.cik, mq.manager_name
+"""
+
 def main():
+    parser = argparse.ArgumentParser(description="Generate SEC 13F data completeness report")
+    parser.add_argument("--format", choices=FORMATS, default="csv", help="Report file format (default: csv)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help=f"Connections running report partitions at once (default: {WORKERS})")
+    parser.add_argument("--no-enqueue", action="store_true",
+                        help=f"Don't queue {', '.join(REPAIR_REASONS)} periods for repair")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiling_from_args(args)
+
     print("=" * 70)
     print("SEC 13F Data Completeness Report")
     print("=" * 70)
     
     load_dotenv()
+    db_url = os.environ["DATABASE_URL"]
     
-    conn = psycopg2.connect(
-        os.environ["DATABASE_URL"],
-        connect_timeout=30,
-    )
+    conn = psycopg2.connect(db_url, connect_timeout=30)
     cur = conn.cursor()
+    ensure_period_stats(cur)
+    ranges = cik_ranges(cur, "manager_quarter", args.workers * PARTITIONS_PER_WORKER)
+    conn.commit()
+    cur.close()
+    conn.close()
+    print(f"\n⚙️  {len(ranges)} CIK partitions on {args.workers} connections")
     
     # =========================================================================
     # SUMMARY STATS
     # =========================================================================
     print("\n📊 SUMMARY STATISTICS\n")
     
-    cur.execute("SELECT COUNT(*) FROM manager_quarter")
-    total_periods = cur.fetchone()[0]
-    
-    cur.execute("SELECT COUNT(DISTINCT (cik, period_end)) FROM manager_quarter_holding")
-    periods_with_holdings = cur.fetchone()[0]
-    
-    cur.execute("SELECT COUNT(DISTINCT cik) FROM manager_quarter")
-    total_managers = cur.fetchone()[0]
+    _, partials = map_partitions(db_url, SUMMARY_SQL, ranges, args.workers)
+    total_periods, periods_with_holdings, total_managers = (sum(p[0][i] for p in partials) for i in range(3))
     
     print(f"   Total manager-periods expected: {total_periods:,}")
     print(f"   Periods with holdings data:     {periods_with_holdings:,}")
@@ -43,280 +157,105 @@ def main():
     print(f"   Total unique managers:          {total_managers:,}")
     
     # =========================================================================
-    # STATUS BREAKDOWN
-    # =========================================================================
-    print("\n📊 STATUS BREAKDOWN\n")
-    
-    cur.execute("""
-        SELECT 
-            status,
-            COUNT(*) as period_count,
-            COUNT(DISTINCT cik) as manager_count
-        FROM (
-            SELECT 
-                mq.cik,
-                mq.period_end,
-                CASE
-                    WHEN h.actual_holdings IS NULL THEN 'MISSING'
-                    WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 'VALUE_1000X_HIGH'
-                    WHEN mq.total_value_m > 0 AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 THEN 'VALUE_MISMATCH'
-                    WHEN mq.num_holdings > 0 AND COALESCE(h.actual_holdings, 0) < mq.num_holdings * 0.95 THEN 'PARTIAL'
-                    ELSE 'OK'
-                END as status
-            FROM manager_quarter mq
-            LEFT JOIN (
-                SELECT 
-                    cik,
-                    period_end,
-                    COUNT(*) as actual_holdings,
-                    SUM(value_usd) / 1000000.0 as sum_value_m
-                FROM manager_quarter_holding
-                GROUP BY cik, period_end
-            ) h ON mq.cik = h.cik AND mq.period_end = h.period_end
-        ) sub
-        GROUP BY status
-        ORDER BY 
-            CASE status 
-                WHEN 'OK' THEN 1
-                WHEN 'PARTIAL' THEN 2
-                WHEN 'VALUE_MISMATCH' THEN 3
-                WHEN 'VALUE_1000X_HIGH' THEN 4
-                WHEN 'MISSING' THEN 5
-            END
-    """)
-    
-    print(f"   {'Status':<20} {'Periods':>10} {'Managers':>10}")
-    print(f"   {'-'*20} {'-'*10} {'-'*10}")
-    for row in cur.fetchall():
-        status, period_count, manager_count = row
-        print(f"   {status:<20} {period_count:>10,} {manager_count:>10,}")
-    
-    # =========================================================================
-    # EXPORT FULL REPORT TO CSV
+    # EXPORT FULL AND PROBLEMS-ONLY REPORTS (one streamed pass)
     # =========================================================================
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    # Full comparison report
-    print(f"\n📄 Generating full comparison report...")
+    print("\n📄 Generating full comparison and problems-only reports...")
     
-    cur.execute("""
-        SELECT 
-            mq.cik,
-            mq.period_end,
-            mq.manager_name,
-            mq.num_holdings as expected_holdings,
-            COALESCE(h.actual_holdings, 0) as downloaded_holdings,
-            mq.total_value_m as expected_value_millions,
-            ROUND(COALESCE(h.sum_value_m, 0)::numeric, 2) as downloaded_value_millions,
-            CASE 
-                WHEN mq.num_holdings > 0 THEN 
-                    ROUND(100.0 * COALESCE(h.actual_holdings, 0) / mq.num_holdings, 1)
-                ELSE NULL 
-            END as holdings_pct_complete,
-            CASE 
-                WHEN mq.total_value_m > 0 THEN 
-                    ROUND(100.0 * COALESCE(h.sum_value_m, 0) / mq.total_value_m, 1)
-                ELSE NULL 
-            END as value_pct_complete,
-            CASE
-                WHEN h.actual_holdings IS NULL THEN 'MISSING'
-                WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 'VALUE_1000X_HIGH'
-                WHEN mq.total_value_m > 0 AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 THEN 'VALUE_MISMATCH'
-                WHEN mq.num_holdings > 0 AND COALESCE(h.actual_holdings, 0) < mq.num_holdings * 0.95 THEN 'PARTIAL'
-                ELSE 'OK'
-            END as status
-        FROM manager_quarter mq
-        LEFT JOIN (
-            SELECT 
-                cik,
-                period_end,
-                COUNT(*) as actual_holdings,
-                SUM(value_usd) / 1000000.0 as sum_value_m
-            FROM manager_quarter_holding
-            GROUP BY cik, period_end
-        ) h ON mq.cik = h.cik AND mq.period_end = h.period_end
-        ORDER BY mq.cik, mq.period_end
-    """)
+    columns, rows = stream_partitions(db_url, FULL_SQL, ranges, args.workers)
     
-    rows = cur.fetchall()
-    columns = [
-        'cik', 'period_end', 'manager_name', 
-        'expected_holdings', 'downloaded_holdings',
-        'expected_value_millions', 'downloaded_value_millions',
-        'holdings_pct_complete', 'value_pct_complete', 'status'
-    ]
+    # Problems-only: the non-OK rows of the same pass, without holdings_pct_complete
+    problem_columns = columns.select(PROBLEM_COLUMNS, rename={'value_pct_complete': 'value_pct'})
+    problem_idx = [columns.index(c) for c in PROBLEM_COLUMNS]
+    status_idx = columns.index('status')
     
-    filename = f"data_completeness_full_{timestamp}.csv"
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(columns)
-        writer.writerows(rows)
+    # Problems-only keeps its old order: status, manager_name (NULLs last), period_end
+    s, m, p = (PROBLEM_COLUMNS.index(c) for c in ('status', 'manager_name', 'period_end'))
     
-    print(f"   ✓ Saved: {filename} ({len(rows):,} rows)")
+    status_periods = Counter()
+    status_managers = defaultdict(set)
+    repairs = []
+    full_file = f"data_completeness_full_{timestamp}.{args.format}"
+    problems_file = f"data_completeness_problems_{timestamp}.{args.format}"
+    with ExternalSort(key=lambda r: (r[s], r[m] is None, r[m] or "", r[p])) as problem_rows:
+        with open_report(full_file, columns) as full:
+            for row in rows:
+                full.write(row)
+                status = row[status_idx]
+                status_periods[status] += 1
+                status_managers[status].add(row[0])
+                if status != 'OK':
+                    problem_rows.add([row[i] for i in problem_idx])
+                if status in REPAIR_REASONS:
+                    repairs.append((row[0], row[1], status))
+        
+        print(f"   ✓ Saved: {full_file} ({full.rows_written:,} rows)")
+        
+        with open_report(problems_file, problem_columns) as problems:
+            for row in problem_rows:
+                problems.write(row)
+    print(f"   ✓ Saved: {problems_file} ({problems.rows_written:,} rows)")
+    
+    if not args.no_enqueue:
+        conn = psycopg2.connect(db_url, connect_timeout=30)
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    ensure_repair_queue(cur)
+                    pending = enqueue_repairs(cur, repairs)
+        finally:
+            conn.close()
+        print(f"   🧰 Queued for repair: {len(repairs):,} periods ({pending:,} pending)"
+              f" -> scrape_single_13f_optimized.py --queue")
     
     # =========================================================================
-    # EXPORT PROBLEMS ONLY TO CSV
+    # STATUS BREAKDOWN
     # =========================================================================
-    print(f"\n📄 Generating problems-only report...")
-    
-    cur.execute("""
-        SELECT 
-            mq.cik,
-            mq.period_end,
-            mq.manager_name,
-            mq.num_holdings as expected_holdings,
-            COALESCE(h.actual_holdings, 0) as downloaded_holdings,
-            mq.total_value_m as expected_value_millions,
-            ROUND(COALESCE(h.sum_value_m, 0)::numeric, 2) as downloaded_value_millions,
-            CASE 
-                WHEN mq.total_value_m > 0 THEN 
-                    ROUND(100.0 * COALESCE(h.sum_value_m, 0) / mq.total_value_m, 1)
-                ELSE NULL 
-            END as value_pct,
-            CASE
-                WHEN h.actual_holdings IS NULL THEN 'MISSING'
-                WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 'VALUE_1000X_HIGH'
-                WHEN mq.total_value_m > 0 AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 THEN 'VALUE_MISMATCH'
-                WHEN mq.num_holdings > 0 AND COALESCE(h.actual_holdings, 0) < mq.num_holdings * 0.95 THEN 'PARTIAL'
-                ELSE 'OK'
-            END as status
-        FROM manager_quarter mq
-        LEFT JOIN (
-            SELECT 
-                cik,
-                period_end,
-                COUNT(*) as actual_holdings,
-                SUM(value_usd) / 1000000.0 as sum_value_m
-            FROM manager_quarter_holding
-            GROUP BY cik, period_end
-        ) h ON mq.cik = h.cik AND mq.period_end = h.period_end
-        WHERE 
-            h.actual_holdings IS NULL
-            OR (mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000)
-            OR (mq.total_value_m > 0 AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2)
-            OR (mq.num_holdings > 0 AND COALESCE(h.actual_holdings, 0) < mq.num_holdings * 0.95)
-        ORDER BY status, mq.manager_name, mq.period_end
-    """)
-    
-    rows = cur.fetchall()
-    columns = [
-        'cik', 'period_end', 'manager_name', 
-        'expected_holdings', 'downloaded_holdings',
-        'expected_value_millions', 'downloaded_value_millions',
-        'value_pct', 'status'
-    ]
-    
-    filename = f"data_completeness_problems_{timestamp}.csv"
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(columns)
-        writer.writerows(rows)
+    print("\n📊 STATUS BREAKDOWN\n")
     
-    print(f"   ✓ Saved: {filename} ({len(rows):,} rows)")
+    print(f"   {'Status':<20} {'Periods':>10} {'Managers':>10}")
+    print(f"   {'-'*20} {'-'*10} {'-'*10}")
+    for status in STATUS_ORDER:
+        if status_periods[status]:
+            print(f"   {status:<20} {status_periods[status]:>10,} {len(status_managers[status]):>10,}")
     
     # =========================================================================
-    # EXPORT MANAGER SUMMARY TO CSV
+    # EXPORT MANAGER SUMMARY
     # =========================================================================
     print(f"\n📄 Generating manager summary report...")
     
-    cur.execute("""
-        SELECT 
-            mq.cik,
-            mq.manager_name,
-            COUNT(*) as total_periods,
-            SUM(CASE WHEN h.actual_holdings IS NOT NULL 
-                     AND (mq.total_value_m IS NULL OR mq.total_value_m = 0 OR ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) <= mq.total_value_m * 0.2)
-                     AND (mq.num_holdings IS NULL OR mq.num_holdings = 0 OR COALESCE(h.actual_holdings, 0) >= mq.num_holdings * 0.95)
-                     THEN 1 ELSE 0 END) as ok_periods,
-            SUM(CASE WHEN h.actual_holdings IS NULL THEN 1 ELSE 0 END) as missing_periods,
-            SUM(CASE WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 1 ELSE 0 END) as value_1000x_periods,
-            SUM(CASE WHEN h.actual_holdings IS NOT NULL 
-                     AND mq.total_value_m > 0 
-                     AND COALESCE(h.sum_value_m, 0) <= mq.total_value_m * 1000
-                     AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 
-                     THEN 1 ELSE 0 END) as value_mismatch_periods,
-            SUM(CASE WHEN h.actual_holdings IS NOT NULL 
-                     AND mq.num_holdings > 0 
-                     AND COALESCE(h.actual_holdings, 0) < mq.num_holdings * 0.95 
-                     THEN 1 ELSE 0 END) as partial_periods
-        FROM manager_quarter mq
-        LEFT JOIN (
-            SELECT 
-                cik,
-                period_end,
-                COUNT(*) as actual_holdings,
-                SUM(value_usd) / 1000000.0 as sum_value_m
-            FROM manager_quarter_holding
-            GROUP BY cik, period_end
-        ) h ON mq.cik = h.cik AND mq.period_end = h.period_end
-        GROUP BY mq.cik, mq.manager_name
-        ORDER BY mq.manager_name
-    """)
-    
-    rows = cur.fetchall()
-    columns = [
-        'cik', 'manager_name', 'total_periods', 'ok_periods',
-        'missing_periods', 'value_1000x_periods', 'value_mismatch_periods', 'partial_periods'
-    ]
+    columns, partials = map_partitions(db_url, MANAGER_SQL, ranges, args.workers)
+    managers = sorted((row for rows in partials for row in rows), key=lambda r: (r[1] is None, r[1] or "", r[0] or ""))
     
-    filename = f"data_completeness_by_manager_{timestamp}.csv"
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(columns)
-        writer.writerows(rows)
+    filename = f"data_completeness_by_manager_{timestamp}.{args.format}"
+    with open_report(filename, columns) as out:
+        for row in managers:
+            out.write(row)
     
-    print(f"   ✓ Saved: {filename} ({len(rows):,} rows)")
+    print(f"   ✓ Saved: {filename} ({out.rows_written:,} rows)")
     
     # =========================================================================
     # SHOW TOP PROBLEM MANAGERS
     # =========================================================================
     print(f"\n🔍 TOP 20 MANAGERS WITH ISSUES:\n")
     
-    cur.execute("""
-        SELECT 
-            mq.cik,
-            mq.manager_name,
-            COUNT(*) as total_periods,
-            SUM(CASE WHEN h.actual_holdings IS NULL THEN 1 ELSE 0 END) as missing,
-            SUM(CASE WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 1 ELSE 0 END) as val_1000x,
-            SUM(CASE WHEN h.actual_holdings IS NOT NULL 
-                     AND mq.total_value_m > 0 
-                     AND COALESCE(h.sum_value_m, 0) <= mq.total_value_m * 1000
-                     AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 
-                     THEN 1 ELSE 0 END) as val_mismatch
-        FROM manager_quarter mq
-        LEFT JOIN (
-            SELECT cik, period_end, COUNT(*) as actual_holdings, SUM(value_usd) / 1000000.0 as sum_value_m
-            FROM manager_quarter_holding GROUP BY cik, period_end
-        ) h ON mq.cik = h.cik AND mq.period_end = h.period_end
-        GROUP BY mq.cik, mq.manager_name
-        HAVING 
-            SUM(CASE WHEN h.actual_holdings IS NULL THEN 1 ELSE 0 END) > 0
-            OR SUM(CASE WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 1 ELSE 0 END) > 0
-            OR SUM(CASE WHEN h.actual_holdings IS NOT NULL AND mq.total_value_m > 0 
-                        AND COALESCE(h.sum_value_m, 0) <= mq.total_value_m * 1000
-                        AND ABS(COALESCE(h.sum_value_m, 0) - mq.total_value_m) > mq.total_value_m * 0.2 
-                        THEN 1 ELSE 0 END) > 0
-        ORDER BY 
-            SUM(CASE WHEN h.actual_holdings IS NULL THEN 1 ELSE 0 END) DESC,
-            SUM(CASE WHEN mq.total_value_m > 0 AND COALESCE(h.sum_value_m, 0) > mq.total_value_m * 1000 THEN 1 ELSE 0 END) DESC
-        LIMIT 20
-    """)
+    # Managers with missing, 1000x or mismatched periods; most missing, then most 1000x first
+    problem_managers = [m for m in managers if m[4] or m[5] or m[6]]
+    problem_managers.sort(key=lambda m: (-m[4], -m[5]))
     
     print(f"   {'Manager':<40} {'Total':>6} {'Miss':>6} {'1000x':>6} {'Mismatch':>8}")
     print(f"   {'-'*40} {'-'*6} {'-'*6} {'-'*6} {'-'*8}")
-    for row in cur.fetchall():
-        cik, name, total, missing, val_1000x, val_mismatch = row
+    for row in problem_managers[:20]:
+        cik, name, total, _, missing, val_1000x, val_mismatch, _ = row
+        name = name or ''
         name_short = (name[:37] + '...') if len(name) > 40 else name
         print(f"   {name_short:<40} {total:>6} {missing:>6} {val_1000x:>6} {val_mismatch:>8}")
     
     print("\n" + "=" * 70)
     print("✅ Reports generated successfully!")
     print("=" * 70)
-    
-    cur.close()
-    conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
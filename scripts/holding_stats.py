@@ -0,0 +1,179 @@
+"""
+Per-period holding statistics, maintained at write time.
+
+Every QA and report script used to aggregate manager_quarter_holding
+(COUNT(*), SUM(value_usd), MAX(line_no) ... GROUP BY cik, period_end) over
+tens of millions of rows, often several times per run. holding_period_stats
+keeps those aggregates, one row per (cik, period_end):
+
+  num_holdings    rows stored for the period
+  num_valued      rows with value_usd > 0
+  value_usd_sum   SUM(value_usd)
+  max_line_no     MAX(line_no) (well above num_holdings means skipped lines)
+  null_shares     rows without shares (failed / partial parses)
+  source          the writer that last touched the period
+
+Writers call refresh_period_stats in the same transaction as their DELETE /
+INSERT into manager_quarter_holding: it recomputes the touched periods only
+(through the primary key, which leads with cik, period_end) and deletes the
+stats of periods left without holdings, so the table can never disagree
+with the committed holdings. It refreshes the periods' SEC fingerprints
+(fingerprint_tree) in the same step. Readers join it instead of aggregating;
+PERIOD_TOTALS is the drop-in replacement for the usual subquery.
+
+ensure_period_stats creates the table and, the first time, fills it from
+the existing holdings. Holdings written by anything that does not maintain
+the stats (a manual fix in psql) need a rebuild: --rebuild below.
+
+Usage:
+    ensure_period_stats(cur)
+    refresh_period_stats(cur, [(cik, period_end)], "scrape_single_13f")
+
+    cur.execute(f"SELECT ... FROM manager_quarter mq LEFT JOIN {PERIOD_TOTALS} h USING (cik, period_end)")
+
+From the shell:
+    python holding_stats.py --rebuild
+"""
+import argparse
+import os
+from datetime import date
+
+import psycopg2
+from dotenv import load_dotenv
+
+from filing_ids import period_end_quarter
+from fingerprint_tree import SEC, refresh_fingerprints
+from profiling import stage
+
+TABLE = "holding_period_stats"
+HOLDINGS_TABLE = "manager_quarter_holding"
+
+STATS_COLUMNS = ["num_holdings", "num_valued", "value_usd_sum", "max_line_no", "null_shares"]
+STATS_SELECT = """
+    COUNT(*),
+    COUNT(*) FILTER (WHERE value_usd > 0),
+    SUM(value_usd),
+    MAX(line_no),
+    COUNT(*) FILTER (WHERE shares IS NULL)
+"""
+
+# Same shape as the old per-period aggregate: cik, period_end, actual_holdings, sum_value_m
+PERIOD_TOTALS = f"""(
+    SELECT cik, period_end, num_holdings AS actual_holdings, value_usd_sum / 1000000.0 AS sum_value_m
+    FROM {TABLE}
+)"""
+
+
+def ensure_period_stats(cur):
+    """Create holding_period_stats; returns True when it was just created and filled."""
+    cur.execute("SELECT to_regclass(%s)", (TABLE,))
+    if cur.fetchone()[0] is not None:
+        return False
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            cik TEXT NOT NULL,
+            period_end DATE NOT NULL,
+            num_holdings INTEGER NOT NULL,
+            num_valued INTEGER NOT NULL,
+            value_usd_sum NUMERIC,
+            max_line_no INTEGER,
+            null_shares INTEGER NOT NULL,
+            source TEXT,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (cik, period_end)
+        )
+    """)
+    cur.execute("SELECT to_regclass(%s)", (HOLDINGS_TABLE,))
+    if cur.fetchone()[0] is not None:
+        print(f"🔧 {TABLE}: building from {HOLDINGS_TABLE} (one-time)...")
+        rebuild_period_stats(cur)
+    return True
+
+
+@stage("db")
+def refresh_period_stats(cur, periods, source):
+    """Recompute the stats of the given (cik, period_end) pairs. Returns periods with holdings.
+
+    Call in the writer's transaction, after its writes to manager_quarter_holding.
+    """
+    periods = sorted(set(periods))
+    if not periods:
+        return 0
+    ciks = [p[0] for p in periods]
+    ends = [p[1] for p in periods]
+    cur.execute(f"""
+        WITH touched AS (
+            SELECT * FROM unnest(%(ciks)s::text[], %(ends)s::date[]) AS t (cik, period_end)
+        ),
+        stats AS (
+            SELECT h.cik, h.period_end, {STATS_SELECT}
+            FROM touched t
+            JOIN {HOLDINGS_TABLE} h ON h.cik = t.cik AND h.period_end = t.period_end
+            GROUP BY h.cik, h.period_end
+        ),
+        gone AS (
+            DELETE FROM {TABLE} s
+            USING touched t
+            WHERE s.cik = t.cik AND s.period_end = t.period_end
+              AND NOT EXISTS (SELECT 1 FROM stats n WHERE n.cik = t.cik AND n.period_end = t.period_end)
+        )
+        INSERT INTO {TABLE} (cik, period_end, {", ".join(STATS_COLUMNS)}, source)
+        SELECT stats.*, %(source)s FROM stats
+        ON CONFLICT (cik, period_end) DO UPDATE SET
+            {", ".join(f"{c} = EXCLUDED.{c}" for c in STATS_COLUMNS)},
+            source = EXCLUDED.source, updated_at = NOW()
+    """, {"ciks": ciks, "ends": ends, "source": source})
+    written = cur.rowcount
+    refresh_fingerprints(cur, SEC, [
+        (cik, period_end_quarter(end if isinstance(end, date) else date.fromisoformat(str(end)[:10])))
+        for cik, end in periods
+    ])
+    return written
+
+
+@stage("db")
+def rebuild_period_stats(cur, source="rebuild"):
+    """Recompute every period from manager_quarter_holding. Returns periods written."""
+    cur.execute(f"LOCK TABLE {TABLE} IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(f"TRUNCATE {TABLE}")
+    cur.execute(f"""
+        INSERT INTO {TABLE} (cik, period_end, {", ".join(STATS_COLUMNS)}, source)
+        SELECT cik, period_end, {STATS_SELECT}, %s
+        FROM {HOLDINGS_TABLE}
+        GROUP BY cik, period_end
+    """, (source,))
+    written = cur.rowcount
+    cur.execute(f"ANALYZE {TABLE}")
+    return written
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Maintain holding_period_stats")
+    ap.add_argument("--rebuild", action="store_true",
+                    help="Recompute every period from manager_quarter_holding")
+    args = ap.parse_args()
+
+    load_dotenv()
+    if "DATABASE_URL" not in os.environ:
+        print("❌ DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                created = ensure_period_stats(cur)
+                if args.rebuild and not created:
+                    written = rebuild_period_stats(cur)
+                    print(f"✅ {TABLE} rebuilt: {written:,} periods")
+                cur.execute(f"SELECT COUNT(*), COALESCE(SUM(num_holdings), 0) FROM {TABLE}")
+                periods, holdings = cur.fetchone()
+    finally:
+        conn.close()
+
+    print(f"📊 {TABLE}: {periods:,} periods, {holdings:,} holdings")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,84 @@
+"""
+Compressed columnar archive of scraped holdings rows.
+
+Replaces the CSV backup the scrapers used to append next to their database
+load: rows (tuples in HOLDING_COLUMNS order, as handed to CopyWriter) are
+buffered and written as zstd-compressed Parquet part files, one per
+CHUNK_ROWS rows. Text columns are stored as strings and value_000 / pct /
+shares as doubles, so the archive reads back with the same types whatever
+mix of strings and numbers the source returned.
+
+Needs pyarrow (pip install pyarrow); it is imported only when an archive is
+opened, so scripts that never pass --archive-dir do not depend on it.
+
+Usage:
+    with HoldingsArchive(args.archive_dir, prefix="backfill") as archive:
+        archive.write(rows)
+    print(archive.rows_written, archive.files)
+
+    # Reading back
+    import pyarrow.parquet as pq
+    table = pq.read_table(args.archive_dir)
+"""
+import os
+import time
+
+from copy_writer import CHUNK_ROWS
+from profiling import stage
+from resume_store import HOLDING_COLUMNS, NUMERIC_COLUMNS, to_number
+
+COMPRESSION = "zstd"
+
+
+def _text(v):
+    return None if v is None else str(v)
+
+
+class HoldingsArchive:
+    """Buffers holdings rows and writes them as compressed Parquet part files."""
+
+    def __init__(self, directory, prefix="holdings", chunk_rows=CHUNK_ROWS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Writing a holdings archive needs pyarrow: pip install pyarrow") from e
+        self._pa, self._pq = pa, pq
+        self.schema = pa.schema([(c, pa.float64() if c in NUMERIC_COLUMNS else pa.string())
+                                 for c in HOLDING_COLUMNS])
+        self.directory = directory
+        self.prefix = f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}"
+        self.chunk_rows = chunk_rows
+        self.rows_written = 0
+        self.files = []
+        self._rows = []
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close()
+
+    def write(self, rows):
+        self._rows.extend(rows)
+        while len(self._rows) >= self.chunk_rows:
+            chunk, self._rows = self._rows[:self.chunk_rows], self._rows[self.chunk_rows:]
+            self._write_part(chunk)
+
+    def close(self):
+        if self._rows:
+            chunk, self._rows = self._rows, []
+            self._write_part(chunk)
+
+    @stage("archive")
+    def _write_part(self, rows):
+        columns = []
+        for i, name in enumerate(HOLDING_COLUMNS):
+            convert = to_number if name in NUMERIC_COLUMNS else _text
+            columns.append(self._pa.array([convert(r[i]) for r in rows], type=self.schema.field(name).type))
+        table = self._pa.Table.from_arrays(columns, schema=self.schema)
+        path = os.path.join(self.directory, f"{self.prefix}-{len(self.files):05d}.parquet")
+        self._pq.write_table(table, path, compression=COMPRESSION)
+        self.files.append(path)
+        self.rows_written += len(rows)
@@ -0,0 +1,246 @@
+"""
+Canonical CIKs and a natural key for public.expected_13finfo_holdings.
+
+The table used to receive both '0000102909' and '102909' for the same
+manager, so every comparison query wrapped cik in LPAD(LTRIM(cik, '0'), 10,
+'0') (which no index can serve) and remove_duplicates.py had to rebuild the
+table from time to time. Now:
+
+  cik          always the 10-digit zero-padded text form, the same form as
+               manager_quarter_holding.cik, so joins are plain equality
+  natural key  unique (cik, quarter, cusip, class, option_type), with NULL
+               cusip / class / option_type treated as ''
+
+Writers stage rows and upsert them (upsert_holdings_rows): CIKs are
+normalized on the way in; when a batch has several rows for one key the one
+staged last (the latest scrape) is kept as is, nothing is summed; a key that
+is already stored is overwritten by the newer scrape. A duplicate can never
+be written. The 13f.info fingerprints (fingerprint_tree) of the upserted periods are
+refreshed in the same transaction.
+
+ensure_holdings_key creates the key; on a table that predates it, it first
+normalizes CIKs and collapses existing duplicates (keeping the most recently
+scraped row per key), once. An index from before NULL cusips were keyed as
+'' (LEGACY_KEY_INDEX) counts as missing and is replaced the same way. The same steps are exposed per partition
+(normalize_partition_ciks, dedupe_partition) for remove_duplicates.py,
+which runs them online, one quarter or CIK range per transaction.
+
+Usage:
+    ensure_holdings_key(cur)
+    upsert_holdings_rows(cur, TABLE, HOLDING_COLUMNS, rows)     # tuples in column order
+    CopyWriter(db_url, TABLE, HOLDING_COLUMNS, copy=upsert_holdings_rows)
+
+    cur.execute(f"INSERT INTO {TABLE} (...) SELECT ... {ON_CONFLICT_UPDATE}")
+"""
+from copy_writer import copy_rows
+from fingerprint_tree import INFO, refresh_fingerprints
+
+TABLE = "public.expected_13finfo_holdings"
+KEY_INDEX = "expected_13finfo_holdings_key"
+LEGACY_KEY_INDEX = "expected_13finfo_holdings_natural_key"     # NULL cusips were distinct
+CIK_CHECK = "expected_13finfo_holdings_cik_canonical"
+STAGE_TABLE = "expected_13finfo_holdings_stage"
+
+HOLDING_COLUMNS = ["manager_url", "cik", "quarter", "filing_url", "sym", "issuer_name",
+                   "class", "cusip", "value_000", "pct", "shares", "principal", "option_type"]
+
+# Index columns of the natural key, as ON CONFLICT must spell them
+NATURAL_KEY = "cik, quarter, (COALESCE(cusip, '')), (COALESCE(class, '')), (COALESCE(option_type, ''))"
+
+UPDATE_COLUMNS = [c for c in HOLDING_COLUMNS if c not in ("cik", "quarter", "cusip")]
+ON_CONFLICT_UPDATE = (f"ON CONFLICT ({NATURAL_KEY}) DO UPDATE SET "
+                      + ", ".join(f"{c} = EXCLUDED.{c}" for c in UPDATE_COLUMNS)
+                      + ", scraped_at = NOW()")
+
+
+def normalize_cik(cik):
+    """'102909', 102909 or '0000102909' -> '0000102909'; None / '' -> None."""
+    if cik is None:
+        return None
+    cik = str(cik).strip()
+    if not cik:
+        return None
+    return cik.lstrip("0").zfill(10)
+
+
+def cik_sql(expr):
+    """SQL for the canonical form of a cik expression (normalize_cik in SQL)."""
+    return f"LPAD(LTRIM(NULLIF(TRIM({expr}), ''), '0'), 10, '0')"
+
+
+def _latest_select(source):
+    """SELECT over `source` keeping its last row (highest ctid) per natural key, in HOLDING_COLUMNS order."""
+    key = f"{cik_sql('cik')}, quarter, COALESCE(cusip, ''), COALESCE(class, ''), COALESCE(option_type, '')"
+    outputs = [cik_sql("cik") if c == "cik" else c for c in HOLDING_COLUMNS]
+    return f"""
+        SELECT DISTINCT ON ({key}) {", ".join(f"{expr} AS {c}" for expr, c in zip(outputs, HOLDING_COLUMNS))}
+        FROM {source}
+        ORDER BY {key}, ctid DESC
+    """
+
+
+def upsert_holdings_rows(cur, table, columns, rows):
+    """Stage rows with COPY and upsert them on the natural key. Returns rows staged.
+
+    Same signature as copy_writer.copy_rows, so it can be CopyWriter's copy step.
+    """
+    if list(columns) != HOLDING_COLUMNS:
+        raise ValueError(f"upsert_holdings_rows expects HOLDING_COLUMNS, got {columns}")
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {STAGE_TABLE}
+        (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP
+    """)
+    # The stage is emptied after every call, so ctid order is the order rows were scraped in
+    copy_rows(cur, STAGE_TABLE, HOLDING_COLUMNS, rows)
+    cur.execute(f"""
+        INSERT INTO {table} ({", ".join(HOLDING_COLUMNS)})
+        {_latest_select(STAGE_TABLE)}
+        {ON_CONFLICT_UPDATE}
+    """)
+    if table == TABLE:
+        cur.execute(f"SELECT DISTINCT {cik_sql('cik')}, quarter FROM {STAGE_TABLE} WHERE quarter IS NOT NULL")
+        refresh_fingerprints(cur, INFO, [p for p in cur.fetchall() if p[0]])
+    cur.execute(f"TRUNCATE {STAGE_TABLE}")
+    return len(rows)
+
+
+def _key_index_valid(cur, table, index=KEY_INDEX):
+    """True / False for a valid / invalid (failed CONCURRENTLY build) key index, None if absent."""
+    schema = table.rpartition(".")[0] or "public"
+    cur.execute("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s
+    """, (schema, index))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def has_holdings_key(cur, table=TABLE):
+    return bool(_key_index_valid(cur, table))
+
+
+def holdings_partitions(cur, table=TABLE, cik_batch=None):
+    """Dedupe partitions: [(quarter, cik_lo, cik_hi)], one per quarter, or per cik_batch CIKs of a quarter.
+
+    CIK bounds are canonical; run normalize_partition_ciks on the quarter first.
+    """
+    cur.execute(f"SELECT DISTINCT quarter FROM {table} ORDER BY quarter")
+    quarters = [q for (q,) in cur.fetchall()]
+    if not cik_batch:
+        return [(q, None, None) for q in quarters]
+    parts = []
+    for q in quarters:
+        cur.execute(f"""
+            SELECT DISTINCT {cik_sql("cik")} AS c FROM {table}
+            WHERE quarter IS NOT DISTINCT FROM %s AND cik IS NOT NULL
+            ORDER BY c
+        """, (q,))
+        ciks = [c for (c,) in cur.fetchall() if c]
+        if not ciks:
+            parts.append((q, None, None))
+        for i in range(0, len(ciks), cik_batch):
+            batch = ciks[i:i + cik_batch]
+            parts.append((q, batch[0], batch[-1]))
+    return parts
+
+
+def normalize_partition_ciks(cur, table, quarter, cik_lo=None, cik_hi=None):
+    """Rewrite numeric CIKs of one partition to the canonical form. Returns rows changed."""
+    cur.execute(f"""
+        UPDATE {table} SET cik = {cik_sql("cik")}
+        WHERE quarter IS NOT DISTINCT FROM %(quarter)s
+          AND cik IS DISTINCT FROM {cik_sql("cik")} AND TRIM(cik) ~ '^[0-9]*$'
+          AND (%(lo)s::text IS NULL OR {cik_sql("cik")} BETWEEN %(lo)s AND %(hi)s)
+    """, {"quarter": quarter, "lo": cik_lo, "hi": cik_hi})
+    return cur.rowcount
+
+
+def dedupe_partition(cur, table, quarter, cik_lo=None, cik_hi=None):
+    """Collapse duplicate natural keys in one partition in place.
+
+    Per key the most recently scraped row is kept as it is (the last written,
+    highest ctid, on ties); nothing is summed, since duplicates are copies of
+    the same line. Only the surplus ctids are deleted, so nothing is copied
+    and only those rows are locked. Returns (duplicate keys, rows deleted).
+    """
+    key = "cik, COALESCE(cusip, ''), COALESCE(class, ''), COALESCE(option_type, '')"
+    cur.execute(f"""
+        WITH ranked AS (
+            SELECT ctid AS rid,
+                   ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY scraped_at DESC NULLS LAST, ctid DESC) AS rn
+            FROM {table}
+            WHERE quarter IS NOT DISTINCT FROM %(quarter)s
+              AND cik IS NOT NULL
+              AND (%(lo)s::text IS NULL OR cik BETWEEN %(lo)s AND %(hi)s)
+        ),
+        deleted AS (
+            DELETE FROM {table} h
+            USING ranked r
+            WHERE h.ctid = r.rid AND r.rn > 1
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM ranked WHERE rn = 2), (SELECT COUNT(*) FROM deleted)
+    """, {"quarter": quarter, "lo": cik_lo, "hi": cik_hi})
+    return cur.fetchone()
+
+
+def duplicate_quarters(cur, table=TABLE):
+    """Quarters that still have duplicate natural keys (the ones the unique index would reject)."""
+    cur.execute(f"""
+        SELECT DISTINCT quarter FROM (
+            SELECT quarter FROM {table}
+            WHERE cik IS NOT NULL AND quarter IS NOT NULL
+            GROUP BY cik, quarter, COALESCE(cusip, ''), COALESCE(class, ''), COALESCE(option_type, '')
+            HAVING COUNT(*) > 1
+        ) d
+    """)
+    return [q for (q,) in cur.fetchall()]
+
+
+def drop_invalid_holdings_key(cur, table=TABLE, concurrently=False):
+    """Drop the key index left invalid by a failed CONCURRENTLY build. Returns True if one was dropped."""
+    if _key_index_valid(cur, table) is not False:
+        return False
+    schema = table.rpartition(".")[0] or "public"
+    cur.execute(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}{schema}.{KEY_INDEX}")
+    return True
+
+
+def create_holdings_key(cur, table=TABLE, concurrently=False):
+    """Add the natural-key unique index and CIK check (concurrently needs an autocommit connection)."""
+    drop_invalid_holdings_key(cur, table, concurrently)
+    cur.execute(f"""
+        CREATE UNIQUE INDEX {"CONCURRENTLY " if concurrently else ""}IF NOT EXISTS {KEY_INDEX}
+        ON {table} ({NATURAL_KEY})
+    """)
+    if _key_index_valid(cur, table, LEGACY_KEY_INDEX) is not None:
+        schema = table.rpartition(".")[0] or "public"
+        cur.execute(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}{schema}.{LEGACY_KEY_INDEX}")
+    # NOT VALID: enforced for new rows; legacy non-numeric CIKs are left alone
+    cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {CIK_CHECK}")
+    cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {CIK_CHECK} CHECK (cik ~ '^[0-9]{{10}}$') NOT VALID")
+
+
+def ensure_holdings_key(cur, table=TABLE):
+    """Create the natural-key index and CIK check, migrating existing rows first if needed.
+
+    The migration runs quarter by quarter inside the caller's transaction;
+    for a large table run remove_duplicates.py first, which does the same
+    work online in short transactions. Returns True when a migration ran.
+    """
+    if has_holdings_key(cur, table):
+        return False
+
+    print(f"🔧 {table}: normalizing CIKs and adding the natural key (one-time migration)...")
+    normalized = groups = deleted = 0
+    for quarter, _, _ in holdings_partitions(cur, table):
+        normalized += normalize_partition_ciks(cur, table, quarter)
+        g, d = dedupe_partition(cur, table, quarter)
+        groups += g
+        deleted += d
+    create_holdings_key(cur, table)
+    print(f"   CIKs normalized: {normalized:,} | duplicate keys: {groups:,} | rows removed: {deleted:,}")
+    return True
@@ -0,0 +1,244 @@
+"""
+Single source of manager categories: bank | asset_manager | hedge_fund | other.
+
+Classification used to be implemented three times with drifting keyword
+lists (scrape_cik_manager_name.py, api/hedgefunds.js, api/sync13f.js), and
+the API versions ran on every row of every response. The rules now live
+here only, and the results are materialized into manager_classification,
+which the API joins by CIK.
+
+Rules are ordered: the first rule with a keyword anywhere in the upper-cased
+name wins (banks before asset managers before hedge funds). All keywords
+are compiled into one Aho-Corasick automaton, so a name is scanned once
+whatever the number of keywords, instead of once per keyword.
+
+manager_classification is synced from cik_manager_name with
+table_sync.sync_table: only managers that are new, renamed or classified
+differently are written. rules_version (a hash of RULES) is stored per row,
+so editing the rules reclassifies every manager on the next sync.
+
+The API already joined a manager_classification (cik, manager_name) before
+this module existed. ensure_classification_table adds the category columns
+to such a table rather than assuming them, and rows the sync did not insert
+(synced = FALSE) are never deleted, so managers missing from
+cik_manager_name keep their name in the API (and are classified by it).
+
+The API now serves these rules instead of its own keyword lists, which
+changes some categories: "LP", "LLC", "ADVISER", "HEDGE" now mean
+hedge_fund; "CITI ", "PNC ", "CITIZENS", "FIFTH THIRD" and "TRUIST" mean
+bank; "GEODE", "SSGA" and "PRUDENTIAL" mean asset_manager; and "FRANKLIN"
+only counts as "FRANKLIN TEMPLETON". api/sync13f.js keeps a copy of RULES
+to classify managers this table does not have yet (it writes their category
+into manager_quarter.type); change both together.
+
+Usage:
+    classify_manager("BLACKROCK INC.")                  # 'asset_manager'
+    sync_manager_classification(cur)                    # after cik_manager_name changed
+
+From the shell:
+    python manager_classification.py                    # sync the table
+    python manager_classification.py --classify "CITADEL ADVISORS LLC"
+"""
+import argparse
+import hashlib
+import os
+from collections import deque
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from table_sync import column_types, sync_table
+
+TABLE = "manager_classification"
+NAMES_TABLE = "cik_manager_name"
+COLUMNS = ["cik", "manager_name", "category", "rules_version"]
+DEFAULT_CATEGORY = "other"
+
+# (category, keywords) in priority order
+RULES = [
+    ("bank", [
+        "BANK", "BANC", "BANCORP", "TRUST", "CREDIT UNION",
+        "JPMORGAN", "CHASE", "WELLS FARGO", "CITIGROUP", "CITI ",
+        "MORGAN STANLEY", "GOLDMAN SACHS", "BANK OF AMERICA",
+        "BARCLAYS", "UBS", "HSBC", "STATE STREET", "NORTHERN TRUST",
+        "PNC ", "US BANK", "CITIZENS", "FIFTH THIRD", "TRUIST",
+    ]),
+    ("asset_manager", [
+        "VANGUARD", "BLACKROCK", "FIDELITY", "SCHWAB", "INVESCO",
+        "T ROWE", "T. ROWE", "FRANKLIN TEMPLETON", "DIMENSIONAL",
+        "PIMCO", "CAPITAL GROUP", "WELLINGTON", "AMUNDI",
+        "GEODE", "SSGA", "NORTHERN TRUST INVEST", "PRUDENTIAL",
+    ]),
+    ("hedge_fund", [
+        "HEDGE", "MASTER FUND", "OPPORTUNITY FUND",
+    ]),
+    # Generic investment manager keywords -> hedge_fund (most 13F filers)
+    ("hedge_fund", [
+        "CAPITAL", "MANAGEMENT", "PARTNERS", "ADVISOR", "ADVISER", "FUND", "INVEST", "LP", "LLC",
+    ]),
+]
+
+RULES_VERSION = hashlib.sha1(repr(RULES).encode("utf-8")).hexdigest()[:12]
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over (keyword, rank) pairs; best_rank(text) is the lowest rank found."""
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.rank = [None]      # lowest rank of any keyword ending at the state (or via its fail chain)
+        for word, rank in keywords:
+            state = 0
+            for ch in word:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.rank.append(None)
+                state = nxt
+            self.rank[state] = rank if self.rank[state] is None else min(self.rank[state], rank)
+
+        # Breadth-first: fail links, and inherit the ranks of keywords that are suffixes
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                inherited = self.rank[self.fail[nxt]]
+                if inherited is not None and (self.rank[nxt] is None or inherited < self.rank[nxt]):
+                    self.rank[nxt] = inherited
+
+    def best_rank(self, text):
+        goto, fail, rank = self.goto, self.fail, self.rank
+        best = None
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            r = rank[state]
+            if r is not None and (best is None or r < best):
+                best = r
+                if best == 0:
+                    break
+        return best
+
+
+_AUTOMATON = KeywordAutomaton((kw, i) for i, (_, keywords) in enumerate(RULES) for kw in keywords)
+
+
+def classify_manager(name):
+    """Classify manager into: bank, asset_manager, hedge_fund, or other."""
+    rank = _AUTOMATON.best_rank(str(name or "").upper())
+    return DEFAULT_CATEGORY if rank is None else RULES[rank][0]
+
+
+def ensure_classification_table(cur):
+    """Create the table, or migrate a pre-existing (cik, manager_name) one to this schema."""
+    cur.execute("SELECT to_regclass(%s)", (TABLE,))
+    if cur.fetchone()[0] is None:
+        cur.execute(f"""
+            CREATE TABLE {TABLE} (
+                cik TEXT PRIMARY KEY,
+                manager_name TEXT,
+                category TEXT,
+                rules_version TEXT,
+                synced BOOLEAN NOT NULL DEFAULT FALSE,
+                updated_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+    else:
+        # Older table: the sync compares and writes cik / manager_name as text
+        types = column_types(cur, TABLE, ["cik", "manager_name"])
+        wrong = {c: t for c, t in types.items() if t != "text" and not t.startswith("character varying")}
+        if wrong:
+            raise ValueError(f"{TABLE} has non-text column(s) {wrong}; migrate them to TEXT first")
+        cur.execute(f"""
+            ALTER TABLE {TABLE}
+                ADD COLUMN IF NOT EXISTS category TEXT,
+                ADD COLUMN IF NOT EXISTS rules_version TEXT,
+                ADD COLUMN IF NOT EXISTS synced BOOLEAN NOT NULL DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT NOW()
+        """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE}_category ON {TABLE} (category)")
+
+
+def sync_manager_classification(cur, delete_missing=True):
+    """Classify every manager in cik_manager_name and write the changes. Returns a SyncResult.
+
+    delete_missing only removes rows this sync inserted (synced) whose CIK
+    left cik_manager_name; rows that predate the sync are only ever updated.
+    """
+    ensure_classification_table(cur)
+    cur.execute(f"SELECT cik FROM {TABLE}")
+    existing = {cik for (cik,) in cur.fetchall()}
+    cur.execute(f"SELECT cik, manager_name FROM {NAMES_TABLE}")
+    rows = [(cik, name, classify_manager(name), RULES_VERSION) for cik, name in cur.fetchall()]
+    result = sync_table(cur, TABLE, ["cik"], COLUMNS, rows, delete_missing=False, touch="updated_at = NOW()")
+    inserted = sorted({cik for cik, *_ in rows if cik not in existing})
+    if inserted:
+        cur.execute(f"UPDATE {TABLE} SET synced = TRUE WHERE cik = ANY(%s)", (inserted,))
+
+    # Older rows for managers cik_manager_name lacks: classify them by their own name
+    cur.execute(f"""
+        SELECT cik, manager_name FROM {TABLE} c
+        WHERE NOT c.synced AND c.rules_version IS DISTINCT FROM %s
+          AND NOT EXISTS (SELECT 1 FROM {NAMES_TABLE} n WHERE n.cik = c.cik)
+    """, (RULES_VERSION,))
+    legacy = [(cik, classify_manager(name), RULES_VERSION) for cik, name in cur.fetchall()]
+    if legacy:
+        execute_values(cur, f"""
+            UPDATE {TABLE} c SET category = v.category, rules_version = v.rules_version, updated_at = NOW()
+            FROM (VALUES %s) AS v (cik, category, rules_version)
+            WHERE c.cik = v.cik
+        """, legacy, page_size=1000)
+    deleted = 0
+    if delete_missing:
+        cur.execute(f"""
+            DELETE FROM {TABLE} c
+            WHERE c.synced AND NOT EXISTS (SELECT 1 FROM {NAMES_TABLE} n WHERE n.cik = c.cik)
+        """)
+        deleted = cur.rowcount
+    return result._replace(deleted=deleted)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Materialize manager categories into manager_classification")
+    ap.add_argument("--classify", metavar="NAME", help="Only print the category of one manager name")
+    args = ap.parse_args()
+
+    if args.classify:
+        print(classify_manager(args.classify))
+        return 0
+
+    load_dotenv()
+    if "DATABASE_URL" not in os.environ:
+        print("❌ DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                result = sync_manager_classification(cur)
+                cur.execute(f"SELECT category, COUNT(*) FROM {TABLE} GROUP BY category ORDER BY 2 DESC")
+                counts = cur.fetchall()
+    finally:
+        conn.close()
+
+    print(f"✅ {TABLE} synced (rules {RULES_VERSION}): {result}")
+    for category, n in counts:
+        print(f"   {category}: {n}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,81 @@
+"""
+Persistent revalidation cache for 13f.info manager pages.
+
+One row per manager page URL with the HTTP validators from the last full
+fetch (ETag / Last-Modified) and a digest of the filing list extracted from
+it. A backfill sends the validators back as a conditional GET and only
+parses and diffs pages that were sent again:
+
+  304 Not Modified          unchanged, nothing to parse
+  200 with the same digest  filing list unchanged; still diffed against the
+                            database (quarters may have been deleted there)
+  200 with a new digest     parse, diff against the database, backfill
+
+An entry is only saved once every filing on the page is in the database, so
+a manager whose backfill failed part-way is fully re-checked on the next run.
+
+Usage:
+    ensure_page_cache(cur)
+    cache = load_page_cache(cur)                      # {url: PageCacheEntry}
+    save_page_cache(cur, [(url, etag, last_modified, filings_digest(filings)), ...])
+    drop_page_cache(cur, incomplete_urls)             # re-check these next run
+"""
+import hashlib
+from collections import namedtuple
+
+from psycopg2.extras import execute_values
+
+PAGE_CACHE_TABLE = "thirteenf_page_cache"
+
+PageCacheEntry = namedtuple("PageCacheEntry", "etag last_modified digest")
+
+
+def ensure_page_cache(cur):
+    """Create the cache table if needed."""
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {PAGE_CACHE_TABLE} (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            filings_digest TEXT NOT NULL,
+            checked_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+
+
+def filings_digest(filings):
+    """Order-independent sha256 of (quarter, filing_id) pairs."""
+    text = "\n".join(sorted(f"{quarter}\x1f{filing_id}" for quarter, filing_id in filings))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_page_cache(cur):
+    """Every cached page: {url: PageCacheEntry}."""
+    cur.execute(f"SELECT url, etag, last_modified, filings_digest FROM {PAGE_CACHE_TABLE}")
+    return {url: PageCacheEntry(etag, last_modified, digest) for url, etag, last_modified, digest in cur.fetchall()}
+
+
+def save_page_cache(cur, rows):
+    """Upsert cache entries.
+
+    rows: iterable of (url, etag, last_modified, filings_digest)
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    execute_values(cur, f"""
+        INSERT INTO {PAGE_CACHE_TABLE} (url, etag, last_modified, filings_digest)
+        VALUES %s
+        ON CONFLICT (url) DO UPDATE SET
+            etag = EXCLUDED.etag,
+            last_modified = EXCLUDED.last_modified,
+            filings_digest = EXCLUDED.filings_digest,
+            checked_at = NOW()
+    """, rows, page_size=1000)
+
+
+def drop_page_cache(cur, urls):
+    """Forget cached pages so the next run fetches and diffs them in full."""
+    urls = list(urls)
+    if urls:
+        cur.execute(f"DELETE FROM {PAGE_CACHE_TABLE} WHERE url = ANY(%s)", (urls,))
@@ -0,0 +1,227 @@
+"""
+Low-overhead sampling profiler for the ingest and report scripts.
+
+A background thread snapshots every thread's Python stack at a fixed interval
+(sys._current_frames), so the scraped code runs unmodified and the overhead is
+one stack walk per thread per tick. Code can tag pipeline stages with
+`stage("parse")`, `stage("db")`, `stage("io")` (local files), ... and samples
+are attributed to the innermost active stage of the sampled thread.
+
+At exit two files are written:
+  <prefix>.folded  collapsed stacks, one "stage;frame;frame count" per line
+                   (flamegraph.pl, inferno-flamegraph and speedscope read it)
+  <prefix>.txt     top-N hot functions (self and inclusive) per stage
+
+Usage inside a script:
+    from profiling import add_profile_arguments, start_profiling_from_args, stage
+
+    ap = argparse.ArgumentParser()
+    add_profile_arguments(ap)
+    args = ap.parse_args()
+    start_profiling_from_args(args)
+
+    with stage("parse"):
+        holdings = parse(xml)
+
+    @stage("db")              # stage() also works as a decorator
+    def insert_chunk(cur, rows): ...
+
+Usage from the shell:
+    python scrape_single_13f_optimized.py --csv input.csv --profile
+    python scrape_single_13f_optimized.py --csv input.csv --profile runs/sec_q3 --profile-interval 2
+    flamegraph.pl runs/sec_q3.folded > sec_q3.svg
+"""
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_INTERVAL_MS = 5.0
+DEFAULT_TOP_N = 25
+MAIN_STAGE = "main"
+
+# thread ident -> list of active stage names (innermost last)
+_STAGES: dict[int, list[str]] = {}
+_PROFILER = None
+
+
+@contextmanager
+def stage(name: str):
+    """Tag the calling thread as being inside pipeline stage `name`.
+
+    Costs two dict/list operations when profiling is off. Under asyncio many
+    tasks share one thread, so the tag is the most recently entered stage that
+    is still open; keep tagged sections free of awaits for exact attribution.
+    """
+    if _PROFILER is None:
+        yield
+        return
+    stack = _STAGES.setdefault(threading.get_ident(), [])
+    stack.append(name)
+    try:
+        yield
+    finally:
+        # remove() rather than pop(): interleaved asyncio tasks may exit out of order
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] == name:
+                del stack[i]
+                break
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Wall-clock stack sampler with per-stage attribution."""
+
+    def __init__(self, prefix: str, interval_ms: float = DEFAULT_INTERVAL_MS, top_n: int = DEFAULT_TOP_N):
+        self.prefix = prefix
+        self.interval = max(interval_ms, 0.5) / 1000.0
+        self.top_n = top_n
+        self.stacks = Counter()           # (stage, frames...) -> samples
+        self.ticks = 0
+        self.started = None
+        self._labels = {}                 # code object -> label cache
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._main_ident = threading.main_thread().ident
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = _frame_label(code)
+        return label
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.ticks += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                active = _STAGES.get(ident)
+                if active:
+                    tag = active[-1]
+                elif ident == self._main_ident:
+                    tag = MAIN_STAGE
+                else:
+                    # Untagged pool threads are idle workers waiting on a queue
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                frames.reverse()
+                self.stacks[(tag, *frames)] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=1.0)
+
+    def write(self):
+        """Write the .folded and .txt outputs; returns the two paths."""
+        folded_path = f"{self.prefix}.folded"
+        summary_path = f"{self.prefix}.txt"
+        out_dir = os.path.dirname(folded_path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+        with open(folded_path, "w", encoding="utf-8") as f:
+            for key, count in sorted(self.stacks.items(), key=lambda kv: -kv[1]):
+                f.write(f"[{key[0]}];" + ";".join(key[1:]) + f" {count}\n")
+
+        stage_total = Counter()
+        self_counts = defaultdict(Counter)
+        incl_counts = defaultdict(Counter)
+        for key, count in self.stacks.items():
+            tag, frames = key[0], key[1:]
+            stage_total[tag] += count
+            if frames:
+                self_counts[tag][frames[-1]] += count
+            for label in set(frames):
+                incl_counts[tag][label] += count
+
+        elapsed = time.perf_counter() - (self.started or time.perf_counter())
+        all_samples = sum(stage_total.values()) or 1
+        lines = [
+            f"Sampling profile: {' '.join(sys.argv)}",
+            f"Wall time: {elapsed:.1f}s | interval: {self.interval * 1000:.1f}ms | "
+            f"ticks: {self.ticks} | samples: {sum(stage_total.values())}",
+            "",
+            f"{'Stage':<20} {'Samples':>10} {'Share':>8}",
+        ]
+        for tag, count in stage_total.most_common():
+            lines.append(f"{tag:<20} {count:>10,} {100.0 * count / all_samples:>7.1f}%")
+
+        for tag, count in stage_total.most_common():
+            lines.append("")
+            lines.append(f"=== [{tag}] {count:,} samples - top {self.top_n} by self time ===")
+            lines.append(f"{'Self':>8} {'Self%':>7} {'Incl%':>7}  Function")
+            for label, n in self_counts[tag].most_common(self.top_n):
+                incl = incl_counts[tag][label]
+                lines.append(f"{n:>8,} {100.0 * n / count:>6.1f}% {100.0 * incl / count:>6.1f}%  {label}")
+
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return folded_path, summary_path
+
+
+def _finish():
+    global _PROFILER
+    prof = _PROFILER
+    if prof is None:
+        return
+    prof.stop()
+    _PROFILER = None
+    try:
+        folded_path, summary_path = prof.write()
+        print(f"\n🔬 Profile written: {folded_path} (flamegraph) | {summary_path} (top functions per stage)")
+    except OSError as e:
+        print(f"\n⚠️ Could not write profile {prof.prefix}: {e}")
+
+
+def default_prefix() -> str:
+    script = os.path.splitext(os.path.basename(sys.argv[0] or "script"))[0]
+    return f"profile_{script}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+
+def start_profiling(prefix: str | None = None, interval_ms: float = DEFAULT_INTERVAL_MS,
+                    top_n: int = DEFAULT_TOP_N) -> SamplingProfiler:
+    """Start the sampler (idempotent) and register the exit-time writer."""
+    global _PROFILER
+    if _PROFILER is not None:
+        return _PROFILER
+    _PROFILER = SamplingProfiler(prefix or default_prefix(), interval_ms, top_n)
+    _PROFILER.start()
+    atexit.register(_finish)
+    print(f"🔬 Sampling profiler on ({_PROFILER.interval * 1000:.1f}ms) -> {_PROFILER.prefix}.folded / .txt")
+    return _PROFILER
+
+
+def add_profile_arguments(parser):
+    """Add --profile [PREFIX], --profile-interval and --profile-top to an argparse parser."""
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="PREFIX",
+                        help="Run the sampling profiler and write PREFIX.folded / PREFIX.txt at exit "
+                             "(default prefix: profile_<script>_<timestamp>)")
+    parser.add_argument("--profile-interval", type=float, default=DEFAULT_INTERVAL_MS, metavar="MS",
+                        help=f"Sampling interval in milliseconds (default: {DEFAULT_INTERVAL_MS:g})")
+    parser.add_argument("--profile-top", type=int, default=DEFAULT_TOP_N, metavar="N",
+                        help=f"Hot functions listed per stage (default: {DEFAULT_TOP_N})")
+    return parser
+
+
+def start_profiling_from_args(args):
+    """Start profiling if --profile was given; no-op otherwise."""
+    if getattr(args, "profile", None) is None:
+        return None
+    return start_profiling(args.profile or None, args.profile_interval, args.profile_top)
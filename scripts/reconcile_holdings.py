@@ -0,0 +1,372 @@
+"""
+Position-level reconciliation of 13f.info holdings against SEC holdings.
+
+find_value_discrepancies.py only compares quarter totals, and the supplement
+scripts replace whole quarters when a total looks short. This compares the
+two sources position by position, keyed by (cik, quarter, cusip, put_call):
+both sides are extracted with COPY into Arrow tables, aggregated per
+position (class variants and multi-line positions summed) and matched with
+one vectorized hash join; the status of every position is computed on
+whole columns at once:
+
+  missing       SEC has the position, 13f.info does not
+  extra         13f.info has it, SEC does not (reported, never repaired)
+  duplicated    13f.info holds it from more than one filing, or in more
+                class variants than SEC reports
+  1000x_high    13f.info value 900-1100x the SEC value (thousands read as dollars)
+  1000x_low     13f.info value 1/1100-1/900 of the SEC value
+  value_mismatch values differ by more than VALUE_TOLERANCE and the
+                rounding of value_000
+
+Positions that are not OK are stored in holding_reconciliation (the rows of
+a reconciled quarter are replaced on every run). apply_reconciliation then
+repairs exactly those positions from SEC (delete the 13f.info rows of the
+position, insert the SEC aggregate marked SEC_SUPPLEMENTED), so a repair or
+supplement touches the affected rows only. supplement_with_sec_data*.py use
+this with --mode positions. With --drifted only the periods whose
+fingerprints differ between the sources (fingerprint_tree) are reconciled.
+
+Needs pyarrow (pip install pyarrow), imported on first use.
+
+Usage:
+    counts = reconcile(cur, [(cik, "Q3 2025"), ...])     # Counter of statuses
+    deleted, inserted = apply_reconciliation(cur, periods)
+
+From the shell:
+    python reconcile_holdings.py --quarter "Q3 2025"
+    python reconcile_holdings.py --cik 0001067983 --report reconciliation.csv.gz
+    python reconcile_holdings.py --quarter "Q3 2025" --apply
+    python reconcile_holdings.py --drifted --apply
+"""
+import argparse
+import io
+import os
+from collections import Counter, defaultdict
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+from copy_writer import copy_rows
+from filing_ids import quarter_period_end
+from fingerprint_tree import INFO, SEC, diff_periods, refresh_fingerprints
+from holdings_table import ON_CONFLICT_UPDATE, ensure_holdings_key, normalize_cik
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from report_export import FORMATS, open_report, stream_query
+
+TABLE = "holding_reconciliation"
+TABLE_13FINFO = "public.expected_13finfo_holdings"
+TABLE_SEC = "public.manager_quarter_holding"
+SCOPE_TABLE = "reconcile_scope"
+
+KEY = ["cik", "quarter", "cusip", "put_call"]
+RESULT_COLUMNS = KEY + ["period_end", "status", "info_rows", "info_filings", "sec_lines",
+                        "info_value_usd", "sec_value_usd", "info_shares", "sec_shares"]
+
+OK = "ok"
+REPAIRABLE = ("missing", "duplicated", "1000x_high", "1000x_low", "value_mismatch")
+
+VALUE_TOLERANCE = 0.01      # relative value difference still counted as equal
+ROUNDING_USD = 1000         # 13f.info rounds each row to $000
+BATCH_PERIODS = 2000        # (cik, quarter) periods reconciled per extract
+
+# One row per source line; keys normalized so that the join can match them exactly
+INFO_EXTRACT = f"""
+    SELECT h.cik, h.quarter, COALESCE(h.cusip, '') AS cusip, COALESCE(UPPER(h.option_type), '') AS put_call,
+           COALESCE(h.class, '') AS class, h.filing_url, h.value_000 * 1000.0 AS value_usd, h.shares
+    FROM {TABLE_13FINFO} h
+    JOIN {SCOPE_TABLE} s ON h.cik = s.cik AND h.quarter = s.quarter
+"""
+SEC_EXTRACT = f"""
+    SELECT h.cik, s.quarter, COALESCE(h.cusip, '') AS cusip, COALESCE(UPPER(h.put_call), '') AS put_call,
+           COALESCE(h.title_of_class, '') AS class, h.value_usd::float8 AS value_usd, h.shares
+    FROM {TABLE_SEC} h
+    JOIN {SCOPE_TABLE} s ON h.cik = s.cik AND h.period_end = s.period_end
+"""
+
+
+def _arrow():
+    try:
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.csv as pacsv
+    except ImportError as e:
+        raise RuntimeError("Reconciling holdings needs pyarrow: pip install pyarrow") from e
+    return np, pa, pc, pacsv
+
+
+def ensure_reconciliation_table(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            cik TEXT NOT NULL,
+            quarter TEXT NOT NULL,
+            cusip TEXT NOT NULL,
+            put_call TEXT NOT NULL,
+            period_end DATE,
+            status TEXT NOT NULL,
+            info_rows INTEGER,
+            info_filings INTEGER,
+            sec_lines INTEGER,
+            info_value_usd NUMERIC,
+            sec_value_usd NUMERIC,
+            info_shares NUMERIC,
+            sec_shares NUMERIC,
+            reconciled_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (cik, quarter, cusip, put_call)
+        )
+    """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE}_status ON {TABLE} (status)")
+
+
+def _set_scope(cur, periods):
+    """Fill the session's scope table with (cik, quarter, period_end); returns the normalized periods."""
+    scope = sorted({(normalize_cik(cik), quarter, quarter_period_end(quarter)) for cik, quarter in periods})
+    scope = [p for p in scope if p[0] and p[2]]
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {SCOPE_TABLE} (
+            cik TEXT, quarter TEXT, period_end DATE, PRIMARY KEY (cik, quarter)
+        )
+    """)
+    cur.execute(f"TRUNCATE {SCOPE_TABLE}")
+    execute_values(cur, f"INSERT INTO {SCOPE_TABLE} (cik, quarter, period_end) VALUES %s", scope, page_size=1000)
+    cur.execute(f"ANALYZE {SCOPE_TABLE}")
+    return scope
+
+
+@stage("db")
+def _extract(cur, sql, columns):
+    """COPY a query out as CSV and read it into an Arrow table with the given column types."""
+    _, _, _, pacsv = _arrow()
+    buf = io.BytesIO()
+    cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)", buf)
+    buf.seek(0)
+    return pacsv.read_csv(buf, convert_options=pacsv.ConvertOptions(
+        column_types=columns, strings_can_be_null=True, quoted_strings_can_be_null=False))
+
+
+def _positions(table, prefix, extra_aggregates):
+    """Aggregate source lines into one row per KEY position, columns prefixed."""
+    _, pa, pc, _ = _arrow()
+    counted = pc.CountOptions(mode="all")
+    grouped = table.group_by(KEY).aggregate([
+        ("value_usd", "sum"),
+        ("shares", "sum"),
+        ("cusip", "count", counted),
+        ("class", "count_distinct"),
+    ] + extra_aggregates)
+    names = {"value_usd_sum": "value_usd", "shares_sum": "shares", "cusip_count": "rows",
+             "class_count_distinct": "classes", "filing_url_count_distinct": "filings"}
+    return grouped.rename_columns([c if c in KEY else prefix + names[c] for c in grouped.column_names])
+
+
+@stage("reconcile")
+def classify_positions(info, sec):
+    """Full outer hash join of the two position tables; returns it with a status column."""
+    np, pa, pc, _ = _arrow()
+    joined = info.join(sec, keys=KEY, join_type="full outer", coalesce_keys=True)
+
+    def col(name, fill=0.0):
+        return pc.fill_null(joined[name].cast(pa.float64()), fill).to_numpy(zero_copy_only=False)
+
+    has_info = joined["info_rows"].is_valid().to_numpy(zero_copy_only=False)
+    has_sec = joined["sec_rows"].is_valid().to_numpy(zero_copy_only=False)
+    info_value, sec_value = col("info_value_usd"), col("sec_value_usd")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(sec_value != 0, info_value / sec_value, np.nan)
+    tolerance = np.maximum(np.abs(sec_value) * VALUE_TOLERANCE, col("info_rows") * ROUNDING_USD)
+
+    status = np.select(
+        [
+            ~has_info,
+            ~has_sec,
+            (col("info_filings") > 1) | (col("info_rows") > col("sec_classes")),
+            (ratio >= 900) & (ratio <= 1100),
+            (ratio >= 1 / 1100) & (ratio <= 1 / 900),
+            np.abs(info_value - sec_value) > tolerance,
+        ],
+        ["missing", "extra", "duplicated", "1000x_high", "1000x_low", "value_mismatch"],
+        default=OK,
+    )
+    return joined.append_column("status", pa.array(status, type=pa.string()))
+
+
+@stage("db")
+def reconcile(cur, periods):
+    """Reconcile the given (cik, quarter) periods; stores their non-OK positions. Returns a Counter of statuses."""
+    _, pa, pc, _ = _arrow()
+    ensure_reconciliation_table(cur)
+    counts = Counter()
+    periods = list(periods)
+    for i in range(0, len(periods), BATCH_PERIODS):
+        scope = _set_scope(cur, periods[i:i + BATCH_PERIODS])
+        if not scope:
+            continue
+        key_types = {c: pa.string() for c in KEY + ["class", "filing_url"]}
+        info = _extract(cur, INFO_EXTRACT, {**key_types, "value_usd": pa.float64(), "shares": pa.float64()})
+        sec = _extract(cur, SEC_EXTRACT, {**key_types, "value_usd": pa.float64(), "shares": pa.float64()})
+        positions = classify_positions(
+            _positions(info, "info_", [("filing_url", "count_distinct")]),
+            _positions(sec, "sec_", []),
+        )
+        statuses = positions["status"]
+        counts.update(dict(zip(*[a.to_pylist() for a in pc.value_counts(statuses).flatten()])))
+
+        bad = positions.filter(pc.not_equal(statuses, OK))
+        period_ends = {(cik, quarter): end for cik, quarter, end in scope}
+        rows = [
+            (r["cik"], r["quarter"], r["cusip"], r["put_call"], period_ends[(r["cik"], r["quarter"])], r["status"],
+             r["info_rows"], r["info_filings"], r["sec_rows"],
+             r["info_value_usd"], r["sec_value_usd"], r["info_shares"], r["sec_shares"])
+            for r in bad.to_pylist()
+        ]
+        cur.execute(f"""
+            DELETE FROM {TABLE} r USING {SCOPE_TABLE} s
+            WHERE r.cik = s.cik AND r.quarter = s.quarter
+        """)
+        if rows:
+            copy_rows(cur, TABLE, RESULT_COLUMNS, rows)
+    return counts
+
+
+@stage("db")
+def apply_reconciliation(cur, periods=None, statuses=REPAIRABLE):
+    """Repair stored positions (of the given periods, default all) from SEC. Returns (deleted, inserted).
+
+    Repaired positions are removed from holding_reconciliation.
+    """
+    ensure_holdings_key(cur, TABLE_13FINFO)
+    where = "r.status = ANY(%(statuses)s)"
+    if periods is not None:
+        _set_scope(cur, periods)
+        where += f" AND EXISTS (SELECT 1 FROM {SCOPE_TABLE} s WHERE s.cik = r.cik AND s.quarter = r.quarter)"
+    cur.execute(f"""
+        CREATE TEMP TABLE reconcile_repair ON COMMIT DROP AS
+        SELECT r.cik, r.quarter, r.cusip, r.put_call, r.period_end FROM {TABLE} r WHERE {where}
+    """, {"statuses": list(statuses)})
+
+    cur.execute(f"""
+        DELETE FROM {TABLE_13FINFO} h
+        USING reconcile_repair r
+        WHERE h.cik = r.cik AND h.quarter = r.quarter
+          AND COALESCE(h.cusip, '') = r.cusip AND COALESCE(UPPER(h.option_type), '') = r.put_call
+    """)
+    deleted = cur.rowcount
+
+    # Same shape as the supplement scripts' insert: one row per natural key, multi-line positions summed;
+    # put_call upper-cased as matched, so 'Put' and 'PUT' lines make one row
+    cur.execute(f"""
+        INSERT INTO {TABLE_13FINFO}
+        (manager_url, cik, quarter, filing_url, sym, issuer_name, class, cusip,
+         value_000, pct, shares, principal, option_type)
+        SELECT
+            '',
+            r.cik,
+            r.quarter,
+            'SEC_SUPPLEMENTED',
+            NULL,
+            MAX(sec.issuer),
+            MAX(sec.title_of_class),
+            sec.cusip,
+            ROUND(SUM(sec.value_usd) / 1000),
+            NULL,
+            SUM(sec.shares),
+            MAX(sec.share_type),
+            UPPER(sec.put_call)
+        FROM reconcile_repair r
+        JOIN {TABLE_SEC} sec
+          ON sec.cik = r.cik AND sec.period_end = r.period_end
+         AND COALESCE(sec.cusip, '') = r.cusip AND COALESCE(UPPER(sec.put_call), '') = r.put_call
+        GROUP BY r.cik, r.quarter, sec.cusip, COALESCE(sec.title_of_class, ''), UPPER(sec.put_call)
+        {ON_CONFLICT_UPDATE}
+    """)
+    inserted = cur.rowcount
+
+    cur.execute(f"""
+        DELETE FROM {TABLE} t USING reconcile_repair r
+        WHERE t.cik = r.cik AND t.quarter = r.quarter AND t.cusip = r.cusip AND t.put_call = r.put_call
+    """)
+    cur.execute("SELECT DISTINCT cik, quarter FROM reconcile_repair")
+    refresh_fingerprints(cur, INFO, cur.fetchall())
+    cur.execute("DROP TABLE reconcile_repair")
+    return deleted, inserted
+
+
+def scope_periods(cur, quarter=None, cik=None):
+    """(cik, quarter) periods either source has, optionally for one quarter and/or CIK."""
+    cur.execute(f"""
+        SELECT cik, quarter FROM {TABLE_13FINFO}
+        WHERE (%(quarter)s::text IS NULL OR quarter = %(quarter)s) AND (%(cik)s::text IS NULL OR cik = %(cik)s)
+        GROUP BY cik, quarter
+        UNION
+        SELECT cik, 'Q' || EXTRACT(QUARTER FROM period_end)::int || ' ' || EXTRACT(YEAR FROM period_end)::int
+        FROM holding_period_stats
+        WHERE (%(period_end)s::date IS NULL OR period_end = %(period_end)s) AND (%(cik)s::text IS NULL OR cik = %(cik)s)
+    """, {"quarter": quarter, "cik": normalize_cik(cik), "period_end": quarter_period_end(quarter) if quarter else None})
+    return cur.fetchall()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Reconcile 13f.info holdings against SEC holdings, position by position")
+    ap.add_argument("--quarter", help='Only this quarter, e.g. "Q3 2025"')
+    ap.add_argument("--cik", help="Only this manager")
+    ap.add_argument("--report", metavar="PATH",
+                    help=f"Also write the non-OK positions to a report file ({', '.join('.' + f for f in FORMATS)})")
+    ap.add_argument("--apply", action="store_true", help="Repair the non-OK positions from SEC")
+    ap.add_argument("--drifted", action="store_true",
+                    help="Only periods whose SEC and 13f.info fingerprints differ (fingerprint_tree)")
+    add_profile_arguments(ap)
+    args = ap.parse_args()
+    start_profiling_from_args(args)
+
+    load_dotenv()
+    if "DATABASE_URL" not in os.environ:
+        print("❌ DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        with conn.cursor() as cur:
+            if args.drifted:
+                periods, _ = diff_periods(cur, SEC, INFO, args.quarter, normalize_cik(args.cik))
+            else:
+                periods = scope_periods(cur, args.quarter, args.cik)
+            by_quarter = defaultdict(list)
+            for cik, quarter in periods:
+                by_quarter[quarter].append((cik, quarter))
+            print(f"🔍 Reconciling {len(periods):,} manager quarters in {len(by_quarter)} quarters...")
+
+            totals = Counter()
+            for quarter in sorted(by_quarter, key=quarter_period_end):
+                counts = reconcile(cur, by_quarter[quarter])
+                totals.update(counts)
+                bad = sum(n for s, n in counts.items() if s != OK)
+                print(f"   {quarter}: {sum(counts.values()):,} positions, {bad:,} not OK")
+                if args.apply:
+                    deleted, inserted = apply_reconciliation(cur, by_quarter[quarter])
+                    print(f"   {quarter}: repaired (-{deleted:,} / +{inserted:,} rows)")
+                conn.commit()
+
+            print("\n📈 Positions by status:")
+            for status, n in totals.most_common():
+                print(f"   {status}: {n:,}")
+
+            if args.report:
+                columns, rows = stream_query(conn, f"""
+                    SELECT {", ".join(RESULT_COLUMNS)} FROM {TABLE}
+                    WHERE (%(quarter)s::text IS NULL OR quarter = %(quarter)s)
+                      AND (%(cik)s::text IS NULL OR cik = %(cik)s)
+                    ORDER BY cik, quarter, cusip, put_call
+                """, {"quarter": args.quarter, "cik": normalize_cik(args.cik)})
+                with open_report(args.report, columns) as out:
+                    for row in rows:
+                        out.write(row)
+                conn.commit()
+                print(f"\n💾 {out.rows_written:,} positions saved to: {args.report}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,131 +1,175 @@
 """
-Remove duplicates from public.expected_13finfo_holdings
+Remove duplicates from public.expected_13finfo_holdings - online, partition by partition
 
-The issue: CIK format is inconsistent ('0000102909' vs '102909')
-This causes duplicate rows for the same holding.
+The issue: CIK format was inconsistent ('0000102909' vs '102909'), which
+caused duplicate rows for the same holding. Ingest now normalizes CIKs and
+upserts on the natural key (cik, quarter, cusip, class, option_type) (see
+holdings_table.py); this script cleans up the existing backlog without
+taking the table offline.
 
-This script:
-1. Identifies duplicates
-2. Keeps one row per unique (cik_normalized, quarter, cusip, sym, class)
-3. Normalizes CIK to 10-digit padded format
+Instead of rebuilding the table in one transaction (a full copy and a table
+lock), it works one quarter - or one CIK range of a quarter with
+--cik-batch - per short transaction:
+1. Normalizes CIKs of the partition to 10-digit padded format
+2. Per duplicate group keeps the most recently scraped row as it is and
+   deletes only the surplus ctids
+3. Records the quarter in holdings_dedupe_progress (rows without a quarter
+   under NULL_QUARTER)
+
+Readers are never blocked (only the rows being changed are locked), and the
+script can be interrupted at any point: finished quarters are skipped on the
+next run. Once every quarter is clean the unique natural-key index is built
+with CREATE INDEX CONCURRENTLY. If that build fails (say a writer added a
+duplicate meanwhile), the invalid index is dropped and the quarters that
+have duplicates again are taken out of the progress table, so the next run
+re-checks them before retrying the index.
+
+Usage:
+  python remove_duplicates.py                       # all quarters, then the index
+  python remove_duplicates.py --quarter "Q3 2025"   # one quarter only
+  python remove_duplicates.py --cik-batch 500       # smaller transactions
+  python remove_duplicates.py --restart             # forget progress, re-check everything
 """
+import argparse
 import os
+import time
+
 import psycopg2
 from dotenv import load_dotenv
 
+from holdings_table import (create_holdings_key, dedupe_partition, drop_invalid_holdings_key, duplicate_quarters,
+                            has_holdings_key, holdings_partitions, normalize_partition_ciks)
+
 load_dotenv()
 
 TABLE = "public.expected_13finfo_holdings"
+PROGRESS_TABLE = "holdings_dedupe_progress"
+LOCK_TIMEOUT = "5s"     # give way to other writers instead of queueing behind them
+NULL_QUARTER = "(no quarter)"   # progress key of the rows whose quarter is NULL
+
+
+def progress_key(quarter):
+    return NULL_QUARTER if quarter is None else quarter
+
+
+def ensure_progress(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+            quarter TEXT PRIMARY KEY,
+            normalized INTEGER NOT NULL,
+            duplicate_keys INTEGER NOT NULL,
+            deleted INTEGER NOT NULL,
+            done_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
 
 
 def main():
+    ap = argparse.ArgumentParser(description="Online, resumable dedupe of expected_13finfo_holdings")
+    ap.add_argument("--quarter", help='Only this quarter, e.g. "Q3 2025"')
+    ap.add_argument("--cik-batch", type=int, default=0,
+                    help="CIKs per transaction within a quarter (0 = whole quarter)")
+    ap.add_argument("--restart", action="store_true", help="Ignore recorded progress")
+    ap.add_argument("--no-index", action="store_true", help="Do not build the natural-key index at the end")
+    args = ap.parse_args()
+
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
         print("❌ DATABASE_URL not set")
         return
-    
+
     conn = psycopg2.connect(db_url)
-    conn.autocommit = False
-    
     try:
+        with conn:
+            with conn.cursor() as cur:
+                if has_holdings_key(cur, TABLE):
+                    print("✅ Natural key already in place - duplicates cannot exist")
+                    return
+                ensure_progress(cur)
+                if args.restart:
+                    cur.execute(f"TRUNCATE {PROGRESS_TABLE}")
+                cur.execute(f"SELECT quarter FROM {PROGRESS_TABLE}")
+                done = {q for (q,) in cur.fetchall()}
+
+                print("📊 Planning partitions...")
+                partitions = [p for p in holdings_partitions(cur, TABLE, args.cik_batch)
+                              if progress_key(p[0]) not in done and (not args.quarter or p[0] == args.quarter)]
+
+        quarters = sorted({q for q, _, _ in partitions}, key=str)
+        print(f"▶️ {len(partitions)} partitions in {len(quarters)} quarters to check "
+              f"({len(done)} quarters already done)")
+
+        totals = {"normalized": 0, "duplicate_keys": 0, "deleted": 0}
+        per_quarter = {}
+        start_time = time.time()
+
+        for i, (quarter, cik_lo, cik_hi) in enumerate(partitions, 1):
+            # One short transaction per partition; an interrupt loses at most this one
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+                    normalized = normalize_partition_ciks(cur, TABLE, quarter, cik_lo, cik_hi)
+                    groups, deleted = dedupe_partition(cur, TABLE, quarter, cik_lo, cik_hi)
+
+                    q = per_quarter.setdefault(quarter, [0, 0, 0])
+                    q[0] += normalized
+                    q[1] += groups
+                    q[2] += deleted
+
+                    last_of_quarter = i == len(partitions) or partitions[i][0] != quarter
+                    if last_of_quarter:
+                        cur.execute(f"""
+                            INSERT INTO {PROGRESS_TABLE} (quarter, normalized, duplicate_keys, deleted)
+                            VALUES (%s, %s, %s, %s)
+                            ON CONFLICT (quarter) DO UPDATE SET
+                                normalized = EXCLUDED.normalized,
+                                duplicate_keys = EXCLUDED.duplicate_keys,
+                                deleted = EXCLUDED.deleted,
+                                done_at = NOW()
+                        """, (progress_key(quarter), *q))
+
+            totals["normalized"] += normalized
+            totals["duplicate_keys"] += groups
+            totals["deleted"] += deleted
+
+            elapsed = time.time() - start_time
+            rate = i / elapsed if elapsed > 0 else 0
+            eta = (len(partitions) - i) / rate if rate > 0 else 0
+            span = f" CIK {cik_lo}..{cik_hi}" if cik_lo else ""
+            print(f"[{i}/{len(partitions)}] {progress_key(quarter)}{span}: normalized={normalized:,} "
+                  f"dup_keys={groups:,} deleted={deleted:,} | ETA: {eta/60:.1f}min")
+
+        print(f"\n✅ Dedupe pass complete in {(time.time() - start_time)/60:.1f} minutes")
+        print(f"   CIKs normalized: {totals['normalized']:,}")
+        print(f"   Duplicate keys:  {totals['duplicate_keys']:,}")
+        print(f"   Rows deleted:    {totals['deleted']:,}")
+
+        if args.no_index or args.quarter:
+            print("ℹ️ Natural-key index not built (run without --quarter/--no-index once every quarter is done)")
+            return
+
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        print("\n🔧 Building the natural-key index (CONCURRENTLY)...")
+        conn.autocommit = True
         with conn.cursor() as cur:
-            # Step 1: Count before
-            print("📊 Checking current state...")
-            cur.execute(f"SELECT COUNT(*) FROM {TABLE}")
-            total_before = cur.fetchone()[0]
-            print(f"   Total rows: {total_before:,}")
-            
-            # Check for duplicates
-            cur.execute(f"""
-                SELECT COUNT(*) FROM (
-                    SELECT LTRIM(cik, '0') as cik_norm, quarter, cusip, 
-                           COALESCE(sym, '') as sym, COALESCE(class, '') as class
-                    FROM {TABLE}
-                    GROUP BY 1, 2, 3, 4, 5
-                    HAVING COUNT(*) > 1
-                ) dupes
-            """)
-            dupe_groups = cur.fetchone()[0]
-            print(f"   Duplicate groups: {dupe_groups:,}")
-            
-            if dupe_groups == 0:
-                print("✅ No duplicates found!")
+            try:
+                create_holdings_key(cur, TABLE, concurrently=True)
+            except psycopg2.Error as e:
+                print(f"❌ Index build failed: {e}")
+                # An invalid unique index would still reject writes without serving ON CONFLICT
+                drop_invalid_holdings_key(cur, TABLE, concurrently=True)
+                redo = [progress_key(q) for q in duplicate_quarters(cur, TABLE)]
+                if redo:
+                    cur.execute(f"DELETE FROM {PROGRESS_TABLE} WHERE quarter = ANY(%s)", (redo,))
+                    print(f"   {len(redo)} quarters have duplicates again; rerun to re-check them")
                 return
-            
-            # Step 2: Create temp table with deduplicated data
-            print("\n🔄 Deduplicating...")
-            cur.execute(f"""
-                CREATE TEMP TABLE holdings_deduped AS
-                SELECT DISTINCT ON (LTRIM(cik, '0'), quarter, cusip, COALESCE(sym, ''), COALESCE(class, ''))
-                    manager_url,
-                    LPAD(LTRIM(cik, '0'), 10, '0') as cik,
-                    quarter,
-                    filing_url,
-                    sym,
-                    issuer_name,
-                    class,
-                    cusip,
-                    value_000,
-                    pct,
-                    shares,
-                    principal,
-                    option_type,
-                    scraped_at
-                FROM {TABLE}
-                ORDER BY LTRIM(cik, '0'), quarter, cusip, COALESCE(sym, ''), COALESCE(class, ''), 
-                         scraped_at DESC NULLS LAST
-            """)
-            
-            cur.execute("SELECT COUNT(*) FROM holdings_deduped")
-            deduped_count = cur.fetchone()[0]
-            print(f"   Unique rows: {deduped_count:,}")
-            print(f"   Duplicates to remove: {total_before - deduped_count:,}")
-            
-            # Step 3: Replace table contents
-            print("\n🗑️  Replacing table contents...")
-            cur.execute(f"TRUNCATE TABLE {TABLE}")
-            
-            cur.execute(f"""
-                INSERT INTO {TABLE} 
-                    (manager_url, cik, quarter, filing_url, sym, issuer_name, class, cusip, 
-                     value_000, pct, shares, principal, option_type, scraped_at)
-                SELECT * FROM holdings_deduped
-            """)
-            
-            # Step 4: Verify
-            cur.execute(f"SELECT COUNT(*) FROM {TABLE}")
-            total_after = cur.fetchone()[0]
-            
-            # Check no remaining duplicates
-            cur.execute(f"""
-                SELECT COUNT(*) FROM (
-                    SELECT cik, quarter, cusip, sym, class
-                    FROM {TABLE}
-                    GROUP BY 1, 2, 3, 4, 5
-                    HAVING COUNT(*) > 1
-                ) dupes
-            """)
-            remaining_dupes = cur.fetchone()[0]
-            
-            # Cleanup temp table
-            cur.execute("DROP TABLE holdings_deduped")
-            
-            # Commit
-            conn.commit()
-            
-            print(f"\n✅ DONE!")
-            print(f"   Before: {total_before:,} rows")
-            print(f"   After:  {total_after:,} rows")
-            print(f"   Removed: {total_before - total_after:,} duplicates")
-            print(f"   Remaining duplicates: {remaining_dupes}")
-            
-    except Exception as e:
-        conn.rollback()
-        print(f"❌ Error: {e}")
-        raise
+        print("✅ Natural key in place; ingest upserts from now on")
+
+    except KeyboardInterrupt:
+        print("\n⏸️ Interrupted - finished partitions are committed; rerun to resume")
     finally:
         conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,202 @@
+"""
+Queue of SEC periods to re-ingest, from detection straight to the ingest engine.
+
+Repairs used to be a hand-off: generate_completeness_report.py wrote CSVs,
+someone filtered them into value_holdings_chk_mismatch_filtered.csv, and
+fix_all_mismatches.py re-downloaded the periods one at a time. Now the
+report enqueues every period it finds broken, with a reason code, and
+scrape_single_13f_optimized.py --queue claims them and re-ingests them with
+its parallel workers, up to a repair budget per run.
+
+One row per (cik, period_end):
+
+  reason     MISSING, VALUE_1000X_HIGH or PARTIAL (the report's status codes;
+             claimed in that order)
+  status     pending   waiting for a consumer
+             claimed   being re-ingested (back to pending after CLAIM_TIMEOUT)
+             done      re-ingested
+             skipped   SEC has nothing to load (no filing, 13F-NT notice)
+             failed    MAX_ATTEMPTS re-ingests did not fix it
+  attempts   re-ingests so far
+
+Enqueueing a period that is already queued only updates its reason. A
+period detected again after it was re-ingested goes back to pending, until
+it has had MAX_ATTEMPTS; skipped and failed periods stay out of the way
+until --retry below. Claims use FOR UPDATE SKIP LOCKED, so several
+consumers can drain the queue at once.
+
+Usage:
+    enqueue_repairs(cur, [(cik, period_end, "MISSING")])
+    tasks = claim_repairs(cur, 100)                   # [(cik, period_end, reason)]
+    finish_repairs(cur, [(cik, period_end, DONE)])    # DONE / SKIPPED / ERROR
+
+From the shell:
+    python repair_queue.py              # queue summary
+    python repair_queue.py --retry      # requeue skipped and failed periods
+"""
+import argparse
+import os
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from profiling import stage
+
+QUEUE_TABLE = "repair_queue"
+
+# Reasons the queue accepts, in claim order
+REASONS = ["MISSING", "VALUE_1000X_HIGH", "PARTIAL"]
+
+PENDING, CLAIMED, DONE, SKIPPED, FAILED = "pending", "claimed", "done", "skipped", "failed"
+ERROR = "error"     # finish_repairs outcome: pending again, or failed after MAX_ATTEMPTS
+
+MAX_ATTEMPTS = 3
+CLAIM_TIMEOUT = "2 hours"   # claims older than this are assumed lost with their consumer
+
+
+def ensure_repair_queue(cur):
+    """Create the queue table if needed."""
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {QUEUE_TABLE} (
+            cik TEXT NOT NULL,
+            period_end DATE NOT NULL,
+            reason TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT '{PENDING}',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            note TEXT,
+            detected_at TIMESTAMP DEFAULT NOW(),
+            claimed_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            PRIMARY KEY (cik, period_end)
+        )
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{QUEUE_TABLE}_pending
+        ON {QUEUE_TABLE} (priority, attempts, detected_at) WHERE status = '{PENDING}'
+    """)
+
+
+@stage("db")
+def enqueue_repairs(cur, tasks):
+    """Queue (cik, period_end, reason) tasks; other reasons and rows without a CIK are ignored.
+
+    Returns periods now pending.
+    """
+    values = sorted({(cik, period_end): (cik, period_end, reason, REASONS.index(reason))
+                     for cik, period_end, reason in tasks if cik and period_end and reason in REASONS}.values())
+    if not values:
+        return 0
+    rows = execute_values(cur, f"""
+        INSERT INTO {QUEUE_TABLE} (cik, period_end, reason, priority)
+        VALUES %s
+        ON CONFLICT (cik, period_end) DO UPDATE SET
+            reason = EXCLUDED.reason,
+            priority = EXCLUDED.priority,
+            detected_at = NOW(),
+            status = CASE
+                WHEN {QUEUE_TABLE}.status IN ('{CLAIMED}', '{SKIPPED}', '{FAILED}') THEN {QUEUE_TABLE}.status
+                WHEN {QUEUE_TABLE}.attempts >= {MAX_ATTEMPTS} THEN '{FAILED}'
+                ELSE '{PENDING}'
+            END
+        RETURNING status
+    """, values, page_size=1000, fetch=True)
+    return sum(1 for (status,) in rows if status == PENDING)
+
+
+@stage("db")
+def claim_repairs(cur, limit):
+    """Claim up to limit pending periods, most urgent reason first. Returns [(cik, period_end, reason)].
+
+    Within a reason, periods not yet tried go before ones whose re-ingest failed.
+
+    Commit right away so other consumers see the claims.
+    """
+    cur.execute(f"""
+        UPDATE {QUEUE_TABLE} SET status = '{PENDING}', claimed_at = NULL
+        WHERE status = '{CLAIMED}' AND claimed_at < NOW() - INTERVAL '{CLAIM_TIMEOUT}'
+    """)
+    cur.execute(f"""
+        UPDATE {QUEUE_TABLE} q
+        SET status = '{CLAIMED}', claimed_at = NOW(), attempts = q.attempts + 1
+        FROM (
+            SELECT cik, period_end FROM {QUEUE_TABLE}
+            WHERE status = '{PENDING}'
+            ORDER BY priority, attempts, detected_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ) c
+        WHERE q.cik = c.cik AND q.period_end = c.period_end
+        RETURNING q.cik, q.period_end, q.reason
+    """, (limit,))
+    return sorted(cur.fetchall(), key=lambda t: (REASONS.index(t[2]), t[0], t[1]))
+
+
+@stage("db")
+def finish_repairs(cur, outcomes):
+    """Record claimed periods' outcomes: (cik, period_end, DONE / SKIPPED / ERROR[, note])."""
+    values = [(cik, period_end, outcome, rest[0] if rest else None) for cik, period_end, outcome, *rest in outcomes]
+    if not values:
+        return
+    execute_values(cur, f"""
+        UPDATE {QUEUE_TABLE} q SET
+            status = CASE
+                WHEN o.outcome <> '{ERROR}' THEN o.outcome
+                WHEN q.attempts >= {MAX_ATTEMPTS} THEN '{FAILED}'
+                ELSE '{PENDING}'
+            END,
+            note = o.note,
+            claimed_at = NULL,
+            finished_at = NOW()
+        FROM (VALUES %s) AS o (cik, period_end, outcome, note)
+        WHERE q.cik = o.cik AND q.period_end = o.period_end::date AND q.status = '{CLAIMED}'
+    """, values, page_size=1000)
+
+
+def queue_summary(cur):
+    """[(status, reason, periods)], pending first."""
+    cur.execute(f"""
+        SELECT status, reason, COUNT(*)
+        FROM {QUEUE_TABLE}
+        GROUP BY status, reason
+        ORDER BY status <> '{PENDING}', status, MIN(priority)
+    """)
+    return cur.fetchall()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Show or reset the SEC repair queue")
+    ap.add_argument("--retry", action="store_true", help="Requeue skipped and failed periods with fresh attempts")
+    args = ap.parse_args()
+
+    load_dotenv()
+    if "DATABASE_URL" not in os.environ:
+        print("❌ DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                ensure_repair_queue(cur)
+                if args.retry:
+                    cur.execute(f"""
+                        UPDATE {QUEUE_TABLE} SET status = '{PENDING}', attempts = 0, note = NULL
+                        WHERE status IN ('{SKIPPED}', '{FAILED}')
+                    """)
+                    print(f"🔁 Requeued {cur.rowcount:,} periods")
+                summary = queue_summary(cur)
+    finally:
+        conn.close()
+
+    print(f"📋 {QUEUE_TABLE}:")
+    if not summary:
+        print("   (empty)")
+    for status, reason, n in summary:
+        print(f"   {status:<8} {reason:<17} {n:>8,}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,365 @@
+"""
+Streaming export of large report queries.
+
+The reports used to cur.fetchall() (or pandas.read_sql) the whole result
+before writing the first line: gigabytes of client memory on the full
+dataset, and nothing on disk until the query had finished. Here rows come
+from a named (server-side) cursor ITERSIZE at a time and go straight to a
+writer, so memory is one batch and the file grows while the query runs.
+
+The output format follows the file name:
+
+  .csv          plain CSV
+  .csv.gz       gzip-compressed CSV
+  .parquet      zstd-compressed Parquet, one row group per CHUNK_ROWS rows
+
+Parquet column types come from the query's result types (numeric columns
+as doubles, dates as dates, everything else as strings), so every row
+group has the same schema whatever the first rows contain. Parquet needs
+pyarrow (pip install pyarrow); it is imported only for .parquet files.
+
+Large reports can also run partitioned: cik_ranges splits a table's CIKs
+into ranges of about equal row count, and each range runs on its own
+connection, `workers` at a time (map_partitions for small per-range
+results, stream_partitions for row streams). Disjoint CIK ranges make the
+merge exact: counts add up, and per-range results ordered by cik
+concatenate into one result ordered by cik. stream_partitions spills each
+range to a temporary file as it streams and yields them in range order, so
+all ranges run at once while memory stays one batch per worker.
+
+Rows that must leave in another order than the query's go through
+ExternalSort: it sorts SORT_RUN_ROWS rows at a time, spills each sorted run
+to a temporary file the same way, and merges the runs on the way out.
+
+Usage:
+    columns, rows = stream_query(conn, sql, params)
+    with open_report("report.csv.gz", columns) as out:
+        for row in rows:
+            out.write(row)
+    print(out.rows_written, out.path)
+
+    # sql filtered with cik_range_sql("mq.cik"), ordered by cik
+    ranges = cik_ranges(cur, "manager_quarter", parts=8)
+    columns, rows = stream_partitions(db_url, sql, ranges, workers=4)
+
+    with ExternalSort(key=lambda r: (r[2], r[0])) as ordered:
+        for row in rows:
+            ordered.add(row)
+        for row in ordered: ...
+"""
+import csv
+import gzip
+import heapq
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import psycopg2
+
+from profiling import stage
+
+ITERSIZE = 10000        # rows per round trip of the server-side cursor
+CHUNK_ROWS = 100000     # rows per Parquet row group
+SORT_RUN_ROWS = 200000  # rows ExternalSort holds in memory before spilling a sorted run
+FORMATS = ("csv", "csv.gz", "parquet")
+
+# Postgres type OIDs -> Parquet column kinds (anything else is written as text)
+_INT_OIDS = {20, 21, 23}                # int8, int2, int4
+_FLOAT_OIDS = {700, 701, 1700}          # float4, float8, numeric
+_DATE_OIDS = {1082}
+_BOOL_OIDS = {16}
+
+_cursor_names = 0
+
+
+def stream_query(conn, sql, params=None, itersize=ITERSIZE):
+    """Run sql on a named cursor; returns (column names, row iterator).
+
+    The query runs in conn's current transaction, which stays open until the
+    iterator is exhausted; the cursor is closed then.
+    """
+    global _cursor_names
+    _cursor_names += 1
+    cur = conn.cursor(name=f"report_export_{_cursor_names}")
+    cur.itersize = itersize
+    cur.execute(sql, params)
+    first = cur.fetchmany(itersize)     # a named cursor has no description before the first fetch
+    columns = [d.name for d in cur.description]
+    types = [d.type_code for d in cur.description]
+
+    def rows():
+        try:
+            batch = first
+            while batch:
+                yield from batch
+                batch = cur.fetchmany(itersize)
+        finally:
+            cur.close()
+
+    return ReportColumns(columns, types), rows()
+
+
+class ReportColumns(list):
+    """Column names (a plain list) that also carry the Postgres type OIDs, for Parquet."""
+
+    def __init__(self, names, type_codes=None):
+        super().__init__(names)
+        self.type_codes = list(type_codes) if type_codes is not None else [None] * len(names)
+
+    def select(self, names, rename=None):
+        """The named subset, in the given order; rename maps a name to its output name."""
+        rename = rename or {}
+        return ReportColumns([rename.get(n, n) for n in names], [self.type_codes[self.index(n)] for n in names])
+
+
+def cik_ranges(cur, table, parts):
+    """Split table's CIKs into up to `parts` ranges of about equal row count.
+
+    Returns [(lo, hi)] covering every CIK: lo inclusive, hi exclusive, None
+    for an open end (see cik_range_sql).
+    """
+    if parts <= 1:
+        return [(None, None)]
+    cur.execute(f"SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY cik) FROM {table}",
+                ([i / parts for i in range(1, parts)],))
+    bounds = sorted({b for b in cur.fetchone()[0] or [] if b is not None})
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def cik_range_sql(column):
+    """WHERE condition for one cik_ranges range, with %(cik_lo)s / %(cik_hi)s parameters.
+
+    Rows without a CIK fall in the last range, where ORDER BY cik puts them.
+    """
+    return (f"(({column} IS NULL AND %(cik_hi)s::text IS NULL) "
+            f"OR ((%(cik_lo)s::text IS NULL OR {column} >= %(cik_lo)s) "
+            f"AND (%(cik_hi)s::text IS NULL OR {column} < %(cik_hi)s)))")
+
+
+def _range_params(params, cik_range):
+    return {**(params or {}), "cik_lo": cik_range[0], "cik_hi": cik_range[1]}
+
+
+def _on_connection(db_url, fn, *args):
+    conn = psycopg2.connect(db_url, connect_timeout=30)
+    try:
+        return fn(conn, *args)
+    finally:
+        conn.close()
+
+
+def map_partitions(db_url, sql, ranges, workers, params=None):
+    """Run sql once per CIK range, concurrently; returns (columns, [rows of each range]) in range order."""
+    def fetch(conn, cik_range):
+        with conn.cursor() as cur:
+            cur.execute(sql, _range_params(params, cik_range))
+            return [d.name for d in cur.description], cur.fetchall()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda r: _on_connection(db_url, fetch, r), ranges))
+    return results[0][0], [rows for _, rows in results]
+
+
+def _spill_rows(rows):
+    """Pickle rows to a temporary file, ITERSIZE per batch; returns it rewound."""
+    spill = tempfile.TemporaryFile()
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= ITERSIZE:
+            pickle.dump(batch, spill)
+            batch = []
+    if batch:
+        pickle.dump(batch, spill)
+    spill.seek(0)
+    return spill
+
+
+def _read_spill(spill):
+    """The rows of a _spill_rows file, a batch at a time."""
+    while True:
+        try:
+            batch = pickle.load(spill)
+        except EOFError:
+            return
+        yield from batch
+
+
+def _spill(conn, sql, params):
+    columns, rows = stream_query(conn, sql, params)
+    return columns, _spill_rows(rows)
+
+
+def stream_partitions(db_url, sql, ranges, workers, params=None):
+    """stream_query over CIK ranges run concurrently; returns (columns, rows in range order).
+
+    Each range streams into a temporary file on its own connection; rows of
+    a range are yielded once it has finished, while later ranges still run.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(_on_connection, db_url, _spill, sql, _range_params(params, r)) for r in ranges]
+    try:
+        columns = futures[0].result()[0]
+    except BaseException:
+        executor.shutdown(cancel_futures=True)
+        raise
+
+    def rows():
+        try:
+            for future in futures:
+                _, spill = future.result()
+                with spill:
+                    yield from _read_spill(spill)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    future.result()[1].close()      # spills of ranges never read
+
+    return columns, rows()
+
+
+class ExternalSort:
+    """Rows added in any order, read back sorted by key, holding at most run_rows in memory.
+
+    Sorted runs spill to temporary files and are merged when iterated (stable,
+    like sorted()). Iterate once; closing drops the spill files.
+    """
+
+    def __init__(self, key, run_rows=SORT_RUN_ROWS):
+        self.key = key
+        self.run_rows = run_rows
+        self.rows_added = 0
+        self._batch = []
+        self._runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close()
+
+    def add(self, row):
+        self._batch.append(row)
+        self.rows_added += 1
+        if len(self._batch) >= self.run_rows:
+            self._batch.sort(key=self.key)
+            with stage("io"):
+                self._runs.append(_spill_rows(self._batch))
+            self._batch = []
+
+    def __iter__(self):
+        self._batch.sort(key=self.key)
+        if not self._runs:
+            return iter(self._batch)
+        return heapq.merge(*(_read_spill(run) for run in self._runs), iter(self._batch), key=self.key)
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._batch = []
+
+
+def _format_of(path):
+    for fmt in sorted(FORMATS, key=len, reverse=True):
+        if path.endswith("." + fmt):
+            return fmt
+    raise ValueError(f"Unknown report format for {path}; use one of {', '.join('.' + f for f in FORMATS)}")
+
+
+def open_report(path, columns):
+    """A writer for path in the format its extension names."""
+    fmt = _format_of(path)
+    if fmt == "parquet":
+        return ParquetReport(path, columns)
+    return CsvReport(path, columns, compress=fmt == "csv.gz")
+
+
+class CsvReport:
+    """Writes rows to a (optionally gzip-compressed) CSV file as they come."""
+
+    def __init__(self, path, columns, compress=False):
+        self.path = path
+        self.rows_written = 0
+        if compress:
+            self._file = gzip.open(path, "wt", newline="", encoding="utf-8")
+        else:
+            self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(list(columns))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close()
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self.rows_written += 1
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetReport:
+    """Buffers CHUNK_ROWS rows at a time and writes each batch as a Parquet row group."""
+
+    def __init__(self, path, columns, chunk_rows=CHUNK_ROWS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Writing a Parquet report needs pyarrow: pip install pyarrow") from e
+        self._pa = pa
+        type_codes = getattr(columns, "type_codes", [None] * len(columns))
+        self.schema = pa.schema([(name, self._arrow_type(oid)) for name, oid in zip(columns, type_codes)])
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.rows_written = 0
+        self._rows = []
+        self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def _arrow_type(self, oid):
+        pa = self._pa
+        if oid in _INT_OIDS:
+            return pa.int64()
+        if oid in _FLOAT_OIDS:
+            return pa.float64()
+        if oid in _DATE_OIDS:
+            return pa.date32()
+        if oid in _BOOL_OIDS:
+            return pa.bool_()
+        return pa.string()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close()
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.chunk_rows:
+            self._flush()
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        self._writer.close()
+
+    @stage("export")
+    def _flush(self):
+        arrays = []
+        for i, field in enumerate(self.schema):
+            values = [r[i] for r in self._rows]
+            if field.type == self._pa.float64():
+                values = [float(v) if isinstance(v, Decimal) else v for v in values]
+            elif field.type == self._pa.string():
+                values = [None if v is None else str(v) for v in values]
+            arrays.append(self._pa.array(values, type=field.type))
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows_written += len(self._rows)
+        self._rows = []
@@ -0,0 +1,261 @@
+"""
+Local resume store for the 13f.info holdings downloaders.
+
+One SQLite file holds, per (manager_url, quarter), the fetch state and the
+holdings rows that were scraped for it, written in the same transaction, so
+a manager can never be marked done without its rows (or the other way
+round). Resume is an indexed query instead of loading a done-managers text
+file, and the final Postgres load streams rows out of the store with COPY
+instead of re-parsing a checkpoint CSV.
+
+Tables:
+  manager_quarters  status ('ok', 'no_filing', 'no_data', 'failed'),
+                    filing_url, num_rows, digest (fingerprints.holdings_hash
+                    of the rows), last error, attempts
+  holdings          rows in HOLDING_COLUMNS order (expected_13finfo_holdings)
+
+'ok' and 'no_filing' are done; 'no_data' and 'failed' are retried.
+
+Usage:
+    store = ResumeStore(args.store)
+    remaining = store.remaining(quarter, manager_urls)
+    store.record([(manager_url, quarter, "ok", filing_url, rows, None), ...])
+    store.copy_to_postgres(cur, TABLE)          # every 'ok' row, via COPY
+    store.close()
+
+From the shell:
+    python resume_store.py --status
+    python resume_store.py --import-legacy --quarter "Q3 2025" \\
+        --csv 13finfo_holdings_checkpoint.csv --done-file 13finfo_holdings_done_managers.txt
+"""
+import argparse
+import csv
+import os
+import sqlite3
+from collections import Counter
+
+from copy_writer import CHUNK_ROWS
+from fingerprints import holdings_hash
+from holdings_table import HOLDING_COLUMNS, upsert_holdings_rows
+
+DEFAULT_STORE = "13finfo_resume.sqlite"
+
+NUMERIC_COLUMNS = {"value_000", "pct", "shares"}
+DONE_STATUSES = ("ok", "no_filing")
+
+_NUMERIC_POSITIONS = [i for i, c in enumerate(HOLDING_COLUMNS) if c in NUMERIC_COLUMNS]
+
+
+def to_number(v):
+    """Numeric value or None (like pd.to_numeric(errors="coerce")); integral values as int"""
+    if v is None or v == "":
+        return None
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    if f != f or f in (float("inf"), float("-inf")):
+        return None
+    return int(f) if f.is_integer() else f
+
+
+def clean_row(row):
+    """Row tuple in HOLDING_COLUMNS order with the numeric columns coerced."""
+    row = list(row)
+    for i in _NUMERIC_POSITIONS:
+        row[i] = to_number(row[i])
+    return tuple(row)
+
+
+class ResumeStore:
+    """Per-(manager, quarter) fetch state and scraped rows in one SQLite file."""
+
+    def __init__(self, path=DEFAULT_STORE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        cols = ", ".join(HOLDING_COLUMNS)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS manager_quarters (
+                    manager_url TEXT NOT NULL,
+                    quarter TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    filing_url TEXT,
+                    num_rows INTEGER NOT NULL DEFAULT 0,
+                    digest TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 1,
+                    updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+                    PRIMARY KEY (manager_url, quarter)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_manager_quarters_quarter_status
+                ON manager_quarters (quarter, status)
+            """)
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS holdings ({cols})")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_holdings_quarter_manager
+                ON holdings (quarter, manager_url)
+            """)
+
+    def close(self):
+        self.conn.close()
+
+    def done_managers(self, quarter):
+        """Manager URLs already done ('ok' or 'no_filing') for quarter."""
+        placeholders = ", ".join("?" for _ in DONE_STATUSES)
+        cur = self.conn.execute(f"""
+            SELECT manager_url FROM manager_quarters
+            WHERE quarter = ? AND status IN ({placeholders})
+        """, (quarter, *DONE_STATUSES))
+        return {url for (url,) in cur}
+
+    def remaining(self, quarter, manager_urls):
+        """manager_urls not yet done for quarter, in their original order."""
+        done = self.done_managers(quarter)
+        return [u for u in manager_urls if u not in done]
+
+    def record(self, results):
+        """Record a batch of fetch results in one transaction.
+
+        results: iterable of (manager_url, quarter, status, filing_url, rows, error)
+        rows are tuples in HOLDING_COLUMNS order (may be empty). Any rows
+        stored earlier for the same (manager_url, quarter) are replaced.
+        """
+        placeholders = ", ".join("?" for _ in HOLDING_COLUMNS)
+        with self.conn:
+            for manager_url, quarter, status, filing_url, rows, error in results:
+                rows = [clean_row(r) for r in rows or ()]
+                self.conn.execute("DELETE FROM holdings WHERE quarter = ? AND manager_url = ?",
+                                  (quarter, manager_url))
+                if rows:
+                    self.conn.executemany(
+                        f"INSERT INTO holdings ({', '.join(HOLDING_COLUMNS)}) VALUES ({placeholders})", rows)
+                self.conn.execute("""
+                    INSERT INTO manager_quarters (manager_url, quarter, status, filing_url, num_rows, digest, error)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (manager_url, quarter) DO UPDATE SET
+                        status = excluded.status,
+                        filing_url = excluded.filing_url,
+                        num_rows = excluded.num_rows,
+                        digest = excluded.digest,
+                        error = excluded.error,
+                        attempts = manager_quarters.attempts + 1,
+                        updated_at = datetime('now')
+                """, (manager_url, quarter, status, filing_url, len(rows),
+                      holdings_hash(rows) if rows else None, error))
+
+    def status_counts(self, quarter=None):
+        """{status: (managers, rows)} for one quarter, or every quarter."""
+        where, params = ("WHERE quarter = ?", (quarter,)) if quarter else ("", ())
+        cur = self.conn.execute(f"""
+            SELECT status, COUNT(*), COALESCE(SUM(num_rows), 0)
+            FROM manager_quarters {where}
+            GROUP BY status
+        """, params)
+        return {status: (managers, rows) for status, managers, rows in cur}
+
+    def iter_row_chunks(self, quarter=None, chunk_rows=CHUNK_ROWS):
+        """Lists of 'ok' holdings rows (HOLDING_COLUMNS order), about chunk_rows at a time.
+
+        A chunk only ends between managers, so one filing's rows are never split.
+        """
+        cols = ", ".join(f"h.{c}" for c in HOLDING_COLUMNS)
+        where, params = ("AND h.quarter = ?", (quarter,)) if quarter else ("", ())
+        cur = self.conn.execute(f"""
+            SELECT {cols}
+            FROM holdings h
+            JOIN manager_quarters m ON m.manager_url = h.manager_url AND m.quarter = h.quarter
+            WHERE m.status = 'ok' {where}
+            ORDER BY h.quarter, h.manager_url
+        """, params)
+        chunk = []
+        for row in cur:
+            if len(chunk) >= chunk_rows and (row[0], row[2]) != (chunk[-1][0], chunk[-1][2]):
+                yield chunk
+                chunk = []
+            chunk.append(row)
+        if chunk:
+            yield chunk
+
+    def copy_to_postgres(self, cur, table, quarter=None):
+        """COPY every 'ok' row (optionally one quarter) into a Postgres table; returns the row count.
+
+        Rows are upserted on the table's natural key (holdings_table).
+        """
+        total = 0
+        for chunk in self.iter_row_chunks(quarter):
+            upsert_holdings_rows(cur, table, HOLDING_COLUMNS, chunk)
+            total += len(chunk)
+            print(f"✅ Copied chunk: {len(chunk)} rows (total={total})")
+        return total
+
+    def import_legacy(self, quarter, csv_path=None, done_path=None):
+        """Import a checkpoint CSV and done-managers file from before the store existed.
+
+        Managers in the done file become 'ok' if the CSV has rows for them
+        (CSV rows for other quarters are skipped), 'no_filing' otherwise.
+        """
+        if self.conn.execute("SELECT 1 FROM manager_quarters WHERE quarter = ? LIMIT 1", (quarter,)).fetchone():
+            raise RuntimeError(f"{self.path} already has state for {quarter}; import into a fresh store")
+        rows_by_manager = Counter()
+        placeholders = ", ".join("?" for _ in HOLDING_COLUMNS)
+        with self.conn:
+            if csv_path and os.path.exists(csv_path):
+                with open(csv_path, newline="", encoding="utf-8") as f:
+                    chunk = []
+                    for rec in csv.DictReader(f):
+                        if (rec.get("quarter") or "").strip() != quarter:
+                            continue
+                        chunk.append(clean_row(rec.get(c) or None for c in HOLDING_COLUMNS))
+                        rows_by_manager[rec["manager_url"]] += 1
+                        if len(chunk) >= CHUNK_ROWS:
+                            self.conn.executemany(
+                                f"INSERT INTO holdings ({', '.join(HOLDING_COLUMNS)}) VALUES ({placeholders})", chunk)
+                            chunk = []
+                    if chunk:
+                        self.conn.executemany(
+                            f"INSERT INTO holdings ({', '.join(HOLDING_COLUMNS)}) VALUES ({placeholders})", chunk)
+            done = set()
+            if done_path and os.path.exists(done_path):
+                with open(done_path, encoding="utf-8") as f:
+                    done = {line.strip() for line in f if line.strip()}
+            self.conn.executemany("""
+                INSERT INTO manager_quarters (manager_url, quarter, status, num_rows)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (manager_url, quarter) DO NOTHING
+            """, [(url, quarter, "ok" if rows_by_manager[url] else "no_filing", rows_by_manager[url])
+                  for url in done | set(rows_by_manager)])
+        return len(done | set(rows_by_manager)), sum(rows_by_manager.values())
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Inspect or seed the 13f.info resume store")
+    ap.add_argument("--store", default=DEFAULT_STORE)
+    ap.add_argument("--quarter", help='e.g. "Q3 2025" (required for --import-legacy)')
+    ap.add_argument("--status", action="store_true", help="Print per-status manager/row counts")
+    ap.add_argument("--import-legacy", action="store_true",
+                    help="Import a checkpoint CSV and done-managers file into the store")
+    ap.add_argument("--csv", default="13finfo_holdings_checkpoint.csv")
+    ap.add_argument("--done-file", default="13finfo_holdings_done_managers.txt")
+    args = ap.parse_args()
+
+    store = ResumeStore(args.store)
+    try:
+        if args.import_legacy:
+            if not args.quarter:
+                ap.error("--import-legacy needs --quarter")
+            managers, rows = store.import_legacy(args.quarter, args.csv, args.done_file)
+            print(f"📥 Imported {managers:,} managers and {rows:,} rows for {args.quarter} into {args.store}")
+        if args.status or not args.import_legacy:
+            for status, (managers, rows) in sorted(store.status_counts(args.quarter).items()):
+                print(f"   {status:<10} {managers:>8,} managers {rows:>12,} rows")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
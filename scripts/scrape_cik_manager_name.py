@@ -5,13 +5,15 @@ Creates/updates the 'cik_manager_name' table in PostgreSQL.
 
 Optimized for speed with:
 - Parallel HTTP requests via ThreadPoolExecutor
-- Batch database inserts with execute_values
+- Diff-based sync: only new, changed and vanished managers are written
 - Minimal parsing (only extract what's needed)
-- Optional manager classification
+- Refreshes manager_classification (categories served by the API)
+- Optional classification column in cik_manager_name
 
 Usage:
     python scrape_cik_manager_name.py
     python scrape_cik_manager_name.py --with-classification
+    python scrape_cik_manager_name.py --full-refresh     # shadow table + atomic rename
 """
 import argparse
 import os
@@ -19,83 +21,28 @@ import re
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from bs4 import BeautifulSoup
 import psycopg2
-from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+from manager_classification import classify_manager, sync_manager_classification
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from table_sync import replace_table, sync_table
+from thirteenf_client import SyncThirteenFClient
+from thirteenf_html import manager_links
+
 # Configuration
 BASE_URL = "https://13f.info"
 LETTERS = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ") + ["0"]
 MAX_WORKERS = 12  # Parallel threads for fetching letter pages
-REQUEST_TIMEOUT = 30
 
+UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) CIK-Scraper/1.0"
 HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) CIK-Scraper/1.0",
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
     "Accept-Language": "en-US,en;q=0.9",
 }
 
-# Classification keywords
-BANK_KEYWORDS = [
-    "BANK", "BANC", "BANCORP", "TRUST", "CREDIT UNION",
-    "JPMORGAN", "CHASE", "WELLS FARGO", "CITIGROUP", "CITI ",
-    "MORGAN STANLEY", "GOLDMAN SACHS", "BANK OF AMERICA",
-    "BARCLAYS", "UBS", "HSBC", "STATE STREET", "NORTHERN TRUST",
-    "PNC ", "US BANK", "CITIZENS", "FIFTH THIRD", "TRUIST",
-]
-
-ASSET_MANAGER_KEYWORDS = [
-    "VANGUARD", "BLACKROCK", "FIDELITY", "SCHWAB", "INVESCO",
-    "T ROWE", "T. ROWE", "FRANKLIN TEMPLETON", "DIMENSIONAL",
-    "PIMCO", "CAPITAL GROUP", "WELLINGTON", "AMUNDI",
-    "GEODE", "SSGA", "NORTHERN TRUST INVEST", "PRUDENTIAL",
-]
-
-HEDGE_FUND_KEYWORDS = [
-    "HEDGE", "MASTER FUND", "OPPORTUNITY FUND",
-]
-
-
-def classify_manager(name):
-    """Classify manager into: bank, asset_manager, hedge_fund, or other."""
-    upper_name = name.upper()
-    
-    # Check banks first (most specific)
-    if any(kw in upper_name for kw in BANK_KEYWORDS):
-        return "bank"
-    
-    # Check large asset managers
-    if any(kw in upper_name for kw in ASSET_MANAGER_KEYWORDS):
-        return "asset_manager"
-    
-    # Check hedge fund indicators
-    if any(kw in upper_name for kw in HEDGE_FUND_KEYWORDS):
-        return "hedge_fund"
-    
-    # Generic investment manager keywords -> hedge_fund (most 13F filers)
-    generic_kw = ["CAPITAL", "MANAGEMENT", "PARTNERS", "ADVISOR", "ADVISER", "FUND", "INVEST", "LP", "LLC"]
-    if any(kw in upper_name for kw in generic_kw):
-        return "hedge_fund"
-    
-    return "other"
-
-
-def create_session():
-    """Create session with connection pooling and retry logic."""
-    session = requests.Session()
-    session.headers.update(HEADERS)
-    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry, pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS * 2)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
-    return session
-
-
-SESSION = create_session()
+# Shared 13f.info client (pooling, retries, 429 backoff); worker threads block on it
+CLIENT = SyncThirteenFClient(user_agent=UA, headers=HEADERS)
 
 # Pre-compiled regex for CIK extraction from URL
 RE_CIK = re.compile(r'/manager/(\d{10})-')
@@ -109,17 +56,16 @@ def fetch_managers_for_letter(letter):
     url = f"{BASE_URL}/managers/{letter.lower()}"
     
     try:
-        r = SESSION.get(url, timeout=REQUEST_TIMEOUT)
-        r.raise_for_status()
+        html = CLIENT.fetch_text(url)
+        if html is None:
+            raise RuntimeError("fetch failed")
         
-        soup = BeautifulSoup(r.content, "lxml")
+        with stage("parse"):
+            links = manager_links(html)
         managers = []
         
         # Manager links look like: /manager/0001540358-a16z-capital-management-l-l-c
-        for a in soup.select('a[href^="/manager/"]'):
-            href = a.get("href", "")
-            name = a.get_text(strip=True)
-            
+        for href, name in links:
             if not href or not name:
                 continue
             
@@ -139,7 +85,11 @@ def main():
     parser = argparse.ArgumentParser(description="Scrape CIK-manager name mappings from 13f.info")
     parser.add_argument("--with-classification", action="store_true", 
                         help="Also classify managers (bank, asset_manager, hedge_fund, other)")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="Rebuild the table in a shadow copy and swap it in, instead of a diff sync")
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling_from_args(args)
     
     load_dotenv()
     
@@ -172,6 +122,7 @@ def main():
             else:
                 all_managers.extend(managers)
                 print(f"  ✓ /managers/{letter}: {len(managers)} managers")
+    CLIENT.report()
     
     # Deduplicate by CIK (keep first occurrence)
     seen_ciks = set()
@@ -206,75 +157,49 @@ def main():
     conn.autocommit = False
     cur = conn.cursor()
     
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cik_manager_name (
+            cik TEXT PRIMARY KEY,
+            manager_name TEXT NOT NULL,
+            classification TEXT,
+            source TEXT DEFAULT '13f.info',
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    
+    # Index on manager_name for fast lookups
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_cik_manager_name_name 
+        ON cik_manager_name (manager_name)
+    """)
+    
     if args.with_classification:
-        # Create table with classification
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS cik_manager_name (
-                cik TEXT PRIMARY KEY,
-                manager_name TEXT NOT NULL,
-                classification TEXT,
-                source TEXT DEFAULT '13f.info',
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
-        
-        # Create indexes
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_cik_manager_name_name 
-            ON cik_manager_name (manager_name)
-        """)
         cur.execute("""
             CREATE INDEX IF NOT EXISTS idx_cik_manager_name_classification 
             ON cik_manager_name (classification)
         """)
-        
-        # Upsert with classification
-        execute_values(
-            cur,
-            """
-            INSERT INTO cik_manager_name (cik, manager_name, classification, updated_at)
-            VALUES %s
-            ON CONFLICT (cik) DO UPDATE SET
-                manager_name = EXCLUDED.manager_name,
-                classification = EXCLUDED.classification,
-                updated_at = NOW()
-            """,
-            [(cik, name, cat, datetime.now()) for cik, name, cat in classified],
-            page_size=1000
-        )
+        columns, rows = ["cik", "manager_name", "classification"], classified
     else:
-        # Create table without classification
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS cik_manager_name (
-                cik TEXT PRIMARY KEY,
-                manager_name TEXT NOT NULL,
-                classification TEXT,
-                source TEXT DEFAULT '13f.info',
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
-        
-        # Create index on manager_name for fast lookups
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_cik_manager_name_name 
-            ON cik_manager_name (manager_name)
-        """)
-        
-        # Upsert all managers (update name if CIK exists)
-        execute_values(
-            cur,
-            """
-            INSERT INTO cik_manager_name (cik, manager_name, updated_at)
-            VALUES %s
-            ON CONFLICT (cik) DO UPDATE SET
-                manager_name = EXCLUDED.manager_name,
-                updated_at = NOW()
-            """,
-            [(cik, name, datetime.now()) for cik, name in unique_managers],
-            page_size=1000
-        )
+        columns, rows = ["cik", "manager_name"], unique_managers
+    
+    if args.full_refresh:
+        if errors:
+            print("❌ Full refresh refused: some letter pages failed, the table would lose those managers")
+            conn.rollback()
+            return 1
+        replace_table(cur, "cik_manager_name", columns, rows)
+        print(f"   Full refresh: {len(rows)} rows swapped in")
+    else:
+        # Only new, renamed (or reclassified) and vanished managers are written;
+        # with failed letter pages nothing is deleted
+        result = sync_table(cur, "cik_manager_name", ["cik"], columns, rows,
+                            delete_missing=not errors, touch="updated_at = NOW()")
+        print(f"   Sync: {result}")
+    
+    # Materialized categories the API joins (manager_classification.py)
+    result = sync_manager_classification(cur, delete_missing=not errors)
+    print(f"   manager_classification: {result}")
     
     conn.commit()
     
@@ -28,9 +28,16 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import psycopg2
-from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from cover_page import is_notice, parse_cover_page
+from fingerprints import content_hash, holdings_hash
+from amendments import APPEND, REPLACE, is_amendment, plan_period, write_filing
+from holding_stats import ensure_period_stats
+from sec_ledger import ensure_ledger, ledger_state, record_cover_pages, record_loaded
+from value_units import LOW_CONFIDENCE, detect_value_units
+
 # Configuration
 SEC_HEADERS = {
     "User-Agent": "Naveen Mokkapati navmok@gmail.com", 
@@ -47,6 +54,9 @@ RE_XML_HREF = re.compile(r'href="([^"]+\.xml)"', re.IGNORECASE)
 RE_PRIMARY_DOC = re.compile(r'primary.*doc', re.IGNORECASE)
 RE_INFO_TABLE = re.compile(r'info.*table', re.IGNORECASE)
 
+# Ledger snapshot for the CIKs being processed, loaded once in main() (read-only in workers)
+LEDGER_STATE = {}
+
 # Thread-safe index cache
 QUARTERLY_INDEXES = {}
 INDEX_LOCK = Lock()
@@ -59,13 +69,14 @@ class RateLimitedSession(requests.Session):
     """Session that strictly adheres to SEC rate limits (10 req/sec)."""
     def request(self, method, url, *args, **kwargs):
         global LAST_REQUEST_TIME
-        with RATE_LIMIT_LOCK:
+        with stage("rate_limit"), RATE_LIMIT_LOCK:
             now = time.time()
             elapsed = now - LAST_REQUEST_TIME
             if elapsed < SEC_RATE_LIMIT_INTERVAL:
                 time.sleep(SEC_RATE_LIMIT_INTERVAL - elapsed)
             LAST_REQUEST_TIME = time.time()
-        return super().request(method, url, *args, **kwargs)
+        with stage("fetch"):
+            return super().request(method, url, *args, **kwargs)
 
 def create_session():
     """Create session with connection pooling, retry logic, and rate limiting."""
@@ -152,32 +163,31 @@ def period_to_quarter(period_end):
     return dt.year, (dt.month - 1) // 3 + 1, dt
 
 
-def find_13f_filing(cik, period_end):
-    """Find the 13F filing. Prefers original over amendments."""
+def find_13f_filings(cik, period_end):
+    """Find the original 13F filing for a period plus the amendments filed in its window.
+
+    The 150-day window can reach the next period's original, so only the
+    earliest original is kept. Amendments are matched to the period later,
+    from their cover page. Returns copies, ordered by filing date.
+    """
     cik_padded = str(cik).zfill(10)
     year, quarter, target_date = period_to_quarter(period_end)
-    
+
     filing_year, filing_quarter = (year, quarter + 1) if quarter < 4 else (year + 1, 1)
-    
+    next_y, next_q = (filing_year, filing_quarter + 1) if filing_quarter < 4 else (filing_year + 1, 1)
+
     start_date = target_date + timedelta(days=1)
     end_date = target_date + timedelta(days=150)
-    
-    # Check primary quarter
-    index = download_quarterly_index(filing_year, filing_quarter)
-    candidates = [f for f in index.get(cik_padded, []) if start_date <= f["filing_date"] <= end_date]
-    
-    # Check next quarter if needed
-    if not candidates:
-        next_y, next_q = (filing_year, filing_quarter + 1) if filing_quarter < 4 else (filing_year + 1, 1)
-        index2 = download_quarterly_index(next_y, next_q)
-        candidates = [f for f in index2.get(cik_padded, []) if start_date <= f["filing_date"] <= end_date]
-    
-    if not candidates:
-        return None
-    
-    # Prefer original (no /A) over amendments, then earliest date
-    candidates.sort(key=lambda x: (x["form_type"].endswith("/A"), x["filing_date"]))
-    return candidates[0]
+
+    # Both indexes: amendments often land in the quarter after the original
+    candidates = []
+    for y, q in ((filing_year, filing_quarter), (next_y, next_q)):
+        index = download_quarterly_index(y, q)
+        candidates.extend(f for f in index.get(cik_padded, []) if start_date <= f["filing_date"] <= end_date)
+
+    originals = sorted((f for f in candidates if not is_amendment(f)), key=lambda x: x["filing_date"])
+    chain = originals[:1] + [f for f in candidates if is_amendment(f)]
+    return [dict(f) for f in sorted(chain, key=lambda x: (x["filing_date"], x["accession_no"]))]
 
 
 def get_filing_xml_urls(cik, accession_no):
@@ -225,39 +235,27 @@ def get_filing_xml_urls(cik, accession_no):
         return None, None
 
 
-def fetch_value_total(xml_url):
-    """Fetch total value from primary_doc.xml (in thousands). Fast string search."""
+def fetch_cover_page(xml_url):
+    """Fetch primary_doc.xml and extract its cover/summary page fields in one pass."""
     try:
         r = SESSION.get(xml_url, timeout=30)
         if r.status_code != 200:
             return None
-        
-        content = r.content
-        for tag in (b'tableValueTotal', b'valueTotal', b'securitiesOwnedAggregateValue'):
-            idx = content.find(tag)
-            if idx != -1:
-                start = content.find(b'>', idx) + 1
-                end = content.find(b'<', start)
-                if start > 0 and end > start:
-                    try:
-                        return int(content[start:end].strip())
-                    except:
-                        pass
-        return None
+        return parse_cover_page(r.content)
     except:
         return None
 
 
 def fetch_holdings_raw(xml_url):
-    """Fetch holdings from info_table.xml. Returns RAW values (not multiplied)."""
+    """Fetch holdings from info_table.xml. Returns (holdings, raw_hash) with RAW values (not multiplied)."""
     try:
         r = SESSION.get(xml_url, timeout=120)
         if r.status_code != 200:
-            return []
+            return [], None
         
         content_length = r.headers.get('content-length')
         if content_length and int(content_length) > 25_000_000:
-            return []  # Skip files > 25MB
+            return [], None  # Skip files > 25MB
         
         holdings = []
         idx = 0
@@ -364,73 +362,9 @@ def fetch_holdings_raw(xml_url):
                 print(f"XML Parse Error on {xml_url}: {e}")
             pass
 
-        return holdings
+        return holdings, content_hash(r.content)
     except:
-        return []
-
-
-def determine_value_multiplier(holdings_raw, total_value_thousands):
-    """
-    Determine if holdings values are in thousands or actual dollars.
-    
-    Strategies:
-    1. AUM Cap Heuristic:
-       - If 'total_value_thousands' > 25,000,000 (Implies $25 Trillion AUM), 
-         the header is definitely in Dollars, not Thousands. 
-         (Largest asset managers ~10T).
-       - In this case, if Raw Sum matches Header, Raw is also Dollars -> Multiplier 1.
-       
-    2. Share Ratio Heuristic (Avg Price):
-       - If RawValue/Shares > 1.5, likely Dollars ($1.50/share is very low for Thousands representation).
-       - Normal stock ~ $50. In Thousands that's 0.05.
-       
-    3. Consistency check.
-    """
-    if not holdings_raw:
-        return 1000
-    
-    # Sum raw values
-    total_raw_val = sum(h[4] for h in holdings_raw if h[4] is not None)
-    
-    # 1. AUM Cap Heuristic (Catch filers putting Dollars in Header)
-    # 25,000,000 in 'Thousands' = 25 Trillion. safely above BlackRock.
-    if total_value_thousands and total_value_thousands > 25_000_000:
-        # Header is definitely Dollars.
-        # Check consistency with Raw
-        if total_raw_val > 0:
-            ratio = total_raw_val / total_value_thousands
-            if 0.8 < ratio < 1.2:
-                print(f"   ℹ️  Detected DOLLAR format via AUM Cap ({total_value_thousands})")
-                return 1
-
-    # 2. Share Ratio Heuristic
-    total_shares = sum(h[5] for h in holdings_raw if h[5] is not None and h[5] > 0)
-    
-    if total_shares > 0:
-        avg_raw_ratio = total_raw_val / total_shares
-        
-        # Lowered threshold to 2.0 (Implies avg share price $2000 if in thousands)
-        # Most portfolios average $50-$200.
-        if avg_raw_ratio > 2.0:
-            print(f"   ℹ️  Detected DOLLAR format via Implied Price ({avg_raw_ratio:.2f})")
-            return 1
-
-    # 3. Consistency Check (Fallback)
-    if not total_value_thousands or total_raw_val == 0:
-        return 1000
-    
-    total_value_dollars = total_value_thousands * 1000
-    
-    ratio_if_thousands = total_raw_val / total_value_thousands
-    ratio_if_dollars = total_raw_val / total_value_dollars
-    
-    diff_thousands = abs(ratio_if_thousands - 1.0)
-    diff_dollars = abs(ratio_if_dollars - 1.0)
-    
-    if diff_dollars < diff_thousands and diff_dollars < 0.2:
-        return 1
-    else:
-        return 1000
+        return [], None
 
 
 def apply_value_multiplier(holdings_raw, multiplier):
@@ -444,50 +378,140 @@ def apply_value_multiplier(holdings_raw, multiplier):
 
 
 def process_filing(task):
-    """Process a single filing. Returns (cik, period_end, status, holdings_data, total_value, acc_no, multiplier)."""
+    """Process one (cik, period_end). Returns (cik, period_end, status, parts).
+
+    parts lists what still has to be applied for the period as
+    (filing, mode, holdings_raw, cover) in filing order, where mode is
+    amendments.REPLACE / APPEND, or "notice" for a 13F-NT. Filings the ledger
+    already has as loaded are skipped. Values are left raw; their units are
+    decided for the whole batch in commit_batch.
+    """
     cik, period_end = task
-    
+
     try:
-        filing = find_13f_filing(cik, period_end)
-        if not filing:
-            return (cik, period_end, "no_filing", None, None, None, None)
-        
-        acc_no = filing["accession_no"]
-        # time.sleep(REQUEST_DELAY_SEC)  <-- Handled by RateLimitSession
-        
-        primary_url, info_url = get_filing_xml_urls(cik, acc_no)
-        
-        # Fetch total value first (needed to determine multiplier)
-        total_value = None
-        if primary_url:
-            total_value = fetch_value_total(primary_url)
-        
-        # Fetch raw holdings
-        holdings_raw = []
-        if info_url:
-            # time.sleep(REQUEST_DELAY_SEC) <-- Handled by RateLimitSession
-            holdings_raw = fetch_holdings_raw(info_url)
-        
-        if not holdings_raw:
-            return (cik, period_end, "no_holdings", None, total_value, acc_no, None)
-        
-        # Determine if values are in thousands or dollars
-        multiplier = determine_value_multiplier(holdings_raw, total_value)
-        
-        # Apply multiplier to get final USD values
-        holdings = apply_value_multiplier(holdings_raw, multiplier)
-        
-        return (cik, period_end, "success", holdings, total_value, acc_no, multiplier)
-    
+        with stage("index"):
+            filings = find_13f_filings(cik, period_end)
+        if not filings:
+            return (cik, period_end, "no_filing", None)
+
+        target_date = period_to_quarter(period_end)[2]
+        known = LEDGER_STATE.get(cik, {})
+        applied = {acc for acc, (p, status, _) in known.items() if p == target_date and status == "loaded"}
+
+        # Amendment types come from the cover page; only read it for amendments the ledger lacks
+        docs = {}
+        chain = []
+        for f in filings:
+            acc_no = f["accession_no"]
+            if is_amendment(f):
+                if acc_no in known and known[acc_no][2]:
+                    if known[acc_no][0] != target_date:
+                        continue
+                    f["amendment_type"] = known[acc_no][2]
+                else:
+                    primary_url, info_url = get_filing_xml_urls(cik, acc_no)
+                    cover = None
+                    if primary_url:
+                        with stage("parse"):
+                            cover = fetch_cover_page(primary_url)
+                    # Same window, other period (e.g. a late amendment to the previous quarter)
+                    if cover and cover["period_of_report"] and cover["period_of_report"] != target_date:
+                        continue
+                    docs[acc_no] = (info_url, cover)
+                    f["amendment_type"] = cover and cover["amendment_type"]
+            chain.append(f)
+
+        plan = plan_period(chain, applied)
+        if not plan:
+            return (cik, period_end, "up_to_date", None)
+
+        parts = []
+        for f, mode in plan:
+            acc_no = f["accession_no"]
+            if acc_no not in docs:
+                primary_url, info_url = get_filing_xml_urls(cik, acc_no)
+                cover = None
+                if primary_url:
+                    with stage("parse"):
+                        cover = fetch_cover_page(primary_url)
+                docs[acc_no] = (info_url, cover)
+            info_url, cover = docs[acc_no]
+
+            # 13F-NT notices have no information table: skip before requesting one
+            if is_notice(cover):
+                if mode == REPLACE:
+                    return (cik, period_end, "notice", [(f, "notice", None, cover)])
+                continue
+
+            holdings_raw, f["raw_hash"] = [], None
+            if info_url:
+                with stage("parse"):
+                    holdings_raw, f["raw_hash"] = fetch_holdings_raw(info_url)
+            if not holdings_raw:
+                if mode == REPLACE:
+                    return (cik, period_end, "no_holdings", None)
+                continue
+            parts.append((f, mode, holdings_raw, cover))
+
+        return (cik, period_end, "success", parts)
+
     except Exception as e:
-        return (cik, period_end, "error", None, None, None, None)
+        return (cik, period_end, "error", None)
+
+
+def commit_batch(cur, conn, pending_inserts):
+    """Decide value units for the whole batch, then apply each filing as a replace or append."""
+    flat = [(p_cik, p_period, f, mode, raw, cover)
+            for p_cik, p_period, parts in pending_inserts
+            for f, mode, raw, cover in parts]
+
+    with stage("units"):
+        decisions = detect_value_units([
+            ([(h[4], h[5], h[6]) for h in raw], cover and cover["table_value_total"], p_period)
+            for _, p_period, _, _, raw, cover in flat
+        ])
+
+    with stage("db"):
+        record_cover_pages(cur, [(f["accession_no"], p_cik, p_period, "cover", cover)
+                                 for p_cik, p_period, f, _, _, cover in flat])
+        ledger_rows = []
+        for (p_cik, p_period, f, mode, raw, cover), units in zip(flat, decisions):
+            p_acc = f["accession_no"]
+            p_holdings = apply_value_multiplier(raw, units.multiplier)
+            p_total = cover and cover["table_value_total"]
+            if p_total and mode == REPLACE:
+                cur.execute("UPDATE manager_quarter SET total_value_m = %s WHERE cik = %s AND period_end = %s",
+                            (p_total / 1000.0, p_cik, p_period))
+            elif p_total:
+                cur.execute("UPDATE manager_quarter SET total_value_m = COALESCE(total_value_m, 0) + %s "
+                            "WHERE cik = %s AND period_end = %s",
+                            (p_total / 1000.0, p_cik, p_period))
+            write_filing(cur, p_cik, p_period, p_acc, p_holdings, mode, source="scrape_single_13f")
+            ledger_rows.append((p_acc, p_cik, p_period, len(p_holdings), units, mode,
+                                f["raw_hash"], holdings_hash(p_holdings)))
+        for p_cik, p_period, _ in pending_inserts:
+            cur.execute("""
+                UPDATE manager_quarter SET num_holdings = COALESCE((
+                    SELECT num_holdings FROM holding_period_stats WHERE cik = %s AND period_end = %s
+                ), 0) WHERE cik = %s AND period_end = %s
+            """, (p_cik, p_period, p_cik, p_period))
+        record_loaded(cur, ledger_rows)
+        conn.commit()
+
+    dollars = sum(1 for d in decisions if d.multiplier == 1)
+    low = sum(1 for d in decisions if d.confidence < LOW_CONFIDENCE)
+    appended = sum(1 for row in ledger_rows if row[5] == APPEND)
+    print(f"💾 Committed {len(decisions)} filings ({appended} appended amendments) | units: "
+          f"{dollars} dollars, {len(decisions) - dollars} thousands, {low} low-confidence")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Scrape SEC 13F data from CSV (optimized)")
     parser.add_argument("--csv", required=True, help="CSV file with cik,period_end columns")
     parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Parallel workers (default: 8)")
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling_from_args(args)
     
     load_dotenv()
     
@@ -543,11 +567,14 @@ def main():
             PRIMARY KEY (cik, period_end, accession_no, line_no)
         )
     """)
+    ensure_ledger(cur)
+    ensure_period_stats(cur)
     conn.commit()
+    LEDGER_STATE.update(ledger_state(cur, {cik for cik, _ in tasks}))
     
     # Process in parallel
     start_time = datetime.now()
-    success = no_filing = errors = 0
+    success = no_filing = notices = up_to_date = errors = 0
     pending_inserts = []
     
     print(f"\n🚀 Processing {len(tasks)} filings with {args.workers} workers...\n")
@@ -556,37 +583,34 @@ def main():
         futures = {executor.submit(process_filing, t): t for t in tasks}
         
         for i, future in enumerate(as_completed(futures), 1):
-            cik, period_end, status, holdings, total_value, acc_no, multiplier = future.result()
+            cik, period_end, status, parts = future.result()
             
             if status == "success":
                 success += 1
-                pending_inserts.append((cik, period_end, holdings, total_value, acc_no))
-                mult_info = " [x1 dollars]" if multiplier == 1 else ""
-                print(f"[{i}/{len(tasks)}] ✓ {cik} {period_end}: {len(holdings)} holdings{mult_info}")
+                pending_inserts.append((cik, period_end, parts))
+                rows = sum(len(raw) for _, _, raw, _ in parts)
+                appended = sum(1 for _, mode, _, _ in parts if mode == APPEND)
+                delta_info = f" [+{appended} amendment(s)]" if appended else ""
+                print(f"[{i}/{len(tasks)}] ✓ {cik} {period_end}: {rows} holdings{delta_info}")
+            elif status == "up_to_date":
+                up_to_date += 1
+                print(f"[{i}/{len(tasks)}] = {cik} {period_end}: already applied")
             elif status == "no_filing":
                 no_filing += 1
                 print(f"[{i}/{len(tasks)}] ⚠️ {cik} {period_end}: no filing")
+            elif status == "notice":
+                notices += 1
+                record_cover_pages(cur, [(f["accession_no"], cik, period_end, "notice", cover)
+                                         for f, _, _, cover in parts])
+                conn.commit()
+                print(f"[{i}/{len(tasks)}] 📭 {cik} {period_end}: 13F-NT notice, no holdings")
             else:
                 errors += 1
                 print(f"[{i}/{len(tasks)}] ❌ {cik} {period_end}: {status}")
             
             # Batch commit to database
             if len(pending_inserts) >= BATCH_COMMIT_SIZE:
-                for p_cik, p_period, p_holdings, p_total, p_acc in pending_inserts:
-                    if p_total:
-                        cur.execute("UPDATE manager_quarter SET total_value_m = %s WHERE cik = %s AND period_end = %s",
-                                    (p_total / 1000.0, p_cik, p_period))
-                    cur.execute("DELETE FROM manager_quarter_holding WHERE cik = %s AND period_end = %s", (p_cik, p_period))
-                    values = [(p_cik, p_period, p_acc, *h) for h in p_holdings]
-                    execute_values(cur, """
-                        INSERT INTO manager_quarter_holding (cik, period_end, accession_no, line_no, issuer,
-                        title_of_class, cusip, value_usd, shares, share_type, put_call, investment_discretion,
-                        other_manager, voting_sole, voting_shared, voting_none) VALUES %s
-                        ON CONFLICT (cik, period_end, accession_no, line_no) DO NOTHING
-                    """, values, page_size=1000)
-                    cur.execute("UPDATE manager_quarter SET num_holdings = %s WHERE cik = %s AND period_end = %s",
-                                (len(p_holdings), p_cik, p_period))
-                conn.commit()
+                commit_batch(cur, conn, pending_inserts)
                 pending_inserts.clear()
             
             # Progress every 25 items
@@ -598,21 +622,7 @@ def main():
     
     # Final commit for remaining inserts
     if pending_inserts:
-        for p_cik, p_period, p_holdings, p_total, p_acc in pending_inserts:
-            if p_total:
-                cur.execute("UPDATE manager_quarter SET total_value_m = %s WHERE cik = %s AND period_end = %s",
-                            (p_total / 1000.0, p_cik, p_period))
-            cur.execute("DELETE FROM manager_quarter_holding WHERE cik = %s AND period_end = %s", (p_cik, p_period))
-            values = [(p_cik, p_period, p_acc, *h) for h in p_holdings]
-            execute_values(cur, """
-                INSERT INTO manager_quarter_holding (cik, period_end, accession_no, line_no, issuer,
-                title_of_class, cusip, value_usd, shares, share_type, put_call, investment_discretion,
-                other_manager, voting_sole, voting_shared, voting_none) VALUES %s
-                ON CONFLICT (cik, period_end, accession_no, line_no) DO NOTHING
-            """, values, page_size=1000)
-            cur.execute("UPDATE manager_quarter SET num_holdings = %s WHERE cik = %s AND period_end = %s",
-                        (len(p_holdings), p_cik, p_period))
-        conn.commit()
+        commit_batch(cur, conn, pending_inserts)
     
     total_time = datetime.now() - start_time
     rate = len(tasks) / total_time.total_seconds() if total_time.total_seconds() > 0 else 0
@@ -620,7 +630,7 @@ def main():
     print("\n" + "=" * 60)
     print("✅ COMPLETED")
     print(f"   Time: {str(total_time).split('.')[0]} ({rate:.2f} filings/sec)")
-    print(f"   Success: {success} | No filing: {no_filing} | Errors: {errors}")
+    print(f"   Success: {success} | No filing: {no_filing} | Notices: {notices} | Up to date: {up_to_date} | Errors: {errors}")
     print("=" * 60)
     
     cur.close()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-Scrape SEC 13F holdings for CIK/period_end pairs from a CSV file.
+Scrape SEC 13F holdings for CIK/period_end pairs from a CSV file (or the repair queue).
 Updates public.manager_quarter_holding table.
 
 OPTIMIZED VERSION with:
@@ -11,9 +11,15 @@ OPTIMIZED VERSION with:
 - Efficient XML streaming
 - Single-pass XML parsing (10x fewer iterations per holding)
 
+With --queue the periods come from repair_queue instead (enqueued by
+generate_completeness_report.py): they are claimed in rounds, re-ingested
+even if the ledger has them as loaded, and marked done / skipped in the
+transaction that commits their holdings, up to --budget periods per run.
+
 Usage:
     python scrape_single_13f_optimized.py --csv input.csv
     python scrape_single_13f_optimized.py --csv input.csv --workers 12
+    python scrape_single_13f_optimized.py --queue --budget 2000
 """
 import argparse
 import csv
@@ -21,6 +27,7 @@ import os
 import io
 import re
 import time
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from threading import Lock
@@ -29,9 +36,17 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import psycopg2
-from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from cover_page import is_notice, parse_cover_page
+from fingerprints import content_hash, holdings_hash
+from amendments import APPEND, REPLACE, is_amendment, plan_period, write_filing
+from holding_stats import ensure_period_stats
+from repair_queue import DONE, ERROR, SKIPPED, claim_repairs, ensure_repair_queue, finish_repairs
+from sec_ledger import ensure_ledger, ledger_state, record_cover_pages, record_loaded
+from value_units import LOW_CONFIDENCE, detect_value_units
+
 # Configuration
 SEC_HEADERS = {
     "User-Agent": "Naveen Mokkapati navmok@gmail.com",
@@ -41,6 +56,8 @@ SEC_HEADERS = {
 REQUEST_TIMEOUT = 60
 MAX_WORKERS = 10  # Can run higher worker count, rate limiter controls throughput
 BATCH_COMMIT_SIZE = 50
+REPAIR_BUDGET = 500  # --queue: periods re-ingested per run
+CLAIM_ROUND_PER_WORKER = 10  # --queue: periods claimed per round, per worker
 SEC_RATE_LIMIT_INTERVAL = 0.11  # ~9 requests/sec (safety buffer for 10/sec limit)
 
 # Pre-compiled regex patterns for speed
@@ -48,6 +65,9 @@ RE_XML_HREF = re.compile(r'href="([^"]+\.xml)"', re.IGNORECASE)
 RE_PRIMARY_DOC = re.compile(r'primary.*doc', re.IGNORECASE)
 RE_INFO_TABLE = re.compile(r'info.*table', re.IGNORECASE)
 
+# Ledger snapshot for the CIKs being processed, loaded once in main() (read-only in workers)
+LEDGER_STATE = {}
+
 # Thread-safe index cache
 QUARTERLY_INDEXES = {}
 INDEX_LOCK = Lock()
@@ -61,13 +81,14 @@ class RateLimitedSession(requests.Session):
     """Session that strictly adheres to SEC rate limits (10 req/sec)."""
     def request(self, method, url, *args, **kwargs):
         global LAST_REQUEST_TIME
-        with RATE_LIMIT_LOCK:
+        with stage("rate_limit"), RATE_LIMIT_LOCK:
             now = time.time()
             elapsed = now - LAST_REQUEST_TIME
             if elapsed < SEC_RATE_LIMIT_INTERVAL:
                 time.sleep(SEC_RATE_LIMIT_INTERVAL - elapsed)
             LAST_REQUEST_TIME = time.time()
-        return super().request(method, url, *args, **kwargs)
+        with stage("fetch"):
+            return super().request(method, url, *args, **kwargs)
 
 
 def create_session():
@@ -154,32 +175,31 @@ def period_to_quarter(period_end):
     return dt.year, (dt.month - 1) // 3 + 1, dt
 
 
-def find_13f_filing(cik, period_end):
-    """Find the 13F filing. Prefers original over amendments."""
+def find_13f_filings(cik, period_end):
+    """Find the original 13F filing for a period plus the amendments filed in its window.
+
+    The 150-day window can reach the next period's original, so only the
+    earliest original is kept. Amendments are matched to the period later,
+    from their cover page. Returns copies, ordered by filing date.
+    """
     cik_padded = str(cik).zfill(10)
     year, quarter, target_date = period_to_quarter(period_end)
 
     filing_year, filing_quarter = (year, quarter + 1) if quarter < 4 else (year + 1, 1)
+    next_y, next_q = (filing_year, filing_quarter + 1) if filing_quarter < 4 else (filing_year + 1, 1)
 
     start_date = target_date + timedelta(days=1)
     end_date = target_date + timedelta(days=150)
 
-    # Check primary quarter
-    index = download_quarterly_index(filing_year, filing_quarter)
-    candidates = [f for f in index.get(cik_padded, []) if start_date <= f["filing_date"] <= end_date]
-
-    # Check next quarter if needed
-    if not candidates:
-        next_y, next_q = (filing_year, filing_quarter + 1) if filing_quarter < 4 else (filing_year + 1, 1)
-        index2 = download_quarterly_index(next_y, next_q)
-        candidates = [f for f in index2.get(cik_padded, []) if start_date <= f["filing_date"] <= end_date]
-
-    if not candidates:
-        return None
+    # Both indexes: amendments often land in the quarter after the original
+    candidates = []
+    for y, q in ((filing_year, filing_quarter), (next_y, next_q)):
+        index = download_quarterly_index(y, q)
+        candidates.extend(f for f in index.get(cik_padded, []) if start_date <= f["filing_date"] <= end_date)
 
-    # Prefer original (no /A) over amendments, then earliest date
-    candidates.sort(key=lambda x: (x["form_type"].endswith("/A"), x["filing_date"]))
-    return candidates[0]
+    originals = sorted((f for f in candidates if not is_amendment(f)), key=lambda x: x["filing_date"])
+    chain = originals[:1] + [f for f in candidates if is_amendment(f)]
+    return [dict(f) for f in sorted(chain, key=lambda x: (x["filing_date"], x["accession_no"]))]
 
 
 def get_filing_xml_urls(cik, accession_no):
@@ -227,31 +247,19 @@ def get_filing_xml_urls(cik, accession_no):
         return None, None
 
 
-def fetch_value_total(xml_url):
-    """Fetch total value from primary_doc.xml (in thousands). Fast string search."""
+def fetch_cover_page(xml_url):
+    """Fetch primary_doc.xml and extract its cover/summary page fields in one pass."""
     try:
         r = SESSION.get(xml_url, timeout=30)
         if r.status_code != 200:
             return None
-
-        content = r.content
-        for tag in (b'tableValueTotal', b'valueTotal', b'securitiesOwnedAggregateValue'):
-            idx = content.find(tag)
-            if idx != -1:
-                start = content.find(b'>', idx) + 1
-                end = content.find(b'<', start)
-                if start > 0 and end > start:
-                    try:
-                        return int(content[start:end].strip())
-                    except:
-                        pass
-        return None
+        return parse_cover_page(r.content)
     except:
         return None
 
 
 def fetch_holdings_raw(xml_url):
-    """Fetch holdings from info_table.xml. Returns RAW values (not multiplied).
+    """Fetch holdings from info_table.xml. Returns (holdings, raw_hash) with RAW values (not multiplied).
 
     OPTIMIZED: Builds a single lookup dict per infoTable element instead of
     iterating through children multiple times per field (~10x fewer iterations).
@@ -259,11 +267,11 @@ def fetch_holdings_raw(xml_url):
     try:
         r = SESSION.get(xml_url, timeout=120)
         if r.status_code != 200:
-            return []
+            return [], None
 
         content_length = r.headers.get('content-length')
         if content_length and int(content_length) > 25_000_000:
-            return []  # Skip files > 25MB
+            return [], None  # Skip files > 25MB
 
         holdings = []
         idx = 0
@@ -344,59 +352,9 @@ def fetch_holdings_raw(xml_url):
             if not holdings:
                 print(f"XML Parse Error on {xml_url}: {e}")
 
-        return holdings
+        return holdings, content_hash(r.content)
     except:
-        return []
-
-
-def determine_value_multiplier(holdings_raw, total_value_thousands):
-    """
-    Determine if holdings values are in thousands or actual dollars.
-
-    Strategies:
-    1. AUM Cap Heuristic: If header > $25T, it's in dollars
-    2. Share Ratio Heuristic: If value/shares > 2.0, likely dollars
-    3. Consistency check with header value
-    """
-    if not holdings_raw:
-        return 1000
-
-    # Sum raw values
-    total_raw_val = sum(h[4] for h in holdings_raw if h[4] is not None)
-
-    # 1. AUM Cap Heuristic
-    if total_value_thousands and total_value_thousands > 25_000_000:
-        if total_raw_val > 0:
-            ratio = total_raw_val / total_value_thousands
-            if 0.8 < ratio < 1.2:
-                print(f"   ℹ️  Detected DOLLAR format via AUM Cap ({total_value_thousands})")
-                return 1
-
-    # 2. Share Ratio Heuristic
-    total_shares = sum(h[5] for h in holdings_raw if h[5] is not None and h[5] > 0)
-
-    if total_shares > 0:
-        avg_raw_ratio = total_raw_val / total_shares
-        if avg_raw_ratio > 2.0:
-            print(f"   ℹ️  Detected DOLLAR format via Implied Price ({avg_raw_ratio:.2f})")
-            return 1
-
-    # 3. Consistency Check
-    if not total_value_thousands or total_raw_val == 0:
-        return 1000
-
-    total_value_dollars = total_value_thousands * 1000
-
-    ratio_if_thousands = total_raw_val / total_value_thousands
-    ratio_if_dollars = total_raw_val / total_value_dollars
-
-    diff_thousands = abs(ratio_if_thousands - 1.0)
-    diff_dollars = abs(ratio_if_dollars - 1.0)
-
-    if diff_dollars < diff_thousands and diff_dollars < 0.2:
-        return 1
-    else:
-        return 1000
+        return [], None
 
 
 def apply_value_multiplier(holdings_raw, multiplier):
@@ -410,62 +368,275 @@ def apply_value_multiplier(holdings_raw, multiplier):
 
 
 def process_filing(task):
-    """Process a single filing. Returns (cik, period_end, status, holdings_data, total_value, acc_no, multiplier)."""
-    cik, period_end = task
+    """Process one (cik, period_end, force). Returns (cik, period_end, status, parts).
+
+    parts lists what still has to be applied for the period as
+    (filing, mode, holdings_raw, cover) in filing order, where mode is
+    amendments.REPLACE / APPEND, or "notice" for a 13F-NT. Filings the ledger
+    already has as loaded are skipped, unless force (re-ingest the period). Values are left raw; their units are
+    decided for the whole batch in commit_batch.
+    """
+    cik, period_end, force = task
 
     try:
-        filing = find_13f_filing(cik, period_end)
-        if not filing:
-            return (cik, period_end, "no_filing", None, None, None, None)
+        with stage("index"):
+            filings = find_13f_filings(cik, period_end)
+        if not filings:
+            return (cik, period_end, "no_filing", None)
+
+        target_date = period_to_quarter(period_end)[2]
+        known = LEDGER_STATE.get(cik, {})
+        applied = set() if force else {acc for acc, (p, status, _) in known.items()
+                                       if p == target_date and status == "loaded"}
+
+        # Amendment types come from the cover page; only read it for amendments the ledger lacks
+        docs = {}
+        chain = []
+        for f in filings:
+            acc_no = f["accession_no"]
+            if is_amendment(f):
+                if acc_no in known and known[acc_no][2]:
+                    if known[acc_no][0] != target_date:
+                        continue
+                    f["amendment_type"] = known[acc_no][2]
+                else:
+                    primary_url, info_url = get_filing_xml_urls(cik, acc_no)
+                    cover = None
+                    if primary_url:
+                        with stage("parse"):
+                            cover = fetch_cover_page(primary_url)
+                    # Same window, other period (e.g. a late amendment to the previous quarter)
+                    if cover and cover["period_of_report"] and cover["period_of_report"] != target_date:
+                        continue
+                    docs[acc_no] = (info_url, cover)
+                    f["amendment_type"] = cover and cover["amendment_type"]
+            chain.append(f)
+
+        plan = plan_period(chain, applied)
+        if not plan:
+            return (cik, period_end, "up_to_date", None)
+
+        parts = []
+        for f, mode in plan:
+            acc_no = f["accession_no"]
+            if acc_no not in docs:
+                primary_url, info_url = get_filing_xml_urls(cik, acc_no)
+                cover = None
+                if primary_url:
+                    with stage("parse"):
+                        cover = fetch_cover_page(primary_url)
+                docs[acc_no] = (info_url, cover)
+            info_url, cover = docs[acc_no]
+
+            # 13F-NT notices have no information table: skip before requesting one
+            if is_notice(cover):
+                if mode == REPLACE:
+                    return (cik, period_end, "notice", [(f, "notice", None, cover)])
+                continue
+
+            holdings_raw, f["raw_hash"] = [], None
+            if info_url:
+                with stage("parse"):
+                    holdings_raw, f["raw_hash"] = fetch_holdings_raw(info_url)
+            if not holdings_raw:
+                if mode == REPLACE:
+                    return (cik, period_end, "no_holdings", None)
+                continue
+            parts.append((f, mode, holdings_raw, cover))
+
+        return (cik, period_end, "success", parts)
 
-        acc_no = filing["accession_no"]
+    except Exception as e:
+        return (cik, period_end, "error", None)
 
-        primary_url, info_url = get_filing_xml_urls(cik, acc_no)
 
-        total_value = None
-        if primary_url:
-            total_value = fetch_value_total(primary_url)
+def commit_batch(cur, conn, pending_inserts):
+    """Decide value units for the whole batch, then apply each filing as a replace or append."""
+    flat = [(p_cik, p_period, f, mode, raw, cover)
+            for p_cik, p_period, parts in pending_inserts
+            for f, mode, raw, cover in parts]
+
+    with stage("units"):
+        decisions = detect_value_units([
+            ([(h[4], h[5], h[6]) for h in raw], cover and cover["table_value_total"], p_period)
+            for _, p_period, _, _, raw, cover in flat
+        ])
+
+    with stage("db"):
+        record_cover_pages(cur, [(f["accession_no"], p_cik, p_period, "cover", cover)
+                                 for p_cik, p_period, f, _, _, cover in flat])
+        ledger_rows = []
+        for (p_cik, p_period, f, mode, raw, cover), units in zip(flat, decisions):
+            p_acc = f["accession_no"]
+            p_holdings = apply_value_multiplier(raw, units.multiplier)
+            p_total = cover and cover["table_value_total"]
+            if p_total and mode == REPLACE:
+                cur.execute("UPDATE manager_quarter SET total_value_m = %s WHERE cik = %s AND period_end = %s",
+                            (p_total / 1000.0, p_cik, p_period))
+            elif p_total:
+                cur.execute("UPDATE manager_quarter SET total_value_m = COALESCE(total_value_m, 0) + %s "
+                            "WHERE cik = %s AND period_end = %s",
+                            (p_total / 1000.0, p_cik, p_period))
+            write_filing(cur, p_cik, p_period, p_acc, p_holdings, mode, source="scrape_single_13f_optimized")
+            ledger_rows.append((p_acc, p_cik, p_period, len(p_holdings), units, mode,
+                                f["raw_hash"], holdings_hash(p_holdings)))
+        for p_cik, p_period, _ in pending_inserts:
+            cur.execute("""
+                UPDATE manager_quarter SET num_holdings = COALESCE((
+                    SELECT num_holdings FROM holding_period_stats WHERE cik = %s AND period_end = %s
+                ), 0) WHERE cik = %s AND period_end = %s
+            """, (p_cik, p_period, p_cik, p_period))
+        record_loaded(cur, ledger_rows)
+        conn.commit()
+
+    dollars = sum(1 for d in decisions if d.multiplier == 1)
+    low = sum(1 for d in decisions if d.confidence < LOW_CONFIDENCE)
+    appended = sum(1 for row in ledger_rows if row[5] == APPEND)
+    print(f"💾 Committed {len(decisions)} filings ({appended} appended amendments) | units: "
+          f"{dollars} dollars, {len(decisions) - dollars} thousands, {low} low-confidence")
+
+
+def flush_batch(cur, conn, pending_inserts, notices, outcomes, queue):
+    """Commit a batch: its filings, its notices' cover pages and, with queue, every period's outcome.
+
+    notices: record_cover_pages rows. A database error (a deadlock with a
+    concurrent writer, a lost row lock) rolls the whole batch back; with queue
+    its filings and notices go back to repair_queue as ERROR, the rest keep
+    their outcome, and the run carries on. Returns a Counter of the statuses
+    rolled back.
+    """
+    try:
+        if notices:
+            record_cover_pages(cur, notices)
+        if queue:
+            finish_repairs(cur, [(cik, period_end, DONE) for cik, period_end, _ in pending_inserts] + outcomes)
+        if pending_inserts:
+            commit_batch(cur, conn, pending_inserts)
+        conn.commit()
+        return Counter()
+    except psycopg2.Error as e:
+        if conn.closed:
+            raise
+        conn.rollback()
+        error = f"db: {type(e).__name__}"
+        failed = {(cik, period_end): "success" for cik, period_end, _ in pending_inserts}
+        failed.update({(cik, period_end): "notice" for _, cik, period_end, _, _ in notices})
+        detail = (str(e).strip().splitlines() or [""])[0]
+        print(f"❌ Rolled back {len(failed)} periods ({error}) {detail}")
+
+    if queue:
+        try:
+            finish_repairs(cur, [(cik, period_end, ERROR, error) for cik, period_end in failed] +
+                           [o for o in outcomes if (o[0], o[1]) not in failed])
+            conn.commit()
+        except psycopg2.Error:
+            if conn.closed:
+                raise
+            conn.rollback()
+            print("❌ Could not record the batch in repair_queue; its claims expire after the claim timeout")
+    return Counter(failed.values())
+
+
+def prefetch_indexes(tasks):
+    """Download, in parallel, the quarterly indexes the tasks' filings can be in."""
+    quarters_needed = set()
+    for cik, period_end, _ in tasks:
+        year, quarter, _ = period_to_quarter(period_end)
+        fy, fq = (year, quarter + 1) if quarter < 4 else (year + 1, 1)
+        quarters_needed.add((fy, fq))
+        ny, nq = (fy, fq + 1) if fq < 4 else (fy + 1, 1)
+        quarters_needed.add((ny, nq))
+    quarters_needed -= set(QUARTERLY_INDEXES)
+    if not quarters_needed:
+        return
 
-        holdings_raw = []
-        if info_url:
-            holdings_raw = fetch_holdings_raw(info_url)
+    print(f"\n📥 Pre-downloading {len(quarters_needed)} indexes...")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda q: download_quarterly_index(q[0], q[1]), sorted(quarters_needed)))
 
-        if not holdings_raw:
-            return (cik, period_end, "no_holdings", None, total_value, acc_no, None)
 
-        multiplier = determine_value_multiplier(holdings_raw, total_value)
-        holdings = apply_value_multiplier(holdings_raw, multiplier)
+def run_tasks(cur, conn, tasks, workers, queue=False):
+    """Ingest (cik, period_end, force) tasks with parallel workers. Returns a Counter of statuses.
 
-        return (cik, period_end, "success", holdings, total_value, acc_no, multiplier)
+    With queue=True the tasks are claimed repair_queue periods: each one's
+    outcome is recorded in the transaction that commits its holdings. A batch
+    the database rejects is rolled back and counted as db_error (see
+    flush_batch); the run goes on with the next one.
+    """
+    prefetch_indexes(tasks)
+    LEDGER_STATE.update(ledger_state(cur, {cik for cik, _, _ in tasks}))
 
-    except Exception as e:
-        return (cik, period_end, "error", None, None, None, None)
+    start_time = datetime.now()
+    counts = Counter()
+    pending_inserts = []
+    outcomes = []     # queue outcomes of tasks with nothing to insert, committed with the next batch
 
+    print(f"\n🚀 Processing {len(tasks)} filings with {workers} workers...\n")
 
-def commit_batch(cur, conn, pending_inserts):
-    """Commit a batch of inserts to the database."""
-    for p_cik, p_period, p_holdings, p_total, p_acc in pending_inserts:
-        if p_total:
-            cur.execute("UPDATE manager_quarter SET total_value_m = %s WHERE cik = %s AND period_end = %s",
-                        (p_total / 1000.0, p_cik, p_period))
-        cur.execute("DELETE FROM manager_quarter_holding WHERE cik = %s AND period_end = %s", (p_cik, p_period))
-        values = [(p_cik, p_period, p_acc, *h) for h in p_holdings]
-        execute_values(cur, """
-            INSERT INTO manager_quarter_holding (cik, period_end, accession_no, line_no, issuer,
-            title_of_class, cusip, value_usd, shares, share_type, put_call, investment_discretion,
-            other_manager, voting_sole, voting_shared, voting_none) VALUES %s
-            ON CONFLICT (cik, period_end, accession_no, line_no) DO NOTHING
-        """, values, page_size=1000)
-        cur.execute("UPDATE manager_quarter SET num_holdings = %s WHERE cik = %s AND period_end = %s",
-                    (len(p_holdings), p_cik, p_period))
-    conn.commit()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_filing, t): t for t in tasks}
+
+        for i, future in enumerate(as_completed(futures), 1):
+            cik, period_end, status, parts = future.result()
+            counts[status] += 1
+
+            if status == "success":
+                pending_inserts.append((cik, period_end, parts))
+                rows = sum(len(raw) for _, _, raw, _ in parts)
+                appended = sum(1 for _, mode, _, _ in parts if mode == APPEND)
+                delta_info = f" [+{appended} amendment(s)]" if appended else ""
+                print(f"[{i}/{len(tasks)}] ✓ {cik} {period_end}: {rows} holdings{delta_info}")
+            elif status == "up_to_date":
+                outcomes.append((cik, period_end, DONE))
+                print(f"[{i}/{len(tasks)}] = {cik} {period_end}: already applied")
+            elif status == "no_filing":
+                outcomes.append((cik, period_end, SKIPPED, status))
+                print(f"[{i}/{len(tasks)}] ⚠️ {cik} {period_end}: no filing")
+            elif status == "notice":
+                outcomes.append((cik, period_end, SKIPPED, status))
+                print(f"[{i}/{len(tasks)}] 📭 {cik} {period_end}: 13F-NT notice, no holdings")
+                lost = flush_batch(cur, conn, [], [(f["accession_no"], cik, period_end, "notice", cover)
+                                                   for f, _, _, cover in parts], outcomes, queue)
+                counts.subtract(lost)
+                counts["db_error"] += sum(lost.values())
+                outcomes.clear()
+            else:
+                outcomes.append((cik, period_end, SKIPPED if status == "no_holdings" else ERROR, status))
+                print(f"[{i}/{len(tasks)}] ❌ {cik} {period_end}: {status}")
+
+            # Batch commit to database
+            if len(pending_inserts) >= BATCH_COMMIT_SIZE:
+                lost = flush_batch(cur, conn, pending_inserts, [], outcomes, queue)
+                counts.subtract(lost)
+                counts["db_error"] += sum(lost.values())
+                pending_inserts.clear()
+                outcomes.clear()
+
+            # Progress every 25 items
+            if i % 25 == 0:
+                elapsed = (datetime.now() - start_time).total_seconds()
+                rate = i / elapsed if elapsed > 0 else 0
+                eta = timedelta(seconds=int((len(tasks) - i) / rate)) if rate > 0 else timedelta(0)
+                print(f"📊 Progress: {i}/{len(tasks)} | {rate:.1f}/s | ETA: {eta}")
+
+    # Final commit
+    lost = flush_batch(cur, conn, pending_inserts, [], outcomes, queue)
+    counts.subtract(lost)
+    counts["db_error"] += sum(lost.values())
+    return +counts
 
 
 def main():
     parser = argparse.ArgumentParser(description="Scrape SEC 13F data from CSV (optimized)")
-    parser.add_argument("--csv", required=True, help="CSV file with cik,period_end columns")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="CSV file with cik,period_end columns")
+    source.add_argument("--queue", action="store_true", help="Re-ingest periods claimed from repair_queue")
+    parser.add_argument("--budget", type=int, default=REPAIR_BUDGET,
+                        help=f"With --queue: most periods to repair this run (default: {REPAIR_BUDGET})")
     parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Parallel workers (default: 10)")
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling_from_args(args)
 
     load_dotenv()
 
@@ -475,36 +646,27 @@ def main():
 
     # Read CSV
     tasks = []
-    with open(args.csv, 'r', newline='', encoding='utf-8-sig') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            cik = row.get('cik', '').strip().zfill(10)
-            period_end = row.get('period_end', '').strip()
-            if cik and period_end:
-                tasks.append((cik, period_end))
-
-    if not tasks:
-        print("❌ No valid rows in CSV")
-        return 1
+    if args.csv:
+        with open(args.csv, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                cik = row.get('cik', '').strip().zfill(10)
+                period_end = row.get('period_end', '').strip()
+                if cik and period_end:
+                    tasks.append((cik, period_end, False))
+
+        if not tasks:
+            print("❌ No valid rows in CSV")
+            return 1
 
     print("=" * 60)
     print("SEC 13F Optimized Batch Scraper v2")
-    print(f"Tasks: {len(tasks)} | Workers: {args.workers}")
+    if args.queue:
+        print(f"Repair queue | Budget: {args.budget} | Workers: {args.workers}")
+    else:
+        print(f"Tasks: {len(tasks)} | Workers: {args.workers}")
     print("=" * 60)
 
-    # Pre-download indexes in parallel
-    quarters_needed = set()
-    for cik, period_end in tasks:
-        year, quarter, _ = period_to_quarter(period_end)
-        fy, fq = (year, quarter + 1) if quarter < 4 else (year + 1, 1)
-        quarters_needed.add((fy, fq))
-        ny, nq = (fy, fq + 1) if fq < 4 else (fy + 1, 1)
-        quarters_needed.add((ny, nq))
-
-    print(f"\n📥 Pre-downloading {len(quarters_needed)} indexes...")
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        list(executor.map(lambda q: download_quarterly_index(q[0], q[1]), sorted(quarters_needed)))
-
     # Database connection
     conn = psycopg2.connect(os.environ["DATABASE_URL"], connect_timeout=30)
     conn.autocommit = False
@@ -521,56 +683,38 @@ def main():
             PRIMARY KEY (cik, period_end, accession_no, line_no)
         )
     """)
+    ensure_ledger(cur)
+    ensure_period_stats(cur)
+    ensure_repair_queue(cur)
     conn.commit()
 
-    # Process in parallel
     start_time = datetime.now()
-    success = no_filing = errors = 0
-    pending_inserts = []
-
-    print(f"\n🚀 Processing {len(tasks)} filings with {args.workers} workers...\n")
-
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        futures = {executor.submit(process_filing, t): t for t in tasks}
-
-        for i, future in enumerate(as_completed(futures), 1):
-            cik, period_end, status, holdings, total_value, acc_no, multiplier = future.result()
-
-            if status == "success":
-                success += 1
-                pending_inserts.append((cik, period_end, holdings, total_value, acc_no))
-                mult_info = " [x1 dollars]" if multiplier == 1 else ""
-                print(f"[{i}/{len(tasks)}] ✓ {cik} {period_end}: {len(holdings)} holdings{mult_info}")
-            elif status == "no_filing":
-                no_filing += 1
-                print(f"[{i}/{len(tasks)}] ⚠️ {cik} {period_end}: no filing")
-            else:
-                errors += 1
-                print(f"[{i}/{len(tasks)}] ❌ {cik} {period_end}: {status}")
-
-            # Batch commit to database
-            if len(pending_inserts) >= BATCH_COMMIT_SIZE:
-                commit_batch(cur, conn, pending_inserts)
-                pending_inserts.clear()
-
-            # Progress every 25 items
-            if i % 25 == 0:
-                elapsed = (datetime.now() - start_time).total_seconds()
-                rate = i / elapsed if elapsed > 0 else 0
-                eta = timedelta(seconds=int((len(tasks) - i) / rate)) if rate > 0 else timedelta(0)
-                print(f"📊 Progress: {i}/{len(tasks)} | {rate:.1f}/s | ETA: {eta}")
-
-    # Final commit
-    if pending_inserts:
-        commit_batch(cur, conn, pending_inserts)
+    if args.queue:
+        # Claim in rounds, so periods enqueued while this runs are picked up within the budget
+        counts = Counter()
+        while sum(counts.values()) < args.budget:
+            claimed = claim_repairs(cur, min(args.workers * CLAIM_ROUND_PER_WORKER, args.budget - sum(counts.values())))
+            conn.commit()
+            if not claimed:
+                break
+            reasons = Counter(reason for _, _, reason in claimed)
+            print(f"\n🧰 Claimed {len(claimed)} repairs: " + ", ".join(f"{r} {n}" for r, n in reasons.items()))
+            # Forced: the ledger may say these filings are loaded, but what is stored is wrong
+            counts.update(run_tasks(cur, conn, [(cik, period_end, True) for cik, period_end, _ in claimed],
+                                    args.workers, queue=True))
+    else:
+        counts = run_tasks(cur, conn, tasks, args.workers)
 
+    processed = sum(counts.values())
     total_time = datetime.now() - start_time
-    rate = len(tasks) / total_time.total_seconds() if total_time.total_seconds() > 0 else 0
+    rate = processed / total_time.total_seconds() if total_time.total_seconds() > 0 else 0
+    errors = processed - sum(counts[s] for s in ("success", "no_filing", "notice", "up_to_date"))
 
     print("\n" + "=" * 60)
     print("✅ COMPLETED")
     print(f"   Time: {str(total_time).split('.')[0]} ({rate:.2f} filings/sec)")
-    print(f"   Success: {success} | No filing: {no_filing} | Errors: {errors}")
+    print(f"   Success: {counts['success']} | No filing: {counts['no_filing']} | Notices: {counts['notice']} | "
+          f"Up to date: {counts['up_to_date']} | Errors: {errors}")
     print("=" * 60)
 
     cur.close()
@@ -0,0 +1,202 @@
+"""
+Per-accession status ledger for SEC 13F ingestion.
+
+One row per filing (accession_no) that an ingest or repair script has seen,
+recording what was found and how it was loaded. Repair and completeness
+checks read it instead of re-downloading filings or re-scanning
+manager_quarter_holding.
+
+Columns:
+  status                    'cover' (cover page read), 'notice' (13F-NT, no
+                            information table), 'loaded' (holdings written) or
+                            'superseded' (rows removed by a later base filing)
+  applied_mode              'replace' or 'append' (see amendments.py)
+  raw_hash / holdings_hash  content fingerprints from fingerprints.py; repair
+                            passes skip filings whose content is unchanged
+  value_multiplier / value_confidence / value_signals
+                            unit decision from value_units.detect_value_units
+  submission_type ... table_value_total
+                            cover-page fields from cover_page.parse_cover_page
+"""
+from psycopg2.extras import execute_values
+
+from cover_page import COVER_FIELDS
+
+LEDGER_TABLE = "sec_filing_ledger"
+
+# Non-key columns; ensure_ledger adds any that are missing, so older ledgers pick up new fields
+LEDGER_COLUMNS = [
+    ("value_multiplier", "INTEGER"),
+    ("value_confidence", "REAL"),
+    ("value_signals", "TEXT"),
+    ("submission_type", "TEXT"),
+    ("period_of_report", "DATE"),
+    ("is_amendment", "BOOLEAN"),
+    ("amendment_type", "TEXT"),
+    ("report_type", "TEXT"),
+    ("other_managers_count", "INTEGER"),
+    ("table_entry_total", "INTEGER"),
+    ("table_value_total", "BIGINT"),
+    ("applied_mode", "TEXT"),
+    ("raw_hash", "TEXT"),
+    ("holdings_hash", "TEXT"),
+]
+
+
+def ensure_ledger(cur):
+    """Create the ledger table (and any columns added since) if needed."""
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+            accession_no TEXT PRIMARY KEY,
+            cik TEXT NOT NULL,
+            period_end DATE NOT NULL,
+            status TEXT,
+            num_holdings INTEGER,
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    for name, sql_type in LEDGER_COLUMNS:
+        cur.execute(f"ALTER TABLE {LEDGER_TABLE} ADD COLUMN IF NOT EXISTS {name} {sql_type}")
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{LEDGER_TABLE}_cik_period
+        ON {LEDGER_TABLE} (cik, period_end)
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{LEDGER_TABLE}_value_confidence
+        ON {LEDGER_TABLE} (value_confidence)
+    """)
+
+
+def record_cover_pages(cur, rows):
+    """Upsert cover-page fields.
+
+    rows: iterable of (accession_no, cik, period_end, status, cover dict)
+    An existing 'loaded' status is kept unless the new status is 'notice'.
+    Rows whose fields are unchanged are not rewritten.
+    """
+    values = [(acc, cik, period_end, status, *(cover.get(f) for f in COVER_FIELDS))
+              for acc, cik, period_end, status, cover in rows if cover]
+    if not values:
+        return
+    cols = ", ".join(COVER_FIELDS)
+    updates = ",\n            ".join(f"{f} = EXCLUDED.{f}" for f in COVER_FIELDS)
+    current = ", ".join(f"{LEDGER_TABLE}.{f}" for f in COVER_FIELDS)
+    incoming = ", ".join(f"EXCLUDED.{f}" for f in COVER_FIELDS)
+    status_expr = (f"CASE WHEN {LEDGER_TABLE}.status = 'loaded' AND EXCLUDED.status <> 'notice' "
+                   f"THEN {LEDGER_TABLE}.status ELSE EXCLUDED.status END")
+    execute_values(cur, f"""
+        INSERT INTO {LEDGER_TABLE} (accession_no, cik, period_end, status, {cols})
+        VALUES %s
+        ON CONFLICT (accession_no) DO UPDATE SET
+            status = {status_expr},
+            {updates},
+            updated_at = NOW()
+        WHERE ({current}) IS DISTINCT FROM ({incoming})
+           OR {LEDGER_TABLE}.status IS DISTINCT FROM {status_expr}
+    """, values, page_size=1000)
+
+
+def record_loaded(cur, rows):
+    """Mark filings as loaded, with their unit decision and how they were applied.
+
+    rows: iterable of (accession_no, cik, period_end, num_holdings, UnitDecision, mode,
+                       raw_hash, holdings_hash)
+    A 'replace' deleted every other accession's rows for the period, so those
+    are marked superseded first.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    replaced = [(acc, cik, period_end) for acc, cik, period_end, _, _, mode, _, _ in rows if mode == "replace"]
+    if replaced:
+        execute_values(cur, f"""
+            UPDATE {LEDGER_TABLE} l SET status = 'superseded', updated_at = NOW()
+            FROM (VALUES %s) AS r (accession_no, cik, period_end)
+            WHERE l.cik = r.cik AND l.period_end = r.period_end::date
+              AND l.accession_no <> r.accession_no AND l.status = 'loaded'
+        """, replaced, page_size=1000)
+    values = [(acc, cik, period_end, "loaded", num_holdings,
+               d.multiplier, d.confidence, d.signals, mode, raw_hash, h_hash)
+              for acc, cik, period_end, num_holdings, d, mode, raw_hash, h_hash in rows]
+    execute_values(cur, f"""
+        INSERT INTO {LEDGER_TABLE} (accession_no, cik, period_end, status, num_holdings,
+            value_multiplier, value_confidence, value_signals, applied_mode, raw_hash, holdings_hash)
+        VALUES %s
+        ON CONFLICT (accession_no) DO UPDATE SET
+            cik = EXCLUDED.cik,
+            period_end = EXCLUDED.period_end,
+            status = EXCLUDED.status,
+            num_holdings = EXCLUDED.num_holdings,
+            value_multiplier = EXCLUDED.value_multiplier,
+            value_confidence = EXCLUDED.value_confidence,
+            value_signals = EXCLUDED.value_signals,
+            applied_mode = EXCLUDED.applied_mode,
+            raw_hash = EXCLUDED.raw_hash,
+            holdings_hash = EXCLUDED.holdings_hash,
+            updated_at = NOW()
+    """, values, page_size=1000)
+
+
+def ledger_state(cur, ciks):
+    """What the ledger knows about these managers' filings.
+
+    Returns {cik: {accession_no: (period_end, status, amendment_type)}}.
+    """
+    cur.execute(f"""
+        SELECT cik, accession_no, period_end, status, amendment_type
+        FROM {LEDGER_TABLE}
+        WHERE cik = ANY(%s)
+    """, (list(ciks),))
+    state = {}
+    for cik, acc, period_end, status, amendment_type in cur.fetchall():
+        state.setdefault(cik, {})[acc] = (period_end, status, amendment_type)
+    return state
+
+
+def loaded_fingerprint(cur, accession_no):
+    """(raw_hash, holdings_hash) of a loaded accession, or None if it is not loaded."""
+    cur.execute(f"""
+        SELECT raw_hash, holdings_hash
+        FROM {LEDGER_TABLE}
+        WHERE accession_no = %s AND status = 'loaded'
+    """, (accession_no,))
+    return cur.fetchone()
+
+
+def low_confidence_periods(cur, threshold):
+    """(cik, period_end) pairs whose loaded filing has a unit confidence below threshold."""
+    cur.execute(f"""
+        SELECT DISTINCT cik, period_end
+        FROM {LEDGER_TABLE}
+        WHERE value_confidence IS NOT NULL AND value_confidence < %s
+        ORDER BY cik, period_end
+    """, (threshold,))
+    return cur.fetchall()
+
+
+def notice_periods(cur):
+    """(cik, period_end) pairs covered only by a 13F-NT notice (nothing to download)."""
+    cur.execute(f"""
+        SELECT cik, period_end
+        FROM {LEDGER_TABLE}
+        GROUP BY cik, period_end
+        HAVING BOOL_AND(status = 'notice')
+    """)
+    return cur.fetchall()
+
+
+def short_periods(cur):
+    """Loaded filings whose stored row count is below the cover page's tableEntryTotal.
+
+    Returns (cik, period_end, table_entry_total, stored_rows) tuples.
+    """
+    cur.execute(f"""
+        SELECT l.cik, l.period_end, l.table_entry_total, COUNT(h.line_no) AS stored_rows
+        FROM {LEDGER_TABLE} l
+        LEFT JOIN manager_quarter_holding h
+            ON h.cik = l.cik AND h.period_end = l.period_end AND h.accession_no = l.accession_no
+        WHERE l.status = 'loaded' AND l.table_entry_total > 0
+        GROUP BY l.cik, l.period_end, l.table_entry_total
+        HAVING COUNT(h.line_no) < l.table_entry_total
+    """)
+    return cur.fetchall()
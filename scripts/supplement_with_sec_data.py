@@ -4,11 +4,13 @@ Supplement 13f.info holdings with SEC data for incomplete quarters
 Since 13f.info's API doesn't return all holdings, this script:
 1. Identifies quarters where 13f.info has <X% of expected value/holdings
 2. For those quarters, copies holdings from SEC's manager_quarter_holding table
-3. Either replaces or supplements the 13f.info data
+3. Either replaces or supplements the 13f.info data, or (--mode positions)
+   repairs only the positions that reconcile_holdings.py finds differ from SEC
 
 Usage:
   python supplement_with_sec_data.py --threshold 90 --dry-run
   python supplement_with_sec_data.py --threshold 90 --mode replace
+  python supplement_with_sec_data.py --threshold 90 --mode positions
 """
 import argparse
 import os
@@ -16,6 +18,12 @@ import psycopg2
 from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+from fingerprint_tree import INFO, refresh_fingerprints
+from holding_stats import TABLE as TABLE_SEC_STATS, ensure_period_stats
+from holdings_table import ON_CONFLICT_UPDATE, ensure_holdings_key
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from reconcile_holdings import apply_reconciliation, reconcile
+
 load_dotenv()
 
 TABLE_13FINFO = "public.expected_13finfo_holdings"
@@ -24,6 +32,7 @@ TABLE_SEC = "public.manager_quarter_holding"
 BATCH_SIZE = 100
 
 
+@stage("db")
 def get_incomplete_quarters(cur, threshold: float):
     """
     Find quarters where 13f.info has less than threshold% of SEC value.
@@ -35,22 +44,20 @@ def get_incomplete_quarters(cur, threshold: float):
             cik,
             'Q' || EXTRACT(QUARTER FROM period_end)::int || ' ' || EXTRACT(YEAR FROM period_end)::int as quarter,
             period_end,
-            SUM(value_usd)::float as sec_value_usd,
-            COUNT(*)::int as sec_holdings
-        FROM {TABLE_SEC}
-        WHERE value_usd IS NOT NULL AND value_usd > 0
-        GROUP BY cik, period_end
-        HAVING SUM(value_usd) > 1000000
+            value_usd_sum::float as sec_value_usd,
+            num_valued as sec_holdings
+        FROM {TABLE_SEC_STATS}
+        WHERE value_usd_sum > 1000000
     ),
     info_totals AS (
         SELECT 
-            LPAD(LTRIM(cik, '0'), 10, '0') as cik,
+            cik,
             quarter,
             (SUM(value_000) * 1000)::float as info_value_usd,
             COUNT(*)::int as info_holdings
         FROM {TABLE_13FINFO}
         WHERE value_000 IS NOT NULL AND value_000 > 0
-        GROUP BY LPAD(LTRIM(cik, '0'), 10, '0'), quarter
+        GROUP BY cik, quarter
     )
     SELECT 
         s.cik,
@@ -71,6 +78,7 @@ def get_incomplete_quarters(cur, threshold: float):
     return cur.fetchall()
 
 
+@stage("db")
 def process_batch_replace(cur, quarters: list) -> tuple[int, int]:
     """
     Process a batch of quarters - delete 13f.info and insert SEC data.
@@ -86,11 +94,11 @@ def process_batch_replace(cur, quarters: list) -> tuple[int, int]:
         # Delete existing 13f.info data
         cur.execute(f"""
             DELETE FROM {TABLE_13FINFO}
-            WHERE LPAD(LTRIM(cik, '0'), 10, '0') = %s AND quarter = %s
+            WHERE cik = %s AND quarter = %s
         """, (cik, quarter))
         total_deleted += cur.rowcount
         
-        # Insert from SEC
+        # Insert from SEC, one row per natural key (multi-line positions summed)
         cur.execute(f"""
             INSERT INTO {TABLE_13FINFO}
             (manager_url, cik, quarter, filing_url, sym, issuer_name, class, cusip, 
@@ -101,33 +109,50 @@ def process_batch_replace(cur, quarters: list) -> tuple[int, int]:
                 %s,
                 'SEC_SUPPLEMENTED',
                 NULL,
-                issuer,
-                title_of_class,
+                MAX(issuer),
+                MAX(title_of_class),
                 cusip,
-                ROUND(value_usd / 1000),
+                ROUND(SUM(value_usd) / 1000),
                 NULL,
-                shares,
-                share_type,
-                put_call
+                SUM(shares),
+                MAX(share_type),
+                MAX(put_call)
             FROM {TABLE_SEC}
             WHERE cik = %s AND period_end = %s
+            GROUP BY cusip, COALESCE(title_of_class, ''), COALESCE(put_call, '')
+            {ON_CONFLICT_UPDATE}
         """, (cik, quarter, cik, period_end))
         total_inserted += cur.rowcount
     
+    refresh_fingerprints(cur, INFO, [(cik, quarter) for cik, quarter, *_ in quarters])
     return total_deleted, total_inserted
 
 
+def process_batch_positions(cur, quarters: list) -> tuple[int, int]:
+    """
+    Process a batch of quarters - reconcile them against SEC position by position
+    and repair only the positions that differ.
+    Returns (deleted_count, inserted_count)
+    """
+    periods = [(cik, quarter) for cik, quarter, *_ in quarters]
+    reconcile(cur, periods)
+    return apply_reconciliation(cur, periods)
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--threshold", type=float, default=90.0, 
                     help="Replace quarters with less than this %% completeness (default: 90)")
-    ap.add_argument("--mode", choices=['replace', 'supplement'], default='replace',
-                    help="'replace' = delete 13f.info and use SEC, 'supplement' = keep both")
+    ap.add_argument("--mode", choices=['replace', 'supplement', 'positions'], default='replace',
+                    help="'replace' = delete 13f.info and use SEC, 'supplement' = keep both, "
+                         "'positions' = repair only the positions that differ from SEC")
     ap.add_argument("--dry-run", action="store_true",
                     help="Show what would be done without making changes")
     ap.add_argument("--limit", type=int, default=0,
                     help="Limit number of quarters to process (0=all)")
+    add_profile_arguments(ap)
     args = ap.parse_args()
+    start_profiling_from_args(args)
     
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
@@ -145,6 +170,11 @@ def main():
     
     try:
         with conn.cursor() as cur:
+            # CIKs must be canonical for the plain-equality joins below
+            ensure_holdings_key(cur, TABLE_13FINFO)
+            ensure_period_stats(cur)
+            conn.commit()
+            
             # Find incomplete quarters
             print("\n📊 Finding incomplete quarters...")
             incomplete = get_incomplete_quarters(cur, args.threshold)
@@ -183,7 +213,10 @@ def main():
                 batch_num = (i // BATCH_SIZE) + 1
                 total_batches = (len(incomplete) + BATCH_SIZE - 1) // BATCH_SIZE
                 
-                deleted, inserted = process_batch_replace(cur, batch)
+                if args.mode == "positions":
+                    deleted, inserted = process_batch_positions(cur, batch)
+                else:
+                    deleted, inserted = process_batch_replace(cur, batch)
                 total_deleted += deleted
                 total_inserted += inserted
                 
@@ -6,6 +6,7 @@ Uses bulk SQL operations instead of row-by-row processing.
 Usage:
   python supplement_with_sec_data_fast.py --threshold 90 --dry-run
   python supplement_with_sec_data_fast.py --threshold 90 --mode replace
+  python supplement_with_sec_data_fast.py --threshold 90 --mode positions
 """
 import argparse
 import os
@@ -13,6 +14,12 @@ import time
 import psycopg2
 from dotenv import load_dotenv
 
+from fingerprint_tree import INFO, refresh_fingerprints
+from holding_stats import TABLE as TABLE_SEC_STATS, ensure_period_stats
+from holdings_table import ON_CONFLICT_UPDATE, ensure_holdings_key
+from profiling import add_profile_arguments, start_profiling_from_args
+from reconcile_holdings import apply_reconciliation, reconcile
+
 load_dotenv()
 
 TABLE_13FINFO = "public.expected_13finfo_holdings"
@@ -23,11 +30,14 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--threshold", type=float, default=90.0, 
                     help="Replace quarters with less than this %% completeness (default: 90)")
-    ap.add_argument("--mode", choices=['replace', 'supplement'], default='replace',
-                    help="'replace' = delete 13f.info and use SEC, 'supplement' = keep both")
+    ap.add_argument("--mode", choices=['replace', 'supplement', 'positions'], default='replace',
+                    help="'replace' = delete 13f.info and use SEC, 'supplement' = keep both, "
+                         "'positions' = repair only the positions that differ from SEC")
     ap.add_argument("--dry-run", action="store_true",
                     help="Show what would be done without making changes")
+    add_profile_arguments(ap)
     args = ap.parse_args()
+    start_profiling_from_args(args)
     
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
@@ -47,6 +57,11 @@ def main():
         with conn.cursor() as cur:
             start_time = time.time()
             
+            # CIKs must be canonical for the plain-equality joins below
+            ensure_holdings_key(cur, TABLE_13FINFO)
+            ensure_period_stats(cur)
+            conn.commit()
+            
             # Step 1: Create temp table with incomplete quarters
             print("\n📊 Finding incomplete quarters...")
             
@@ -57,22 +72,20 @@ def main():
                         cik,
                         'Q' || EXTRACT(QUARTER FROM period_end)::int || ' ' || EXTRACT(YEAR FROM period_end)::int as quarter,
                         period_end,
-                        SUM(value_usd)::float as sec_value_usd,
-                        COUNT(*)::int as sec_holdings
-                    FROM {TABLE_SEC}
-                    WHERE value_usd IS NOT NULL AND value_usd > 0
-                    GROUP BY cik, period_end
-                    HAVING SUM(value_usd) > 1000000
+                        value_usd_sum::float as sec_value_usd,
+                        num_valued as sec_holdings
+                    FROM {TABLE_SEC_STATS}
+                    WHERE value_usd_sum > 1000000
                 ),
                 info_totals AS (
                     SELECT 
-                        LPAD(LTRIM(cik, '0'), 10, '0') as cik,
+                        cik,
                         quarter,
                         (SUM(value_000) * 1000)::float as info_value_usd,
                         COUNT(*)::int as info_holdings
                     FROM {TABLE_13FINFO}
                     WHERE value_000 IS NOT NULL AND value_000 > 0
-                    GROUP BY LPAD(LTRIM(cik, '0'), 10, '0'), quarter
+                    GROUP BY cik, quarter
                 )
                 SELECT 
                     s.cik,
@@ -123,44 +136,61 @@ def main():
                 cur.execute("DROP TABLE incomplete_quarters")
                 return
             
-            # Step 2: Delete existing 13f.info data for incomplete quarters (bulk)
-            print(f"\n🗑️ Deleting existing 13f.info holdings for {count} quarters...")
-            
-            cur.execute(f"""
-                DELETE FROM {TABLE_13FINFO} h
-                USING incomplete_quarters iq
-                WHERE LPAD(LTRIM(h.cik, '0'), 10, '0') = iq.cik
-                  AND h.quarter = iq.quarter
-            """)
-            deleted = cur.rowcount
-            print(f"   Deleted: {deleted:,} holdings")
-            
-            # Step 3: Insert SEC data for incomplete quarters (bulk)
-            print(f"\n📥 Inserting SEC holdings for {count} quarters...")
-            
-            cur.execute(f"""
-                INSERT INTO {TABLE_13FINFO}
-                (manager_url, cik, quarter, filing_url, sym, issuer_name, class, cusip, 
-                 value_000, pct, shares, principal, option_type)
-                SELECT 
-                    '',
-                    iq.cik,
-                    iq.quarter,
-                    'SEC_SUPPLEMENTED',
-                    NULL,
-                    sec.issuer,
-                    sec.title_of_class,
-                    sec.cusip,
-                    ROUND(sec.value_usd / 1000),
-                    NULL,
-                    sec.shares,
-                    sec.share_type,
-                    sec.put_call
-                FROM {TABLE_SEC} sec
-                JOIN incomplete_quarters iq ON sec.cik = iq.cik AND sec.period_end = iq.period_end
-            """)
-            inserted = cur.rowcount
-            print(f"   Inserted: {inserted:,} holdings")
+            if args.mode == "positions":
+                # Only the positions that differ from SEC are rewritten; the rest of the quarter stays
+                print(f"\n🔍 Reconciling {count} quarters position by position...")
+                cur.execute("SELECT cik, quarter FROM incomplete_quarters")
+                periods = cur.fetchall()
+                statuses = reconcile(cur, periods)
+                for status, n in statuses.most_common():
+                    print(f"   {status}: {n:,} positions")
+                deleted, inserted = apply_reconciliation(cur, periods)
+                print(f"   Repaired: {deleted:,} holdings deleted, {inserted:,} inserted")
+            else:
+                # Step 2: Delete existing 13f.info data for incomplete quarters (bulk)
+                print(f"\n🗑️ Deleting existing 13f.info holdings for {count} quarters...")
+            
+                cur.execute(f"""
+                    DELETE FROM {TABLE_13FINFO} h
+                    USING incomplete_quarters iq
+                    WHERE h.cik = iq.cik
+                      AND h.quarter = iq.quarter
+                """)
+                deleted = cur.rowcount
+                print(f"   Deleted: {deleted:,} holdings")
+            
+                # Step 3: Insert SEC data for incomplete quarters (bulk)
+                print(f"\n📥 Inserting SEC holdings for {count} quarters...")
+            
+                cur.execute(f"""
+                    INSERT INTO {TABLE_13FINFO}
+                    (manager_url, cik, quarter, filing_url, sym, issuer_name, class, cusip, 
+                     value_000, pct, shares, principal, option_type)
+                    SELECT 
+                        '',
+                        iq.cik,
+                        iq.quarter,
+                        'SEC_SUPPLEMENTED',
+                        NULL,
+                        MAX(sec.issuer),
+                        MAX(sec.title_of_class),
+                        sec.cusip,
+                        ROUND(SUM(sec.value_usd) / 1000),
+                        NULL,
+                        SUM(sec.shares),
+                        MAX(sec.share_type),
+                        MAX(sec.put_call)
+                    FROM {TABLE_SEC} sec
+                    JOIN incomplete_quarters iq ON sec.cik = iq.cik AND sec.period_end = iq.period_end
+                    GROUP BY iq.cik, iq.quarter, sec.cusip,
+                             COALESCE(sec.title_of_class, ''), COALESCE(sec.put_call, '')
+                    {ON_CONFLICT_UPDATE}
+                """)
+                inserted = cur.rowcount
+                print(f"   Inserted: {inserted:,} holdings")
+
+                cur.execute("SELECT cik, quarter FROM incomplete_quarters")
+                refresh_fingerprints(cur, INFO, cur.fetchall())
             
             # Commit
             conn.commit()
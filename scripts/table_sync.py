@@ -0,0 +1,292 @@
+"""
+Diff-based sync of small reference tables (cik_manager_name,
+expected_13finfo_summary) against a fresh scrape.
+
+Re-upserting every row (or TRUNCATE + reload) rewrites the whole table on
+every run: every row gets a new tuple version, WAL carries the full table
+and caches lose it, although usually only a handful of rows changed.
+sync_table instead reads the current table once, hashes each row
+(fingerprints.row_digest over the synced columns) and writes only:
+
+  inserts     keys that are not in the table yet
+  updates     keys whose row hash changed (by ctid; `touch` adds e.g.
+              "updated_at = NOW()" to the SET list)
+  tombstones  keys no longer in the scrape, and surplus copies of a key the
+              table holds more than once (skipped with delete_missing=False,
+              e.g. when part of the scrape failed)
+
+The table is locked against other writers (SHARE ROW EXCLUSIVE; readers are
+not blocked) for the caller's transaction, so the ctids read stay valid.
+
+sync_from_stage does the same diff in SQL for scrapes too large to hold in
+memory: the rows are COPYed into a staging table as they arrive and the
+changes are applied set-based (rows compared with IS DISTINCT FROM; keys
+matched on their text form with NULL as '', so the joins can hash).
+
+replace_table is the full refresh: it loads every row (or a SELECT, e.g.
+from a staging table) into a shadow table (LIKE the live one, indexes
+included) and swaps it in with two renames, so readers see the old contents
+until the commit and the new ones after it, never an empty or half-loaded
+table. Index names, grants and sequences are carried over: the shadow gets
+the live table's privileges, sequences owned by the live table's columns
+(serial) are handed to the shadow's columns before the old table is dropped,
+and identity sequences continue from the live table's values.
+
+Usage:
+    result = sync_table(cur, "cik_manager_name", ["cik"], ["cik", "manager_name"], rows,
+                        touch="updated_at = NOW()")
+    print(result)       # inserted=12 updated=3 deleted=1 unchanged=8123
+
+    sync_from_stage(cur, TABLE, STAGE_TABLE, KEY, COLUMNS)
+    replace_table(cur, TABLE, COLUMNS, source=latest_rows_sql(STAGE_TABLE, KEY, COLUMNS))
+"""
+import re
+from collections import namedtuple
+
+from psycopg2.extras import execute_values
+
+from copy_writer import copy_rows
+from fingerprints import row_digest
+from profiling import stage
+
+PAGE_SIZE = 1000
+LOCK_TIMEOUT = "5s"     # for the rename swap: give up instead of queueing readers behind it
+
+
+class SyncResult(namedtuple("SyncResult", "inserted updated deleted unchanged")):
+    def __str__(self):
+        return " ".join(f"{k}={v:,}" for k, v in self._asdict().items())
+
+
+def _split_name(table):
+    schema, _, name = table.rpartition(".")
+    return schema or "public", name
+
+
+def column_types(cur, table, columns):
+    """{column: SQL type} for casting VALUES lists (an all-NULL column would otherwise be text)."""
+    cur.execute("""
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+    """, (table,))
+    types = dict(cur.fetchall())
+    missing = [c for c in columns if c not in types]
+    if missing:
+        raise ValueError(f"{table} has no column(s) {missing}")
+    return {c: types[c] for c in columns}
+
+
+def diff_rows(current, rows, key_positions):
+    """Diff new rows against the current table.
+
+    current: iterable of (ctid, row) as read from the table
+    rows:    new rows (tuples, same column order); the last row of a key wins
+    Returns (inserts, updates [(ctid, row)], tombstones [ctid], unchanged count).
+    """
+    stored = {}
+    tombstones = []
+    for rid, row in current:
+        key = tuple(row[i] for i in key_positions)
+        if key in stored:
+            tombstones.append(rid)      # duplicate key in a table without a unique index
+        else:
+            stored[key] = (rid, row_digest(row))
+
+    latest = {}
+    for row in rows:
+        latest[tuple(row[i] for i in key_positions)] = row
+
+    inserts, updates, unchanged = [], [], 0
+    for key, row in latest.items():
+        old = stored.pop(key, None)
+        if old is None:
+            inserts.append(row)
+        elif old[1] != row_digest(row):
+            updates.append((old[0], row))
+        else:
+            unchanged += 1
+    tombstones.extend(rid for rid, _ in stored.values())
+    return inserts, updates, tombstones, unchanged
+
+
+@stage("db")
+def sync_table(cur, table, key_columns, columns, rows, delete_missing=True, touch=None, page_size=PAGE_SIZE):
+    """Write only the difference between `rows` and `table`; returns a SyncResult.
+
+    key_columns identify a row; columns (which include the key) are compared
+    and written, other columns of the table are left alone. Runs in the
+    caller's transaction.
+    """
+    columns = list(columns)
+    key_positions = [columns.index(c) for c in key_columns]
+    types = column_types(cur, table, columns)
+
+    cur.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(f"SELECT ctid::text, {', '.join(columns)} FROM {table}")
+    current = [(r[0], tuple(r[1:])) for r in cur]
+    inserts, updates, tombstones, unchanged = diff_rows(current, rows, key_positions)
+
+    if inserts:
+        execute_values(cur, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+                       inserts, page_size=page_size)
+    if updates:
+        assignments = [f"{c} = v.{c}" for c in columns if c not in key_columns] + ([touch] if touch else [])
+        template = "(%s::tid, " + ", ".join(f"%s::{types[c]}" for c in columns) + ")"
+        execute_values(cur, f"""
+            UPDATE {table} t SET {", ".join(assignments)}
+            FROM (VALUES %s) AS v (rid, {", ".join(columns)})
+            WHERE t.ctid = v.rid
+        """, [(rid, *row) for rid, row in updates], template=template, page_size=page_size)
+    if tombstones and delete_missing:
+        for i in range(0, len(tombstones), page_size):
+            cur.execute(f"DELETE FROM {table} WHERE ctid = ANY(%s::tid[])", (tombstones[i:i + page_size],))
+
+    return SyncResult(len(inserts), len(updates), len(tombstones) if delete_missing else 0, unchanged)
+
+
+def _key_match(key_columns, a, b):
+    return " AND ".join(f"COALESCE({a}.{c}::text, '') = COALESCE({b}.{c}::text, '')" for c in key_columns)
+
+
+def latest_rows_sql(stage_table, key_columns, columns):
+    """SELECT of the staged rows, one per key (the last staged row of a key wins)."""
+    key = ", ".join(f"COALESCE(s.{c}::text, '')" for c in key_columns)
+    return f"""
+        SELECT DISTINCT ON ({key}) {", ".join(f"s.{c}" for c in columns)}
+        FROM {stage_table} s
+        ORDER BY {key}, s.ctid DESC
+    """
+
+
+@stage("db")
+def sync_from_stage(cur, table, stage_table, key_columns, columns, delete_missing=True, touch=None):
+    """sync_table with the new rows in stage_table instead of in memory; returns a SyncResult."""
+    columns = list(columns)
+    values = [c for c in columns if c not in key_columns]
+    cur.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(f"CREATE TEMP TABLE sync_latest ON COMMIT DROP AS {latest_rows_sql(stage_table, key_columns, columns)}")
+    cur.execute("SELECT COUNT(*) FROM sync_latest")
+    staged = cur.fetchone()[0]
+
+    deleted = 0
+    if delete_missing:
+        # Surplus copies of a key first, so every key below maps to one row
+        cur.execute(f"""
+            DELETE FROM {table} t USING {table} d
+            WHERE {_key_match(key_columns, "t", "d")} AND t.ctid > d.ctid
+        """)
+        deleted += cur.rowcount
+
+    updated = 0
+    if values:
+        assignments = [f"{c} = n.{c}" for c in values] + ([touch] if touch else [])
+        cur.execute(f"""
+            UPDATE {table} t SET {", ".join(assignments)}
+            FROM sync_latest n
+            WHERE {_key_match(key_columns, "t", "n")}
+              AND ({", ".join(f"t.{c}" for c in values)}) IS DISTINCT FROM ({", ".join(f"n.{c}" for c in values)})
+        """)
+        updated = cur.rowcount
+
+    cur.execute(f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        SELECT {", ".join(f"n.{c}" for c in columns)} FROM sync_latest n
+        WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {_key_match(key_columns, "t", "n")})
+    """)
+    inserted = cur.rowcount
+
+    if delete_missing:
+        cur.execute(f"""
+            DELETE FROM {table} t
+            WHERE NOT EXISTS (SELECT 1 FROM sync_latest n WHERE {_key_match(key_columns, "t", "n")})
+        """)
+        deleted += cur.rowcount
+    cur.execute("DROP TABLE sync_latest")
+    return SyncResult(inserted, updated, deleted, staged - inserted - updated)
+
+
+def _index_shape(indexdef):
+    # "CREATE UNIQUE INDEX name ON schema.table USING btree (cik)" -> "CREATE UNIQUE INDEX USING btree (cik)"
+    return re.sub(r" INDEX \S+ ON (ONLY )?\S+ ", " INDEX ", indexdef)
+
+
+def _indexes(cur, schema, name):
+    cur.execute("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = %s AND tablename = %s",
+                (schema, name))
+    return {_index_shape(d): n for n, d in cur.fetchall()}
+
+
+def _copy_grants(cur, schema, source, target):
+    """GRANT target what pg_class.relacl grants on source (the owner's own entries excepted)."""
+    cur.execute("""
+        SELECT format('GRANT %%s ON %%I.%%I TO %%s%%s', a.privilege_type, n.nspname, %s,
+                      CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END,
+                      CASE WHEN a.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END)
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        CROSS JOIN LATERAL aclexplode(c.relacl) a
+        LEFT JOIN pg_roles r ON r.oid = a.grantee
+        WHERE n.nspname = %s AND c.relname = %s AND a.grantee <> c.relowner
+    """, (target, schema, source))
+    for (grant,) in cur.fetchall():
+        cur.execute(grant)
+
+
+def _sequences(cur, schema, name, deptype):
+    """[(sequence, column)] of the sequences owned by (deptype 'a', serial) or identity of ('i') name's columns."""
+    cur.execute("""
+        SELECT s.relname, quote_ident(a.attname)
+        FROM pg_depend d
+        JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.classid = 'pg_class'::regclass AND d.refclassid = 'pg_class'::regclass
+          AND d.refobjid = format('%%I.%%I', %s, %s)::regclass AND d.deptype = %s
+    """, (schema, name, deptype))
+    return cur.fetchall()
+
+
+@stage("db")
+def replace_table(cur, table, columns, rows=None, source=None):
+    """Full refresh: load rows (COPY) or a source SELECT into a shadow table and swap it in atomically.
+
+    Returns rows loaded.
+
+    Runs in the caller's transaction; the swap takes effect at its commit.
+    Fails (and leaves the live table alone) if a view or foreign key
+    depends on the table.
+    """
+    schema, name = _split_name(table)
+    shadow, retired = f"{name}_sync_new", f"{name}_sync_old"
+
+    cur.execute(f"DROP TABLE IF EXISTS {schema}.{shadow}")
+    cur.execute(f"CREATE TABLE {schema}.{shadow} (LIKE {schema}.{name} INCLUDING ALL)")
+    # LIKE gives identity columns fresh sequences: continue them from the live ones before loading
+    identities = {c: s for s, c in _sequences(cur, schema, name, "i")}
+    for sequence, column in _sequences(cur, schema, shadow, "i"):
+        cur.execute(f"SELECT setval('{schema}.{sequence}', last_value, is_called) FROM {schema}.{identities[column]}")
+    if source is not None:
+        cur.execute(f"INSERT INTO {schema}.{shadow} ({', '.join(columns)}) {source}")
+        loaded = cur.rowcount
+    else:
+        copy_rows(cur, f"{schema}.{shadow}", columns, rows)
+        loaded = len(rows)
+    cur.execute(f"ANALYZE {schema}.{shadow}")
+    _copy_grants(cur, schema, name, shadow)
+
+    live_indexes = _indexes(cur, schema, name)
+    shadow_indexes = _indexes(cur, schema, shadow)
+
+    cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+    # Serial sequences are shared (the shadow's defaults use them) and would go with the old table
+    for sequence, column in _sequences(cur, schema, name, "a"):
+        cur.execute(f"ALTER SEQUENCE {schema}.{sequence} OWNED BY {schema}.{shadow}.{column}")
+    cur.execute(f"ALTER TABLE {schema}.{name} RENAME TO {retired}")
+    cur.execute(f"ALTER TABLE {schema}.{shadow} RENAME TO {name}")
+    cur.execute(f"DROP TABLE {schema}.{retired}")
+    for sequence, column in _sequences(cur, schema, name, "i"):
+        cur.execute(f"ALTER SEQUENCE {schema}.{sequence} RENAME TO {identities[column]}")
+    for shape, index in shadow_indexes.items():
+        if shape in live_indexes and live_indexes[shape] != index:
+            cur.execute(f"ALTER INDEX {schema}.{index} RENAME TO {live_indexes[shape]}")
+    return loaded
@@ -0,0 +1,71 @@
+"""
+Truncation tests for thirteenf_json: a payload cut anywhere must raise
+TruncatedPayload (which ThirteenFClient retries), never a plain decode error.
+
+Run:
+    python -m pytest test_thirteenf_json.py
+    python test_thirteenf_json.py
+"""
+import json
+
+import pytest
+
+from thirteenf_json import HoldingsRowDecoder, TruncatedPayload
+
+# 13f.info layout (streamed) and a dict layout (json.loads fallback)
+STREAMED = ('{"data": [["AAPL", "APPLE INC", "COM", "037833100", 1234.5, 0.25, 100, null, null],'
+            ' ["SPY", "SPDR S&P 500", "TR UNIT", "78462F103", -12, 1e-3, 2E+2, true, false]],'
+            ' "filing": {"quarter": "Q3 2025"}}')
+DATA_END = STREAMED.index("]]") + 2    # past the data list nothing else is read
+FALLBACK = ('{"filing": {"rows": [' + ", ".join(
+    f'{{"cusip": "03783310{i}", "value": {i + 1}234.5, "shares": -{i + 1}E+2, "put": {"null" if i % 2 else "true"}}}'
+    for i in range(5)) + ']}}')
+
+
+def decode(text, chunk=7):
+    data = text.encode("utf-8")
+    decoder = HoldingsRowDecoder()
+    rows = []
+    for i in range(0, len(data), chunk):
+        rows.extend(decoder.feed(data[i:i + chunk]))
+    rows.extend(decoder.finish())
+    return rows
+
+
+@pytest.mark.parametrize("payload, rows", [(STREAMED, 2), (FALLBACK, 5)])
+def test_full_payload_decodes(payload, rows):
+    assert len(decode(payload)) == rows
+
+
+@pytest.mark.parametrize("payload, end", [(STREAMED, DATA_END), (FALLBACK, len(FALLBACK))])
+def test_every_cut_point_is_truncated(payload, end):
+    for cut in range(end):
+        with pytest.raises(TruncatedPayload):
+            decode(payload[:cut])
+
+
+def test_cut_after_the_data_list_keeps_the_rows():
+    assert len(decode(STREAMED[:DATA_END + 5])) == 2
+
+
+@pytest.mark.parametrize("tail", ["n", "nul", "tr", "fals", "123.", "-", "1e", "2E+", "0."])
+def test_cut_inside_a_trailing_literal_or_number(tail):
+    with pytest.raises(TruncatedPayload):
+        decode('{"data": [["AAPL", 100, ' + tail)
+    with pytest.raises(TruncatedPayload):
+        decode('{"filing": {"rows": [{"cusip": "037833100", "shares": ' + tail)
+
+
+@pytest.mark.parametrize("bad", [
+    '{"data": [["AAPL", 100, nulx]]}',
+    '{"data": [["AAPL", 01]]}',
+    '{"data": [["AAPL" 100]]}',
+    '{"filing": {"rows": [{"cusip": 1.2.3}]}}',
+])
+def test_invalid_json_is_not_truncation(bad):
+    with pytest.raises(json.JSONDecodeError):
+        decode(bad)
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
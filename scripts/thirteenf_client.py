@@ -0,0 +1,347 @@
+"""
+Shared HTTP client for 13f.info.
+
+Every 13f.info scraper fetches through this module, so connection pooling,
+concurrency, retries and error reporting are tuned in one place:
+
+  - one aiohttp session with keep-alive pooling and DNS caching
+  - a global in-flight cap plus a per-host cap
+  - retries on 429/5xx/timeouts with jittered exponential backoff; a 429
+    pauses every request to that host (honouring Retry-After), not just the
+    one that was throttled
+  - an in-memory LRU response cache for pages fetched more than once (index
+    pages), with concurrent requests for the same URL sharing one fetch
+  - conditional GETs (If-None-Match / If-Modified-Since) for callers that
+    persist validators between runs, so unchanged pages come back as 304
+  - holdings payloads (/data/13f/{id}) decoded row by row as the bytes
+    arrive (thirteenf_json), without holding the body text or walking a tree;
+    a payload cut short is retried, invalid JSON is not
+  - error accounting: nothing is swallowed silently, every failure is counted
+    by kind and client.report() prints the totals at the end of a run
+
+Usage (asyncio scripts):
+    from thirteenf_client import ThirteenFClient
+
+    async with ThirteenFClient(user_agent=UA) as client:
+        html = await client.fetch_text(url, cache=True)
+        rows = await client.fetch_holdings_rows(f"{BASE}/data/13f/{filing_id}")
+        page = await client.revalidate(url, etag, last_modified)   # page.not_modified on 304
+        client.report()
+
+Usage (thread-pooled scripts):
+    from thirteenf_client import SyncThirteenFClient
+
+    CLIENT = SyncThirteenFClient(user_agent=UA)
+    html = CLIENT.fetch_text(url)           # blocking, safe from any thread
+    CLIENT.close()
+
+fetch_text / fetch_json / fetch_holdings_rows return None when the page is
+missing or every retry failed; the reason is in client.stats.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from profiling import stage
+from thirteenf_json import HoldingsRowDecoder, TruncatedPayload
+
+BASE = "https://13f.info"
+DEFAULT_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) 13f-scraper/4.0"
+
+# Tuning for every 13f.info entry point
+DEFAULT_CONCURRENCY = 100       # requests in flight overall
+DEFAULT_PER_HOST = 50           # requests in flight per host
+DEFAULT_TIMEOUT = 30            # seconds per attempt
+DEFAULT_RETRIES = 4             # attempts after the first
+BACKOFF_BASE = 0.5              # seconds, doubled per attempt
+BACKOFF_MAX = 30.0
+CACHE_SIZE = 512                # cached responses (only for cache=True requests)
+KEEPALIVE_TIMEOUT = 60
+STREAM_CHUNK = 64 * 1024        # bytes per read when decoding holdings payloads
+FAILED_URL_SAMPLE = 20          # failed URLs kept for the report
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Result of a GET: body is None when not_modified (304); etag/last_modified are the
+# response validators, or the ones sent when a 304 does not repeat them
+Page = namedtuple("Page", "body etag last_modified not_modified")
+
+
+class ClientStats:
+    """Request/outcome counters for one client."""
+
+    def __init__(self):
+        self.requests = 0           # HTTP attempts sent
+        self.ok = 0
+        self.not_modified = 0       # 304 responses to conditional requests
+        self.cache_hits = 0
+        self.retries = 0
+        self.throttled = 0          # 429 responses
+        self.not_found = 0
+        self.failed = 0             # gave up (after retries, or a non-retryable status)
+        self.errors = Counter()     # failure kind -> count
+        self.failed_urls = []
+
+    def record_failure(self, url, kind):
+        self.failed += 1
+        self.errors[kind] += 1
+        if len(self.failed_urls) < FAILED_URL_SAMPLE:
+            self.failed_urls.append((url, kind))
+
+    def summary(self):
+        parts = [f"{self.requests:,} requests", f"{self.ok:,} ok"]
+        if self.not_modified:
+            parts.append(f"{self.not_modified:,} not modified")
+        if self.cache_hits:
+            parts.append(f"{self.cache_hits:,} cached")
+        if self.retries:
+            parts.append(f"{self.retries:,} retried ({self.throttled:,} x 429)")
+        if self.not_found:
+            parts.append(f"{self.not_found:,} not found")
+        failed = f"{self.failed:,} failed"
+        if self.errors:
+            failed += " (" + ", ".join(f"{k}: {v:,}" for k, v in self.errors.most_common()) + ")"
+        parts.append(failed)
+        return " | ".join(parts)
+
+
+def _error_kind(exc):
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exc, aiohttp.ClientConnectionError):
+        return "connection"
+    if isinstance(exc, TruncatedPayload):
+        return "truncated"      # body cut short: retried like a dropped connection
+    if isinstance(exc, (aiohttp.ContentTypeError, json.JSONDecodeError, UnicodeDecodeError)):
+        return "decode"
+    return type(exc).__name__
+
+
+def _retry_after(resp):
+    value = resp.headers.get("Retry-After")
+    try:
+        return min(float(value), BACKOFF_MAX) if value else None
+    except ValueError:
+        return None
+
+
+def _backoff(attempt):
+    return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+
+async def _read_body(resp, body_kind):
+    if body_kind == "json":
+        return await resp.json(content_type=None)
+    if body_kind == "rows":
+        decoder = HoldingsRowDecoder()
+        rows = []
+        async for chunk in resp.content.iter_chunked(STREAM_CHUNK):
+            with stage("parse"):
+                rows.extend(decoder.feed(chunk))
+        with stage("parse"):
+            rows.extend(decoder.finish())
+        return rows
+    return await resp.text()
+
+
+class ThirteenFClient:
+    """Async 13f.info client; use as `async with ThirteenFClient() as client`."""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, cache_size=CACHE_SIZE,
+                 user_agent=DEFAULT_UA, headers=None):
+        self.concurrency = concurrency
+        self.per_host = min(per_host, concurrency)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.cache_size = cache_size
+        self.headers = {"User-Agent": user_agent, **(headers or {})}
+        self.stats = ClientStats()
+        self.session = None
+        self._slots = None
+        self._host_slots = {}
+        self._paused_until = {}     # host -> monotonic time before which requests wait
+        self._cache = OrderedDict()
+        self._inflight = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.per_host,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _host_slot(self, host):
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = asyncio.Semaphore(self.per_host)
+        return slot
+
+    async def _wait_if_paused(self, host):
+        while True:
+            delay = self._paused_until.get(host, 0) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _request(self, url, body_kind, etag=None, last_modified=None):
+        """GET with retries; returns a Page or None (failure recorded in stats)."""
+        host = urlsplit(url).netloc
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        kind = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats.retries += 1
+            await self._wait_if_paused(host)
+            delay = None
+            async with self._slots, self._host_slot(host):
+                self.stats.requests += 1
+                try:
+                    async with self.session.get(url, headers=headers or None) as resp:
+                        if resp.status == 200:
+                            body = await _read_body(resp, body_kind)
+                            self.stats.ok += 1
+                            return Page(body, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), False)
+                        if resp.status == 304 and headers:
+                            self.stats.not_modified += 1
+                            return Page(None, resp.headers.get("ETag", etag),
+                                        resp.headers.get("Last-Modified", last_modified), True)
+                        if resp.status == 404:
+                            self.stats.not_found += 1
+                            return None
+                        kind = f"http {resp.status}"
+                        if resp.status not in RETRY_STATUSES:
+                            break
+                        if resp.status == 429:
+                            self.stats.throttled += 1
+                            delay = _retry_after(resp) or _backoff(attempt)
+                            # Throttling is per host: hold back every request to it, not just this one
+                            self._paused_until[host] = max(self._paused_until.get(host, 0),
+                                                           time.monotonic() + delay)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    kind = _error_kind(e)
+                    if kind == "decode":
+                        break
+            if attempt < self.retries:
+                await asyncio.sleep(delay or _backoff(attempt))
+        self.stats.record_failure(url, kind)
+        return None
+
+    async def _fetch(self, url, body_kind, cache):
+        if not cache:
+            page = await self._request(url, body_kind)
+            return page.body if page else None
+        key = (url, body_kind)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.stats.cache_hits += 1
+            return self._cache[key]
+        # Concurrent callers for the same URL share one request
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._request(url, body_kind))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats.cache_hits += 1
+        page = await asyncio.shield(task)
+        body = page.body if page else None
+        if body is not None:
+            self._cache[key] = body
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return body
+
+    async def fetch_text(self, url, cache=False):
+        """Page body as text, or None. cache=True for pages fetched more than once."""
+        return await self._fetch(url, "text", cache)
+
+    async def fetch_json(self, url, cache=False):
+        """Decoded JSON, or None."""
+        return await self._fetch(url, "json", cache)
+
+    async def fetch_holdings_rows(self, url):
+        """Holdings rows of a /data/13f/{filing_id} payload, decoded as they stream in; or None.
+
+        The known {"data": [[...], ...]} layout is decoded row by row; anything
+        else falls back to the generic table search in thirteenf_json.
+        """
+        return await self._fetch(url, "rows", False)
+
+    async def revalidate(self, url, etag=None, last_modified=None):
+        """Conditional GET of a text page with the validators saved from a previous run.
+
+        Returns a Page (not_modified=True and body None on 304), or None on failure.
+        Never served from the in-memory cache.
+        """
+        return await self._request(url, "text", etag, last_modified)
+
+    def report(self, label="13f.info"):
+        print(f"🌐 {label}: {self.stats.summary()}")
+        for url, kind in self.stats.failed_urls[:5]:
+            print(f"   ❌ {kind}: {url}")
+
+
+class SyncThirteenFClient:
+    """Blocking facade over ThirteenFClient for thread-pooled scripts.
+
+    The async client runs on a private event loop thread, so every worker
+    thread shares its connection pool, caps, backoff and stats.
+    """
+
+    def __init__(self, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="13finfo-client", daemon=True)
+        self._thread.start()
+        self.client = ThirteenFClient(**kwargs)
+        self._call(self.client.__aenter__())
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    @property
+    def stats(self):
+        return self.client.stats
+
+    def fetch_text(self, url, cache=False):
+        return self._call(self.client.fetch_text(url, cache))
+
+    def fetch_json(self, url, cache=False):
+        return self._call(self.client.fetch_json(url, cache))
+
+    def fetch_holdings_rows(self, url):
+        return self._call(self.client.fetch_holdings_rows(url))
+
+    def revalidate(self, url, etag=None, last_modified=None):
+        return self._call(self.client.revalidate(url, etag, last_modified))
+
+    def report(self, label="13f.info"):
+        self.client.report(label)
+
+    def close(self):
+        if self._loop.is_running():
+            self._call(self.client.close())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
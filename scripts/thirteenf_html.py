@@ -0,0 +1,103 @@
+"""
+Fast extraction of links and tables from 13f.info HTML pages.
+
+The manager index pages (/managers/<letter>) and manager pages
+(/manager/<cik>-<slug>) are parsed with lxml.html directly: one C-level
+parse, XPath selection, no BeautifulSoup tree. On recorded pages this is
+several times faster than BeautifulSoup's html.parser backend (see
+benchmark_13finfo_html.py), which keeps phase 1 of the backfills network-bound.
+
+Text is normalized like BeautifulSoup's get_text(strip=True): every text node
+stripped, then concatenated. Results are in document order.
+
+Usage:
+    from thirteenf_html import manager_links, quarter_filings, filing_for_quarter, first_table_rows
+
+    for href, name in manager_links(html): ...
+    for quarter, filing_id, href in quarter_filings(html): ...
+    filing_id, href = filing_for_quarter(html, "Q3 2025")
+    rows = first_table_rows(html)          # [[cell text, ...], ...]
+"""
+import re
+
+from lxml import etree
+from lxml import html as lxml_html
+
+RE_QUARTER = re.compile(r"^(Q[1-4]\s+\d{4})$")
+RE_FILING_ID = re.compile(r"/13f/(\d+)-")
+ROW_TAGS = ("tr", "div", "li")
+
+_LINKS = etree.XPath("//a[starts-with(@href, $prefix)]")
+
+
+def _root(html):
+    """Parsed document, or None for empty/unparseable input."""
+    if not html:
+        return None
+    try:
+        return lxml_html.fromstring(html)
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def _text(el, sep=""):
+    return sep.join(s.strip() for s in el.itertext() if s.strip())
+
+
+def links(html, prefix):
+    """(href, text) for every <a> whose href starts with prefix."""
+    root = _root(html)
+    if root is None:
+        return []
+    return [(a.get("href"), _text(a)) for a in _LINKS(root, prefix=prefix)]
+
+
+def manager_links(html):
+    """(href, manager name) for every /manager/ link on an index page."""
+    return links(html, "/manager/")
+
+
+def quarter_filings(html):
+    """(quarter, filing_id, href) for every /13f/ link whose text is a quarter ("Q3 2025")."""
+    filings = []
+    for href, text in links(html, "/13f/"):
+        quarter_match = RE_QUARTER.match(text)
+        if not quarter_match:
+            continue
+        id_match = RE_FILING_ID.search(href)
+        if id_match:
+            filings.append((quarter_match.group(1), id_match.group(1), href))
+    return filings
+
+
+def filing_for_quarter(html, quarter):
+    """(filing_id, href) of the filing listed in the same row as `quarter`, or (None, None).
+
+    Rows are the innermost <tr>/<div>/<li> around each /13f/ link, so a page
+    wrapper that happens to contain the quarter text never matches the page's
+    first filing link.
+    """
+    root = _root(html)
+    if root is None:
+        return None, None
+    quarter_pat = re.compile(rf"\b{re.escape(quarter)}\b", re.I)
+    for a in _LINKS(root, prefix="/13f/"):
+        row = next(a.iterancestors(*ROW_TAGS), None)
+        if row is None or not quarter_pat.search(_text(row, " ")):
+            continue
+        href = a.get("href")
+        id_match = RE_FILING_ID.search(href)
+        if id_match:
+            return id_match.group(1), href
+    return None, None
+
+
+def first_table_rows(html):
+    """Cell texts of each row of the first <table> (td and th), or [] if there is none."""
+    root = _root(html)
+    if root is None:
+        return []
+    table = next(root.iter("table"), None)
+    if table is None:
+        return []
+    return [[_text(cell) for cell in tr if cell.tag in ("td", "th")] for tr in table.iter("tr")]
@@ -0,0 +1,264 @@
+"""
+Incremental decoding of 13f.info holdings payloads (/data/13f/{filing_id}).
+
+The endpoint returns {"data": [[sym, issuer, class, cusip, value, pct,
+shares, principal, option], ...], ...}. Decoding the whole body with
+json.loads keeps the text and the full tree in memory at once, and callers
+then walked the tree looking for the biggest list. HoldingsRowDecoder
+instead reads the byte stream, recognizes that layout and hands back each
+row as soon as its closing bracket arrives, so only the rows (and one
+network chunk) are ever held.
+
+Anything else (no top-level "data" key, "data" not a list of lists) falls
+back to json.loads of the whole body plus find_holdings_table, the generic
+tree walk; its rows may be dicts, so callers normalize rows rather than
+index them (add_holdings_from_13finfo_filing.normalize_holding_row).
+
+A body that ends early (dropped connection) raises TruncatedPayload, which
+the client retries; other invalid JSON raises json.JSONDecodeError.
+
+Usage:
+    decoder = HoldingsRowDecoder()
+    for chunk in byte_chunks:
+        for row in decoder.feed(chunk): ...
+    for row in decoder.finish(): ...
+
+    rows = list(decode_holdings_rows(resp.iter_content(65536)))   # same, as a generator
+"""
+import codecs
+import json
+import re
+
+WHITESPACE = " \t\n\r"
+
+_DECODER = json.JSONDecoder()
+_MORE = object()    # the value at the cursor continues in the next chunk
+
+# What a JSON literal or number cut short can look like: 'nul', 'tr', '12.', '-', '1e+'
+_LITERALS = ("null", "true", "false", "NaN", "Infinity", "-Infinity")
+_NUMBER_PREFIX = re.compile(r"-?(?:0|[1-9][0-9]*)?(?:\.[0-9]*)?(?:[eE][+-]?[0-9]*)?")
+
+
+class TruncatedPayload(ValueError):
+    """The payload ended before the JSON did."""
+
+
+def _ran_out(err):
+    """True when a JSONDecodeError was caused by the input ending, not by bad JSON.
+
+    That is an unterminated string, an error at the end of the input, or one
+    inside a trailing literal or number that the end cut short ("..., 100, n",
+    "nul", "123." fail with "Expecting value" / "Expecting ',' delimiter"
+    before the end).
+    """
+    doc = err.doc.rstrip()
+    if err.msg.startswith("Unterminated string") or err.pos >= len(doc):
+        return True
+    start = len(doc)
+    while start and (doc[start - 1].isalnum() or doc[start - 1] in "+-."):
+        start -= 1
+    tail = doc[start:]
+    if not tail or err.pos < start:
+        return False
+    return any(lit.startswith(tail) for lit in _LITERALS) or _NUMBER_PREFIX.fullmatch(tail) is not None
+
+
+def find_holdings_table(payload):
+    """
+    Generic fallback: the largest holdings-like list anywhere under payload["data"].
+
+    A list of dicts qualifies when most rows have a 'cusip' key; any list of
+    lists qualifies (the 13f.info row layout).
+    """
+    root = payload.get("data", payload) if isinstance(payload, dict) else payload
+
+    best = []
+    stack = [root]
+
+    def is_holding_dict(d):
+        if not isinstance(d, dict):
+            return False
+        keys = {k.lower() for k in d.keys()}
+        return "cusip" in keys
+
+    while stack:
+        x = stack.pop()
+
+        if isinstance(x, dict):
+            for vv in x.values():
+                stack.append(vv)
+
+        elif isinstance(x, list):
+            if not x:
+                continue
+
+            is_list_of_dicts = all(isinstance(i, dict) for i in x)
+            is_list_of_lists = all(isinstance(i, list) for i in x)
+
+            if is_list_of_dicts:
+                # must contain cusip in most rows
+                holding_like = sum(1 for i in x if is_holding_dict(i))
+                if holding_like >= max(5, int(0.5 * len(x))):
+                    if len(x) > len(best):
+                        best = x
+
+            elif is_list_of_lists:
+                if len(x) > len(best):
+                    best = x
+
+            for i in x:
+                if isinstance(i, (dict, list)):
+                    stack.append(i)
+
+    return best
+
+
+class HoldingsRowDecoder:
+    """Feed payload bytes; get back the rows of the top-level "data" list as they complete."""
+
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+        self._raw = []          # text kept until the layout is confirmed, for the fallback
+        self.streamed = False   # True once the first row confirmed the data list-of-lists layout
+        self.fallback = False
+        self.skipped = 0        # non-list elements in a streamed data list
+
+    def feed(self, chunk):
+        """Rows completed by this chunk of bytes."""
+        return self._consume(self._text.decode(chunk), eof=False)
+
+    def finish(self):
+        """Remaining rows at end of input.
+
+        Raises TruncatedPayload when the input stopped mid-payload, ValueError
+        (json.JSONDecodeError, UnicodeDecodeError) when it is not valid JSON.
+        """
+        try:
+            text = self._text.decode(b"", final=True)
+        except UnicodeDecodeError as e:
+            if e.reason == "unexpected end of data":   # cut inside a multi-byte character
+                raise TruncatedPayload("truncated 13f.info holdings payload") from e
+            raise
+        try:
+            rows = self._consume(text, eof=True)
+            if self.fallback:
+                payload = json.loads("".join(self._raw))
+                self._raw = []
+                return list(find_holdings_table(payload))
+        except json.JSONDecodeError as e:
+            if _ran_out(e):
+                raise TruncatedPayload(f"truncated 13f.info holdings payload: {e.msg}") from e
+            raise
+        if self._state != "done":
+            raise TruncatedPayload("truncated 13f.info holdings payload")
+        return rows
+
+    def _fall_back(self):
+        self.fallback = True
+        self._buf = ""
+        self._pos = 0
+
+    def _skip_ws(self):
+        buf, pos = self._buf, self._pos
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return pos < len(buf)
+
+    def _value(self, eof):
+        try:
+            value, end = _DECODER.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            return _MORE
+        if end == len(self._buf) and not eof:
+            return _MORE    # a number at the end of the buffer may have more digits coming
+        self._pos = end
+        return value
+
+    def _consume(self, text, eof):
+        if self.fallback or not self.streamed:
+            self._raw.append(text)
+        if self.fallback:
+            return []
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+
+        rows = []
+        while self._skip_ws():
+            c = self._buf[self._pos]
+            state = self._state
+            if state == "start":
+                if c != "{":
+                    self._fall_back()
+                    break
+                self._pos += 1
+                self._state = "key"
+            elif state == "key":
+                if c == ",":
+                    self._pos += 1
+                    continue
+                if c != '"':
+                    self._fall_back()   # no "data" key (or not JSON)
+                    break
+                key = self._value(eof)
+                if key is _MORE:
+                    break
+                self._key = key
+                self._state = "colon"
+            elif state == "colon":
+                if c != ":":
+                    self._fall_back()
+                    break
+                self._pos += 1
+                self._state = "rows_open" if self._key == "data" else "value"
+            elif state == "value":
+                if self._value(eof) is _MORE:
+                    break
+                self._state = "key"
+            elif state == "rows_open":
+                if c != "[":
+                    self._fall_back()
+                    break
+                self._pos += 1
+                self._state = "rows"
+            elif state == "rows":
+                if c == ",":
+                    self._pos += 1
+                    continue
+                if c == "]":
+                    self._pos += 1
+                    self._state = "done"
+                    self.streamed = True
+                    self._raw = []
+                    continue
+                row = self._value(eof)
+                if row is _MORE:
+                    break
+                if not self.streamed:
+                    if not isinstance(row, list):
+                        self._fall_back()
+                        break
+                    self.streamed = True
+                    self._raw = []
+                if isinstance(row, list):
+                    rows.append(row)
+                else:
+                    self.skipped += 1
+            else:
+                # Past the data list: nothing else in the payload is needed
+                self._pos = len(self._buf)
+        return rows
+
+
+def decode_holdings_rows(chunks):
+    """Yield holdings rows from an iterable of payload byte chunks."""
+    decoder = HoldingsRowDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.finish()
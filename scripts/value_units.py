@@ -0,0 +1,145 @@
+"""
+Batch value-unit detection for SEC 13F information tables.
+
+13F <value> fields were reported in thousands of dollars until the SEC rule
+change that took effect for filings made on/after 2023-01-03 (periods ending
+2022-12-31 onward), which report whole dollars. Plenty of filers get it wrong
+in both directions, so the unit is scored per filing from three signals:
+
+  header  sum(<value>) / tableValueTotal lands on 1000x or 1/1000x
+          (holdings and cover page in different units), or on 1x with a
+          header too large to be thousands
+  price   median <value>/<sshPrnamt> over SH rows; a typical $10-$500 stock
+          is 10-500 in dollars but 0.01-0.5 in thousands
+  date    the reporting-date rule above (a prior, weakest weight)
+
+Every filing in a batch is scored at once with numpy, so the cost is a handful
+of array passes per commit batch instead of Python loops per filing.
+
+Usage:
+    from value_units import detect_value_units
+
+    decisions = detect_value_units([(rows, header_total, period_end), ...])
+    for d in decisions:
+        d.multiplier, d.confidence, d.signals
+
+`rows` is a sequence of (value, shares, share_type) triples; value/shares may
+be None. `confidence` is in [0, 1]; filings below LOW_CONFIDENCE are the ones
+repair modes should re-check.
+"""
+from datetime import date, datetime
+from typing import NamedTuple
+
+import numpy as np
+
+DOLLARS_FROM_PERIOD = date(2022, 12, 31)
+LOW_CONFIDENCE = 0.5
+
+# Signal weights (header agreement is near-proof, the date rule only a prior)
+W_HEADER = 3.0
+W_PRICE = 2.0
+W_DATE = 1.0
+
+HEADER_TOL = 0.1                        # log10 tolerance around 1x / 1000x (~26%)
+PRICE_SCALE = 1.0                       # log10 distance from $1 that counts as certain
+MIN_PRICED_ROWS = 3                     # below this the price signal gets half weight
+IMPLAUSIBLE_HEADER_THOUSANDS = 25_000_000_000  # $25T if read as thousands
+
+
+class UnitDecision(NamedTuple):
+    multiplier: int        # 1 (dollars) or 1000 (thousands)
+    confidence: float      # 0..1, agreement-weighted
+    signals: str           # e.g. "header=+1.00 price=+0.84 date=+1"
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    s = str(value).strip()
+    if "/" in s:
+        return datetime.strptime(s, "%m/%d/%Y").date()
+    return datetime.strptime(s[:10], "%Y-%m-%d").date()
+
+
+def _group_median(groups, values, n):
+    """Lower median of `values` per group id in [0, n); NaN where a group is empty."""
+    out = np.full(n, np.nan)
+    if values.size == 0:
+        return out, np.zeros(n, dtype=np.int64)
+    order = np.lexsort((values, groups))
+    sorted_vals = values[order]
+    counts = np.bincount(groups, minlength=n)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    has = counts > 0
+    out[has] = sorted_vals[starts[has] + (counts[has] - 1) // 2]
+    return out, counts
+
+
+def detect_value_units(filings):
+    """Score a batch of filings. `filings` is a list of (rows, header_total, period_end).
+
+    Returns one UnitDecision per filing, in order.
+    """
+    n = len(filings)
+    if n == 0:
+        return []
+
+    lengths = np.fromiter((len(f[0]) for f in filings), dtype=np.int64, count=n)
+    gid = np.repeat(np.arange(n), lengths)
+    total_rows = int(lengths.sum())
+
+    values = np.fromiter((r[0] if r[0] is not None else np.nan for f in filings for r in f[0]),
+                         dtype=np.float64, count=total_rows)
+    shares = np.fromiter((r[1] if r[1] is not None else np.nan for f in filings for r in f[0]),
+                         dtype=np.float64, count=total_rows)
+    is_prn = np.fromiter(((r[2] or "").upper() == "PRN" for f in filings for r in f[0]),
+                         dtype=bool, count=total_rows)
+    header = np.array([f[1] if f[1] else np.nan for f in filings], dtype=np.float64)
+    dollars_era = np.array([_as_date(f[2]) >= DOLLARS_FROM_PERIOD for f in filings])
+
+    # --- header signal -------------------------------------------------------
+    value_sum = np.bincount(gid, weights=np.nan_to_num(values), minlength=n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_ratio = np.log10(value_sum / header)
+    s_header = np.zeros(n)
+    s_header[np.abs(log_ratio - 3) < HEADER_TOL] = 1.0     # holdings dollars, header thousands
+    s_header[np.abs(log_ratio + 3) < HEADER_TOL] = -1.0    # holdings thousands, header dollars
+    same_units = np.abs(log_ratio) < HEADER_TOL
+    s_header[same_units & (header > IMPLAUSIBLE_HEADER_THOUSANDS)] = 1.0
+    w_header = np.where(s_header != 0, W_HEADER, 0.0)
+
+    # --- implied price signal ------------------------------------------------
+    priced = (values > 0) & (shares > 0) & ~is_prn
+    med_log_price, priced_rows = _group_median(
+        gid[priced], np.log10(values[priced] / shares[priced]), n)
+    s_price = np.clip(np.nan_to_num(med_log_price) / PRICE_SCALE, -1.0, 1.0)
+    w_price = np.where(priced_rows >= MIN_PRICED_ROWS, W_PRICE,
+                       np.where(priced_rows > 0, W_PRICE / 2, 0.0))
+
+    # --- reporting-date rule -------------------------------------------------
+    s_date = np.where(dollars_era, 1.0, -1.0)
+    w_date = np.full(n, W_DATE)
+
+    score = w_header * s_header + w_price * s_price + w_date * s_date
+    weight = w_header + w_price + w_date
+    confidence = np.abs(score) / weight
+    multiplier = np.where(score > 0, 1, 1000)
+
+    # Nothing to look at: keep the historical thousands default, flag for review
+    empty = value_sum == 0
+    multiplier[empty] = 1000
+    confidence[empty] = 0.0
+
+    decisions = []
+    for i in range(n):
+        parts = []
+        if w_header[i]:
+            parts.append(f"header={s_header[i]:+.2f}")
+        if w_price[i]:
+            parts.append(f"price={s_price[i]:+.2f}")
+        parts.append(f"date={int(s_date[i]):+d}")
+        decisions.append(UnitDecision(int(multiplier[i]), round(float(confidence[i]), 3), " ".join(parts)))
+    return decisions
+
@@ -7,6 +7,7 @@ This script:
 3. Re-downloads only what's needed
 4. Fixes the value multiplication bug (some filings are in dollars, not thousands)
 """
+import argparse
 import requests
 import psycopg2
 from psycopg2.extras import execute_values
@@ -18,6 +19,15 @@ from dotenv import load_dotenv
 from lxml import etree
 import time
 
+from profiling import add_profile_arguments, start_profiling_from_args, stage
+from amendments import REPLACE, clear_for_base
+from cover_page import is_notice, parse_cover_page
+from fingerprints import content_hash, holdings_hash, stored_holdings_hash
+from holding_stats import ensure_period_stats, refresh_period_stats
+from sec_ledger import (ensure_ledger, loaded_fingerprint, low_confidence_periods, notice_periods,
+                        record_cover_pages, record_loaded, short_periods)
+from value_units import LOW_CONFIDENCE, detect_value_units
+
 SEC_HEADERS = {
     "User-Agent": "Naveen Mokkapati navmok@gmail.com",
     "Accept": "*/*",
@@ -29,11 +39,13 @@ SEC_HEADERS = {
 # Set to True to only show what needs to be done (no actual downloads)
 DRY_RUN = False
 
-# Modes: "missing_only", "missing_and_bad", "partial", "bad_values", "all"
+# Modes: "missing_only", "missing_and_bad", "partial", "bad_values", "low_confidence", "all"
 # - missing_only: Only download periods with no holdings at all
 # - missing_and_bad: Missing + periods with 1000x value bug (RECOMMENDED)
 # - partial: Download missing + periods with incomplete holdings (value mismatch)
 # - bad_values: All of the above + suspicious values
+# - low_confidence: Periods whose value units (thousands vs dollars) were decided
+#   with confidence below value_units.LOW_CONFIDENCE, per sec_filing_ledger
 # - all: Re-download everything (full refresh)
 REPAIR_MODE = "missing_and_bad"  # RECOMMENDED: fixes 4311 missing + 84 bad values
 
@@ -54,6 +66,7 @@ SESSION.headers.update(SEC_HEADERS)
 QUARTERLY_INDEXES = {}
 
 
+@stage("fetch")
 def request_with_retry(url, timeout=None, stream=False):
     """Make HTTP request with retry logic for stubborn failures"""
     if timeout is None:
@@ -94,6 +107,7 @@ def request_with_retry(url, timeout=None, stream=False):
     return FailedResponse()
 
 
+@stage("index")
 def download_quarterly_index(year, quarter):
     """Download and parse master.idx for a quarter - with retry logic"""
     key = (year, quarter)
@@ -180,6 +194,7 @@ def period_to_quarter(period_end):
     return dt.year, quarter, dt
 
 
+@stage("index")
 def find_13f_filing(cik, period_end, debug=False):
     cik_padded = str(cik).zfill(10)
     year, quarter, target_date = period_to_quarter(period_end)
@@ -278,52 +293,49 @@ def find_info_table_url(xml_urls):
     return None
 
 
-def fetch_value_total(xml_url):
-    """Fetch total value from primary_doc.xml - returns value in THOUSANDS (as reported)"""
+@stage("parse")
+def fetch_cover_page(xml_url):
+    """Fetch primary_doc.xml and extract its cover/summary page fields in one pass"""
     try:
         r = request_with_retry(xml_url)
         if r.status_code == 404 or r.status_code == 0:
             return None
         r.raise_for_status()
-        
-        root = etree.fromstring(r.content)
-        
-        for elem in root.iter():
-            if '}' in elem.tag:
-                elem.tag = elem.tag.split('}', 1)[1]
-        
-        for elem in root.iter():
-            if elem.tag in ['tableValueTotal', 'valueTotal', 'securitiesOwnedAggregateValue']:
-                if elem.text and elem.text.strip():
-                    try:
-                        # This is in THOUSANDS as per SEC spec
-                        return int(elem.text.strip())
-                    except ValueError:
-                        pass
-        return None
+        return parse_cover_page(r.content)
     except:
         return None
 
 
-def fetch_holdings(xml_url, max_size_mb=25):
-    """
-    Fetch holdings from info_table.xml
-    
-    IMPORTANT: SEC 13F values are reported in THOUSANDS of dollars.
-    So we multiply by 1000 to get actual USD.
-    """
+@stage("fetch")
+def fetch_info_table(xml_url, max_size_mb=25):
+    """Download info_table.xml; returns the raw bytes, or None."""
     try:
         r = request_with_retry(xml_url, timeout=REQUEST_TIMEOUT * 2, stream=True)
         if r.status_code == 404 or r.status_code == 0:
-            return []
+            return None
         r.raise_for_status()
         
         content_length = r.headers.get('content-length')
         if content_length and int(content_length) > max_size_mb * 1_000_000:
             print(f"  ⚠️  Skipping large file: {int(content_length) / 1_000_000:.1f}MB", flush=True)
-            return []
+            return None
         
-        xml_content = r.content
+        return r.content
+    except Exception as e:
+        print(f"  ⚠️  Error: {e}", flush=True)
+        return None
+
+
+@stage("parse")
+def parse_holdings(xml_content):
+    """
+    Parse holdings from info_table.xml bytes
+    
+    Values are returned RAW ("value_raw"): filers report thousands before the
+    2023 rule change and dollars after, and many get it wrong, so the units are
+    decided per filing by value_units.detect_value_units.
+    """
+    try:
         holdings = []
         idx = 0
         
@@ -379,19 +391,15 @@ def fetch_holdings(xml_url, max_size_mb=25):
                 voting_shared = get_child_int(voting_elem, 'shared')
                 voting_none = get_child_int(voting_elem, 'none')
             
-            # Get value in thousands (as reported in SEC filing)
-            value_thousands = get_child_int(elem, "value")
-            
-            # Convert to actual USD (multiply by 1000)
-            # SEC 13F always reports values in thousands
-            value_usd = value_thousands * 1000 if value_thousands else None
+            # Raw value as reported (thousands or dollars, decided later)
+            value_raw = get_child_int(elem, "value")
             
             holding = {
                 "line_no": idx,
                 "issuer": get_child_text(elem, "nameOfIssuer"),
                 "title_of_class": get_child_text(elem, "titleOfClass"),
                 "cusip": get_child_text(elem, "cusip"),
-                "value_usd": value_usd,
+                "value_raw": value_raw,
                 "shares": get_child_float(elem, "sshPrnamt"),
                 "share_type": get_child_text(elem, "sshPrnamtType"),
                 "put_call": get_child_text(elem, "putCall"),
@@ -430,13 +438,28 @@ def process_manager_period(cik, period_end, cur, conn):
         primary_doc_url = find_primary_doc_url(xml_urls)
         info_table_url = find_info_table_url(xml_urls)
         
-        total_value = None
+        cover = None
         if primary_doc_url:
-            total_value = fetch_value_total(primary_doc_url)
+            cover = fetch_cover_page(primary_doc_url)
+        total_value = cover["table_value_total"] if cover else None
         
-        holdings = []
-        if info_table_url:
-            holdings = fetch_holdings(info_table_url)
+        # 13F-NT notices have no information table: record and skip the download
+        if is_notice(cover):
+            record_cover_pages(cur, [(acc_no, cik, period_end, "notice", cover)])
+            return {"status": "notice"}
+        record_cover_pages(cur, [(acc_no, cik, period_end, "cover", cover)])
+        
+        xml_content = fetch_info_table(info_table_url) if info_table_url else None
+        raw_hash = content_hash(xml_content)
+        
+        # Same document as the loaded one and the stored rows untouched: nothing to rewrite
+        prior = loaded_fingerprint(cur, acc_no)
+        stored_hash = stored_holdings_hash(cur, cik, period_end, acc_no) if prior else None
+        if prior and raw_hash and prior[0] == raw_hash and prior[1] == stored_hash:
+            time.sleep(REQUEST_DELAY_SEC)
+            return {"status": "unchanged"}
+        
+        holdings = parse_holdings(xml_content) if xml_content else []
         
         if total_value:
             # total_value is in thousands, convert to millions for total_value_m
@@ -444,25 +467,37 @@ def process_manager_period(cik, period_end, cur, conn):
             cur.execute("""
                 UPDATE manager_quarter
                 SET total_value_m = %s
-                WHERE cik = %s AND period_end = %s
-            """, (total_value_m, cik, period_end))
+                WHERE cik = %s AND period_end = %s AND total_value_m IS DISTINCT FROM %s
+            """, (total_value_m, cik, period_end, total_value_m))
         
+        units = None
         if holdings:
-            # Delete old holdings first
-            cur.execute("""
-                DELETE FROM manager_quarter_holding
-                WHERE cik = %s AND period_end = %s
-            """, (cik, period_end))
+            units = detect_value_units([
+                ([(h["value_raw"], h["shares"], h["share_type"]) for h in holdings], total_value, period_end)
+            ])[0]
             
             values = []
             for h in holdings:
                 values.append((
                     cik, period_end, acc_no, h["line_no"],
                     h["issuer"], h["title_of_class"], h["cusip"],
-                    h["value_usd"], h["shares"], h["share_type"],
+                    h["value_raw"] * units.multiplier if h["value_raw"] is not None else None,
+                    h["shares"], h["share_type"],
                     h["put_call"], h["investment_discretion"], h["other_manager"],
                     h["voting_sole"], h["voting_shared"], h["voting_none"]
                 ))
+            new_hash = holdings_hash(v[3:] for v in values)
+            
+            # Parses to exactly the stored rows (e.g. whitespace-only change): only refresh the ledger
+            if stored_hash is None:
+                stored_hash = stored_holdings_hash(cur, cik, period_end, acc_no)
+            if new_hash == stored_hash:
+                record_loaded(cur, [(acc_no, cik, period_end, len(holdings), units, REPLACE, raw_hash, new_hash)])
+                time.sleep(REQUEST_DELAY_SEC)
+                return {"status": "unchanged", "holdings": len(holdings), "units": units}
+            
+            # Delete old holdings first (appended NEW HOLDINGS amendments stay)
+            clear_for_base(cur, cik, period_end, acc_no)
             
             execute_values(cur, """
                 INSERT INTO manager_quarter_holding (
@@ -472,15 +507,18 @@ def process_manager_period(cik, period_end, cur, conn):
                 ) VALUES %s
                 ON CONFLICT (cik, period_end, accession_no, line_no) DO NOTHING
             """, values, page_size=1000)
+            refresh_period_stats(cur, [(cik, period_end)], "verify_and_repair_sec_data")
             
             cur.execute("""
-                UPDATE manager_quarter
-                SET num_holdings = %s
-                WHERE cik = %s AND period_end = %s
-            """, (len(holdings), cik, period_end))
+                UPDATE manager_quarter SET num_holdings = COALESCE((
+                    SELECT num_holdings FROM holding_period_stats WHERE cik = %s AND period_end = %s
+                ), 0) WHERE cik = %s AND period_end = %s
+            """, (cik, period_end, cik, period_end))
+            
+            record_loaded(cur, [(acc_no, cik, period_end, len(holdings), units, REPLACE, raw_hash, new_hash)])
         
         time.sleep(REQUEST_DELAY_SEC)
-        return {"status": "success", "holdings": len(holdings)}
+        return {"status": "success", "holdings": len(holdings), "units": units}
         
     except Exception as e:
         try:
@@ -491,6 +529,10 @@ def process_manager_period(cik, period_end, cur, conn):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Verify and repair SEC 13F data")
+    add_profile_arguments(parser)
+    start_profiling_from_args(parser.parse_args())
+
     print("=" * 70)
     print("SEC 13F Data Verification and Repair")
     print("=" * 70)
@@ -531,6 +573,8 @@ def main():
             PRIMARY KEY (cik, period_end, accession_no, line_no)
         )
     """)
+    ensure_ledger(cur)
+    ensure_period_stats(cur)
     conn.commit()
     
     # =========================================================================
@@ -547,21 +591,23 @@ def main():
     
     # Get all periods that have holdings data
     cur.execute("""
-        SELECT DISTINCT cik, period_end FROM manager_quarter_holding
+        SELECT cik, period_end FROM holding_period_stats
     """)
     has_holdings = set(cur.fetchall())
     print(f"   Periods with holdings data: {len(has_holdings)}")
     
-    # Find missing periods
-    missing_periods = all_expected - has_holdings
+    # Find missing periods (13F-NT notices have nothing to download)
+    notices = set(notice_periods(cur))
+    missing_periods = all_expected - has_holdings - notices
     print(f"   Missing periods (no holdings): {len(missing_periods)}")
+    if notices:
+        print(f"   Periods covered only by a 13F-NT notice (skipped): {len(notices & all_expected)}")
     
     # Find periods with potentially bad values (sum > threshold)
     cur.execute("""
-        SELECT cik, period_end, SUM(value_usd) as total
-        FROM manager_quarter_holding
-        GROUP BY cik, period_end
-        HAVING SUM(value_usd) > %s
+        SELECT cik, period_end, value_usd_sum as total
+        FROM holding_period_stats
+        WHERE value_usd_sum > %s
     """, (BAD_VALUE_THRESHOLD,))
     bad_value_periods = set((row[0], row[1]) for row in cur.fetchall())
     print(f"   Periods with suspicious values (>$1Q): {len(bad_value_periods)}")
@@ -575,23 +621,28 @@ def main():
             mq.cik, 
             mq.period_end,
             mq.total_value_m,
-            COUNT(mqh.line_no) as holdings_count,
-            MAX(mqh.line_no) as max_line_no,
-            SUM(mqh.value_usd) / 1000000.0 as sum_value_m
+            s.num_holdings as holdings_count,
+            s.max_line_no,
+            s.value_usd_sum / 1000000.0 as sum_value_m
         FROM manager_quarter mq
-        INNER JOIN manager_quarter_holding mqh 
-            ON mq.cik = mqh.cik AND mq.period_end = mqh.period_end
+        INNER JOIN holding_period_stats s
+            ON mq.cik = s.cik AND mq.period_end = s.period_end
         WHERE mq.total_value_m IS NOT NULL AND mq.total_value_m > 0
-        GROUP BY mq.cik, mq.period_end, mq.total_value_m
-        HAVING 
+          AND (
             -- Value mismatch: our sum differs from expected by more than 20%
-            ABS(SUM(mqh.value_usd) / 1000000.0 - mq.total_value_m) > mq.total_value_m * 0.20
+            ABS(s.value_usd_sum / 1000000.0 - mq.total_value_m) > mq.total_value_m * 0.20
             OR
             -- Line number gaps: max line_no is much higher than count (indicates skipped rows)
-            MAX(mqh.line_no) > COUNT(mqh.line_no) * 1.1
+            s.max_line_no > s.num_holdings * 1.1
+          )
     """)
     partial_holdings_rows = cur.fetchall()
     partial_periods = set((row[0], row[1]) for row in partial_holdings_rows)
+    
+    # Stored row count below the cover page's tableEntryTotal (no download needed to tell)
+    short_rows = short_periods(cur)
+    partial_periods |= set((row[0], row[1]) for row in short_rows)
+    print(f"   Periods with fewer rows than tableEntryTotal: {len(short_rows)}")
     print(f"   Periods with PARTIAL holdings (incomplete download): {len(partial_periods)}")
     
     # Show some examples of partial downloads
@@ -619,6 +670,9 @@ def main():
     elif REPAIR_MODE == "bad_values":
         tasks = list(missing_periods | bad_value_periods | partial_periods)
         print(f"\n🔧 Mode: bad_values - will repair {len(tasks)} periods (missing + bad values + partial)")
+    elif REPAIR_MODE == "low_confidence":
+        tasks = low_confidence_periods(cur, LOW_CONFIDENCE)
+        print(f"\n🔧 Mode: low_confidence - will re-check {len(tasks)} periods with value-unit confidence < {LOW_CONFIDENCE}")
     else:  # all
         tasks = list(all_expected)
         print(f"\n🔧 Mode: all - will re-download all {len(tasks)} periods")
@@ -673,6 +727,7 @@ def main():
     # =========================================================================
     start_time = datetime.now()
     processed = 0
+    unchanged = 0
     failed = 0
     no_filing = 0
     
@@ -691,10 +746,22 @@ def main():
             
             if result["status"] == "success":
                 processed += 1
-                print(f"✓ {result.get('holdings', 0)} holdings", flush=True)
+                units = result.get("units")
+                unit_info = ""
+                if units:
+                    unit_info = " [x1 dollars]" if units.multiplier == 1 else ""
+                    if units.confidence < LOW_CONFIDENCE:
+                        unit_info += f" [low unit confidence {units.confidence:.2f}]"
+                print(f"✓ {result.get('holdings', 0)} holdings{unit_info}", flush=True)
+            elif result["status"] == "unchanged":
+                unchanged += 1
+                print(f"= unchanged", flush=True)
             elif result["status"] == "no_filing":
                 no_filing += 1
                 print(f"⚠️ No filing", flush=True)
+            elif result["status"] == "notice":
+                no_filing += 1
+                print(f"📭 13F-NT notice", flush=True)
             else:
                 failed += 1
                 print(f"❌ Error", flush=True)
@@ -710,14 +777,14 @@ def main():
         
         print(f"\n📊 Progress: {done}/{len(tasks)} ({100*done/len(tasks):.1f}%)")
         print(f"⏱️  Elapsed: {str(elapsed).split('.')[0]} | ETA: {eta}")
-        print(f"✓ {processed} success | ⚠️ {no_filing} no filing | ❌ {failed} failed")
+        print(f"✓ {processed} success | = {unchanged} unchanged | ⚠️ {no_filing} no filing | ❌ {failed} failed")
     
     # Final summary
     total_time = datetime.now() - start_time
     print("\n" + "=" * 70)
     print("✅ REPAIR COMPLETED")
     print(f"   Total time: {str(total_time).split('.')[0]}")
-    print(f"   Processed: {processed} | No filing: {no_filing} | Failed: {failed}")
+    print(f"   Processed: {processed} | Unchanged: {unchanged} | No filing: {no_filing} | Failed: {failed}")
     print("=" * 70)
     
     cur.close()